@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Benchmark the copy loops of the packagers
+
+Generate an image, then add it to a packager and restore it, for each packager
+using a copy loop (the directory packager is forced to use its buffered copy).
+Each packager is run in its own process, to report its peak RSS.
+
+A latency can be added to each read of the image, to emulate a slow storage
+where reading and writing (or compressing) in separate stages pays off.
+
+Not collected by pytest. Run it with:
+
+    python tests/benchmark_buffers.py [-s 1024] [-d /var/tmp] [--read-latency 2]
+"""
+
+import argparse
+import io
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import virt_backup.backups.packagers
+from virt_backup.backups.packagers import (
+    ReadBackupPackagers,
+    WriteBackupPackagers,
+    fastcopy,
+)
+
+PACKAGERS = {
+    "directory": ("directory", {}),
+    "tar": ("tar", {}),
+    "zstd": ("zstd", {"compression_lvl": 1}),
+    "zstd frames": ("zstd", {"compression_lvl": 1, "frame_size": 2**23}),
+}
+
+
+def build_image(path, size):
+    # Half random data, half compressible data, without holes.
+    block = os.urandom(2**19) + b"virt-backup" * (2**19 // 11) + bytes(2**19 % 11)
+    with open(path, "wb") as f:
+        for _ in range(size):
+            f.write(block)
+
+
+def build_packagers(packager, opts, path):
+    kwargs = {"name": "benchmark", "path": path, **opts}
+    if packager == "tar":
+        kwargs["archive_name"] = "benchmark"
+    elif packager == "zstd":
+        kwargs["name_prefix"] = "benchmark"
+    return (
+        getattr(WriteBackupPackagers, packager).value(**kwargs),
+        getattr(ReadBackupPackagers, packager).value(**kwargs),
+    )
+
+
+class SlowReader(io.FileIO):
+    latency = 0
+
+    def readinto(self, b):
+        time.sleep(self.latency)
+        return super().readinto(b)
+
+
+def slow_open_source(path, io_mode):
+    return SlowReader(path, "rb")
+
+
+def rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(label, image, tmpdir, read_latency=0):
+    """
+    Add and restore image with a packager, in the current process
+    """
+    if read_latency:
+        SlowReader.latency = read_latency / 1000
+        virt_backup.backups.packagers.open_source = slow_open_source
+
+    def unsupported(*args):
+        raise fastcopy._CopyMethodUnsupported()
+
+    fastcopy.FICLONE = 0
+    fastcopy._copy_file_range = fastcopy._sendfile = unsupported
+
+    write_packager, read_packager = build_packagers(
+        *PACKAGERS[label], os.path.join(tmpdir, "packager")
+    )
+    size = os.path.getsize(image) / 2**20
+    rss_start = rss()
+
+    start = time.perf_counter()
+    with write_packager:
+        write_packager.add(image, "image")
+    add_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with read_packager:
+        read_packager.restore("image", os.path.join(tmpdir, "restored"))
+    restore_time = time.perf_counter() - start
+
+    print(
+        "{:<12} add {:7.1f}MiB/s  restore {:7.1f}MiB/s  peak RSS +{:6.1f}MiB".format(
+            label, size / add_time, size / restore_time, rss() - rss_start
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-s", "--size", type=int, default=1024, help="in MiB")
+    parser.add_argument("-d", "--directory", default=None)
+    parser.add_argument(
+        "--read-latency", type=float, default=0, help="per read of the image, in ms"
+    )
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--image", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+            run(args.run, args.image, tmpdir, args.read_latency)
+        return
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        image = os.path.join(tmpdir, "image")
+        print("Generate an image of {}MiB in {}".format(args.size, tmpdir))
+        build_image(image, args.size)
+        for label in PACKAGERS:
+            cmd = [sys.executable, __file__, "--run", label, "--image", image]
+            cmd += ["--read-latency", str(args.read_latency)]
+            if args.directory:
+                cmd += ["-d", args.directory]
+            subprocess.run(cmd, check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark the I/O modes of the packagers
+
+Generate an image, then for each I/O mode copy it with the buffered copy of the
+packagers (tar, zstd, chunkstore) and with the kernel copy of the directory
+packager. The time of each copy is printed with the part of the source and
+target left in the page cache, as reported by mincore().
+
+The source is dropped from the page cache before each copy. Not collected by
+pytest. Run it with:
+
+    python tests/benchmark_iomode.py [-s 1024] [-d /var/tmp]
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import mmap
+import os
+import tempfile
+import time
+
+from virt_backup.backups.packagers import fastcopy
+from virt_backup.backups.packagers.iomode import IO_MODES, open_source, open_target
+from virt_backup.backups.packagers.sparse import copy_sparse
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = (
+    ctypes.c_void_p,
+    ctypes.c_size_t,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_long,
+)
+
+
+def cached_ratio(path):
+    """
+    :returns: part of the file in the page cache
+    """
+    size = os.path.getsize(path)
+    pages = -(-size // mmap.PAGESIZE)
+    vec = (ctypes.c_ubyte * pages)()
+    with open(path, "rb") as f:
+        address = _libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+        try:
+            if _libc.mincore(ctypes.c_void_p(address), ctypes.c_size_t(size), vec):
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            _libc.munmap(ctypes.c_void_p(address), ctypes.c_size_t(size))
+    return sum(v & 1 for v in vec) / pages
+
+
+def drop_cache(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def build_image(path, size):
+    block = os.urandom(2**20)
+    with open(path, "wb") as f:
+        for _ in range(size):
+            f.write(block)
+
+
+def copy_buffered(fsrc, fdst):
+    copy_sparse(fsrc, fdst)
+
+
+def copy_kernel(fsrc, fdst):
+    fastcopy.copy_fileobj(fsrc, fdst)
+
+
+def run(label, copy, src, dst, io_mode):
+    drop_cache(src)
+    start = time.perf_counter()
+    with open_source(src, io_mode) as fsrc, open_target(dst, io_mode) as fdst:
+        copy(fsrc, fdst)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    elapsed = time.perf_counter() - start
+
+    size = os.path.getsize(src) / 2**20
+    print(
+        "{:<28} {:7.2f}s {:8.1f}MiB/s  cached: source {:4.0%}, target {:4.0%}".format(
+            label, elapsed, size / elapsed, cached_ratio(src), cached_ratio(dst)
+        )
+    )
+    drop_cache(dst)
+    os.remove(dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-s", "--size", type=int, default=1024, help="in MiB")
+    parser.add_argument("-d", "--directory", default=None)
+    args = parser.parse_args()
+
+    # A reflink does not copy anything, disable it.
+    fastcopy.FICLONE = 0
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        src, dst = os.path.join(tmpdir, "src"), os.path.join(tmpdir, "dst")
+        print("Generate an image of {}MiB in {}".format(args.size, tmpdir))
+        build_image(src, args.size)
+
+        for name, copy in (
+            ("buffered copy", copy_buffered),
+            ("kernel copy", copy_kernel),
+        ):
+            for io_mode in IO_MODES:
+                run("{}, {}".format(name, io_mode), copy, src, dst, io_mode)
+
+
+if __name__ == "__main__":
+    main()
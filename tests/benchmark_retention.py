@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark the retention planning
+
+Generate backup records spread in domains, then time the planning of their
+cleaning:
+  - with the previous implementation, grouping the backups for each period by
+    arrow date attributes,
+  - with the retention planner.
+
+Not collected by pytest. Run it with:
+
+    python tests/benchmark_retention.py [-n 1000000] [-d 10000]
+"""
+
+import argparse
+from collections import defaultdict
+import random
+import time
+
+import arrow
+
+from virt_backup.backups import DomCompleteBackupRecord
+from virt_backup.groups.retention import plan_retention
+
+RETENTION = {"hourly": 5, "daily": 5, "weekly": 5, "monthly": 5, "yearly": 5}
+
+
+def build_records(nb_backups, nb_domains):
+    rand = random.Random(42)
+    start = arrow.get("2016-01-01").int_timestamp
+    backups_by_domain = {}
+    for i in range(nb_backups):
+        domain_name = "domain-{}".format(i % nb_domains)
+        timestamp = start + rand.randrange(0, 5 * 365 * 86400)
+        backups_by_domain.setdefault(domain_name, []).append(
+            DomCompleteBackupRecord(
+                name="{}_{}".format(timestamp, domain_name),
+                dom_name=domain_name,
+                backup_dir="/tmp",
+                definition_filename="{}_{}.json".format(timestamp, domain_name),
+                timestamp=timestamp,
+            )
+        )
+    return backups_by_domain
+
+
+def plan_by_arrow_periods(backups_by_domain):
+    periods = ("hour", "day", "week", "month", "year")
+    to_delete = {}
+    for domain, backups in backups_by_domain.items():
+        backups = sorted(backups, key=lambda b: b.date)
+        keep = set()
+        for period, n in zip(periods, RETENTION.values()):
+            grouped = defaultdict(list)
+            for b in backups:
+                key = tuple(
+                    getattr(b.date, p)
+                    for p in reversed(periods[periods.index(period) :])
+                )
+                grouped[key].append(b)
+            keep.update(group[0] for _, group in sorted(grouped.items())[-n:])
+        to_delete[domain] = set(backups).difference(keep)
+    return to_delete
+
+
+def timed(label, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:8.2f}s".format(label, elapsed))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--backups", type=int, default=1000000)
+    parser.add_argument("-d", "--domains", type=int, default=10000)
+    args = parser.parse_args()
+
+    print("Generate {} backups for {} domains".format(args.backups, args.domains))
+    backups_by_domain = build_records(args.backups, args.domains)
+
+    previous = timed("arrow periods", plan_by_arrow_periods, backups_by_domain)
+    plan = timed("retention planner", plan_retention, backups_by_domain, **RETENTION)
+
+    assert len(plan) == sum(len(backups) for backups in previous.values())
+    print("Backups to delete: {}".format(len(plan)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Benchmark the scan of a backup directory
+
+Generate synthetic backup definitions, spread in domain directories, then time
+their listing:
+  - sequentially, with a glob and json.load for each file (previous behavior),
+  - with the parallel scanner,
+  - through the catalog: first indexation, listing once indexed, and listing
+    after a change in each domain directory,
+  - as backup objects: lightweight records, as built by a group scan, against
+    full DomCompleteBackup objects. Time and peak memory are measured.
+
+Not collected by pytest. Run it with:
+
+    python tests/benchmark_scan.py [-n 100000] [-d 400] [--dir path]
+"""
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from virt_backup import scanner
+from virt_backup.backups import build_dom_complete_backup_from_def
+from virt_backup.catalog import BackupCatalog
+from virt_backup.groups import CompleteBackupGroup
+from virt_backup.groups.complete import _scan_json_by_domain, list_backups_by_domain
+
+CUR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+
+def build_definitions(backup_dir, nb_definitions, nb_domains):
+    with open(os.path.join(CUR_PATH, "helper", "testdomain.xml")) as f:
+        domain_xml = f.read()
+
+    for domain_id in range(nb_domains):
+        domain_name = "domain-{}".format(domain_id)
+        os.mkdir(os.path.join(backup_dir, domain_name))
+
+    for i in range(nb_definitions):
+        domain_id = i % nb_domains
+        domain_name = "domain-{}".format(domain_id)
+        date = 1569890041 + i * 3600
+        name = "{}_{}_{}".format(date, domain_id, domain_name)
+        definition = {
+            "name": name,
+            "domain_id": domain_id,
+            "domain_name": domain_name,
+            "domain_xml": domain_xml,
+            "disks": {"vda": "{}_vda.qcow2".format(name)},
+            "version": "0.4.0",
+            "date": date,
+            "packager": {"type": "tar", "opts": {"compression": "gz"}},
+        }
+        path = os.path.join(backup_dir, domain_name, "{}.json".format(name))
+        with open(path, "w") as f:
+            json.dump(definition, f, indent=4)
+
+
+def scan_sequentially(backup_dir):
+    backups = {}
+    for json_file in glob.glob(os.path.join(backup_dir, "*/*.json")):
+        with open(json_file, "r") as definition_file:
+            metadata = json.load(definition_file)
+        backups.setdefault(metadata["domain_name"], []).append((json_file, metadata))
+    return backups
+
+
+def touch_domain_dirs(backup_dir):
+    for entry in scanner.iter_subdirs(backup_dir):
+        path = os.path.join(entry.path, "touched")
+        open(path, "w").close()
+        os.remove(path)
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:8.2f}s".format(label, elapsed))
+    return result
+
+
+def traced(label, func, *args):
+    tracemalloc.start()
+    try:
+        result = timed(label, func, *args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    print("{:<40} {:8.1f}MiB peak".format("", peak / 2**20))
+    return result
+
+
+def build_records(backup_dir):
+    group = CompleteBackupGroup(name="bench", backup_dir=backup_dir, hosts=("r:.*",))
+    group.scan_backup_dir()
+    return group.backups
+
+
+def build_full_backups(backup_dir):
+    return {
+        domain_name: [
+            build_dom_complete_backup_from_def(
+                definition,
+                backup_dir=os.path.dirname(path),
+                definition_filename=path,
+            )
+            for path, definition in definitions
+        ]
+        for domain_name, definitions in list_backups_by_domain(backup_dir).items()
+    }
+
+
+def run(backup_dir, nb_definitions):
+    catalog = BackupCatalog(backup_dir)
+    results = (
+        timed("glob + json.load, sequential", scan_sequentially, backup_dir),
+        timed("scanner, parallel", _scan_json_by_domain, backup_dir, ".json"),
+        timed("catalog, first indexation", catalog.list_definitions),
+        timed("catalog, indexed", catalog.list_definitions),
+    )
+    timed("catalog, domain directories changed", _relist, catalog, backup_dir)
+    results += (
+        traced("backup records, indexed", build_records, backup_dir),
+        traced("full backups, indexed", build_full_backups, backup_dir),
+    )
+
+    for result in results:
+        assert sum(len(d) for d in result.values()) == nb_definitions
+
+
+def _relist(catalog, backup_dir):
+    touch_domain_dirs(backup_dir)
+    return catalog.list_definitions()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--definitions", type=int, default=100000)
+    parser.add_argument("-d", "--domains", type=int, default=400)
+    parser.add_argument(
+        "--dir", help="where to generate the definitions (default: temporary dir)"
+    )
+    args = parser.parse_args()
+
+    backup_dir = tempfile.mkdtemp(prefix="virt-backup-bench-", dir=args.dir)
+    try:
+        print(
+            "Generate {} definitions for {} domains in {}".format(
+                args.definitions, args.domains, backup_dir
+            )
+        )
+        build_definitions(backup_dir, args.definitions, args.domains)
+        print("JSON decoder: {}".format("orjson" if scanner.orjson else "json"))
+        run(backup_dir, args.definitions)
+    finally:
+        shutil.rmtree(backup_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark the copy of sparse images
+
+Generate sparse images, with data extents spread over their size, then copy
+each of them with a full read loop (how the directory packager copied images
+before reading their data extents) and with the extent-based copy. The time of
+each copy is printed with the bytes read from the source and the size
+allocated for the target.
+
+The source is dropped from the page cache before each copy. Not collected by
+pytest. Run it with:
+
+    python tests/benchmark_sparse.py [-s 1024] [-d /var/tmp]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from virt_backup.backups.packagers.sparse import copy_sparse
+
+#: part of the images containing data
+DATA_RATIOS = (0.01, 0.1, 0.5)
+
+#: size of each data extent, in bytes
+EXTENT_SIZE = 2**20
+
+
+def build_image(path, size, data_ratio):
+    """
+    :param size: in MiB
+    """
+    block = os.urandom(EXTENT_SIZE)
+    step = int(1 / data_ratio)
+    with open(path, "wb") as f:
+        f.truncate(size * 2**20)
+        for i in range(0, size, step):
+            f.seek(i * EXTENT_SIZE)
+            f.write(block)
+
+
+def drop_cache(path):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def copy_full(fsrc, fdst, buffersize=2**20):
+    read_bytes = 0
+    while True:
+        data = fsrc.read(buffersize)
+        if not data:
+            break
+        read_bytes += len(data)
+        fdst.write(data)
+    return read_bytes
+
+
+def copy_extents(fsrc, fdst):
+    return copy_sparse(fsrc, fdst)
+
+
+def run(label, copy, src, dst):
+    drop_cache(src)
+    start = time.perf_counter()
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        read_bytes = copy(fsrc, fdst)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    elapsed = time.perf_counter() - start
+
+    print(
+        "{:<24} {:7.2f}s  read: {:8.1f}MiB  target allocated: {:8.1f}MiB".format(
+            label,
+            elapsed,
+            read_bytes / 2**20,
+            os.stat(dst).st_blocks * 512 / 2**20,
+        )
+    )
+    os.remove(dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-s", "--size", type=int, default=1024, help="in MiB")
+    parser.add_argument("-d", "--directory", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as tmpdir:
+        src, dst = os.path.join(tmpdir, "src"), os.path.join(tmpdir, "dst")
+        for data_ratio in DATA_RATIOS:
+            build_image(src, args.size, data_ratio)
+            print(
+                "Image of {}MiB, {:.0%} of data, allocated: {:.1f}MiB".format(
+                    args.size, data_ratio, os.stat(src).st_blocks * 512 / 2**20
+                )
+            )
+            for name, copy in (("full read", copy_full), ("extents", copy_extents)):
+                run("  {}".format(name), copy, src, dst)
+            os.remove(src)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import os
+import socket
+import struct
+import threading
+
+from virt_backup.backups import nbd
+from virt_backup.backups.packagers.sparse import iter_data_extents
+
+REP_ERR_UNSUP = nbd.REP_FLAG_ERROR | 1
+REP_ERR_UNKNOWN = nbd.REP_FLAG_ERROR | 6
+
+FLAG_HAS_FLAGS = 1 << 0
+FLAG_READ_ONLY = 1 << 1
+
+ALLOCATION_CONTEXT_ID = 1
+
+
+class NBDServer:
+    """
+    Serve files, read-only, on a unix socket with the NBD protocol. Local
+    stand-in of qemu-nbd, or of the exports of a libvirt pull mode backup job.
+    """
+
+    def __init__(self, socket_path, exports, multi_conn=True, structured_replies=True):
+        self.socket_path = socket_path
+        #: path of the file of each export, `{export_name: path}`
+        self.exports = exports
+        self.multi_conn = multi_conn
+        self.structured_replies = structured_replies
+
+        #: number of connections negotiated, and of read requests received
+        self.connections = 0
+        self.reads = 0
+
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        self._sock.listen()
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        try:
+            # Wakes up the accept() of the server thread.
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        self._thread.join()
+        os.remove(self.socket_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            try:
+                path, structured = self._negotiate(conn)
+                self.connections += 1
+                with open(path, "rb") as f:
+                    self._transmission(conn, f.fileno(), structured)
+            except (ConnectionError, struct.error):
+                pass
+
+    def _negotiate(self, conn):
+        """
+        :returns: `(path of the export, if structured replies are negotiated)`
+        """
+        conn.sendall(
+            struct.pack(
+                ">QQH",
+                nbd.NBDMAGIC,
+                nbd.IHAVEOPT,
+                nbd.FLAG_FIXED_NEWSTYLE | nbd.FLAG_NO_ZEROES,
+            )
+        )
+        _recv(conn, 4)
+        structured = False
+        while True:
+            _, option, length = struct.unpack(">QII", _recv(conn, 16))
+            data = _recv(conn, length)
+            if option == nbd.OPT_STRUCTURED_REPLY and self.structured_replies:
+                structured = True
+                _send_option_reply(conn, option, nbd.REP_ACK)
+            elif option == nbd.OPT_SET_META_CONTEXT and structured:
+                if nbd.ALLOCATION_CONTEXT.encode() in data:
+                    _send_option_reply(
+                        conn,
+                        option,
+                        nbd.REP_META_CONTEXT,
+                        struct.pack(">I", ALLOCATION_CONTEXT_ID)
+                        + nbd.ALLOCATION_CONTEXT.encode(),
+                    )
+                _send_option_reply(conn, option, nbd.REP_ACK)
+            elif option == nbd.OPT_GO:
+                (name_length,) = struct.unpack(">I", data[:4])
+                path = self.exports.get(data[4 : 4 + name_length].decode())
+                if path is None:
+                    _send_option_reply(conn, option, REP_ERR_UNKNOWN, b"unknown export")
+                    continue
+                flags = FLAG_HAS_FLAGS | FLAG_READ_ONLY
+                if self.multi_conn:
+                    flags |= nbd.FLAG_CAN_MULTI_CONN
+                _send_option_reply(
+                    conn,
+                    option,
+                    nbd.REP_INFO,
+                    struct.pack(">HQH", nbd.INFO_EXPORT, os.path.getsize(path), flags),
+                )
+                _send_option_reply(conn, option, nbd.REP_ACK)
+                return path, structured
+            else:
+                _send_option_reply(conn, option, REP_ERR_UNSUP)
+
+    def _transmission(self, conn, fd, structured):
+        while True:
+            _, _, command, cookie, offset, length = struct.unpack(
+                ">IHHQQI", _recv(conn, 28)
+            )
+            if command == nbd.CMD_DISC:
+                return
+            elif command == nbd.CMD_READ:
+                self.reads += 1
+                self._read(conn, fd, cookie, offset, length, structured)
+            elif command == nbd.CMD_BLOCK_STATUS and structured:
+                descriptors = b"".join(
+                    struct.pack(
+                        ">II",
+                        extent_length,
+                        0 if is_data else nbd.STATE_HOLE | nbd.STATE_ZERO,
+                    )
+                    for _, extent_length, is_data in _iter_extents(fd, offset, length)
+                )
+                _send_structured_reply(
+                    conn,
+                    cookie,
+                    nbd.REPLY_TYPE_BLOCK_STATUS,
+                    struct.pack(">I", ALLOCATION_CONTEXT_ID) + descriptors,
+                )
+            else:
+                conn.sendall(
+                    struct.pack(">IIQ", nbd.SIMPLE_REPLY_MAGIC, 22, cookie)  # EINVAL
+                )
+
+    def _read(self, conn, fd, cookie, offset, length, structured):
+        if not structured:
+            conn.sendall(struct.pack(">IIQ", nbd.SIMPLE_REPLY_MAGIC, 0, cookie))
+            conn.sendall(os.pread(fd, length, offset))
+            return
+
+        extents = list(_iter_extents(fd, offset, length))
+        for i, (extent_offset, extent_length, is_data) in enumerate(extents):
+            done = i == len(extents) - 1
+            if is_data:
+                payload = struct.pack(">Q", extent_offset) + os.pread(
+                    fd, extent_length, extent_offset
+                )
+                reply_type = nbd.REPLY_TYPE_OFFSET_DATA
+            else:
+                payload = struct.pack(">QI", extent_offset, extent_length)
+                reply_type = nbd.REPLY_TYPE_OFFSET_HOLE
+            _send_structured_reply(conn, cookie, reply_type, payload, done)
+
+
+def _iter_extents(fd, offset, length):
+    """
+    Split a range of fd in data and hole extents, as `(offset, length, is_data)`
+    """
+    end = min(offset + length, os.fstat(fd).st_size)
+    position = offset
+    for data_offset, data_length in iter_data_extents(fd):
+        data_start, data_end = max(data_offset, offset), min(
+            data_offset + data_length, end
+        )
+        if data_end <= data_start:
+            continue
+        if data_start > position:
+            yield position, data_start - position, False
+        yield data_start, data_end - data_start, True
+        position = data_end
+    if position < end:
+        yield position, end - position, False
+
+
+def _recv(conn, length):
+    data = b""
+    while len(data) < length:
+        received = conn.recv(length - len(data))
+        if not received:
+            raise ConnectionError("connection closed")
+        data += received
+    return data
+
+
+def _send_option_reply(conn, option, reply_type, data=b""):
+    conn.sendall(
+        struct.pack(">QIII", nbd.OPTION_REPLY_MAGIC, option, reply_type, len(data))
+        + data
+    )
+
+
+def _send_structured_reply(conn, cookie, reply_type, payload, done=True):
+    conn.sendall(
+        struct.pack(
+            ">IHHQI",
+            nbd.STRUCTURED_REPLY_MAGIC,
+            nbd.REPLY_FLAG_DONE if done else 0,
+            reply_type,
+            cookie,
+            len(payload),
+        )
+        + payload
+    )
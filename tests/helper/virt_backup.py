@@ -1,4 +1,5 @@
 import os
+import shutil
 import uuid
 import arrow
 import libvirt
@@ -11,7 +12,9 @@ from virt_backup.backups import (
     ReadBackupPackagers,
     WriteBackupPackagers,
 )
+from virt_backup.domains import get_domain_disks_of
 from virt_backup.groups import BackupGroup
+from .nbd import NBDServer
 
 CUR_PATH = os.path.dirname(os.path.realpath(__file__))
 
@@ -84,6 +87,84 @@ class MockDomain:
     def set_mock_snapshot_create(self, mock):
         self._mock_snapshot = mock
 
+    def backupBegin(self, backupXML, checkpointXML=None, flags=0):
+        """
+        Simulate a push mode backup job, by copying each disk to its target, or
+        a pull mode backup job, by exporting each disk with a NBD server until
+        the job is aborted
+        """
+        backup_xml = lxml.etree.fromstring(
+            backupXML, lxml.etree.XMLParser(resolve_entities=False)
+        )
+        if backup_xml.get("mode") == "pull":
+            self._start_pull_backup_job(backup_xml)
+        else:
+            self._run_push_backup_job(backup_xml)
+
+        if checkpointXML:
+            checkpoint_xml = lxml.etree.fromstring(
+                checkpointXML, lxml.etree.XMLParser(resolve_entities=False)
+            )
+            name = checkpoint_xml.xpath("name")[0].text
+            self.checkpoints[name] = MockCheckpoint(self, name)
+
+        self.backup_jobs.append(backupXML)
+
+    def _run_push_backup_job(self, backup_xml):
+        for disk_xml in backup_xml.xpath("disks/disk"):
+            if disk_xml.get("backup") != "yes":
+                continue
+
+            src = get_domain_disks_of(self.dom_xml, disk_xml.get("name"))[
+                disk_xml.get("name")
+            ]["src"]
+            target = disk_xml.xpath("target")[0].get("file")
+            if os.path.exists(src):
+                shutil.copy(src, target)
+            else:
+                with open(target, "w"):
+                    pass
+
+        self._job_stats = {"type": libvirt.VIR_DOMAIN_JOB_COMPLETED}
+
+    def _start_pull_backup_job(self, backup_xml):
+        exports = {}
+        for disk_xml in backup_xml.xpath("disks/disk"):
+            if disk_xml.get("backup") == "yes":
+                name = disk_xml.get("name")
+                exports[name] = get_domain_disks_of(self.dom_xml, name)[name]["src"]
+
+        self.nbd_server = NBDServer(
+            backup_xml.xpath("server")[0].get("socket"), exports
+        ).start()
+        self._job_stats = {
+            "type": libvirt.VIR_DOMAIN_JOB_UNBOUNDED,
+            "operation": libvirt.VIR_DOMAIN_JOB_OPERATION_BACKUP,
+        }
+
+    def jobInfo(self):
+        job_type = (
+            libvirt.VIR_DOMAIN_JOB_UNBOUNDED
+            if self.nbd_server
+            else libvirt.VIR_DOMAIN_JOB_NONE
+        )
+        return [job_type] + [0] * 11
+
+    def jobStats(self, flags=0):
+        return self._job_stats
+
+    def abortJob(self):
+        if self.nbd_server:
+            self.nbd_server.stop()
+            self.nbd_server = None
+        self._job_stats = {"type": libvirt.VIR_DOMAIN_JOB_CANCELLED}
+
+    def checkpointLookupByName(self, name, flags=0):
+        try:
+            return self.checkpoints[name]
+        except KeyError:
+            raise libvirt.libvirtError("Checkpoint not found")
+
     def updateDeviceFlags(self, xml, flags):
         new_device_xml = lxml.etree.fromstring(
             xml, lxml.etree.XMLParser(resolve_entities=False)
@@ -116,6 +197,28 @@ class MockDomain:
         self.set_name(name)
         self.set_uuid(kwargs.get("uuid", str(uuid.uuid4())))
 
+        #: checkpoints created by backup jobs, by name
+        self.checkpoints = {}
+
+        #: backup XML of each backup job started
+        self.backup_jobs = []
+        self._job_stats = {}
+
+        #: NBD server exporting the disks during a pull mode backup job
+        self.nbd_server = None
+
+
+class MockCheckpoint:
+    def getName(self):
+        return self._name
+
+    def delete(self, flags=0):
+        self._dom.checkpoints.pop(self._name)
+
+    def __init__(self, dom, name):
+        self._dom = dom
+        self._name = name
+
 
 class MockSnapshot:
     def getName(self):
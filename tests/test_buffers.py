@@ -0,0 +1,103 @@
+import io
+import os
+from types import SimpleNamespace
+
+from virt_backup.backups.packagers import buffers
+from virt_backup.backups.packagers.buffers import (
+    BufferPool,
+    get_buffer_pool,
+    iter_readinto,
+    readinto_full,
+    tune_buffer_size,
+)
+
+
+class ShortReader(io.RawIOBase):
+    """
+    Return at most 3 bytes per readinto
+    """
+
+    def __init__(self, data):
+        self.data = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        return self.data.readinto(b[:3])
+
+
+class TestBufferPool:
+    def test_buffer(self):
+        pool = BufferPool(16)
+        with pool.buffer() as buf:
+            assert len(buf) == 16
+            assert not buf.readonly
+
+        with pool.buffer() as reused:
+            assert reused.obj is buf.obj
+
+    def test_acquire_concurrent(self):
+        pool = BufferPool(16)
+        first, second = pool.acquire(), pool.acquire()
+        assert first is not second
+
+        pool.release(first)
+        pool.release(second[:4])
+        assert pool.acquire().obj is second.obj
+
+    def test_release_foreign(self):
+        pool = BufferPool(16)
+        pool.release(memoryview(bytes(16)))
+        pool.release(memoryview(bytearray(8)))
+
+        assert not pool._free
+
+    def test_max_free(self):
+        pool = BufferPool(16, max_free=1)
+        buffers = [pool.acquire() for _ in range(3)]
+        for buf in buffers:
+            pool.release(buf)
+
+        assert len(pool._free) == 1
+
+
+def test_get_buffer_pool():
+    assert get_buffer_pool(2**16) is get_buffer_pool(2**16)
+    assert get_buffer_pool(2**16) is not get_buffer_pool(2**17)
+
+
+def test_readinto_full():
+    buf = memoryview(bytearray(8))
+    assert readinto_full(ShortReader(b"0123456789"), buf) == 8
+    assert buf == b"01234567"
+
+    assert readinto_full(ShortReader(b"0123"), buf) == 4
+
+
+def test_iter_readinto():
+    buf = memoryview(bytearray(4))
+    chunks = [bytes(c) for c in iter_readinto(io.BytesIO(b"0123456789"), buf)]
+    assert chunks == [b"0123", b"4567", b"89"]
+
+    chunks = [bytes(c) for c in iter_readinto(io.BytesIO(b"0123456789"), buf, 6)]
+    assert chunks == [b"0123", b"45"]
+
+
+def test_tune_buffer_size(tmpdir, monkeypatch):
+    def stat(path):
+        return SimpleNamespace(st_blksize=3 * 2**20, st_dev=0)
+
+    monkeypatch.setattr(os, "stat", stat)
+    monkeypatch.setattr(buffers, "_get_device_optimal_io_size", lambda dev: 0)
+    assert tune_buffer_size(str(tmpdir)) == 3 * 2**20
+    assert tune_buffer_size(str(tmpdir), size=4 * 2**20) == 6 * 2**20
+
+    monkeypatch.setattr(buffers, "_get_device_optimal_io_size", lambda dev: 2**25)
+    assert tune_buffer_size(str(tmpdir)) == 2**25
+
+
+def test_tune_buffer_size_unexisting(tmpdir):
+    size = tune_buffer_size(str(tmpdir.join("unexisting")))
+    assert size >= buffers.DEFAULT_BUFFER_SIZE
+    assert size % os.stat(str(tmpdir)).st_blksize == 0
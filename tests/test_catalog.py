@@ -0,0 +1,250 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+import virt_backup.catalog
+
+from virt_backup.catalog import CATALOG_FILENAME, BackupCatalog
+from virt_backup.groups import CompleteBackupGroup
+from virt_backup.groups.complete import (
+    _scan_json_by_domain,
+    list_backups_by_domain,
+    list_broken_backups_by_domain,
+)
+
+
+def sorted_definitions(definitions_by_domain):
+    return {
+        domain: sorted(definitions, key=lambda d: d[0])
+        for domain, definitions in definitions_by_domain.items()
+    }
+
+
+@pytest.fixture
+def backup_dir(build_backup_directory):
+    return str(build_backup_directory["backup_dir"])
+
+
+@pytest.fixture
+def catalog(backup_dir):
+    catalog = BackupCatalog(backup_dir)
+    catalog.reindex()
+    return catalog
+
+
+def test_list_definitions(backup_dir):
+    catalog = BackupCatalog(backup_dir)
+    expected = _scan_json_by_domain(backup_dir, ".json")
+
+    assert sorted_definitions(catalog.list_definitions()) == sorted_definitions(
+        expected
+    )
+    assert catalog.exists()
+    assert not catalog.list_definitions(pending=True)
+
+
+def test_list_definitions_pending(backup_dir, catalog):
+    pending_path = os.path.join(backup_dir, "a", "20170101-000000_1_a.json.pending")
+    with open(pending_path, "w") as f:
+        json.dump({"domain_name": "a", "date": 1483228800}, f)
+
+    assert catalog.list_definitions(pending=True) == {
+        "a": [(pending_path, {"domain_name": "a", "date": 1483228800})]
+    }
+    assert list_broken_backups_by_domain(backup_dir) == catalog.list_definitions(
+        pending=True
+    )
+
+
+def test_list_definitions_uses_catalog(backup_dir, catalog, mocker):
+    load = mocker.spy(virt_backup.catalog, "load_json_files")
+    assert catalog.list_definitions()
+    assert not load.called
+
+
+def test_list_definitions_changed_file(backup_dir, catalog, mocker):
+    """
+    Only the files changed in a directory need to be loaded again.
+    """
+    path, definition = sorted(catalog.list_definitions()["a"])[0]
+    definition["name"] = "changed"
+    with open(path, "w") as f:
+        json.dump(definition, f)
+    os.utime(os.path.join(backup_dir, "a"), ns=(0, 0))
+
+    load = mocker.spy(virt_backup.catalog, "load_json_files")
+    assert (path, definition) in catalog.list_definitions()["a"]
+    # The bad json file is loaded again as well, as it is not indexed.
+    (loaded_paths, _), _ = load.call_args
+    assert sorted(loaded_paths) == sorted(
+        (path, os.path.join(backup_dir, "a", "badfile.json"))
+    )
+
+
+def test_list_definitions_changed_dir(backup_dir, catalog):
+    """
+    Directories changed without the catalog need to be indexed again.
+    """
+    domain_dir = os.path.join(backup_dir, "a")
+    removed = sorted(catalog.list_definitions()["a"])[0][0]
+    os.remove(removed)
+    # Ensure the mtime changes even on filesystems with a coarse precision.
+    os.utime(domain_dir, ns=(0, 0))
+
+    definitions = catalog.list_definitions()
+    assert removed not in (path for path, _ in definitions["a"])
+    assert len(definitions["a"]) == len(definitions["b"]) - 1
+
+
+def test_updating(backup_dir, catalog, mocker):
+    domain_dir = os.path.join(backup_dir, "a")
+    path = os.path.join(domain_dir, "20170101-000000_1_a.json")
+    definition = {"domain_name": "a", "date": 1483228800}
+
+    with catalog.updating(domain_dir) as changes:
+        with open(path, "w") as f:
+            json.dump(definition, f)
+        changes.put(path, definition)
+
+    index_domain_dir = mocker.spy(catalog, "_index_domain_dirs")
+    assert (path, definition) in catalog.list_definitions()["a"]
+    # Still in sync with the directory, it does not need to be indexed again.
+    assert not index_domain_dir.called
+
+    with catalog.updating(domain_dir) as changes:
+        os.remove(path)
+        changes.remove(path)
+    assert (path, definition) not in catalog.list_definitions()["a"]
+    assert not index_domain_dir.called
+
+
+def test_updating_nested(backup_dir, catalog, mocker):
+    domain_dir = os.path.join(backup_dir, "a")
+    paths = [
+        os.path.join(domain_dir, "2017010{}-000000_1_a.json".format(i)) for i in (1, 2)
+    ]
+    definition = {"domain_name": "a", "date": 1483228800}
+
+    with catalog.updating(domain_dir) as changes:
+        for path in paths:
+            with catalog.updating(domain_dir) as nested_changes:
+                with open(path, "w") as f:
+                    json.dump(definition, f)
+                nested_changes.put(path, definition)
+        changes.put(paths[0], definition)
+
+    index_domain_dir = mocker.spy(catalog, "_index_domain_dirs")
+    listed = catalog.list_definitions()["a"]
+    assert all((path, definition) in listed for path in paths)
+    assert not index_domain_dir.called
+
+
+def test_updating_error(backup_dir, catalog, mocker):
+    domain_dir = os.path.join(backup_dir, "a")
+    path = os.path.join(domain_dir, "20170101-000000_1_a.json")
+
+    with pytest.raises(RuntimeError):
+        with catalog.updating(domain_dir) as changes:
+            changes.put(path, {"domain_name": "a"})
+            raise RuntimeError()
+
+    # The change has not been applied, and the directory is indexed again.
+    index_domain_dir = mocker.spy(catalog, "_index_domain_dirs")
+    assert path not in (p for p, _ in catalog.list_definitions()["a"])
+    assert index_domain_dir.called
+
+
+def test_updating_concurrent_error(backup_dir, catalog):
+    """
+    A context failing should not let another one record the directory as in sync
+    """
+    domain_dir = os.path.join(backup_dir, "a")
+    path = os.path.join(domain_dir, "20170101-000000_1_a.json")
+    definition = {"domain_name": "a", "date": 1483228800}
+
+    other_path = os.path.join(domain_dir, "20170102-000000_1_a.json")
+
+    with catalog.updating(domain_dir) as changes:
+        with pytest.raises(RuntimeError):
+            with catalog.updating(domain_dir):
+                with open(path, "w") as f:
+                    json.dump(definition, f)
+                raise RuntimeError()
+
+        with open(other_path, "w") as f:
+            json.dump(definition, f)
+        changes.put(other_path, definition)
+
+    listed = catalog.list_definitions()["a"]
+    assert (path, definition) in listed
+    assert (other_path, definition) in listed
+
+
+def test_list_definitions_read_only(backup_dir, catalog, monkeypatch):
+    """
+    Listing an up to date catalog should not wait for the other writers
+    """
+    monkeypatch.setattr(virt_backup.catalog, "CATALOG_TIMEOUT", 0.1)
+    writer = sqlite3.connect(catalog.path, isolation_level=None)
+    try:
+        writer.execute("BEGIN IMMEDIATE")
+        assert catalog.list_definitions()
+        assert catalog.list_summaries()
+
+        os.utime(os.path.join(backup_dir, "a"), ns=(0, 0))
+        with pytest.raises(sqlite3.OperationalError):
+            catalog.list_definitions()
+    finally:
+        writer.close()
+
+
+def test_updating_without_catalog(backup_dir):
+    catalog = BackupCatalog(backup_dir)
+    domain_dir = os.path.join(backup_dir, "a")
+
+    with catalog.updating(domain_dir) as changes:
+        changes.remove(os.path.join(domain_dir, "test.json"))
+    assert not catalog.exists()
+
+
+def test_outdated_catalog(backup_dir, catalog):
+    with sqlite3.connect(catalog.path) as conn:
+        conn.execute("DELETE FROM definitions")
+        conn.execute("PRAGMA user_version = 1")
+
+    assert sorted_definitions(catalog.list_definitions()) == sorted_definitions(
+        _scan_json_by_domain(backup_dir, ".json")
+    )
+
+
+def test_reindex(backup_dir, catalog):
+    with sqlite3.connect(catalog.path) as conn:
+        conn.execute("DELETE FROM definitions")
+
+    assert not catalog.list_definitions()
+    assert catalog.reindex() == 50
+    assert sorted_definitions(catalog.list_definitions()) == sorted_definitions(
+        _scan_json_by_domain(backup_dir, ".json")
+    )
+
+
+def test_list_backups_by_domain_unusable_catalog(backup_dir):
+    with open(os.path.join(backup_dir, CATALOG_FILENAME), "w") as f:
+        f.write("not a database")
+
+    assert sorted_definitions(list_backups_by_domain(backup_dir)) == (
+        sorted_definitions(_scan_json_by_domain(backup_dir, ".json"))
+    )
+
+
+def test_complete_backup_delete(backup_dir, catalog, mocker):
+    group = CompleteBackupGroup(name="test", backup_dir=backup_dir, hosts=("a",))
+    group.scan_backup_dir()
+    backup = group.backups["a"][0]
+    backup.delete()
+
+    index_domain_dir = mocker.spy(catalog, "_index_domain_dirs")
+    assert len(catalog.list_definitions()["a"]) == len(group.backups["a"]) - 1
+    assert not index_domain_dir.called
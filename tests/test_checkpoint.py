@@ -0,0 +1,121 @@
+import threading
+import libvirt
+import lxml.etree
+import pytest
+
+from virt_backup.backups.checkpoint import DomBackupJob, has_checkpoint
+from virt_backup.exceptions import BackupJobFailedError, CancelledError
+
+
+class TestDomBackupJob:
+    job_helper = None
+
+    @pytest.fixture(autouse=True)
+    def gen_job_helper(self, build_mock_domain, tmpdir):
+        dom = build_mock_domain
+        dom.set_storage_basedir(str(tmpdir))
+        self.job_helper = DomBackupJob(
+            dom=dom,
+            disks={"vda": {"src": str(tmpdir.join("vda.qcow2")), "type": "qcow2"}},
+            checkpoint="test_checkpoint",
+            poll_interval=0,
+        )
+        self.targets = {"vda": str(tmpdir.join("vda.backup.qcow2"))}
+
+    def test_gen_libvirt_backup_xml(self):
+        backup_xml = lxml.etree.fromstring(
+            self.job_helper.gen_libvirt_backup_xml(self.targets)
+        )
+
+        assert backup_xml.get("mode") == "push"
+        assert not backup_xml.xpath("incremental")
+        disks = {d.get("name"): d for d in backup_xml.xpath("disks/disk")}
+        assert disks["vda"].get("backup") == "yes"
+        assert disks["vda"].xpath("target")[0].get("file") == self.targets["vda"]
+        assert disks["vda"].xpath("driver")[0].get("type") == "qcow2"
+        assert disks["vdb"].get("backup") == "no"
+
+    def test_gen_libvirt_backup_xml_incremental(self):
+        self.job_helper.parent_checkpoint = "parent_checkpoint"
+        backup_xml = lxml.etree.fromstring(
+            self.job_helper.gen_libvirt_backup_xml(self.targets)
+        )
+
+        assert backup_xml.xpath("incremental")[0].text == "parent_checkpoint"
+
+    def test_gen_libvirt_checkpoint_xml(self):
+        checkpoint_xml = lxml.etree.fromstring(
+            self.job_helper.gen_libvirt_checkpoint_xml()
+        )
+
+        assert checkpoint_xml.xpath("name")[0].text == "test_checkpoint"
+        disks = {
+            d.get("name"): d.get("checkpoint")
+            for d in checkpoint_xml.xpath("disks/disk")
+        }
+        assert disks["vda"] == "bitmap"
+        assert disks["vdb"] == "no"
+
+    def test_start(self, tmpdir):
+        self.job_helper.start(self.targets)
+
+        assert tmpdir.join("vda.backup.qcow2").check()
+        assert has_checkpoint(self.job_helper.dom, "test_checkpoint")
+
+    def test_start_failed(self, monkeypatch):
+        monkeypatch.setattr(
+            self.job_helper.dom,
+            "jobStats",
+            lambda *args: {"type": libvirt.VIR_DOMAIN_JOB_FAILED},
+        )
+
+        with pytest.raises(BackupJobFailedError):
+            self.job_helper.start(self.targets)
+        assert not has_checkpoint(self.job_helper.dom, "test_checkpoint")
+
+    def test_start_cancelled(self, monkeypatch, mocker):
+        monkeypatch.setattr(
+            self.job_helper.dom,
+            "jobInfo",
+            lambda: [libvirt.VIR_DOMAIN_JOB_UNBOUNDED] + [0] * 11,
+        )
+        mocker.spy(self.job_helper.dom, "abortJob")
+        cancel_flag = threading.Event()
+        cancel_flag.set()
+
+        with pytest.raises(CancelledError):
+            self.job_helper.start(self.targets, cancel_flag)
+        assert self.job_helper.dom.abortJob.called
+        assert not has_checkpoint(self.job_helper.dom, "test_checkpoint")
+
+    def test_delete_checkpoint(self):
+        self.job_helper.start(self.targets)
+        self.job_helper.delete_checkpoint("test_checkpoint")
+
+        assert not has_checkpoint(self.job_helper.dom, "test_checkpoint")
+
+    def test_delete_unexisting_checkpoint(self):
+        self.job_helper.delete_checkpoint("test_checkpoint")
+
+    def test_gen_libvirt_backup_xml_pull(self, tmpdir):
+        socket = str(tmpdir.join("nbd.sock"))
+        backup_xml = lxml.etree.fromstring(
+            self.job_helper.gen_libvirt_backup_xml(self.targets, socket=socket)
+        )
+
+        assert backup_xml.get("mode") == "pull"
+        assert backup_xml.xpath("server")[0].get("socket") == socket
+        disks = {d.get("name"): d for d in backup_xml.xpath("disks/disk")}
+        assert disks["vda"].xpath("scratch")[0].get("file") == self.targets["vda"]
+        assert not disks["vda"].xpath("target")
+
+    def test_start_pull(self, tmpdir):
+        self.job_helper.checkpoint = None
+        exports = self.job_helper.start_pull(str(tmpdir.join("nbd.sock")), self.targets)
+
+        assert exports == {"vda": "vda"}
+        assert self.job_helper.is_running()
+        assert not self.job_helper.dom.checkpoints
+
+        self.job_helper.abort()
+        assert not self.job_helper.is_running()
@@ -0,0 +1,60 @@
+import io
+import os
+
+from virt_backup.backups.packagers.chunkstore import (
+    CHUNK_ANCHOR,
+    find_chunk_end,
+    iter_chunks,
+)
+
+
+def test_find_chunk_end_max_size():
+    data = bytes(2**16)
+    assert find_chunk_end(data, 0, 2**12) == 2**14
+    assert find_chunk_end(data, 2**15 + 1, 2**12) == 2**15 + 1 + 2**14
+
+
+def test_find_chunk_end_too_short():
+    assert find_chunk_end(bytes(2**13), 0, 2**12) is None
+
+
+def test_find_chunk_end_anchor():
+    data = os.urandom(2**12) + CHUNK_ANCHOR + bytes(2**14)
+    # With a mask of 0, the first anchor after the minimum size is a boundary.
+    assert find_chunk_end(data, 0, 2**12, mask=0) == 2**12 + len(CHUNK_ANCHOR)
+
+
+def test_find_chunk_end_min_size():
+    data = CHUNK_ANCHOR + bytes(2**14)
+    assert find_chunk_end(data, 0, 2**12, mask=0) == 2**14
+
+
+def test_iter_chunks():
+    content = os.urandom(2**22)
+    chunks = list(iter_chunks(io.BytesIO(content), 0, len(content), 2**18))
+
+    assert b"".join(c for _, c in chunks) == content
+    offset = 0
+    for chunk_offset, chunk in chunks:
+        assert chunk_offset == offset
+        assert len(chunk) <= 2**20
+        offset += len(chunk)
+
+
+def test_iter_chunks_range():
+    content = os.urandom(2**18)
+    chunks = list(iter_chunks(io.BytesIO(content), 2**16, 2**17, 2**14))
+
+    assert chunks[0][0] == 2**16
+    assert b"".join(c for _, c in chunks) == content[2**16 : 2**16 + 2**17]
+
+
+def test_iter_chunks_shift_resistant():
+    content = os.urandom(2**22)
+    shifted = content[:100] + b"inserted" + content[100:]
+
+    chunks = {c for _, c in iter_chunks(io.BytesIO(content), 0, len(content), 2**18)}
+    shifted_chunks = [
+        c for _, c in iter_chunks(io.BytesIO(shifted), 0, len(shifted), 2**18)
+    ]
+    assert sum(1 for c in shifted_chunks if c not in chunks) <= 2
@@ -0,0 +1,125 @@
+import libvirt
+import pytest
+
+from virt_backup.backups.commit import (
+    MIN_BANDWIDTH,
+    BlockCommitController,
+    _CommitState,
+)
+
+
+class MockCommittingDomain:
+    """
+    Domain with a blockcommit, progressing of `commit_rate` bytes and with
+    `write_rate` bytes written by the guest at each poll
+    """
+
+    def __init__(self, commit_rate, write_rate, latency):
+        self.commit_rate = commit_rate
+        self.write_rate = write_rate
+        self.latency = latency
+        self.speeds = []
+        self.job_ended = False
+        self._polls = 0
+
+    def name(self):
+        return "test"
+
+    def blockJobInfo(self, disk, flags=0):
+        if self.job_ended:
+            return {}
+        self._polls += 1
+        return {"cur": self._polls * self.commit_rate, "end": 2**40}
+
+    def blockStatsFlags(self, disk, flags=0):
+        return {
+            "wr_bytes": self._polls * self.write_rate,
+            "wr_operations": self._polls * 100,
+            "wr_total_times": int(self._polls * 100 * self.latency * 1e9),
+        }
+
+    def blockJobSetSpeed(self, disk, bandwidth, flags=0):
+        assert flags == libvirt.VIR_DOMAIN_BLOCK_JOB_SPEED_BANDWIDTH_BYTES
+        self.speeds.append(bandwidth)
+
+
+@pytest.fixture
+def mock_time(mocker):
+    """
+    Make each poll 1 second after the previous one
+    """
+    clock = iter(range(1000))
+    mocker.patch("time.monotonic", side_effect=lambda: next(clock))
+
+
+def poll(controller, nb_polls, bandwidth=0):
+    state = _CommitState(bandwidth)
+    for _ in range(nb_polls):
+        controller.adjust("vda", state)
+    return state
+
+
+def test_adjust_idle(mock_time):
+    """
+    With an idle guest, the bandwidth should increase up to the throughput target
+    """
+    dom = MockCommittingDomain(commit_rate=2**25, write_rate=0, latency=0)
+    controller = BlockCommitController(dom, max_bandwidth=2**27, latency_target=0.01)
+    state = poll(controller, 10, bandwidth=2**25)
+
+    assert dom.speeds == sorted(dom.speeds)
+    assert state.bandwidth == 2**27
+
+
+def test_adjust_busy(mock_time):
+    """
+    With a busy guest, the bandwidth should decrease, but stay above its write rate
+    """
+    dom = MockCommittingDomain(commit_rate=2**27, write_rate=2**24, latency=0.05)
+    controller = BlockCommitController(dom, latency_target=0.01)
+    state = poll(controller, 10)
+
+    assert dom.speeds == sorted(dom.speeds, reverse=True)
+    assert state.bandwidth == 2**24 * 1.25
+
+
+def test_adjust_busy_min_bandwidth(mock_time):
+    dom = MockCommittingDomain(commit_rate=2**27, write_rate=0, latency=0.05)
+    controller = BlockCommitController(dom, latency_target=0.01)
+    state = poll(controller, 20)
+
+    assert state.bandwidth == MIN_BANDWIDTH
+
+
+def test_adjust_unlimited(mock_time):
+    """
+    Without throughput target, the limit should be removed once not slowing the
+    commit down anymore
+    """
+    dom = MockCommittingDomain(commit_rate=2**24, write_rate=0, latency=0)
+    controller = BlockCommitController(dom, latency_target=0.01)
+    state = poll(controller, 5, bandwidth=2**24)
+
+    assert dom.speeds[-1] == 0
+    assert state.bandwidth == 0
+
+
+def test_adjust_job_ended():
+    dom = MockCommittingDomain(commit_rate=2**24, write_rate=0, latency=0)
+    dom.job_ended = True
+    controller = BlockCommitController(dom)
+
+    assert not controller.adjust("vda", _CommitState(0))
+
+
+def test_add_remove():
+    dom = MockCommittingDomain(commit_rate=2**24, write_rate=0, latency=0)
+    controller = BlockCommitController(dom, poll_interval=0.01)
+    controller.add("vda")
+    thread = controller._thread
+    assert thread.is_alive()
+
+    controller.remove("vda")
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    assert controller._thread is None
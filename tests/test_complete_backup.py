@@ -1,15 +1,31 @@
+import concurrent.futures
 import datetime
 import filecmp
+import json
+import logging
 import os
+import time
 import tarfile
 import arrow
 import pytest
 
-from virt_backup.backups import build_dom_complete_backup_from_def
+from virt_backup.backups import (
+    build_dom_complete_backup_from_def,
+    build_dom_complete_backup_record,
+)
+from virt_backup.backups.complete import DomCompleteBackup
+from virt_backup.catalog import summarize_definition
 from virt_backup.domains import get_domain_disks_of
-from virt_backup.exceptions import DomainRunningError
+from virt_backup.exceptions import (
+    DomainRunningError,
+    ImageNotFoundError,
+    ParentBackupNotFoundError,
+)
 
-from helper.virt_backup import build_complete_backup_files_from_domainbackup
+from helper.virt_backup import (
+    build_complete_backup_files_from_domainbackup,
+    build_dombackup,
+)
 
 
 def transform_dombackup_to_dom_complete_backup(dombkup):
@@ -122,6 +138,56 @@ class TestDomCompleteBackup:
         # there should be 1 .xml file + all disks
         assert len(target.listdir()) == 1 + len(complete_backup.disks)
 
+    @pytest.mark.parametrize(
+        "dombackup,is_concurrent",
+        (("get_uncompressed_dombackup", True), ("get_compressed_dombackup", False)),
+    )
+    def test_restore_to_single_packager(
+        self, dombackup, is_concurrent, request, tmpdir, mocker
+    ):
+        backup = self.build_multiple_disks_backup(
+            request.getfixturevalue(dombackup), tmpdir
+        )
+        mocker.spy(backup, "_get_packager")
+        spy_executor = mocker.spy(concurrent.futures, "ThreadPoolExecutor")
+
+        self.restore_to(backup, tmpdir.mkdir("extract"))
+
+        assert backup._get_packager.call_count == 1
+        spy_executor.assert_called_once_with(2 if is_concurrent else 1)
+
+    def test_restore_to_with_error(self, get_uncompressed_dombackup, tmpdir):
+        backup = self.build_multiple_disks_backup(get_uncompressed_dombackup, tmpdir)
+        os.remove(backup.get_complete_path_of(backup.disks["vdb"]))
+        target_dir = tmpdir.mkdir("extract")
+
+        with pytest.raises(ImageNotFoundError):
+            backup.restore_to(str(target_dir))
+
+    def build_multiple_disks_backup(self, dombkup, tmpdir):
+        dombkup.backup_dir = str(tmpdir.mkdir("backup"))
+        dombkup.add_disks("vdb")
+
+        return transform_dombackup_to_dom_complete_backup(dombkup)
+
+    def test_restore_to_progress(
+        self, get_uncompressed_complete_backup, tmpdir, mocker, caplog
+    ):
+        backup = get_uncompressed_complete_backup
+        restore_disk_to = backup.restore_disk_to
+
+        def slow_restore_disk_to(*args, **kwargs):
+            time.sleep(0.2)
+            return restore_disk_to(*args, **kwargs)
+
+        mocker.patch.object(backup, "restore_disk_to", side_effect=slow_restore_disk_to)
+        with caplog.at_level(logging.INFO, logger="virt_backup"):
+            backup.restore_to(str(tmpdir.mkdir("extract")), progress_interval=0.05)
+
+        for disk in backup.disks:
+            assert "Restoring disk {}".format(disk) in caplog.text
+            assert "Disk {} restored".format(disk) in caplog.text
+
     def test_restore_disk_to_dir(self, get_uncompressed_complete_backup, tmpdir):
         backup = get_uncompressed_complete_backup
         src_img = backup.get_complete_path_of(backup.disks["vda"])
@@ -214,3 +280,174 @@ class TestDomCompleteBackup:
         backup.delete()
 
         assert not os.path.exists(backup.backup_dir)
+
+    def test_record(self, get_uncompressed_dombackup, tmpdir):
+        dombkup = get_uncompressed_dombackup
+        dombkup.backup_dir = str(tmpdir)
+        definition = build_complete_backup_files_from_domainbackup(
+            dombkup, arrow.get(2016, 8, 15, 17, 10)
+        )
+        definition_path = str(tmpdir.join("{}.json".format(definition["name"])))
+        with open(definition_path, "w") as f:
+            json.dump(definition, f)
+
+        record = build_dom_complete_backup_record(
+            summarize_definition(definition), str(tmpdir), definition_path
+        )
+        assert record.date == arrow.get(2016, 8, 15, 17, 10)
+        assert record.backup_mode == "full"
+        assert record._backup is None
+
+        assert record.disks == definition["disks"]
+        assert isinstance(record.get_backup(), DomCompleteBackup)
+        vda_path = record.get_complete_path_of(record.disks["vda"])
+        assert os.path.exists(vda_path)
+
+        record.delete()
+        assert not os.path.exists(vda_path)
+        assert not os.path.exists(definition_path)
+
+    def test_delete_chunkstore(self, get_uncompressed_dombackup, tmpdir):
+        dombkup = get_uncompressed_dombackup
+        dombkup.backup_dir = str(tmpdir)
+        dombkup.packager = "chunkstore"
+        backup = transform_dombackup_to_dom_complete_backup(dombkup)
+        packager = backup._get_write_packager()
+        with packager:
+            assert packager.list()
+
+        backup.delete()
+
+        with packager:
+            assert not packager.list()
+        assert not os.path.exists(packager.chunks_path)
+
+    def test_restore_chain_disk_to(self, build_mock_domain, tmpdir, mocker):
+        dom = build_mock_domain
+        dom.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write("vda content")
+        dombkup = build_dombackup(
+            dom=dom,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            backup_mode="incremental",
+        )
+        dates = [arrow.get(2016, 8, 15, 17, 10, i) for i in range(3)]
+        mocker.patch("arrow.now", side_effect=dates)
+        for _ in dates:
+            dombkup.start()
+
+        backups = [
+            build_dom_complete_backup_from_def(
+                json.loads(open(dombkup._get_json_definition_path(d)).read()),
+                dombkup.backup_dir,
+            )
+            for d in dates
+        ]
+        backup = backups[-1]
+        assert [b.name for b in backup.get_backing_chain()] == [b.name for b in backups]
+
+        rebase = mocker.patch.object(DomCompleteBackup, "_qemu_img_rebase")
+        convert = mocker.patch.object(DomCompleteBackup, "_qemu_img_convert")
+        target = str(tmpdir.join("vda.img"))
+        assert backup.restore_disk_to("vda", target) == target
+
+        images = [c[0][0] for c in rebase.call_args_list]
+        backing_images = [c[0][1] for c in rebase.call_args_list]
+        assert [os.path.basename(i) for i in images] == [
+            b.disks["vda"] for b in backups[1:]
+        ]
+        assert [os.path.basename(i) for i in backing_images] == [
+            b.disks["vda"] for b in backups[:-1]
+        ]
+        convert.assert_called_once_with(images[-1], target, "qcow2")
+        # Temporary images are removed.
+        assert not [f for f in os.listdir(str(tmpdir)) if f.startswith(".")]
+
+    def test_restore_chain_disk_to_missing_parent(
+        self, get_uncompressed_complete_backup, tmpdir
+    ):
+        backup = get_uncompressed_complete_backup
+        backup.checkpoint = "virt-backup-test"
+        backup.parent = "unexisting"
+
+        with pytest.raises(ParentBackupNotFoundError):
+            backup.restore_disk_to("vda", str(tmpdir.join("vda.img")))
+
+    @pytest.mark.parametrize("packager", ("tar", "directory", "zstd", "chunkstore"))
+    def test_restore_delta_disk_to(self, build_mock_domain, tmpdir, mocker, packager):
+        dom = build_mock_domain
+        dom.set_storage_basedir(str(tmpdir))
+        disk = tmpdir.join("test-disk-1.qcow2")
+        disk.write_binary(os.urandom(2**20))
+        dombkup = build_dombackup(
+            dom=dom,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager=packager,
+            backup_mode="delta",
+        )
+        mocker.patch.object(dombkup, "_get_ext_snapshot_helper")
+        dates = [arrow.get(2016, 8, 15, 17, 10, i) for i in range(2)]
+        for date in dates:
+            dombkup._get_ext_snapshot_helper.return_value.start.return_value = {
+                "date": date,
+                "disks": {"vda": {"snapshot": "snapshot", "type": "qcow2"}},
+            }
+            dombkup.start()
+            with disk.open("ab") as f:
+                f.write(b"new data")
+        expected = disk.read_binary()[: -len(b"new data")]
+
+        backup = build_dom_complete_backup_from_def(
+            json.loads(open(dombkup._get_json_definition_path(dates[-1])).read()),
+            dombkup.backup_dir,
+        )
+        assert backup.backup_mode == "delta"
+        target = backup.restore_disk_to("vda", str(tmpdir.mkdir("restore")) + "/")
+
+        assert target.endswith(".qcow2")
+        with open(target, "rb") as f:
+            assert f.read() == expected
+        assert os.listdir(str(tmpdir.join("restore"))) == [os.path.basename(target)]
+
+        # The merged image is removed if the delta cannot be restored.
+        mocker.patch.object(
+            backup, "_restore_with_packager", side_effect=Exception("delta error")
+        )
+        with pytest.raises(Exception, match="delta error"):
+            backup.restore_disk_to("vda", str(tmpdir.mkdir("failed")) + "/")
+        assert not tmpdir.join("failed").listdir()
+
+    def test_restore_pull_disk_to(self, build_mock_domain, tmpdir, mocker):
+        dom = build_mock_domain
+        dom.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write("vda content")
+        dombkup = build_dombackup(
+            dom=dom,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            backup_engine="pull",
+        )
+        date = arrow.get(2016, 8, 15, 17, 10, 0)
+        mocker.patch("arrow.now", return_value=date)
+        dombkup.start()
+
+        backup = build_dom_complete_backup_from_def(
+            json.loads(open(dombkup._get_json_definition_path(date)).read()),
+            dombkup.backup_dir,
+        )
+        assert backup.backup_engine == "pull"
+
+        convert = mocker.patch.object(DomCompleteBackup, "_qemu_img_convert")
+        target = backup.restore_disk_to("vda", str(tmpdir.mkdir("restore")) + "/")
+
+        # The raw export is converted back to the format of the disk.
+        assert target.endswith(".qcow2")
+        image = convert.call_args[0][0]
+        assert os.path.basename(image) == backup.disks["vda"]
+        convert.assert_called_once_with(image, target, "qcow2", source_format="raw")
+        # Temporary images are removed.
+        assert not os.listdir(str(tmpdir.join("restore")))
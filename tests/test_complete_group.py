@@ -4,9 +4,16 @@ import os
 import pytest
 
 from virt_backup.groups import CompleteBackupGroup, complete_groups_from_dict
-from virt_backup.groups.complete import list_backups_by_domain
+from virt_backup.groups.deletion import DeletionPool
+from virt_backup.catalog import CATALOG_FILENAME
+from virt_backup.groups.complete import (
+    list_backup_summaries_by_domain,
+    list_backups_by_domain,
+)
 from virt_backup.backups import DomBackup, DomExtSnapshotCallbackRegistrer
-from virt_backup.exceptions import BackupNotFoundError
+from virt_backup.exceptions import BackupNotFoundError, CleanFailureInGroupError
+
+from helper.virt_backup import build_dombackup
 
 
 class TestCompleteBackupGroup:
@@ -21,6 +28,26 @@ class TestCompleteBackupGroup:
         for dom in group.backups:
             assert len(group.backups[dom]) == len(backups_def[dom])
 
+    def test_scan_backup_dir_records(self, build_backup_directory):
+        backup_dir = str(build_backup_directory["backup_dir"])
+
+        group = CompleteBackupGroup(name="test", backup_dir=backup_dir, hosts=("a",))
+        group.scan_backup_dir()
+
+        backups = group.backups["a"]
+        assert [b.date for b in backups] == sorted(
+            build_backup_directory["backup_dates"]
+        )
+        for backup in backups:
+            assert backup.name and backup.parent is None
+            assert backup._backup is None
+            assert not hasattr(backup, "__dict__")
+
+        backup = backups[0]
+        assert backup.dom_xml
+        assert backup._backup is not None
+        assert backup.disks == backup.get_backup().disks
+
     def test_scan_backup_dir_without_host(self, build_backup_directory):
         backup_dir = str(build_backup_directory["backup_dir"])
 
@@ -110,6 +137,26 @@ class TestCompleteBackupGroup:
         nb_remaining_backups = sum(len(b) for b in group.backups.values())
         assert len(cleaned) == nb_initial_backups - nb_remaining_backups
 
+    def test_clean_failure(self, build_backup_directory, mocker):
+        backup_dir = str(build_backup_directory["backup_dir"])
+        group = CompleteBackupGroup(name="test", backup_dir=backup_dir, hosts=["a"])
+        group.scan_backup_dir()
+        plan = group.plan_clean(hourly=2, daily=3, weekly=1, monthly=1, yearly=2)
+        failing = plan.delete["a"][0]
+        mocker.patch.object(failing.get_backup(), "delete", side_effect=OSError("err"))
+
+        with DeletionPool(threads=2) as pool:
+            with pytest.raises(CleanFailureInGroupError) as e:
+                group.clean(plan=plan, deletion_pool=pool)
+
+        assert e.value.exceptions.keys() == {failing}
+        assert len(e.value.removed_backups) == len(plan.delete["a"]) - 1
+        assert failing in group.backups["a"]
+        assert len(group.backups["a"]) == len(plan.keep["a"]) + 1
+        assert [b.timestamp for b in group.backups["a"]] == sorted(
+            b.timestamp for b in group.backups["a"]
+        )
+
     def test_clean_unset_period(self, build_backup_directory):
         """
         Test if cleaning works if some periods are not set.
@@ -139,6 +186,33 @@ class TestCompleteBackupGroup:
             dates = sorted(b.date for b in backups)
             assert dates == expected_dates
 
+    def test_clean_keep_parents(self, build_mock_domain, tmpdir, mocker):
+        dom = build_mock_domain
+        dom.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write("vda content")
+        backup_dir = tmpdir.mkdir("backups")
+        dombkup = build_dombackup(
+            dom=dom,
+            dev_disks=("vda",),
+            backup_dir=str(backup_dir.join(dom.name())),
+            packager="directory",
+            backup_mode="incremental",
+        )
+        dates = [arrow.get(2016, 8, 15, 15 + i, 10, 0) for i in range(3)]
+        mocker.patch("arrow.now", side_effect=dates)
+        for _ in dates:
+            dombkup.start()
+
+        group = CompleteBackupGroup(
+            name="test", backup_dir=str(backup_dir), hosts=["r:.*"]
+        )
+        group.scan_backup_dir()
+        # Only keep the last backup, which needs the 2 others to be restored.
+        cleaned = group.clean(hourly=1, daily=0, weekly=0, monthly=0, yearly=0)
+
+        assert not cleaned
+        assert len(group.backups[dom.name()]) == 3
+
     def test_clean_broken(
         self, build_backup_directory, build_mock_domain, build_mock_libvirtconn, mocker
     ):
@@ -252,3 +326,30 @@ def test_list_backups_by_domain(build_backup_directory):
         assert sorted(expected_backups(domain_id, domain_name)) == sorted(
             backups[domain_name]
         )
+
+
+def test_list_backup_summaries_by_domain(build_backup_directory):
+    backup_dir = str(build_backup_directory["backup_dir"])
+    backups = list_backups_by_domain(backup_dir)
+
+    summaries = list_backup_summaries_by_domain(backup_dir)
+    assert sorted(summaries.keys()) == sorted(backups.keys())
+    for domain_name, domain_backups in backups.items():
+        expected = sorted(
+            (path, definition["name"], arrow.get(definition["date"]).int_timestamp)
+            for path, definition in domain_backups
+        )
+        assert expected == sorted(
+            (path, s["name"], s["date"]) for path, s in summaries[domain_name]
+        )
+
+
+def test_list_backup_summaries_by_domain_without_catalog(build_backup_directory):
+    backup_dir = build_backup_directory["backup_dir"]
+    backup_dir.join(CATALOG_FILENAME).write("not a database")
+
+    summaries = list_backup_summaries_by_domain(str(backup_dir))
+    assert sorted(summaries.keys()) == sorted(build_backup_directory["domain_names"])
+    nb_backups = len(tuple(build_backup_directory["backup_dates"]))
+    for domain_summaries in summaries.values():
+        assert len(domain_summaries) == nb_backups
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from virt_backup.groups.deletion import DeletionPool
+
+
+class TestDeletionPool:
+    def run_tasks(self, pool, paths):
+        running = {path: 0 for path in set(paths)}
+        max_running = dict(running)
+        lock = threading.Lock()
+
+        def task(path):
+            with lock:
+                running[path] += 1
+                max_running[path] = max(max_running[path], running[path])
+            time.sleep(0.02)
+            with lock:
+                running[path] -= 1
+            return path
+
+        with pool:
+            futures = [pool.submit(path, task, path) for path in paths]
+            assert [f.result() for f in futures] == list(paths)
+
+        return max_running
+
+    def test_threads_per_device(self, tmpdir):
+        path = str(tmpdir)
+        max_running = self.run_tasks(
+            DeletionPool(threads=4, threads_per_device=2), [path] * 8
+        )
+
+        assert max_running[path] == 2
+
+    def test_unlimited_per_device(self, tmpdir):
+        path = str(tmpdir)
+        max_running = self.run_tasks(
+            DeletionPool(threads=4, threads_per_device=None), [path] * 8
+        )
+
+        assert max_running[path] == 4
+
+    def test_not_started(self, tmpdir):
+        with pytest.raises(RuntimeError):
+            DeletionPool().submit(str(tmpdir), lambda: None)
@@ -0,0 +1,170 @@
+import io
+import os
+import threading
+
+import pytest
+
+from virt_backup.backups.delta import (
+    HASH_SIZE,
+    DeltaImage,
+    DeltaMergeTarget,
+    HashingImage,
+    ImagePipe,
+    hash_batch,
+    iter_hashed_batches,
+)
+from virt_backup.exceptions import CancelledError, DeltaCorruptedError
+
+BLOCK_SIZE = 2**12
+
+
+def hash_file(data):
+    return b"".join(
+        h for _, _, h in iter_hashed_batches(io.BytesIO(data), BLOCK_SIZE, threads=2)
+    )
+
+
+def build_delta(tmpdir, base, data):
+    src = tmpdir.join("img")
+    src.write_binary(data)
+    image = DeltaImage(str(src), hash_file(base), BLOCK_SIZE, threads=2)
+    with image.open() as f:
+        delta = f.read()
+        assert len(delta) == f.size
+
+    return delta, image.changed_blocks
+
+
+def merge(tmpdir, base, delta):
+    """
+    Write base in a DeltaMergeTarget as a SparseWriter would: its zero blocks
+    are seeked over
+    """
+    target = tmpdir.join("merged")
+    with DeltaMergeTarget(str(target), io.BytesIO(delta)).open() as f:
+        for offset in range(0, len(base), BLOCK_SIZE * 3):
+            chunk = base[offset : offset + BLOCK_SIZE * 3]
+            if any(chunk):
+                f.seek(offset)
+                f.write(chunk)
+        f.truncate(len(base))
+
+    return target.read_binary()
+
+
+def test_iter_hashed_batches():
+    data = os.urandom(BLOCK_SIZE * 1000 + 12)
+    batches = list(iter_hashed_batches(io.BytesIO(data), BLOCK_SIZE, threads=2))
+
+    assert b"".join(d for _, d, _ in batches) == data
+    assert [o for o, _, _ in batches] == [
+        i * len(batches[0][1]) for i in range(len(batches))
+    ]
+    hashes = b"".join(h for _, _, h in batches)
+    assert len(hashes) == 1001 * HASH_SIZE
+    assert hashes == hash_batch(data, BLOCK_SIZE)
+
+
+def test_iter_hashed_batches_cancelled():
+    stop_event = threading.Event()
+    stop_event.set()
+
+    with pytest.raises(CancelledError):
+        list(iter_hashed_batches(io.BytesIO(b"data"), stop_event=stop_event))
+
+
+def test_hashing_image(tmpdir):
+    data = bytearray(os.urandom(BLOCK_SIZE * 600 + 12))
+    # Hole skipped by the reads, hashed as zeros.
+    hole = slice(BLOCK_SIZE * 2 + 5, BLOCK_SIZE * 520)
+    data[hole] = bytes(hole.stop - hole.start)
+    src = tmpdir.join("img")
+    src.write_binary(data)
+
+    hashes = io.BytesIO()
+    image = HashingImage(str(src), hashes, BLOCK_SIZE, threads=2)
+    with image.open() as f:
+        assert f.size == len(data)
+        f.read(hole.start)
+        f.seek(hole.stop)
+        f.read()
+    assert image.finish()
+
+    assert hashes.getvalue() == hash_file(bytes(data))
+
+
+def test_hashing_image_unordered(tmpdir):
+    src = tmpdir.join("img")
+    src.write_binary(os.urandom(BLOCK_SIZE * 4))
+
+    image = HashingImage(str(src), io.BytesIO(), BLOCK_SIZE, threads=2)
+    with image.open() as f:
+        f.seek(BLOCK_SIZE)
+        f.read()
+        f.seek(0)
+        f.read(BLOCK_SIZE)
+
+    assert not image.finish()
+
+
+@pytest.mark.parametrize(
+    "new_size", (BLOCK_SIZE * 64, BLOCK_SIZE * 80 + 3, BLOCK_SIZE * 40 + 7)
+)
+def test_delta_merge(tmpdir, new_size):
+    base = bytearray(os.urandom(BLOCK_SIZE * 64))
+    base[BLOCK_SIZE * 10 : BLOCK_SIZE * 20] = bytes(BLOCK_SIZE * 10)
+    data = bytearray(base[:new_size].ljust(new_size, b"\1"))
+    data[BLOCK_SIZE * 3 + 5 : BLOCK_SIZE * 3 + 10] = b"12345"
+    data[BLOCK_SIZE * 12 + 5 : BLOCK_SIZE * 12 + 10] = b"12345"
+    data[BLOCK_SIZE * 30 : BLOCK_SIZE * 31] = bytes(BLOCK_SIZE)
+    data[-1:] = b"\2"
+
+    delta, changed_blocks = build_delta(tmpdir, bytes(base), bytes(data))
+    assert changed_blocks < len(data) // BLOCK_SIZE
+
+    assert merge(tmpdir, bytes(base), delta) == data
+
+
+def test_delta_merge_corrupted(tmpdir):
+    base = os.urandom(BLOCK_SIZE * 4)
+    delta, _ = build_delta(tmpdir, base, os.urandom(BLOCK_SIZE * 4))
+
+    with pytest.raises(DeltaCorruptedError):
+        merge(tmpdir, base, delta[:-1])
+
+
+def test_image_pipe():
+    pipe = ImagePipe("img", depth=2)
+    data = os.urandom(2**16)
+
+    def write():
+        with pipe.open() as f:
+            f.write(data[:100])
+            f.seek(200)
+            f.write(data[200:])
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    read = b"".join(iter(lambda: pipe.read(1000), b""))
+    thread.join()
+
+    assert read == data[:100] + bytes(100) + data[200:]
+
+
+def test_image_pipe_abort():
+    pipe = ImagePipe("img")
+    pipe.open().write(b"data")
+    pipe.abort(ValueError("restore error"))
+
+    assert pipe.read(4) == b"data"
+    with pytest.raises(ValueError):
+        pipe.read(4)
+
+
+def test_image_pipe_closed():
+    pipe = ImagePipe("img", depth=1)
+    pipe.close()
+
+    with pytest.raises(CancelledError):
+        with pipe.open() as f:
+            f.write(b"data")
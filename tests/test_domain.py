@@ -1,6 +1,7 @@
 import pytest
 
 from virt_backup.domains import (
+    DomainXMLCache,
     search_domains_regex,
     get_domain_disks_of,
     get_domain_incompatible_disks_of,
@@ -30,6 +31,31 @@ def test_get_domain_disks_of_disk_not_found(build_mock_domain):
         get_domain_disks_of(domain.XMLDesc(), "vda", "vdc")
 
 
+def test_domain_xml_cache(build_mock_domain, mocker):
+    domain = build_mock_domain
+    xml_desc = mocker.spy(domain, "XMLDesc")
+    cache = DomainXMLCache(domain)
+
+    assert cache.get_xml() == domain.XMLDesc()
+    parsed = cache.get_parsed()
+    assert parsed.xpath("name")[0].text == domain.name()
+    assert cache.get_parsed() is parsed
+    assert (cache.misses, cache.hits) == (1, 2)
+    assert xml_desc.call_count == 2
+
+
+def test_domain_xml_cache_invalidate(build_mock_domain):
+    domain = build_mock_domain
+    cache = DomainXMLCache(domain)
+    cache.get_parsed()
+
+    domain.set_name("renamed")
+    cache.invalidate()
+
+    assert cache.get_parsed().xpath("name")[0].text == "renamed"
+    assert cache.misses == 2
+
+
 def test_search_domains_regex(build_mock_libvirtconn):
     conn = build_mock_libvirtconn
     domain_names = ("dom1", "dom2", "dom3", "test")
@@ -0,0 +1,69 @@
+import os
+import threading
+import pytest
+
+from virt_backup.backups.packagers import fastcopy
+from virt_backup.backups.packagers.fastcopy import copy_fileobj
+from virt_backup.exceptions import CancelledError
+
+
+@pytest.fixture()
+def src_file(tmpdir):
+    path = str(tmpdir.join("src"))
+    with open(path, "wb") as f:
+        f.truncate(8 * 2**20)
+        f.seek(2**20)
+        f.write(os.urandom(3 * 2**20))
+    return path
+
+
+def copy(src, dst, **kwargs):
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        return copy_fileobj(fsrc, fdst, **kwargs)
+
+
+def assert_same_content(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "rb") as fdst:
+        assert fsrc.read() == fdst.read()
+
+
+def test_copy_fileobj(tmpdir, src_file):
+    dst = str(tmpdir.join("dst"))
+    copy(src_file, dst, range_size=2**20)
+
+    assert_same_content(src_file, dst)
+
+
+@pytest.mark.parametrize(
+    "unsupported,expected_method",
+    (
+        (("FICLONE",), "copy_file_range"),
+        (("FICLONE", "_copy_file_range"), "sendfile"),
+        (("FICLONE", "_copy_file_range", "_sendfile"), "buffered"),
+    ),
+)
+def test_copy_fileobj_fallback(
+    tmpdir, src_file, monkeypatch, unsupported, expected_method
+):
+    def unsupported_copy(*args):
+        raise fastcopy._CopyMethodUnsupported()
+
+    for method in unsupported:
+        if method == "FICLONE":
+            # An invalid ioctl request makes the reflink fail.
+            monkeypatch.setattr(fastcopy, "FICLONE", 0)
+        else:
+            monkeypatch.setattr(fastcopy, method, unsupported_copy)
+
+    dst = str(tmpdir.join("dst"))
+    assert copy(src_file, dst) == expected_method
+    assert_same_content(src_file, dst)
+
+
+def test_copy_fileobj_cancelled(tmpdir, src_file, monkeypatch):
+    monkeypatch.setattr(fastcopy, "FICLONE", 0)
+    stop_event = threading.Event()
+    stop_event.set()
+
+    with pytest.raises(CancelledError):
+        copy(src_file, str(tmpdir.join("dst")), stop_event=stop_event)
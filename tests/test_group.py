@@ -1,3 +1,4 @@
+import arrow
 import os
 import pytest
 
@@ -8,6 +9,7 @@ from virt_backup.groups.pattern import (
 )
 from virt_backup.backups import DomBackup, DomExtSnapshotCallbackRegistrer
 from virt_backup.exceptions import BackupsFailureInGroupError
+from virt_backup.throttle import Throttle
 
 from helper.virt_backup import MockDomain, build_backup_group, build_dombackup
 
@@ -42,6 +44,42 @@ class TestBackupGroup:
 
         assert backup_group.backups[0].quiesce
 
+    def test_add_domain_disk_threads(self, build_mock_domain, build_mock_libvirtconn):
+        dom = build_mock_domain
+        backup_group = build_backup_group(build_mock_libvirtconn)
+        backup_group.default_bak_param["disk_threads"] = 2
+
+        backup_group.add_domain(dom, disk_threads=4)
+
+        assert backup_group.backups[0].disk_threads == 4
+
+    def test_add_domain_bandwidth_limit(
+        self, build_mock_domain, build_mock_libvirtconn
+    ):
+        dom = build_mock_domain
+        total = Throttle(name="total")
+        backup_group = build_backup_group(
+            build_mock_libvirtconn, bandwidth_limit="100M", throttle=total
+        )
+
+        backup_group.add_domain(dom, bandwidth_limit="10M")
+
+        throttle = backup_group.backups[0].throttle
+        assert throttle.rate == 10 * 2**20
+        assert throttle.parent is backup_group.throttle
+        assert backup_group.throttle.rate == 100 * 2**20
+        assert backup_group.throttle.parent is total
+
+    def test_add_domain_without_bandwidth_limit(
+        self, build_mock_domain, build_mock_libvirtconn
+    ):
+        backup_group = build_backup_group(build_mock_libvirtconn)
+
+        backup_group.add_domain(build_mock_domain)
+
+        assert backup_group.throttle is None
+        assert backup_group.backups[0].throttle is None
+
     def test_add_domain_quiesce_default(
         self, build_mock_domain, build_mock_libvirtconn
     ):
@@ -120,6 +158,38 @@ class TestBackupGroup:
         assert len(backup_group.backups) == 1
         assert len(backup_group.backups[0].disks.keys()) == 2
 
+    def test_add_dombackup_dedup_limits(self, build_mock_domain, get_backup_group):
+        """
+        Merged backups should keep the strictest bandwidth limits
+        """
+        dom = build_mock_domain
+        backup_group = get_backup_group
+        group_throttle = Throttle("10M")
+
+        backup_group.add_dombackup(
+            build_dombackup(
+                dom,
+                dev_disks=("vda",),
+                throttle=group_throttle,
+                commit_bandwidth="50M",
+            )
+        )
+        backup_group.add_dombackup(
+            build_dombackup(
+                dom,
+                dev_disks=("vdb",),
+                throttle=Throttle("1M"),
+                commit_bandwidth="100M",
+                commit_latency=20,
+                buffer_size="4M",
+            )
+        )
+        (backup,) = backup_group.backups
+        assert backup.throttle.rate == 2**20
+        assert backup.commit_bandwidth == 50 * 2**20
+        assert backup.commit_latency == 20
+        assert backup.buffer_size == 4 * 2**20
+
     def test_search(self, build_mock_domain, get_backup_group):
         dom = build_mock_domain
         backup_group = get_backup_group
@@ -192,6 +262,50 @@ class TestBackupGroup:
         for b in backup_group.backups:
             assert b.start.called
 
+    def test_start_multithread_longest_first(self, build_mock_libvirtconn, mocker):
+        conn = build_mock_libvirtconn
+        backup_group = build_backup_group(
+            conn,
+            domlst=(
+                MockDomain(_conn=conn, name="short", id=1),
+                MockDomain(_conn=conn, name="long", id=2),
+            ),
+        )
+        started = []
+        for b in backup_group.backups:
+            b.start = mocker.Mock(side_effect=lambda b=b: started.append(b.dom.name()))
+        durations = {"short": 10, "long": 1000}
+        mocker.patch(
+            "virt_backup.groups.scheduling.predict_durations",
+            side_effect=lambda backups: {b: durations[b.dom.name()] for b in backups},
+        )
+
+        backup_group.start_multithread(1)
+
+        assert started == ["long", "short"]
+
+    def test_start_deadline(self, build_mock_libvirtconn, mocker):
+        conn = build_mock_libvirtconn
+        backup_group = build_backup_group(
+            conn,
+            domlst=(
+                MockDomain(_conn=conn, name="short", id=1),
+                MockDomain(_conn=conn, name="long", id=2),
+            ),
+        )
+        for b in backup_group.backups:
+            b.start = mocker.stub()
+        durations = {"short": 10, "long": 1000}
+        mocker.patch(
+            "virt_backup.groups.scheduling.predict_durations",
+            side_effect=lambda backups: {b: durations[b.dom.name()] for b in backups},
+        )
+
+        completed = backup_group.start(deadline=arrow.now().shift(minutes=1))
+
+        assert list(completed) == ["short"]
+        assert [b.dom.name() for b in backup_group.deferred_backups] == ["long"]
+
     def test_start_multithead_with_err(self, build_mock_libvirtconn, mocker):
         conn = build_mock_libvirtconn
         backup_group = build_backup_group(
@@ -425,6 +539,117 @@ def test_groups_from_sanitize_dict_all_config_group_param(
         assert prop not in group.default_bak_param
 
 
+def test_groups_from_dict_bandwidth_limit(build_mock_libvirtconn_filled):
+    conn = build_mock_libvirtconn_filled
+    callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
+    groups_config = {
+        "test": {
+            "target": "/mnt/test",
+            "bandwidth_limit": "100M",
+            "hosts": [{"host": "matching", "bandwidth_limit": "10M"}, "matching2"],
+        },
+    }
+    total = Throttle(name="total")
+    group = next(
+        iter(groups_from_dict(groups_config, conn, callbacks_registrer, total))
+    )
+
+    assert "bandwidth_limit" not in group.default_bak_param
+    assert group.throttle.rate == 100 * 2**20
+    assert group.throttle.parent is total
+    throttles = {b.dom.name(): b.throttle for b in group.backups}
+    assert throttles["matching"].rate == 10 * 2**20
+    assert throttles["matching"].parent is group.throttle
+    assert throttles["matching2"] is group.throttle
+
+
+def test_groups_from_dict_io_options(build_mock_libvirtconn_filled):
+    conn = build_mock_libvirtconn_filled
+    callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
+    groups_config = {
+        "test": {
+            "target": "/mnt/test",
+            "io_mode": "nocache",
+            "buffer_size": "4M",
+            "hosts": ["matching"],
+        },
+    }
+    group = next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+    backup = group.backups[0]
+    assert backup.io_mode == "nocache"
+    assert backup.buffer_size == 4 * 2**20
+    packager_kwargs = backup._get_packager_kwargs("test")
+    assert packager_kwargs["io_mode"] == "nocache"
+    assert packager_kwargs["buffer_size"] == 4 * 2**20
+
+    groups_config["test"]["io_mode"] = "fastest"
+    with pytest.raises(ValueError):
+        next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+
+def test_groups_from_dict_commit_options(build_mock_libvirtconn_filled):
+    conn = build_mock_libvirtconn_filled
+    callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
+    groups_config = {
+        "test": {
+            "target": "/mnt/test",
+            "commit_bandwidth": "100M",
+            "commit_latency": 20,
+            "hosts": ["matching"],
+        },
+    }
+    group = next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+    backup = group.backups[0]
+    controller = backup._get_ext_snapshot_helper().commit_controller
+    assert controller.max_bandwidth == 100 * 2**20
+    assert controller.latency_target == 0.02
+
+    groups_config["test"].pop("commit_bandwidth")
+    groups_config["test"].pop("commit_latency")
+    group = next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+    assert group.backups[0]._get_ext_snapshot_helper().commit_controller is None
+
+
+def test_groups_from_dict_priority(build_mock_libvirtconn_filled):
+    conn = build_mock_libvirtconn_filled
+    callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
+    groups_config = {
+        "test": {
+            "target": "/mnt/test",
+            "priority": 1,
+            "hosts": [{"host": "a", "priority": 2}, "b"],
+        },
+    }
+    group = next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+    priorities = {b.dom.name(): b.priority for b in group.backups}
+    assert priorities == {"a": 2, "b": 1}
+
+
+def test_groups_from_dict_backup_engine(build_mock_libvirtconn_filled):
+    conn = build_mock_libvirtconn_filled
+    callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
+    groups_config = {
+        "test": {
+            "target": "/mnt/test",
+            "backup_engine": "pull",
+            "nbd_connections": 4,
+            "hosts": ["matching"],
+        },
+    }
+    group = next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+    backup = group.backups[0]
+    assert backup.backup_engine == "pull"
+    assert backup.nbd_connections == 4
+
+    groups_config["test"]["backup_engine"] = "invalid"
+    with pytest.raises(ValueError):
+        next(iter(groups_from_dict(groups_config, conn, callbacks_registrer)))
+
+
 def test_groups_from_dict_multiple_groups(build_mock_libvirtconn_filled):
     """
     Test match_domains_from_config with a str pattern
@@ -0,0 +1,110 @@
+import errno
+import os
+import pytest
+
+from virt_backup.backups.packagers import fastcopy, iomode
+from virt_backup.backups.packagers.iomode import (
+    NoCacheFile,
+    check_io_mode,
+    open_source,
+    open_target,
+)
+
+
+@pytest.fixture()
+def src_file(tmpdir):
+    path = str(tmpdir.join("src"))
+    with open(path, "wb") as f:
+        # Size not aligned on the O_DIRECT alignment.
+        f.write(os.urandom(3 * 2**20 + 1234))
+    return path
+
+
+def read_content(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("io_mode", (None, "buffered", "nocache", "direct"))
+def test_open_source(src_file, io_mode):
+    content = read_content(src_file)
+
+    with open_source(src_file, io_mode) as f:
+        assert f.read(100) == content[:100]
+        f.seek(2**20 + 3)
+        assert f.read(2**20) == content[2**20 + 3 : 2 * 2**20 + 3]
+        assert f.tell() == 2 * 2**20 + 3
+        assert f.read() == content[2 * 2**20 + 3 :]
+
+
+def test_open_source_direct_unsupported(src_file, monkeypatch):
+    os_open = os.open
+
+    def open_without_direct(path, flags, *args):
+        if flags & os.O_DIRECT:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        return os_open(path, flags, *args)
+
+    monkeypatch.setattr(os, "open", open_without_direct)
+    with open_source(src_file, "direct") as f:
+        assert isinstance(f, NoCacheFile)
+        assert f.read() == read_content(src_file)
+
+
+@pytest.mark.parametrize("io_mode", ("buffered", "nocache", "direct"))
+def test_open_target(tmpdir, io_mode):
+    target = str(tmpdir.join("target"))
+    with open_target(target, io_mode) as f:
+        f.write(b"data")
+        f.seek(2**20)
+        f.write(b"end")
+        f.truncate(2 * 2**20)
+
+    assert read_content(target) == b"data" + bytes(2**20 - 4) + b"end" + bytes(
+        2**20 - 3
+    )
+    with pytest.raises(FileExistsError):
+        open_target(target, io_mode)
+
+
+def test_nocache_release(src_file, monkeypatch, mocker):
+    monkeypatch.setattr(iomode, "CACHE_WINDOW", 2**20)
+    fadvise = mocker.spy(os, "posix_fadvise")
+
+    with open_source(src_file, "nocache") as f:
+        while f.read(2**19):
+            pass
+
+    released = [c.args[1:3] for c in fadvise.call_args_list if c.args[3] == 4]
+    assert released == [
+        (0, 2**20),
+        (2**20, 2**20),
+        (2 * 2**20, 2**20),
+        (3 * 2**20, 1234),
+    ]
+
+
+def test_nocache_release_kernel_copy(tmpdir, monkeypatch, mocker):
+    monkeypatch.setattr(fastcopy, "FICLONE", 0)
+    release = mocker.spy(NoCacheFile, "_release")
+
+    src_file = str(tmpdir.join("sparse_src"))
+    with open(src_file, "wb") as f:
+        f.truncate(8 * 2**20)
+        f.seek(2**20)
+        f.write(os.urandom(3 * 2**20))
+
+    dst = str(tmpdir.join("dst"))
+    with open_source(src_file, "nocache") as fsrc, open_target(dst, "nocache") as fdst:
+        assert fastcopy.copy_fileobj(fsrc, fdst) != "buffered"
+        assert fsrc._window == fdst._window == (2**20, 4 * 2**20)
+
+    assert release.call_count == 2
+    assert read_content(dst) == read_content(src_file)
+
+
+def test_check_io_mode():
+    assert check_io_mode(None) == "buffered"
+    assert check_io_mode("direct") == "direct"
+    with pytest.raises(ValueError):
+        check_io_mode("fastest")
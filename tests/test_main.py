@@ -9,11 +9,14 @@ from virt_backup.__main__ import (
     clean_backups,
     build_parser,
     list_groups,
+    get_setup_config,
     get_usable_complete_groups,
 )
-from virt_backup.backups import DomExtSnapshotCallbackRegistrer
+from virt_backup.backups import DomCompleteBackup, DomExtSnapshotCallbackRegistrer
+from virt_backup.catalog import BackupCatalog
 from virt_backup.config import get_config, Config
 from virt_backup.groups import CompleteBackupGroup
+from virt_backup.groups.complete import list_backups_by_domain
 from helper.virt_backup import MockConn, MockDomain
 
 CUR_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -320,6 +323,20 @@ class TestListAll(TestList):
                 assert parsed_backups == len(cgroup.backups.get(parsed_domain, []))
 
 
+class TestReindex(AbstractMainTest):
+    default_parser_args = ("reindex",)
+
+    def test_reindex(self, args_parser, mocked_config, capsys):
+        args = args_parser.parse_args(self.default_parser_args)
+        args.func(args)
+
+        backup_dir = str(self.backups["backup_dir"])
+        catalog = BackupCatalog(backup_dir)
+        assert catalog.exists()
+        assert catalog.list_definitions() == list_backups_by_domain(backup_dir)
+        assert "Backups indexed for group test: 50" in capsys.readouterr().out
+
+
 class TestClean(AbstractMainTest):
     default_parser_args = ("clean",)
 
@@ -327,6 +344,72 @@ class TestClean(AbstractMainTest):
         args = args_parser.parse_args(self.default_parser_args)
         clean_backups(args)
 
+    def test_clean_failure(self, args_parser, mocked_config, capsys, mocker):
+        mocker.patch.object(
+            DomCompleteBackup, "delete", side_effect=OSError("disk error")
+        )
+        args = args_parser.parse_args(self.default_parser_args + ("--no-broken",))
+        with pytest.raises(SystemExit) as e:
+            clean_backups(args)
+
+        assert e.value.code == 2
+        out = capsys.readouterr().out
+        assert "Backups removed for group test: 0" in out
+        assert "disk error" in out
+
+    def test_clean_groups_same_backup_dir(
+        self, args_parser, mocked_config, capsys, mocker
+    ):
+        """
+        Groups sharing a backup directory should not remove the same backups
+        """
+        mocked_config["groups"]["test2"] = dict(mocked_config["groups"]["test"])
+        delete = mocker.spy(DomCompleteBackup, "delete")
+        args = args_parser.parse_args(self.default_parser_args + ("--no-broken",))
+        clean_backups(args)
+
+        deleted = [(c.args[0].dom_name, c.args[0].date) for c in delete.call_args_list]
+        assert deleted
+        assert len(deleted) == len(set(deleted))
+        out = capsys.readouterr().out
+        assert out.index("group test:") < out.index("group test2:")
+        assert "Backups removed for group test2: 0" in out
+
+    def test_clean_dry_run(self, args_parser, mocked_config, capsys):
+        backup_dir = str(self.backups["backup_dir"])
+        backups_def = list_backups_by_domain(backup_dir)
+        args = args_parser.parse_args(self.default_parser_args + ("--dry-run",))
+        clean_backups(args)
+
+        assert list_backups_by_domain(backup_dir) == backups_def
+        out = capsys.readouterr().out
+        assert "Broken backups to remove for group test: 0" in out
+        listed = [l for l in out.splitlines() if l.startswith("\t")]
+        assert listed
+        assert "Backups to remove for group test: {}".format(len(listed)) in out
+
+        args = args_parser.parse_args(self.default_parser_args + ("--no-broken",))
+        clean_backups(args)
+        remaining = sum(len(b) for b in list_backups_by_domain(backup_dir).values())
+        assert remaining == sum(len(b) for b in backups_def.values()) - len(listed)
+
+
+@pytest.mark.parametrize(
+    "deadline,valid", (('"06:00"', True), ("22:30", True), ("6h", False))
+)
+def test_get_setup_config_deadline(tmpdir, deadline, valid):
+    """
+    The deadline should be validated when loading the configuration
+    """
+    config_path = tmpdir.join("config.yml")
+    config_path.write("{}\ndeadline: {}\n".format(open(TESTCONF_PATH).read(), deadline))
+
+    if valid:
+        assert get_setup_config(str(config_path))["deadline"] is not None
+    else:
+        with pytest.raises(SystemExit):
+            get_setup_config(str(config_path))
+
 
 def mock_get_config(monkeypatch):
     config = Config(
@@ -0,0 +1,106 @@
+import os
+import pytest
+
+from virt_backup.backups.nbd import NBDClient, NBDImage
+from virt_backup.exceptions import NBDError
+
+from helper.nbd import NBDServer
+
+
+@pytest.fixture()
+def sparse_image(tmpdir):
+    """
+    Sparse image of 16MB, with 2 data extents
+    """
+    image = tmpdir.join("vda.img")
+    with open(str(image), "wb") as f:
+        f.truncate(16 * 2**20)
+        f.seek(2 * 2**20)
+        f.write(os.urandom(2**20))
+        f.seek(10 * 2**20)
+        f.write(b"data")
+    return image
+
+
+@pytest.fixture()
+def nbd_server(tmpdir, sparse_image):
+    server = NBDServer(str(tmpdir.join("nbd.sock")), {"vda": str(sparse_image)})
+    with server:
+        yield server
+
+
+def test_client_read(nbd_server, sparse_image):
+    content = sparse_image.read_binary()
+    with NBDClient(nbd_server.socket_path, "vda") as client:
+        assert client.size == len(content)
+
+        buf = bytearray(4 * 2**20)
+        client.readinto(buf, 2**20)
+        assert buf == content[2**20 : 5 * 2**20]
+
+
+def test_client_read_simple_replies(tmpdir, sparse_image):
+    content = sparse_image.read_binary()
+    server = NBDServer(
+        str(tmpdir.join("nbd.sock")),
+        {"vda": str(sparse_image)},
+        structured_replies=False,
+    )
+    with server, NBDClient(server.socket_path, "vda") as client:
+        buf = bytearray(2**20)
+        client.readinto(buf, 2 * 2**20)
+        assert buf == content[2 * 2**20 : 3 * 2**20]
+
+        # Without block status, all the export is considered as data.
+        assert client.block_status(0, client.size) == [(0, client.size, 0)]
+
+
+def test_client_unknown_export(nbd_server):
+    with pytest.raises(NBDError):
+        NBDClient(nbd_server.socket_path, "vdb").connect()
+
+
+def test_reader(nbd_server, sparse_image):
+    with NBDImage(nbd_server.socket_path, "vda").open() as reader:
+        assert reader.read() == sparse_image.read_binary()
+        assert reader.read() == b""
+
+        reader.seek(10 * 2**20)
+        assert reader.read(4) == b"data"
+
+
+def test_reader_data_extents(nbd_server, sparse_image):
+    with NBDImage(nbd_server.socket_path, "vda").open() as reader:
+        extents = list(reader.iter_data_extents())
+
+    assert len(extents) == 2
+    assert extents[0] == (2 * 2**20, 2**20)
+    assert extents[1][0] == 10 * 2**20
+
+
+def test_reader_multiple_connections(nbd_server, sparse_image):
+    with NBDImage(nbd_server.socket_path, "vda", connections=4).open() as reader:
+        assert reader.read() == sparse_image.read_binary()
+
+    assert nbd_server.connections == 4
+    assert nbd_server.reads >= 4
+
+
+def test_reader_multiple_connections_unsupported(tmpdir, sparse_image):
+    """
+    Only one connection should be used if the server does not allow more
+    """
+    server = NBDServer(
+        str(tmpdir.join("nbd.sock")), {"vda": str(sparse_image)}, multi_conn=False
+    )
+    with server, NBDImage(server.socket_path, "vda", connections=4).open() as reader:
+        assert reader.read() == sparse_image.read_binary()
+
+    assert server.connections == 1
+
+
+def test_image_str():
+    assert str(NBDImage("/tmp/nbd.sock", "vda")) == (
+        "nbd+unix:///vda?socket=/tmp/nbd.sock"
+    )
+    assert str(NBDImage(("localhost", 10809), "vda")) == "nbd://localhost:10809/vda"
@@ -1,11 +1,22 @@
 from abc import ABC
+import glob
+import json
 import os
 import random
+import tarfile
 import threading
 import pytest
 
-from virt_backup.exceptions import CancelledError, ImageNotFoundError
+from virt_backup.exceptions import (
+    CancelledError,
+    ChunkCorruptedError,
+    ImageNotFoundError,
+)
+from virt_backup.backups.nbd import NBDImage
 from virt_backup.backups.packagers import ReadBackupPackagers, WriteBackupPackagers
+from virt_backup.throttle import Throttle
+
+from helper.nbd import NBDServer
 
 
 @pytest.fixture()
@@ -18,6 +29,25 @@ def new_image(tmpdir, name="test", content=None):
     return image
 
 
+@pytest.fixture()
+def new_sparse_image(tmpdir, name="test_sparse"):
+    """
+    Generate a sparse image of 16MB, with 2 data extents.
+    """
+    image = tmpdir.join(name)
+    with open(str(image), "wb") as f:
+        f.truncate(16 * 2**20)
+        f.seek(2 * 2**20)
+        f.write(os.urandom(2**20))
+        f.seek(10 * 2**20)
+        f.write(b"data")
+    return image
+
+
+def allocated_size(path):
+    return os.stat(str(path)).st_blocks * 512
+
+
 @pytest.fixture()
 def cancel_flag():
     return threading.Event()
@@ -76,6 +106,84 @@ class _BaseTestBackupPackager(ABC):
             with pytest.raises(CancelledError):
                 read_packager.restore(name, str(tmpdir), stop_event=cancel_flag)
 
+    def test_restore_sparse(
+        self, tmpdir, write_packager, read_packager, new_sparse_image
+    ):
+        name = new_sparse_image.basename
+
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+        with read_packager:
+            extract_dir = tmpdir.mkdir("extract")
+            target = read_packager.restore(name, str(extract_dir))
+
+        assert allocated_size(target) < os.path.getsize(target)
+        assert extract_dir.join(name).read_binary() == new_sparse_image.read_binary()
+
+    def test_restore_nbd(self, tmpdir, write_packager, read_packager, new_sparse_image):
+        """
+        An image read from a NBD export should be stored like the exported file,
+        holes included
+        """
+        socket_path = str(tmpdir.join("nbd.sock"))
+        with NBDServer(socket_path, {"vda": str(new_sparse_image)}):
+            with write_packager:
+                write_packager.add(NBDImage(socket_path, "vda", 2), name="vda.raw")
+        with read_packager:
+            extract_dir = tmpdir.mkdir("extract")
+            target = read_packager.restore("vda.raw", str(extract_dir))
+
+        assert allocated_size(target) < os.path.getsize(target)
+        assert extract_dir.join("vda.raw").read_binary() == (
+            new_sparse_image.read_binary()
+        )
+
+    def test_throttle(self, tmpdir, write_packager, read_packager, new_image, mocker):
+        throttle = Throttle()
+        consume = mocker.spy(throttle, "consume")
+        write_packager.throttle = read_packager.throttle = throttle
+
+        with write_packager:
+            write_packager.add(str(new_image))
+        with read_packager:
+            read_packager.restore(new_image.basename, str(tmpdir.mkdir("extract")))
+
+        copied = sum(c.args[0] for c in consume.call_args_list)
+        if "reflink" in write_packager.copy_methods.values():
+            # Nothing copied, so nothing throttled.
+            return
+        assert copied == 2 * new_image.size()
+
+    def test_buffer_size(self, tmpdir, write_packager, read_packager, new_image):
+        write_packager.buffer_size = read_packager.buffer_size = 3 * 2**16
+        assert write_packager._get_buffer_size(str(tmpdir)) == 3 * 2**16
+
+        with write_packager:
+            write_packager.add(str(new_image))
+        with read_packager:
+            target = read_packager.restore(
+                new_image.basename, str(tmpdir.mkdir("extract"))
+            )
+
+        with open(target, "rb") as f:
+            assert f.read() == new_image.read_binary()
+
+    @pytest.mark.parametrize("io_mode", ("nocache", "direct"))
+    def test_io_mode(
+        self, tmpdir, write_packager, read_packager, new_sparse_image, io_mode
+    ):
+        write_packager.io_mode = read_packager.io_mode = io_mode
+        name = new_sparse_image.basename
+
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+        with read_packager:
+            extract_dir = tmpdir.mkdir("extract")
+            target = read_packager.restore(name, str(extract_dir))
+
+        assert allocated_size(target) < os.path.getsize(target)
+        assert extract_dir.join(name).read_binary() == new_sparse_image.read_binary()
+
     def test_remove_package(self, write_packager):
         with write_packager:
             pass
@@ -109,6 +217,26 @@ class TestBackupPackagerDir(_BaseTestBackupPackager):
             write_packager.remove(name)
             assert not write_packager.list()
 
+    def test_add_sparse(self, write_packager, new_sparse_image):
+        with write_packager:
+            target = write_packager.add(str(new_sparse_image))
+
+        assert os.path.getsize(target) == os.path.getsize(str(new_sparse_image))
+        assert allocated_size(target) < os.path.getsize(target)
+        with open(target, "rb") as ftarget:
+            assert ftarget.read() == new_sparse_image.read_binary()
+
+    def test_add_copy_method(self, write_packager, new_image):
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        assert write_packager.copy_methods[new_image.basename] in (
+            "reflink",
+            "copy_file_range",
+            "sendfile",
+            "buffered",
+        )
+
     def test_remove_package_cancelled(self, write_packager, cancel_flag):
         """
         Atomic for the directory package, so cancel it will not fail.
@@ -120,6 +248,153 @@ class TestBackupPackagerDir(_BaseTestBackupPackager):
         assert not os.path.exists(write_packager.complete_path)
 
 
+class TestBackupPackagerChunkStore(_BaseTestBackupPackager):
+    @pytest.fixture()
+    def read_packager(self, tmpdir):
+        return ReadBackupPackagers.chunkstore.value(
+            "test", str(tmpdir.join("packager")), "test_package", chunk_size=2**18
+        )
+
+    @pytest.fixture()
+    def write_packager(self, tmpdir):
+        return WriteBackupPackagers.chunkstore.value(
+            "test", str(tmpdir.join("packager")), "test_package", chunk_size=2**18
+        )
+
+    @pytest.fixture()
+    def random_image(self, tmpdir):
+        image = tmpdir.join("random")
+        image.write_binary(os.urandom(4 * 2**20))
+        return image
+
+    def list_chunks(self, packager):
+        return {
+            os.path.basename(p)
+            for p in glob.glob(os.path.join(packager.chunks_path, "*", "*"))
+        }
+
+    def test_add_dedup(self, tmpdir, write_packager, random_image):
+        other_packager = WriteBackupPackagers.chunkstore.value(
+            "test", write_packager.path, "other_package", chunk_size=2**18
+        )
+        with write_packager:
+            write_packager.add(str(random_image))
+        chunks = self.list_chunks(write_packager)
+
+        # Modify the image in the middle, and shift its end.
+        content = random_image.read_binary()
+        random_image.write_binary(
+            content[: 2 * 2**20] + b"modified" + content[2 * 2**20 :]
+        )
+        with other_packager:
+            other_packager.add(str(random_image))
+        new_chunks = self.list_chunks(write_packager) - chunks
+
+        assert chunks
+        assert 0 < len(new_chunks) <= 2
+
+    def test_add_sparse(self, write_packager, new_sparse_image):
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+
+        stored_size = sum(
+            os.path.getsize(write_packager.chunk_path(c))
+            for c in self.list_chunks(write_packager)
+        )
+        assert stored_size < 2 * 2**20 + 2**18
+
+    def test_restore_corrupted(self, tmpdir, write_packager, read_packager, new_image):
+        with write_packager:
+            write_packager.add(str(new_image))
+        chunk = self.list_chunks(write_packager).pop()
+        with open(write_packager.chunk_path(chunk), "ab") as f:
+            f.write(b"corrupted")
+
+        with read_packager:
+            with pytest.raises(ChunkCorruptedError):
+                read_packager.restore(new_image.basename, str(tmpdir.mkdir("extract")))
+        assert not tmpdir.join("extract", new_image.basename).check()
+
+    def test_remove(self, write_packager, random_image, new_image):
+        other_packager = WriteBackupPackagers.chunkstore.value(
+            "test", write_packager.path, "other_package", chunk_size=2**18
+        )
+        with write_packager:
+            write_packager.add(str(random_image))
+            random_chunks = self.list_chunks(write_packager)
+            write_packager.add(str(new_image))
+        with other_packager:
+            other_packager.add(str(random_image))
+
+        with write_packager:
+            write_packager.remove(new_image.basename)
+            assert write_packager.list() == [random_image.basename]
+        # Chunks only referenced by the removed image are freed when closing.
+        assert self.list_chunks(write_packager) == random_chunks
+
+        with write_packager:
+            write_packager.remove(random_image.basename)
+        # Still referenced by the other package.
+        assert self.list_chunks(write_packager) == random_chunks
+
+        with other_packager:
+            other_packager.remove(random_image.basename)
+        assert not self.list_chunks(other_packager)
+
+    def test_remove_package(self, write_packager, new_image):
+        other_packager = WriteBackupPackagers.chunkstore.value(
+            "test", write_packager.path, "other_package", chunk_size=2**18
+        )
+        with write_packager:
+            write_packager.add(str(new_image))
+        with other_packager:
+            other_packager.add(str(new_image), name="other")
+        chunks = self.list_chunks(write_packager)
+
+        write_packager.remove_package()
+        with write_packager:
+            assert not write_packager.list()
+        assert self.list_chunks(write_packager) == chunks
+
+        other_packager.remove_package()
+        assert not os.path.exists(other_packager.chunks_path)
+
+    def test_remove_package_only_checks_its_chunks(
+        self, mocker, write_packager, random_image, new_image
+    ):
+        other_packager = WriteBackupPackagers.chunkstore.value(
+            "test", write_packager.path, "other_package", chunk_size=2**18
+        )
+        with other_packager:
+            other_packager.add(str(random_image))
+        with write_packager:
+            write_packager.add(str(new_image))
+        # Chunk left by an interrupted backup, only removed by a full garbage
+        # collection.
+        orphan = "0" * 64
+        os.makedirs(os.path.dirname(write_packager.chunk_path(orphan)), exist_ok=True)
+        open(write_packager.chunk_path(orphan), "wb").close()
+        count_references = mocker.spy(write_packager, "_count_references")
+        list_chunks = mocker.spy(write_packager, "_list_chunks")
+
+        write_packager.remove_package()
+
+        assert count_references.call_count == 1
+        assert not list_chunks.called
+        assert orphan in self.list_chunks(write_packager)
+        with other_packager:
+            assert other_packager.collect_garbage() == 1
+        assert orphan not in self.list_chunks(write_packager)
+
+    def test_remove_package_cancelled(self, write_packager, new_image, cancel_flag):
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        cancel_flag.set()
+        with pytest.raises(CancelledError):
+            write_packager.remove_package(cancel_flag)
+
+
 class TestBackupPackagerTar(_BaseTestBackupPackager):
     @pytest.fixture()
     def read_packager(self, tmpdir):
@@ -133,6 +408,29 @@ class TestBackupPackagerTar(_BaseTestBackupPackager):
             "test", str(tmpdir.join("packager")), "test_package.tar"
         )
 
+    def test_add_sparse(self, write_packager, new_sparse_image):
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+
+        with tarfile.open(write_packager.complete_path) as tar:
+            member = tar.getmember(new_sparse_image.basename)
+            assert member.sparse
+            assert member.size == os.path.getsize(str(new_sparse_image))
+        assert os.path.getsize(write_packager.complete_path) < member.size
+
+    def test_add_sparse_then_image(self, write_packager, new_sparse_image, new_image):
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+            tar = write_packager._tarfile
+            assert tar.offset == tar.fileobj.tell()
+            write_packager.add(str(new_image))
+
+        with tarfile.open(write_packager.complete_path) as tar:
+            assert tar.getnames() == [new_sparse_image.basename, new_image.basename]
+            assert tar.extractfile(new_image.basename).read() == (
+                new_image.read_binary()
+            )
+
     def test_remove_package_cancelled(self, write_packager, cancel_flag):
         """
         Atomic for the tar package, so cancel it will not fail.
@@ -143,6 +441,199 @@ class TestBackupPackagerTar(_BaseTestBackupPackager):
         write_packager.remove_package()
         assert not os.path.exists(write_packager.complete_path)
 
+    def test_add_index(self, write_packager, new_image, new_sparse_image):
+        with write_packager:
+            write_packager.add(str(new_image))
+            write_packager.add(str(new_sparse_image))
+
+        with open(write_packager.index_path) as f:
+            index = json.load(f)
+        assert index["archive_size"] == os.path.getsize(write_packager.complete_path)
+        members = {m["name"]: m for m in index["members"]}
+
+        with tarfile.open(write_packager.complete_path) as tar:
+            for tarinfo in tar.getmembers():
+                entry = members[tarinfo.name]
+                assert entry["header_offset"] == tarinfo.offset
+                assert entry["data_offset"] == tarinfo.offset_data
+                assert entry["size"] == tarinfo.size
+        assert members[new_sparse_image.basename]["sparse"]
+
+    def test_list_index(self, write_packager, read_packager, new_image, mocker):
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        open_tar = mocker.spy(read_packager, "_open_tar")
+        with read_packager:
+            assert read_packager.list() == [new_image.basename]
+        assert not open_tar.called
+
+    def test_restore_index(
+        self, tmpdir, write_packager, read_packager, new_image, new_sparse_image, mocker
+    ):
+        with write_packager:
+            write_packager.add(str(new_sparse_image))
+            write_packager.add(str(new_image))
+
+        open_tar = mocker.spy(read_packager, "_open_tar")
+        with read_packager:
+            extract_dir = tmpdir.mkdir("extract")
+            for image in (new_image, new_sparse_image):
+                target = read_packager.restore(image.basename, str(extract_dir))
+                assert open(target, "rb").read() == image.read_binary()
+        assert not open_tar.called
+
+    def test_restore_stale_index(
+        self, tmpdir, write_packager, read_packager, new_image
+    ):
+        with write_packager:
+            write_packager.add(str(new_image))
+        with open(write_packager.index_path, "r+") as f:
+            index = json.load(f)
+            index["archive_size"] += 1
+            f.seek(0)
+            json.dump(index, f)
+
+        with read_packager:
+            assert read_packager._index is None
+            target = read_packager.restore(
+                new_image.basename, str(tmpdir.mkdir("extract"))
+            )
+        assert open(target, "rb").read() == new_image.read_binary()
+
+    def test_remove_package_index(self, write_packager):
+        with write_packager:
+            pass
+        assert os.path.exists(write_packager.index_path)
+        write_packager.remove_package()
+        assert not os.path.exists(write_packager.index_path)
+
+
+class TestBackupPackagerTarGzBlocks(TestBackupPackagerTar):
+    """
+    Each member is compressed in its own blocks, and can be read from its offset.
+    """
+
+    @pytest.fixture()
+    def read_packager(self, tmpdir):
+        return ReadBackupPackagers.tar.value(
+            "test", str(tmpdir.join("packager")), "test_package", compression="gz"
+        )
+
+    @pytest.fixture()
+    def write_packager(self, tmpdir):
+        return WriteBackupPackagers.tar.value(
+            "test",
+            str(tmpdir.join("packager")),
+            "test_package",
+            compression="gz",
+            compression_lvl=1,
+            compression_threads=2,
+            compression_block_size=2**20,
+        )
+
+    def test_add_index(self, write_packager, new_image, new_sparse_image):
+        super().test_add_index(write_packager, new_image, new_sparse_image)
+
+        with open(write_packager.index_path) as f:
+            members = json.load(f)["members"]
+        assert members[0]["block_offset"] == 0
+        assert (
+            0
+            < members[1]["block_offset"]
+            < os.path.getsize(write_packager.complete_path)
+        )
+
+
+class TestBackupPackagerTarParallel(TestBackupPackagerTar):
+    @pytest.fixture()
+    def read_packager(self, tmpdir):
+        return ReadBackupPackagers.tar.value(
+            "test",
+            str(tmpdir.join("packager")),
+            "test_package",
+            compression="xz",
+            compression_threads=2,
+        )
+
+    @pytest.fixture()
+    def write_packager(self, tmpdir):
+        return WriteBackupPackagers.tar.value(
+            "test",
+            str(tmpdir.join("packager")),
+            "test_package",
+            compression="xz",
+            compression_lvl=1,
+            compression_threads=2,
+            compression_block_size=2**20,
+        )
+
+    def test_add_streams(self, write_packager, new_image):
+        from virt_backup.backups.packagers.compressors import read_xz_streams
+
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        with open(write_packager.complete_path, "rb") as f:
+            streams = read_xz_streams(f)
+        assert len(streams) > 5
+        assert streams[0][0] == 0
+        for previous, stream in zip(streams, streams[1:]):
+            assert stream[0] == previous[0] + previous[1]
+            assert stream[2] == previous[2] + previous[3]
+
+        # Archive still readable as a standard tar.xz.
+        with tarfile.open(write_packager.complete_path, "r:xz") as tar:
+            assert tar.extractfile(new_image.basename).read() == (
+                new_image.read_binary()
+            )
+
+    def test_read_streams_bounded(self, write_packager, new_image):
+        """
+        Streams decompressed in advance should be bounded by their size
+        """
+        from virt_backup.backups.packagers.compressors import (
+            ParallelXZReader,
+            read_xz_streams,
+        )
+
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        with open(write_packager.complete_path, "rb") as f:
+            streams = read_xz_streams(f)
+        # Streams of 1MiB, for at most 2MiB decompressed in advance.
+        reader = ParallelXZReader(
+            open(write_packager.complete_path, "rb"),
+            streams,
+            threads=2,
+            block_size=2**19,
+        )
+        with reader, tarfile.open(fileobj=reader, mode="r") as tar:
+            fileobj = tar.extractfile(new_image.basename)
+            data = bytearray()
+            while chunk := fileobj.read(2**18):
+                data += chunk
+                assert len(reader._cache) <= 2
+
+        assert data == new_image.read_binary()
+
+    def test_restore_single_stream(self, tmpdir, read_packager, new_image):
+        """
+        Archives written without compression_threads need to be restored as well.
+        """
+        write_packager = WriteBackupPackagers.tar.value(
+            "test", str(tmpdir.join("packager")), "test_package", compression="xz"
+        )
+        with write_packager:
+            write_packager.add(str(new_image))
+
+        with read_packager:
+            restored = read_packager.restore(
+                new_image.basename, str(tmpdir.join("extract"))
+            )
+        assert open(restored, "rb").read() == new_image.read_binary()
+
 
 @pytest.mark.extra
 class TestBackupPackagerZSTD(_BaseTestBackupPackager):
@@ -188,3 +679,61 @@ class TestBackupPackagerZSTD(_BaseTestBackupPackager):
         cancel_flag.set()
         with pytest.raises(CancelledError):
             write_packager.remove_package(cancel_flag)
+
+
+@pytest.mark.extra
+class TestBackupPackagerZSTDSeekable(TestBackupPackagerZSTD):
+    @pytest.fixture()
+    def read_packager(self, tmpdir):
+        return ReadBackupPackagers.zstd.value(
+            "test", str(tmpdir.join("packager")), "test_package", threads=2
+        )
+
+    @pytest.fixture()
+    def write_packager(self, tmpdir):
+        return WriteBackupPackagers.zstd.value(
+            "test",
+            str(tmpdir.join("packager")),
+            "test_package",
+            threads=2,
+            frame_size=2**20,
+        )
+
+    def test_add_seek_table(self, write_packager, new_image):
+        from virt_backup.backups.packagers.zstd import read_seek_table
+
+        with write_packager:
+            archive = write_packager.add(str(new_image))
+
+        with open(archive, "rb") as f:
+            seek_table = read_seek_table(f)
+        assert len(seek_table) == 5
+        assert sum(frame[3] for frame in seek_table) == new_image.size()
+
+    def test_read(self, write_packager, read_packager, new_image):
+        name = new_image.basename
+        content = new_image.read_binary()
+
+        with write_packager:
+            write_packager.add(str(new_image))
+        with read_packager:
+            for offset, size in ((0, 10), (2**20 - 5, 10), (3 * 2**20 + 7, 2**21)):
+                assert read_packager.read(name, offset, size) == (
+                    content[offset : offset + size]
+                )
+
+    def test_restore_single_frame(self, tmpdir, read_packager, new_image):
+        """
+        Archives written without frame_size need to be restored as well.
+        """
+        name = new_image.basename
+        write_packager = WriteBackupPackagers.zstd.value(
+            "test", str(tmpdir.join("packager")), "test_package"
+        )
+        with write_packager:
+            write_packager.add(str(new_image))
+        with read_packager:
+            extract_dir = tmpdir.mkdir("extract")
+            read_packager.restore(name, str(extract_dir))
+
+        assert extract_dir.join(name).read_binary() == new_image.read_binary()
@@ -1,13 +1,18 @@
 import datetime
 import json
+import os
 import tarfile
+import threading
 
 import arrow
+import libvirt
 import pytest
 
 import virt_backup
 from virt_backup.backups import DomBackup, WriteBackupPackagers
+from virt_backup.backups.delta import BLOCK_SIZE, HASH_SIZE, hash_batch
 from virt_backup.backups.snapshot import DomExtSnapshot, DomExtSnapshotCallbackRegistrer
+from virt_backup.catalog import BackupCatalog
 from helper.virt_backup import MockSnapshot, build_dombackup
 
 
@@ -186,6 +191,10 @@ class TestDomBackup:
         }
         assert dombkup.get_definition() == expected_def
 
+    def test_xml_cache_shared(self, get_dombackup):
+        dombkup = get_dombackup
+        assert dombkup._get_ext_snapshot_helper().xml_cache is dombkup._xml_cache
+
     def test_dump_json_definition(self, build_mock_domain, tmpdir):
         backup_dir = tmpdir.mkdir("json_dump")
         dombkup = build_dombackup(
@@ -337,3 +346,413 @@ class TestDomBackup:
         )
 
         assert not dombackup1.compatible_with(dombackup2)
+
+
+class TestDomBackupIncremental:
+    @pytest.fixture
+    def incremental_dombackup(self, build_mock_domain, tmpdir):
+        build_mock_domain.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write("vda content")
+        return build_dombackup(
+            dom=build_mock_domain,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            backup_mode="incremental",
+        )
+
+    def start_backups(self, dombackup, nb_backups, mocker, first=0):
+        dates = [
+            arrow.get(2016, 8, 15, 17, 10, i) for i in range(first, first + nb_backups)
+        ]
+        mocker.patch("arrow.now", side_effect=dates)
+        definitions = []
+        for date in dates:
+            dombackup.start()
+            with open(dombackup._get_json_definition_path(date)) as f:
+                definitions.append(json.load(f))
+
+        return definitions
+
+    def test_start_full(self, incremental_dombackup, mocker):
+        dombkup = incremental_dombackup
+        (definition,) = self.start_backups(dombkup, 1, mocker)
+
+        assert definition["backup_mode"] == "full"
+        assert "parent" not in definition
+        assert definition["checkpoint"] in dombkup.dom.checkpoints
+        assert "<incremental>" not in dombkup.dom.backup_jobs[0]
+        assert os.path.exists(
+            os.path.join(dombkup.backup_dir, definition["disks"]["vda"])
+        )
+        assert definition["disks"]["vda"].endswith(".qcow2")
+        # Temporary job directory and pending info removed.
+        assert sorted(os.listdir(dombkup.backup_dir)) == sorted(
+            (definition["disks"]["vda"], "{}.json".format(definition["name"]))
+        )
+
+    def test_start_xml_cache(self, incremental_dombackup, mocker):
+        """
+        The domain definition should be fetched once per backup, and shared
+        with the backup job helper
+        """
+        dombkup = incremental_dombackup
+        xml_desc = mocker.spy(dombkup.dom, "XMLDesc")
+        self.start_backups(dombkup, 2, mocker)
+
+        assert xml_desc.call_count == 2
+        assert dombkup._xml_cache.hits > 0
+
+    def test_start_incremental(self, incremental_dombackup, mocker):
+        dombkup = incremental_dombackup
+        full, incremental = self.start_backups(dombkup, 2, mocker)
+
+        assert incremental["backup_mode"] == "incremental"
+        assert incremental["parent"] == full["name"]
+        assert (
+            "<incremental>{}</incremental>".format(full["checkpoint"])
+            in dombkup.dom.backup_jobs[1]
+        )
+        # Only the last checkpoint is kept.
+        assert list(dombkup.dom.checkpoints) == [incremental["checkpoint"]]
+
+    def test_start_catalog(self, incremental_dombackup, tmpdir, mocker):
+        dombkup = incremental_dombackup
+        catalog = BackupCatalog(str(tmpdir))
+        self.start_backups(dombkup, 1, mocker)
+        catalog.list_definitions()
+        (definition,) = self.start_backups(dombkup, 1, mocker, first=1)
+
+        index_domain_dir = mocker.spy(catalog, "_index_domain_dirs")
+        definitions = catalog.list_definitions()[dombkup.dom.name()]
+        assert len(definitions) == 2
+        assert (
+            dombkup._get_json_definition_path(arrow.get(definition["date"])),
+            definition,
+        ) in definitions
+        # The catalog has been kept in sync with the files written by the backup.
+        assert not index_domain_dir.called
+        assert not catalog.list_definitions(pending=True)
+
+    def test_start_full_every(self, incremental_dombackup, mocker):
+        dombkup = incremental_dombackup
+        dombkup.full_every = 2
+        definitions = self.start_backups(dombkup, 3, mocker)
+
+        assert [d["backup_mode"] for d in definitions] == [
+            "full",
+            "incremental",
+            "full",
+        ]
+
+    def test_start_full_if_checkpoint_missing(self, incremental_dombackup, mocker):
+        dombkup = incremental_dombackup
+        mocker.patch.object(
+            dombkup.dom, "checkpointLookupByName", side_effect=libvirt.libvirtError("")
+        )
+        definitions = self.start_backups(dombkup, 2, mocker)
+
+        assert [d["backup_mode"] for d in definitions] == ["full", "full"]
+
+    def test_start_full_if_new_disk(self, incremental_dombackup, tmpdir, mocker):
+        dombkup = incremental_dombackup
+        self.start_backups(dombkup, 1, mocker)
+        dombkup.add_disks("vdb")
+        (definition,) = self.start_backups(dombkup, 1, mocker, first=1)
+
+        assert definition["backup_mode"] == "full"
+
+    def test_clean_aborted(self, incremental_dombackup, mocker):
+        dombkup = incremental_dombackup
+        mocker.patch.object(
+            dombkup, "_get_packager", side_effect=Exception("packager error")
+        )
+        mocker.patch("arrow.now", return_value=arrow.get(2016, 8, 15, 17, 10, 13))
+
+        with pytest.raises(Exception):
+            dombkup.start()
+
+        assert not dombkup.dom.checkpoints
+        assert not os.listdir(dombkup.backup_dir)
+
+
+class TestDomBackupPull:
+    @pytest.fixture
+    def pull_dombackup(self, build_mock_domain, tmpdir):
+        build_mock_domain.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write("vda content")
+        return build_dombackup(
+            dom=build_mock_domain,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            backup_engine="pull",
+            nbd_connections=2,
+        )
+
+    def start_backup(self, dombackup, mocker):
+        date = arrow.get(2016, 8, 15, 17, 10, 0)
+        mocker.patch("arrow.now", return_value=date)
+        dombackup.start()
+        with open(dombackup._get_json_definition_path(date)) as f:
+            return json.load(f)
+
+    def test_start(self, pull_dombackup, mocker):
+        dombkup = pull_dombackup
+        ext_snapshot = mocker.spy(dombkup, "_backup_with_ext_snapshot")
+        definition = self.start_backup(dombkup, mocker)
+
+        assert definition["backup_engine"] == "pull"
+        assert not ext_snapshot.called
+        # Recorded to schedule the next backups.
+        assert definition["duration"] >= 0
+        assert definition["disks_size"] == len("vda content")
+        assert 'mode="pull"' in dombkup.dom.backup_jobs[0]
+        # The exports are raw images.
+        assert definition["disks"]["vda"].endswith(".raw")
+        with open(os.path.join(dombkup.backup_dir, definition["disks"]["vda"])) as f:
+            assert f.read() == "vda content"
+        # Job ended, temporary job directory and pending info removed.
+        assert dombkup.dom.nbd_server is None
+        assert sorted(os.listdir(dombkup.backup_dir)) == sorted(
+            (definition["disks"]["vda"], "{}.json".format(definition["name"]))
+        )
+
+    def test_start_inactive_domain(self, pull_dombackup, mocker):
+        """
+        The disks of a stopped domain should be directly copied
+        """
+        dombkup = pull_dombackup
+        dombkup.dom.set_state(5, 0)
+        definition = self.start_backup(dombkup, mocker)
+
+        assert not dombkup.dom.backup_jobs
+        assert "backup_engine" not in definition
+
+    def test_start_incremental_fallback(self, pull_dombackup, mocker):
+        dombkup = pull_dombackup
+        dombkup.backup_mode = "delta"
+        ext_snapshot = mocker.spy(dombkup, "_backup_with_ext_snapshot")
+        self.start_backup(dombkup, mocker)
+
+        assert ext_snapshot.called
+        assert not dombkup.dom.backup_jobs
+
+    def test_invalid_engine(self, build_mock_domain):
+        with pytest.raises(ValueError):
+            build_dombackup(dom=build_mock_domain, backup_engine="invalid")
+
+    def test_clean_aborted(self, pull_dombackup, mocker):
+        dombkup = pull_dombackup
+        mocker.patch.object(
+            dombkup, "_get_packager", side_effect=Exception("packager error")
+        )
+        mocker.patch("arrow.now", return_value=arrow.get(2016, 8, 15, 17, 10, 13))
+
+        with pytest.raises(Exception):
+            dombkup.start()
+
+        assert dombkup.dom.nbd_server is None
+        assert not os.listdir(dombkup.backup_dir)
+
+
+class TestDomBackupDelta:
+    @pytest.fixture
+    def delta_dombackup(self, build_mock_domain, tmpdir, mocker):
+        build_mock_domain.set_storage_basedir(str(tmpdir))
+        tmpdir.join("test-disk-1.qcow2").write_binary(os.urandom(BLOCK_SIZE * 10 + 42))
+        dombkup = build_dombackup(
+            dom=build_mock_domain,
+            dev_disks=("vda",),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            backup_mode="delta",
+        )
+        mocker.patch.object(dombkup, "_get_ext_snapshot_helper")
+        return dombkup
+
+    def start_backups(self, dombackup, nb_backups, first=0):
+        definitions = []
+        for i in range(first, first + nb_backups):
+            date = arrow.get(2016, 8, 15, 17, 10, i)
+            dombackup._get_ext_snapshot_helper.return_value.start.return_value = {
+                "date": date,
+                "disks": {
+                    disk: {"snapshot": "snapshot", "type": prop["type"]}
+                    for disk, prop in dombackup.disks.items()
+                },
+            }
+            dombackup.start()
+            with open(dombackup._get_json_definition_path(date)) as f:
+                definitions.append(json.load(f))
+
+        return definitions
+
+    def test_start_full(self, delta_dombackup):
+        dombkup = delta_dombackup
+        (definition,) = self.start_backups(dombkup, 1)
+
+        assert definition["backup_mode"] == "full"
+        assert definition["block_hashes"]["block_size"] == BLOCK_SIZE
+        hashes_path = os.path.join(
+            dombkup.backup_dir, definition["block_hashes"]["disks"]["vda"]
+        )
+        # 11 blocks, the last one being partial.
+        assert os.path.getsize(hashes_path) == 11 * HASH_SIZE
+
+    def test_start_full_reads_disk_once(self, delta_dombackup, mocker):
+        dombkup = delta_dombackup
+        rehash = mocker.patch("virt_backup.backups.pending.iter_hashed_batches")
+        (definition,) = self.start_backups(dombkup, 1)
+
+        assert not rehash.called
+        with open(dombkup.disks["vda"]["src"], "rb") as f:
+            expected_hashes = hash_batch(f.read(), BLOCK_SIZE)
+        hashes_path = os.path.join(
+            dombkup.backup_dir, definition["block_hashes"]["disks"]["vda"]
+        )
+        with open(hashes_path, "rb") as f:
+            assert f.read() == expected_hashes
+
+    def test_start_delta(self, delta_dombackup):
+        dombkup = delta_dombackup
+        self.start_backups(dombkup, 1)
+        with open(dombkup.disks["vda"]["src"], "r+b") as f:
+            f.seek(BLOCK_SIZE * 3 + 10)
+            f.write(b"changed")
+
+        (definition,) = self.start_backups(dombkup, 1, first=1)
+
+        assert definition["backup_mode"] == "delta"
+        assert definition["parent"] == "20160815-171000_1_test"
+        assert "block_hashes" not in definition
+        delta_path = os.path.join(dombkup.backup_dir, definition["disks"]["vda"])
+        assert delta_path.endswith(".delta")
+        # Header, then one record.
+        assert os.path.getsize(delta_path) == 20 + 8 + BLOCK_SIZE
+        assert not [f for f in os.listdir(dombkup.backup_dir) if f.endswith(".job")]
+
+    def test_start_delta_of_last_full(self, delta_dombackup):
+        dombkup = delta_dombackup
+        definitions = self.start_backups(dombkup, 3)
+
+        assert [d["backup_mode"] for d in definitions] == ["full", "delta", "delta"]
+        assert definitions[1]["parent"] == definitions[2]["parent"]
+
+    def test_start_full_every(self, delta_dombackup):
+        dombkup = delta_dombackup
+        dombkup.full_every = 2
+        definitions = self.start_backups(dombkup, 3)
+
+        assert [d["backup_mode"] for d in definitions] == ["full", "delta", "full"]
+
+    def test_start_full_if_hashes_missing(self, delta_dombackup):
+        dombkup = delta_dombackup
+        (full,) = self.start_backups(dombkup, 1)
+        os.remove(
+            os.path.join(dombkup.backup_dir, full["block_hashes"]["disks"]["vda"])
+        )
+        (definition,) = self.start_backups(dombkup, 1, first=1)
+
+        assert definition["backup_mode"] == "full"
+
+    def test_clean_aborted(self, delta_dombackup, mocker):
+        dombkup = delta_dombackup
+        self.start_backups(dombkup, 1)
+        backup_files = sorted(os.listdir(dombkup.backup_dir))
+
+        mocker.patch(
+            "virt_backup.backups.pending.DeltaImage.open",
+            side_effect=Exception("delta error"),
+        )
+        with pytest.raises(Exception):
+            self.start_backups(dombkup, 1, first=1)
+
+        assert sorted(os.listdir(dombkup.backup_dir)) == backup_files
+
+
+class TestDomBackupConcurrentDisks:
+    @pytest.fixture
+    def multiple_disks_dombackup(self, build_mock_domain, tmpdir, mocker):
+        build_mock_domain.set_storage_basedir(str(tmpdir))
+        for i in (1, 2):
+            tmpdir.join("test-disk-{}.qcow2".format(i)).write("disk {}".format(i))
+        dombkup = build_dombackup(
+            dom=build_mock_domain,
+            dev_disks=("vda", "vdb"),
+            backup_dir=str(tmpdir.join("backups")),
+            packager="directory",
+            disk_threads=2,
+        )
+        snapshot_helper = mocker.patch.object(
+            dombkup, "_get_ext_snapshot_helper"
+        ).return_value
+        snapshot_helper.start.return_value = {
+            "date": arrow.get(2016, 8, 15, 17, 10, 13),
+            "disks": {
+                disk: {"snapshot": "snapshot", "type": "qcow2"}
+                for disk in dombkup.disks
+            },
+        }
+        return dombkup
+
+    def test_start(self, multiple_disks_dombackup, mocker):
+        dombkup = multiple_disks_dombackup
+        # Each disk waits for the other one to be in backup.
+        barrier = threading.Barrier(2, timeout=5)
+        backup_disk = dombkup._backup_disk
+
+        def concurrent_backup_disk(*args, **kwargs):
+            barrier.wait()
+            return backup_disk(*args, **kwargs)
+
+        mocker.patch.object(dombkup, "_backup_disk", side_effect=concurrent_backup_disk)
+        dombkup.start()
+
+        snapshot_helper = dombkup._get_ext_snapshot_helper.return_value
+        assert sorted(
+            c[0][0] for c in snapshot_helper.clean_for_disk.call_args_list
+        ) == [
+            "vda",
+            "vdb",
+        ]
+        with open(
+            dombkup._get_json_definition_path(arrow.get(2016, 8, 15, 17, 10, 13))
+        ) as f:
+            definition = json.load(f)
+        assert sorted(definition["disks"]) == ["vda", "vdb"]
+        for disk in ("vda", "vdb"):
+            assert os.path.exists(
+                os.path.join(dombkup.backup_dir, definition["disks"][disk])
+            )
+
+    def test_start_sequential_packager(self, multiple_disks_dombackup, mocker):
+        dombkup = multiple_disks_dombackup
+        dombkup.packager = "tar"
+        threads = set()
+        backup_disk = dombkup._backup_disk
+
+        def backup_disk_in_thread(*args, **kwargs):
+            threads.add(threading.get_ident())
+            return backup_disk(*args, **kwargs)
+
+        mocker.patch.object(dombkup, "_backup_disk", side_effect=backup_disk_in_thread)
+        dombkup.start()
+
+        assert threads == {threading.get_ident()}
+
+    def test_start_with_error(self, multiple_disks_dombackup, mocker):
+        dombkup = multiple_disks_dombackup
+        backup_disk = dombkup._backup_disk
+
+        def failing_backup_disk(disk, *args, **kwargs):
+            if disk == "vda":
+                raise Exception("backup error")
+            dombkup._cancel_flag.wait(timeout=5)
+            return backup_disk(disk, *args, **kwargs)
+
+        mocker.patch.object(dombkup, "_backup_disk", side_effect=failing_backup_disk)
+
+        with pytest.raises(Exception, match="backup error"):
+            dombkup.start()
+        assert not os.listdir(dombkup.backup_dir)
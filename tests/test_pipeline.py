@@ -0,0 +1,122 @@
+import threading
+
+import pytest
+
+from virt_backup.backups.packagers.buffers import BufferPool
+from virt_backup.backups.packagers.pipeline import run_pipeline
+from virt_backup.exceptions import CancelledError
+
+
+def test_run_pipeline():
+    written = []
+    run_pipeline(lambda: iter(range(10)), written.append)
+
+    assert written == list(range(10))
+
+
+def test_run_pipeline_transform_ordered():
+    written = []
+    run_pipeline(
+        lambda: iter(range(50)), written.append, transform=lambda i: i * 2, workers=4
+    )
+
+    assert written == [i * 2 for i in range(50)]
+
+
+def test_run_pipeline_release():
+    pool = BufferPool(4)
+    chunks = [pool.acquire() for _ in range(3)]
+    released = []
+
+    def release(chunk):
+        released.append(chunk)
+        pool.release(chunk)
+
+    run_pipeline(lambda: iter(chunks), lambda chunk: None, release=release)
+
+    assert released == chunks
+    assert len(pool._free) == 3
+
+
+def test_run_pipeline_bounded():
+    """
+    The reader should not read more than `depth` chunks ahead of the writer
+    """
+    read = []
+    max_ahead = 0
+
+    def write(i):
+        nonlocal max_ahead
+        max_ahead = max(max_ahead, len(read) - i)
+
+    def read_chunks():
+        for i in range(20):
+            read.append(i)
+            yield i
+
+    run_pipeline(read_chunks, write, depth=2)
+
+    # depth chunks in the queue, one kept by the reader, one being written.
+    assert max_ahead <= 2 + 2
+
+
+def test_run_pipeline_read_error():
+    def read_chunks():
+        yield 1
+        raise OSError("read error")
+
+    with pytest.raises(OSError, match="read error"):
+        run_pipeline(read_chunks, lambda chunk: None)
+
+
+def test_run_pipeline_transform_error():
+    def transform(i):
+        if i == 3:
+            raise ValueError("transform error")
+        return i
+
+    with pytest.raises(ValueError, match="transform error"):
+        run_pipeline(
+            lambda: iter(range(10)), lambda chunk: None, transform=transform, workers=2
+        )
+
+
+def test_run_pipeline_write_error_stops_reader():
+    """
+    An error in the writer should stop the reader, even if blocked on a full queue
+    """
+    reader_done = threading.Event()
+
+    def read_chunks():
+        try:
+            yield from range(1000)
+        finally:
+            reader_done.set()
+
+    def write(i):
+        raise OSError("write error")
+
+    with pytest.raises(OSError, match="write error"):
+        run_pipeline(read_chunks, write, depth=1)
+
+    assert reader_done.is_set()
+
+
+def test_run_pipeline_cancelled():
+    stop_event = threading.Event()
+    written = []
+
+    def write(i):
+        written.append(i)
+        if i == 2:
+            stop_event.set()
+
+    with pytest.raises(CancelledError):
+        run_pipeline(
+            lambda: iter(range(100)),
+            write,
+            transform=lambda i: i,
+            stop_event=stop_event,
+        )
+
+    assert written == [0, 1, 2]
@@ -0,0 +1,87 @@
+from collections import defaultdict
+import random
+
+import arrow
+import pytest
+
+from virt_backup.backups import DomCompleteBackupRecord
+from virt_backup.groups.retention import plan_retention
+
+
+def build_record(timestamp, name=None, parent=None):
+    return DomCompleteBackupRecord(
+        name=name or str(timestamp),
+        dom_name="test",
+        backup_dir="/tmp",
+        definition_filename="{}.json".format(timestamp),
+        timestamp=timestamp,
+        parent=parent,
+    )
+
+
+def keep_by_arrow_periods(backups, hourly, daily, weekly, monthly, yearly):
+    """
+    Reference retention, grouping backups by arrow date attributes
+    """
+    periods = ("hour", "day", "week", "month", "year")
+    backups = sorted(backups, key=lambda b: b.timestamp)
+    kept = set()
+    for period, n in zip(periods, (hourly, daily, weekly, monthly, yearly)):
+        if not n:
+            continue
+        grouped = defaultdict(list)
+        for b in backups:
+            date = arrow.get(b.timestamp)
+            key = tuple(
+                getattr(date, p) for p in reversed(periods[periods.index(period) :])
+            )
+            grouped[key].append(b)
+        groups = sorted(grouped.items())
+        if n != "*":
+            groups = groups[-n:]
+        kept.update(group[0] for _, group in groups)
+    return kept
+
+
+@pytest.mark.parametrize(
+    "periods",
+    (
+        (5, 5, 5, 5, 5),
+        (2, 3, 1, 1, 2),
+        (0, 3, 0, 1, 2),
+        (1, 0, 0, 0, 0),
+        (24, 7, "*", 12, "*"),
+    ),
+)
+def test_plan_retention(periods):
+    rand = random.Random(42)
+    start = arrow.get("2015-12-20").int_timestamp
+    backups = [
+        build_record(start + rand.randrange(0, 3 * 365 * 86400)) for _ in range(2000)
+    ]
+    # Add a burst of backups in the same hours.
+    backups += [build_record(start + i * 600) for i in range(100)]
+
+    plan = plan_retention({"test": backups}, *periods)
+
+    expected = keep_by_arrow_periods(backups, *periods)
+    assert set(plan.keep["test"]) == expected
+    assert set(plan.delete["test"]) == set(backups) - expected
+    assert plan.keep["test"] == sorted(expected, key=lambda b: b.timestamp)
+    assert len(plan) == len(backups) - len(expected)
+
+
+def test_plan_retention_keep_parents():
+    full = build_record(1000, name="full")
+    incrementals = [
+        build_record(1000 + i * 3600, name="inc{}".format(i), parent=p)
+        for i, p in enumerate(("full", "inc1", "inc2"), start=1)
+    ]
+    unrelated = build_record(500, name="unrelated")
+    backups = [incrementals[2], unrelated, full] + incrementals[:2]
+
+    plan = plan_retention({"test": backups}, 1, 0, 0, 0, 0)
+
+    assert plan.keep["test"] == [full] + incrementals
+    assert plan.delete["test"] == [unrelated]
+    assert list(plan.iter_deletions()) == [("test", unrelated)]
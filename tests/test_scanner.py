@@ -0,0 +1,73 @@
+import json
+import os
+
+import pytest
+
+from virt_backup import scanner
+from virt_backup.scanner import (
+    PENDING_INFO_SUFFIX,
+    iter_json_files,
+    load_json_files,
+    scan_definitions,
+)
+
+
+@pytest.fixture
+def domain_dir(tmpdir):
+    domain_dir = tmpdir.mkdir("test")
+    for i in range(3):
+        domain_dir.join("{}.json".format(i)).write(json.dumps({"id": i}))
+    domain_dir.join("2.json.pending").write(json.dumps({"id": 2}))
+    domain_dir.join(".hidden.json").write("{}")
+    domain_dir.join("bad.json").write("not json")
+    domain_dir.mkdir("dir.json")
+    return domain_dir
+
+
+def test_iter_json_files(domain_dir):
+    files = {os.path.basename(p): (m, s) for p, m, s in iter_json_files(domain_dir)}
+
+    assert sorted(files) == ["0.json", "1.json", "2.json", "bad.json"]
+    stat = os.stat(str(domain_dir.join("0.json")))
+    assert files["0.json"] == (stat.st_mtime_ns, stat.st_size)
+
+
+def test_iter_json_files_pending(domain_dir):
+    files = [os.path.basename(p) for p, _, _ in iter_json_files(domain_dir, ".pending")]
+    assert files == ["2.json.pending"]
+
+
+def test_iter_json_files_unexisting(tmpdir):
+    assert not list(iter_json_files(str(tmpdir.join("unexisting"))))
+
+
+def test_load_json_files(domain_dir, monkeypatch):
+    monkeypatch.setattr(scanner, "LOAD_BATCH_SIZE", 2)
+    paths = [p for p, _, _ in iter_json_files(domain_dir)]
+
+    loaded = load_json_files(paths, threads=2)
+    assert loaded == {
+        str(domain_dir.join("{}.json".format(i))): {"id": i} for i in range(3)
+    }
+
+
+@pytest.mark.parametrize("has_orjson", (True, False))
+def test_loads_dumps(monkeypatch, has_orjson):
+    if not has_orjson:
+        monkeypatch.setattr(scanner, "orjson", None)
+    elif scanner.orjson is None:
+        pytest.skip("orjson not installed")
+
+    obj = {"name": "test", "disks": {"vda": "vda.qcow2"}, "date": 1}
+    assert isinstance(scanner.dumps(obj), str)
+    assert scanner.loads(scanner.dumps(obj)) == obj
+    assert scanner.loads(json.dumps(obj).encode()) == obj
+
+
+def test_scan_definitions(tmpdir, domain_dir):
+    tmpdir.mkdir("empty")
+    pending = scan_definitions(str(tmpdir), PENDING_INFO_SUFFIX)
+
+    assert pending == {str(domain_dir.join("2.json.pending")): {"id": 2}}
+    assert len(scan_definitions(str(tmpdir))) == 3
+    assert scan_definitions(str(tmpdir.join("unexisting"))) == {}
@@ -0,0 +1,152 @@
+import json
+import os
+
+import arrow
+import pytest
+import yaml
+
+import virt_backup
+from virt_backup.groups.scheduling import (
+    parse_deadline,
+    plan_backups,
+    predict_durations,
+)
+
+from helper.virt_backup import MockDomain, build_dombackup
+
+
+def write_definition(backup_dir, dom_name, date, duration, disks_size=None, **kwargs):
+    domain_dir = os.path.join(backup_dir, dom_name)
+    os.makedirs(domain_dir, exist_ok=True)
+    name = "{}_{}".format(dom_name, date)
+    definition = {
+        "domain_name": dom_name,
+        "name": name,
+        "date": date,
+        "duration": duration,
+        "disks_size": disks_size,
+        "version": virt_backup.VERSION,
+        **kwargs,
+    }
+    with open(os.path.join(domain_dir, "{}.json".format(name)), "w") as f:
+        json.dump(definition, f)
+
+
+@pytest.fixture
+def build_backups(build_mock_libvirtconn, tmpdir):
+    backup_dir = str(tmpdir.join("backups"))
+    os.mkdir(backup_dir)
+
+    def build(*dom_names, **kwargs):
+        backups = []
+        for i, name in enumerate(dom_names):
+            dom = MockDomain(_conn=build_mock_libvirtconn, name=name, id=i)
+            dom.set_storage_basedir(str(tmpdir.mkdir(name)))
+            backups.append(
+                build_dombackup(
+                    dom, backup_dir=backup_dir, dev_disks=("vda",), **kwargs
+                )
+            )
+        return backups
+
+    return backup_dir, build
+
+
+def set_disk_size(backup, size):
+    with open(backup.disks["vda"]["src"], "wb") as f:
+        f.truncate(size)
+
+
+def test_parse_deadline():
+    now = arrow.get(2016, 8, 15, 22, 0)
+
+    assert parse_deadline("23:30", now) == arrow.get(2016, 8, 15, 23, 30)
+    assert parse_deadline("06:00", now) == arrow.get(2016, 8, 16, 6, 0)
+    assert parse_deadline(now.shift(hours=1)) == now.shift(hours=1)
+    for deadline in ("6h", "25:00", True, 24 * 60, ["06:00"]):
+        with pytest.raises(ValueError):
+            parse_deadline(deadline, now)
+
+
+def test_parse_deadline_yaml_int():
+    """
+    An unquoted HH:MM is read by YAML as a base 60 integer
+    """
+    now = arrow.get(2016, 8, 15, 22, 0)
+    deadline = yaml.safe_load("deadline: 22:30")["deadline"]
+
+    assert deadline == 22 * 60 + 30
+    assert parse_deadline(deadline, now) == arrow.get(2016, 8, 15, 22, 30)
+
+
+def test_predict_durations(build_backups):
+    backup_dir, build = build_backups
+    a, b, c = build("a", "b", "c")
+    write_definition(backup_dir, "a", 1, 100, 1000)
+    write_definition(backup_dir, "a", 2, 200, 1000)
+    write_definition(backup_dir, "b", 1, 50, 1000)
+    # Throughput of the last backups: 2000 bytes in 250s.
+    set_disk_size(c, 800)
+
+    assert predict_durations([a, b, c]) == {a: 200, b: 50, c: 100}
+
+
+def test_predict_durations_same_mode(build_backups):
+    backup_dir, build = build_backups
+    (a,) = build("a", backup_mode="incremental")
+    write_definition(backup_dir, "a", 1, 100, backup_mode="incremental")
+    write_definition(backup_dir, "a", 2, 1000, backup_mode="full")
+
+    assert predict_durations([a]) == {a: 100}
+
+
+def test_predict_durations_without_history(build_backups):
+    _, build = build_backups
+    (a,) = build("a")
+
+    assert predict_durations([a]) == {a: None}
+
+
+def test_plan_backups_longest_first(build_backups):
+    backup_dir, build = build_backups
+    a, b, c = build("a", "b", "c")
+    write_definition(backup_dir, "a", 1, 10)
+    write_definition(backup_dir, "b", 1, 300)
+
+    planned, deferred = plan_backups([a, b, c], nb_threads=2)
+
+    # Unpredictable backups are started first.
+    assert planned == [c, b, a]
+    assert not deferred
+
+
+def test_plan_backups_by_size(build_backups):
+    """
+    Without any history, backups are ordered by size of their disks
+    """
+    _, build = build_backups
+    a, b = build("a", "b")
+    set_disk_size(a, 10)
+    set_disk_size(b, 1000)
+
+    planned, _ = plan_backups([a, b])
+
+    assert planned == [b, a]
+
+
+def test_plan_backups_deadline(build_backups):
+    backup_dir, build = build_backups
+    a, b, c, d = build("a", "b", "c", "d")
+    c.priority = 1
+    for dom_name, duration in (("a", 300), ("b", 100), ("c", 250)):
+        write_definition(backup_dir, dom_name, 1, duration)
+    now = arrow.now()
+
+    planned, deferred = plan_backups(
+        [a, b, c, d], nb_threads=1, deadline=now.shift(seconds=400), now=now
+    )
+
+    # c has the highest priority, then a is too long to end after it. d cannot be
+    # predicted, so is not deferred.
+    assert planned == [d, c, b]
+    assert deferred == [a]
@@ -2,12 +2,17 @@ import json
 import os
 import arrow
 import libvirt
+import lxml.etree
 import pytest
 
 from virt_backup.backups import DomBackup
 from virt_backup.domains import get_xml_block_of_disk
 from virt_backup.backups.snapshot import DomExtSnapshot, DomExtSnapshotCallbackRegistrer
-from virt_backup.exceptions import DiskNotFoundError, SnapshotNotStarted
+from virt_backup.exceptions import (
+    DiskNotFoundError,
+    SnapshotNotPivoted,
+    SnapshotNotStarted,
+)
 from helper.virt_backup import MockSnapshot
 
 
@@ -72,6 +77,13 @@ class TestDomExtSnapshot:
         snap = self.snapshot_helper.external_snapshot()
         assert isinstance(snap, MockSnapshot)
 
+    def test_external_snapshot_invalidate_xml_cache(self):
+        cache = self.snapshot_helper.xml_cache
+        self.snapshot_helper.external_snapshot()
+        self.snapshot_helper._get_disk_type("vda")
+
+        assert cache.misses == 2
+
     def test_external_snapshot_quiesce_fallback(self):
         tried = {"quiesce": False}
 
@@ -134,6 +146,19 @@ class TestDomExtSnapshot:
         dom_xml = self.snapshot_helper.dom.XMLDesc()
         assert self.get_src_for_disk(dom_xml, "vda") == "/testvda"
 
+    def test_manually_pivot_disk_xml_cache(self, build_mock_libvirtconn):
+        self.snapshot_helper.conn = build_mock_libvirtconn
+        cached_xml = self.snapshot_helper.xml_cache.get_xml()
+        cached_tree = self.snapshot_helper.xml_cache.get_parsed()
+
+        self.snapshot_helper._manually_pivot_disk("vda", "/testvda", "qcow2")
+        assert lxml.etree.tostring(cached_tree, pretty_print=True).decode() == (
+            cached_xml
+        )
+
+        dom_xml = self.snapshot_helper.xml_cache.get_parsed()
+        assert self.get_src_for_disk(dom_xml, "vda") == "/testvda"
+
     def get_src_for_disk(self, dom_xml, disk):
         elem = get_xml_block_of_disk(dom_xml, disk)
         return elem.xpath("source")[0].get("file")
@@ -162,6 +187,90 @@ class TestDomExtSnapshot:
 
         assert len(snapdir.listdir()) == 0
 
+    def test_clean_concurrent_commits(self, monkeypatch, tmpdir):
+        snapdir = self.prepare_test_clean(monkeypatch, tmpdir)
+        committed = self.mock_blockcommit(monkeypatch, pivoted=("vda", "vdb"))
+        self.snapshot_helper.clean()
+
+        assert sorted(committed) == ["vda", "vdb"]
+        assert not self.snapshot_helper.metadatas["disks"]
+        assert not self.snapshot_helper._callbacks_registrer.callbacks
+        assert len(snapdir.listdir()) == 0
+
+    def test_clean_concurrent_commits_timeout(self, monkeypatch, tmpdir):
+        self.prepare_test_clean(monkeypatch, tmpdir)
+        self.mock_blockcommit(monkeypatch, pivoted=("vda",))
+        self.snapshot_helper.timeout = 0.1
+
+        with pytest.raises(SnapshotNotPivoted):
+            self.snapshot_helper.clean()
+
+        # Only the pivoted disk is considered as cleaned.
+        assert tuple(self.snapshot_helper.metadatas["disks"]) == ("vdb",)
+        snapshot = self.snapshot_helper.metadatas["disks"]["vdb"]["snapshot"]
+        assert tuple(self.snapshot_helper._callbacks_registrer.callbacks) == (
+            os.path.abspath(snapshot),
+        )
+
+    def test_clean_concurrent_commits_error(self, monkeypatch, tmpdir):
+        """
+        A pivot timeout should not mask the failure of a blockcommit
+        """
+        self.prepare_test_clean(monkeypatch, tmpdir)
+        committed = self.mock_blockcommit(monkeypatch, pivoted=())
+        dom = self.snapshot_helper.dom
+
+        def block_commit(disk, *args):
+            if committed:
+                raise libvirt.libvirtError("blockcommit failed")
+            committed.append(disk)
+
+        monkeypatch.setattr(dom, "blockCommit", block_commit, raising=False)
+        self.snapshot_helper.timeout = 0.1
+
+        with pytest.raises(libvirt.libvirtError):
+            self.snapshot_helper.clean()
+        assert committed == ["vda"]
+
+    def test_clean_commit_controller(self, monkeypatch, tmpdir, mocker):
+        self.prepare_test_clean(monkeypatch, tmpdir)
+        self.mock_blockcommit(monkeypatch, pivoted=("vda", "vdb"))
+        block_commit = mocker.spy(self.snapshot_helper.dom, "blockCommit")
+        controller = mocker.Mock(initial_bandwidth=2**20)
+        self.snapshot_helper.commit_controller = controller
+        self.snapshot_helper.clean()
+
+        for c in block_commit.call_args_list:
+            bandwidth, flags = c[0][3:]
+            assert bandwidth == 2**20
+            assert flags & libvirt.VIR_DOMAIN_BLOCK_COMMIT_BANDWIDTH_BYTES
+        for method in (controller.add, controller.remove):
+            assert sorted(c[0][0] for c in method.call_args_list) == ["vda", "vdb"]
+
+    def mock_blockcommit(self, monkeypatch, pivoted):
+        """
+        Mock the blockcommits of a running domain. The disks in `pivoted` are
+        pivoted once all the blockcommits are started.
+        """
+        dom = self.snapshot_helper.dom
+        dom.set_state(1, 0)
+        committed = []
+
+        def block_commit(disk, *args):
+            committed.append(disk)
+            if len(committed) < len(self.snapshot_helper.disks):
+                return
+
+            for d in pivoted:
+                snapshot = self.snapshot_helper.metadatas["disks"][d]["snapshot"]
+                self.snapshot_helper._callbacks_registrer.event_callback(
+                    dom._conn, dom, snapshot, None, libvirt.VIR_DOMAIN_BLOCK_JOB_READY
+                )
+
+        monkeypatch.setattr(dom, "blockCommit", block_commit, raising=False)
+        monkeypatch.setattr(dom, "blockJobAbort", lambda *args: None, raising=False)
+        return committed
+
     def prepare_test_clean(self, monkeypatch, tmpdir):
         snapshots = self.create_temp_snapshot_files(tmpdir)
 
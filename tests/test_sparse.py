@@ -0,0 +1,89 @@
+import os
+import threading
+import pytest
+
+from virt_backup.backups.packagers.sparse import (
+    SparseWriter,
+    copy_sparse,
+    is_zero,
+    iter_data_extents,
+)
+from virt_backup.exceptions import CancelledError
+
+
+@pytest.fixture()
+def sparse_file(tmpdir):
+    path = str(tmpdir.join("sparse"))
+    with open(path, "wb") as f:
+        f.truncate(8 * 2**20)
+        f.seek(4 * 2**20)
+        f.write(b"a" * 4096)
+    return path
+
+
+def test_iter_data_extents(sparse_file):
+    fd = os.open(sparse_file, os.O_RDONLY)
+    try:
+        extents = list(iter_data_extents(fd))
+    finally:
+        os.close(fd)
+
+    # Filesystems not reporting holes will return the full file.
+    assert extents in ([(4 * 2**20, 4096)], [(0, 8 * 2**20)])
+
+
+def test_iter_data_extents_empty(tmpdir):
+    path = str(tmpdir.join("empty"))
+    open(path, "w").close()
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        assert not list(iter_data_extents(fd))
+    finally:
+        os.close(fd)
+
+
+def test_is_zero():
+    assert is_zero(bytes(4096))
+    assert is_zero(bytes(3 * 2**20))
+    assert not is_zero(bytes(4095) + b"a")
+
+
+def test_is_zero_memoryview():
+    buf = memoryview(bytearray(3 * 2**20))
+    assert is_zero(buf)
+    assert is_zero(buf[:4096])
+
+    buf[-1] = 1
+    assert not is_zero(buf)
+
+
+def test_sparse_writer_trailing_hole(tmpdir):
+    path = str(tmpdir.join("target"))
+    with open(path, "wb") as f:
+        writer = SparseWriter(f)
+        writer.write(b"a" * 10)
+        writer.write(bytes(4096))
+        writer.close()
+
+    with open(path, "rb") as f:
+        assert f.read() == b"a" * 10 + bytes(4096)
+
+
+def test_copy_sparse(tmpdir, sparse_file):
+    target = str(tmpdir.join("target"))
+    with open(sparse_file, "rb") as fsrc, open(target, "wb") as fdst:
+        copy_sparse(fsrc, fdst)
+
+    with open(sparse_file, "rb") as fsrc, open(target, "rb") as fdst:
+        assert fsrc.read() == fdst.read()
+    assert os.stat(target).st_blocks * 512 < os.path.getsize(target)
+
+
+def test_copy_sparse_cancelled(tmpdir, sparse_file):
+    target = str(tmpdir.join("target"))
+    stop_event = threading.Event()
+    stop_event.set()
+    with open(sparse_file, "rb") as fsrc, open(target, "wb") as fdst:
+        with pytest.raises(CancelledError):
+            copy_sparse(fsrc, fdst, stop_event=stop_event)
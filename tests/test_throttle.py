@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from virt_backup.exceptions import CancelledError
+from virt_backup.throttle import (
+    MIN_CHUNK_SIZE,
+    Throttle,
+    build_throttle,
+    get_strictest_throttle,
+    parse_rate,
+    parse_size,
+    set_io_priority,
+)
+
+
+@pytest.mark.parametrize(
+    "rate,expected",
+    (
+        (None, None),
+        (1000, 1000),
+        ("1000", 1000),
+        ("500K", 500 * 2**10),
+        ("100M", 100 * 2**20),
+        ("1.5GiB/s", int(1.5 * 2**30)),
+        ("2 mb", 2 * 2**20),
+    ),
+)
+def test_parse_rate(rate, expected):
+    assert parse_rate(rate) == expected
+
+
+def test_parse_rate_invalid():
+    with pytest.raises(ValueError):
+        parse_rate("fast")
+
+
+def test_parse_size():
+    assert parse_size(None) is None
+    assert parse_size("4MiB") == 4 * 2**20
+    with pytest.raises(ValueError):
+        parse_size("4M/s")
+
+
+class TestThrottle:
+    def test_consume(self):
+        throttle = Throttle(2**20, burst=2**16)
+        start = time.monotonic()
+        for _ in range(4):
+            throttle.consume(2**17)
+
+        # 512KB at 1MB/s, minus the initial burst.
+        assert time.monotonic() - start >= 0.4
+
+    def test_consume_shared(self):
+        throttle = Throttle(4 * 2**20, burst=2**16)
+
+        def consume():
+            for _ in range(4):
+                throttle.consume(2**17)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=consume) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # 2MB at 4MB/s, minus the initial burst.
+        assert time.monotonic() - start >= 0.45
+
+    def test_consume_parent(self):
+        parent = Throttle(2**20, burst=2**16)
+        throttle = Throttle(2**30, parent=parent)
+        start = time.monotonic()
+        for _ in range(4):
+            throttle.consume(2**17)
+
+        assert time.monotonic() - start >= 0.4
+
+    def test_consume_unlimited(self):
+        throttle = Throttle()
+        start = time.monotonic()
+        throttle.consume(2**40)
+
+        assert time.monotonic() - start < 0.1
+
+    def test_consume_cancelled(self):
+        throttle = Throttle(2**10, burst=2**10)
+        stop_event = threading.Event()
+        stop_event.set()
+
+        with pytest.raises(CancelledError):
+            throttle.consume(2**20, stop_event)
+
+    def test_log(self, caplog):
+        throttle = Throttle(2**30, name="test", log_interval=0)
+        with caplog.at_level(logging.INFO, logger="virt_backup"):
+            throttle.consume(2**20)
+
+        assert "Bandwidth of test:" in caplog.text
+        assert "limited to 1.0GiB/s" in caplog.text
+
+    def test_get_chunk_size(self):
+        parent = Throttle(2**20)
+        throttle = Throttle(parent=parent)
+
+        assert throttle.get_chunk_size(2**26) == 2**18
+        assert throttle.get_chunk_size(2**10) == 2**10
+        assert Throttle(1).get_chunk_size(2**26) == MIN_CHUNK_SIZE
+
+    def test_get_lowest_rate(self):
+        parent = Throttle(2**20)
+
+        assert Throttle(2**10, parent=parent).get_lowest_rate() == 2**10
+        assert Throttle(parent=parent).get_lowest_rate() == 2**20
+        assert Throttle().get_lowest_rate() is None
+
+
+def test_build_throttle():
+    parent = Throttle()
+    assert build_throttle(None, parent=parent) is parent
+
+    throttle = build_throttle("1M", name="test", parent=parent)
+    assert throttle.rate == 2**20
+    assert throttle.parent is parent
+
+
+def test_get_strictest_throttle():
+    unlimited = Throttle()
+    group = Throttle(2**20)
+    domain = Throttle(2**10, parent=group)
+
+    assert get_strictest_throttle(group, domain) is domain
+    assert get_strictest_throttle(None, Throttle(parent=group)).parent is group
+    assert get_strictest_throttle(unlimited, group) is group
+    assert get_strictest_throttle(unlimited, None) is unlimited
+    assert get_strictest_throttle(None, None) is None
+
+
+def test_set_io_priority(mocker):
+    run = mocker.patch("subprocess.run")
+    set_io_priority("best-effort:7", tid=42)
+
+    assert run.call_args.args[0] == ["ionice", "-c", "2", "-n", "7", "-p", "42"]
+
+
+def test_set_io_priority_invalid():
+    with pytest.raises(ValueError):
+        set_io_priority("fastest")
@@ -2,8 +2,10 @@
 
 import argparse
 import arrow
+import concurrent.futures
 import libvirt
 import logging
+import os
 import sys
 import threading
 from collections import defaultdict
@@ -11,11 +13,16 @@ from collections import defaultdict
 from virt_backup.exceptions import (
     BackupNotFoundError,
     BackupsFailureInGroupError,
+    CleanFailureInGroupError,
     DomainNotFoundError,
 )
 from virt_backup.groups import groups_from_dict, BackupGroup, complete_groups_from_dict
-from virt_backup.backups import DomExtSnapshotCallbackRegistrer
+from virt_backup.groups.deletion import DeletionPool
+from virt_backup.groups.scheduling import parse_deadline
+from virt_backup.backups import DomCompleteBackupRecord, DomExtSnapshotCallbackRegistrer
+from virt_backup.catalog import BackupCatalog
 from virt_backup.config import get_config, Config
+from virt_backup.throttle import Throttle, parse_size, set_io_priority
 from virt_backup.tools import InfoFilter
 from virt_backup import APP_NAME, VERSION, compat_layers
 
@@ -46,6 +53,17 @@ def build_parser():
     sp_restore.add_argument(
         "--date", metavar="date", help="backup date (default: last backup)"
     )
+    sp_restore.add_argument(
+        "-t",
+        "--threads",
+        metavar="threads",
+        type=int,
+        default=0,
+        help=(
+            "number of disks to restore at the same time, when the packager allows "
+            "it (default: all disks)"
+        ),
+    )
     sp_restore.add_argument("target_dir", metavar="target_dir", help="destination path")
     sp_restore.set_defaults(func=restore_backup)
 
@@ -68,6 +86,13 @@ def build_parser():
         dest="no_broken",
         action="store_true",
     )
+    sp_clean.add_argument(
+        "-n",
+        "--dry-run",
+        help="only print the backups which would be removed",
+        dest="dry_run",
+        action="store_true",
+    )
     sp_clean.set_defaults(func=clean_backups)
 
     sp_list = sp_action.add_parser("list", aliases=["ls"], help=("list groups"))
@@ -99,6 +124,14 @@ def build_parser():
     )
     sp_list.set_defaults(func=list_groups)
 
+    sp_reindex = sp_action.add_parser(
+        "reindex", help=("rebuild the backup catalog of groups")
+    )
+    sp_reindex.add_argument(
+        "groups", metavar="group", type=str, nargs="*", help="domain group to reindex"
+    )
+    sp_reindex.set_defaults(func=reindex_groups)
+
     # Debug option
     parser.add_argument(
         "-d",
@@ -161,18 +194,27 @@ def start_backups(parsed_args, *args, **kwargs):
     callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
 
     if config.get("groups", None):
+        if config.get("io_priority"):
+            set_io_priority(config["io_priority"])
+        # Always set, to log the total bandwidth.
+        throttle = Throttle(config.get("bandwidth_limit"), name="total")
         groups = build_all_or_selected_groups(
-            config, conn, callbacks_registrer, parsed_args.groups
+            config, conn, callbacks_registrer, parsed_args.groups, throttle=throttle
         )
         main_group = build_main_backup_group(groups)
         nb_threads = config.get("threads", 0)
+        deadline = None
+        if config.get("deadline") is not None:
+            deadline = parse_deadline(config["deadline"])
         try:
             try:
                 with callbacks_registrer:
                     if nb_threads > 1 or nb_threads == 0:
-                        main_group.start_multithread(nb_threads=nb_threads)
+                        main_group.start_multithread(
+                            nb_threads=nb_threads, deadline=deadline
+                        )
                     else:
-                        main_group.start()
+                        main_group.start(deadline=deadline)
             except BackupsFailureInGroupError as e:
                 logger.error(e)
                 sys.exit(2)
@@ -242,8 +284,17 @@ def restore_backup(parsed_args, *args, **kwargs):
             )
         sys.exit(2)
 
+    if isinstance(backup, DomCompleteBackupRecord):
+        backup = backup.get_backup()
+    if config.get("io_priority"):
+        set_io_priority(config["io_priority"])
+    backup.throttle = Throttle(config.get("bandwidth_limit"), name="restore")
+    group_config = config["groups"][parsed_args.group]
+    backup.io_mode = group_config.get("io_mode")
+    backup.buffer_size = parse_size(group_config.get("buffer_size"))
+
     with callbacks_registrer:
-        backup.restore_to(target_dir)
+        backup.restore_to(target_dir, threads=parsed_args.threads)
 
 
 def clean_backups(parsed_args, *args, **kwargs):
@@ -252,37 +303,146 @@ def clean_backups(parsed_args, *args, **kwargs):
     config = get_setup_config(parsed_args.config_path)
     conn = get_setup_conn(config)
     callbacks_registrer = DomExtSnapshotCallbackRegistrer(conn)
-    groups = get_usable_complete_groups(
-        config, parsed_args.groups, conn, callbacks_registrer
+    groups = list(
+        get_usable_complete_groups(
+            config, parsed_args.groups, conn, callbacks_registrer
+        )
+    )
+    # Shared by all groups, to limit the removals running on a same device.
+    deletion_pool = DeletionPool(
+        threads=config.get("clean_threads", 4),
+        threads_per_device=config.get("clean_threads_per_device", 2),
     )
 
-    with callbacks_registrer:
-        for g in groups:
-            g.scan_backup_dir()
-            current_group_config = config.get_groups()[g.name]
-            clean_params = {
-                "hourly": current_group_config.get("hourly", 5),
-                "daily": current_group_config.get("daily", 5),
-                "weekly": current_group_config.get("weekly", 5),
-                "monthly": current_group_config.get("monthly", 5),
-                "yearly": current_group_config.get("yearly", 5),
+    def clean_groups(dir_groups):
+        return [
+            clean_group(g, config.get_groups()[g.name], parsed_args, deletion_pool)
+            for g in dir_groups
+        ]
+
+    failed = False
+    results = {}
+    with callbacks_registrer, deletion_pool:
+        # Groups sharing a backup directory can plan to remove the same backups:
+        # they are cleaned one after the other, other groups at the same time.
+        groups_by_dir = split_groups_by_backup_dir(groups)
+        with concurrent.futures.ThreadPoolExecutor(
+            max(len(groups_by_dir), 1)
+        ) as executor:
+            futures = {
+                executor.submit(clean_groups, dir_groups): dir_groups
+                for dir_groups in groups_by_dir
             }
-            for k, v in clean_params.items():
-                if v is None:
-                    clean_params[k] = "*"
+            for future, dir_groups in futures.items():
+                for g, result in zip(dir_groups, future.result()):
+                    results[g.name] = result
 
-            if not parsed_args.broken_only:
-                print(
-                    "Backups removed for group {}: {}".format(
-                        g.name or "Undefined", len(g.clean(**clean_params))
-                    )
-                )
-            if not parsed_args.no_broken:
-                print(
-                    "Broken backups removed for group {}: {}".format(
-                        g.name or "Undefined", len(g.clean_broken_backups())
-                    )
+    for g in groups:
+        output, group_failed = results[g.name]
+        print(output)
+        failed = failed or group_failed
+
+    if failed:
+        sys.exit(2)
+
+
+def split_groups_by_backup_dir(groups):
+    """
+    :returns: lists of the groups sharing a same backup directory, each list
+              keeping the order of the configuration
+    """
+    groups_by_dir = {}
+    for g in groups:
+        backup_dir = os.path.realpath(g.backup_dir) if g.backup_dir else None
+        groups_by_dir.setdefault(backup_dir, []).append(g)
+
+    return list(groups_by_dir.values())
+
+
+def clean_group(group, group_config, parsed_args, deletion_pool):
+    """
+    :returns: (output to print, True if some backups could not be removed)
+    """
+    group.scan_backup_dir()
+    clean_params = {
+        "hourly": group_config.get("hourly", 5),
+        "daily": group_config.get("daily", 5),
+        "weekly": group_config.get("weekly", 5),
+        "monthly": group_config.get("monthly", 5),
+        "yearly": group_config.get("yearly", 5),
+    }
+    for k, v in clean_params.items():
+        if v is None:
+            clean_params[k] = "*"
+
+    if parsed_args.dry_run:
+        return format_clean_plan(group, clean_params, parsed_args), False
+
+    group_name = group.name or "Undefined"
+    lines = []
+    failed = False
+    if not parsed_args.broken_only:
+        try:
+            removed = group.clean(**clean_params, deletion_pool=deletion_pool)
+        except CleanFailureInGroupError as e:
+            removed = e.removed_backups
+            failed = True
+            lines.extend(_format_clean_errors(e))
+        lines.insert(
+            0, "Backups removed for group {}: {}".format(group_name, len(removed))
+        )
+    if not parsed_args.no_broken:
+        errors = []
+        try:
+            removed = group.clean_broken_backups(deletion_pool=deletion_pool)
+        except CleanFailureInGroupError as e:
+            removed = e.removed_backups
+            failed = True
+            errors = _format_clean_errors(e)
+        lines.append(
+            "Broken backups removed for group {}: {}".format(group_name, len(removed))
+        )
+        lines.extend(errors)
+
+    return "\n".join(lines), failed
+
+
+def _format_clean_errors(clean_failure):
+    return [
+        "\tError with backup {}: {}".format(
+            getattr(b, "name", None) or b.pending_info.get("name"), e
+        )
+        for b, e in clean_failure.exceptions.items()
+    ]
+
+
+def format_clean_plan(group, clean_params, parsed_args):
+    group_name = group.name or "Undefined"
+    lines = []
+    if not parsed_args.broken_only:
+        plan = group.plan_clean(**clean_params)
+        lines.append("Backups to remove for group {}: {}".format(group_name, len(plan)))
+        for domain, b in plan.iter_deletions():
+            lines.append(
+                "\t{}: {}: {}".format(
+                    domain, b.date, b.get_complete_path_of(b.definition_filename)
                 )
+            )
+    if not parsed_args.no_broken:
+        broken_backups = [
+            (domain, b)
+            for domain, backups in group.broken_backups.items()
+            for b in backups
+        ]
+        lines.append(
+            "Broken backups to remove for group {}: {}".format(
+                group_name, len(broken_backups)
+            )
+        )
+        for domain, b in broken_backups:
+            lines.append("\t{}: {}".format(domain, b.pending_info.get("name")))
+
+    return "\n".join(lines)
 
 
 def list_groups(parsed_args, *args, **kwargs):
@@ -337,6 +497,23 @@ def list_groups(parsed_args, *args, **kwargs):
                 print("\t{}: {} backup(s)".format(dom, len(backups)))
 
 
+def reindex_groups(parsed_args, *args, **kwargs):
+    config = get_setup_config(parsed_args.config_path)
+
+    reindexed_dirs = set()
+    for g in get_usable_complete_groups(config, parsed_args.groups):
+        # Groups can share the same backup directory, and so the same catalog.
+        if g.backup_dir in reindexed_dirs or not os.path.isdir(g.backup_dir):
+            continue
+
+        print(
+            "Backups indexed for group {}: {}".format(
+                g.name, BackupCatalog(g.backup_dir).reindex()
+            )
+        )
+        reindexed_dirs.add(g.backup_dir)
+
+
 def _get_all_hosts_and_bak_by_groups(config, conn, callbacks_registrer, filter_names):
     complete_groups = get_usable_complete_groups(config)
     pending_groups = build_all_or_selected_groups(config, conn, callbacks_registrer)
@@ -389,9 +566,24 @@ def get_setup_config(custom_path=None):
 
     compat_layers.config.convert_warn(loaded_config)
     config.from_dict(loaded_config)
+    try:
+        validate_config(config)
+    except ValueError as e:
+        logger.error("Invalid configuration: %s", e)
+        sys.exit(1)
     return config
 
 
+def validate_config(config):
+    """
+    Check the options which would only fail once the backups are started
+
+    :raises ValueError: if an option is invalid
+    """
+    if config.get("deadline") is not None:
+        parse_deadline(config["deadline"])
+
+
 def get_setup_conn(config):
     if config.get("username", None):
         conn = _get_auth_conn(config)
@@ -435,19 +627,16 @@ def get_usable_complete_groups(
         yield g
 
 
-def build_all_or_selected_groups(config, conn, callbacks_registrer, groups=None):
+def build_all_or_selected_groups(
+    config, conn, callbacks_registrer, groups=None, throttle=None
+):
+    all_groups = groups_from_dict(
+        config["groups"], conn, callbacks_registrer, throttle=throttle
+    )
     if not groups:
-        groups = [
-            g
-            for g in groups_from_dict(config["groups"], conn, callbacks_registrer)
-            if g.autostart
-        ]
+        groups = [g for g in all_groups if g.autostart]
     else:
-        groups = [
-            g
-            for g in groups_from_dict(config["groups"], conn, callbacks_registrer)
-            if g.name in groups
-        ]
+        groups = [g for g in all_groups if g.name in groups]
     return groups
 
 
@@ -7,8 +7,10 @@ from virt_backup.domains import get_domain_disks_of
 __all__ = [
     "DomBackup",
     "DomCompleteBackup",
+    "DomCompleteBackupRecord",
     "DomExtSnapshotCallbackRegistrer",
     "build_dom_complete_backup_from_def",
+    "build_dom_complete_backup_record",
     "build_dom_backup_from_pending_info",
 ]
 
@@ -21,6 +23,12 @@ class _BaseDomBackup(ABC):
     dom = None
     packager = ""
     packager_opts = None
+    #: Throttle limiting the bandwidth of the packagers. Not limited if None.
+    throttle = None
+    #: I/O mode of the packagers to read and write the images. Buffered if None.
+    io_mode = None
+    #: size of the buffers of the packagers. Tuned for the storage if None.
+    buffer_size = None
 
     def __init__(self, *args, **kwargs):
         self._cancel_flag = threading.Event()
@@ -59,10 +67,16 @@ class _BaseDomBackup(ABC):
         definition.
         """
         kwargs = {"name": name, "path": self.backup_dir, **self.packager_opts}
+        if self.throttle is not None:
+            kwargs["throttle"] = self.throttle
+        if self.io_mode is not None:
+            kwargs["io_mode"] = self.io_mode
+        if self.buffer_size is not None:
+            kwargs["buffer_size"] = self.buffer_size
         specific_kwargs = {}
         if self.packager == "tar":
             specific_kwargs["archive_name"] = name
-        elif self.packager == "zstd":
+        elif self.packager in ("zstd", "chunkstore"):
             specific_kwargs["name_prefix"] = name
         kwargs.update(specific_kwargs)
 
@@ -98,7 +112,12 @@ class _BaseDomBackup(ABC):
         return os.path.join(self.backup_dir, filename)
 
 
-from .complete import DomCompleteBackup, build_dom_complete_backup_from_def
+from .complete import (
+    DomCompleteBackup,
+    DomCompleteBackupRecord,
+    build_dom_complete_backup_from_def,
+    build_dom_complete_backup_record,
+)
 from .packagers import ReadBackupPackagers, WriteBackupPackagers
 from .pending import DomBackup, build_dom_backup_from_pending_info
 from .snapshot import DomExtSnapshotCallbackRegistrer
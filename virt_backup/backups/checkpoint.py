@@ -0,0 +1,235 @@
+import logging
+import time
+import libvirt
+import lxml.etree
+
+from virt_backup.domains import (
+    DomainXMLCache,
+    get_domain_disks_of,
+    get_domain_incompatible_disks_of,
+)
+from virt_backup.exceptions import BackupJobFailedError, CancelledError
+
+logger = logging.getLogger("virt_backup")
+
+
+def has_checkpoint(dom, name):
+    try:
+        dom.checkpointLookupByName(name)
+    except libvirt.libvirtError:
+        return False
+    return True
+
+
+class DomBackupJob:
+    """
+    Libvirt backup job, which can create a checkpoint (a persistent dirty
+    bitmap on each disk)
+
+    In push mode, libvirt copies the disks into qcow2 images. If a parent
+    checkpoint is given, only the blocks changed since this checkpoint are
+    copied. In pull mode, the disks are exported by a NBD server, to be read
+    until the job is ended.
+    """
+
+    def __init__(
+        self,
+        dom,
+        disks,
+        checkpoint=None,
+        parent_checkpoint=None,
+        poll_interval=1,
+        xml_cache=None,
+    ):
+        #: domain to backup. Has to be a libvirt.virDomain object
+        self.dom = dom
+
+        #: cached definition of the domain, shared with the backup
+        self.xml_cache = DomainXMLCache(dom) if xml_cache is None else xml_cache
+
+        self.disks = disks
+
+        #: name of the checkpoint to create. No checkpoint is created if None.
+        self.checkpoint = checkpoint
+
+        #: name of the checkpoint to start the incremental backup from. Full
+        #  backup if None.
+        self.parent_checkpoint = parent_checkpoint
+
+        #: interval, in seconds, between 2 checks of the job status
+        self.poll_interval = poll_interval
+
+    def start(self, targets, stop_event=None):
+        """
+        Start the backup job and wait for it to end
+
+        :param targets: path of the qcow2 image to create for each disk,
+                        `{disk: path}`
+        """
+        backup_xml = self.gen_libvirt_backup_xml(targets)
+
+        logger.debug(
+            "%s: start backup job, checkpoint %s (parent: %s)",
+            self.dom.name(),
+            self.checkpoint,
+            self.parent_checkpoint,
+        )
+        self.dom.backupBegin(backup_xml, self._get_checkpoint_xml(), 0)
+        try:
+            self.wait(stop_event)
+        except:
+            if self.checkpoint:
+                self.delete_checkpoint(self.checkpoint)
+            raise
+
+    def start_pull(self, socket, scratch_files):
+        """
+        Start a pull mode backup job, exporting the disks as they are at the
+        start of the job. The job runs until ended by :func:`abort`.
+
+        :param socket: path of the unix socket the NBD server has to listen on
+        :param scratch_files: path of the qcow2 image to create for each disk,
+                              `{disk: path}`, where the blocks written by the
+                              guest during the job are first saved
+        :returns: NBD export name of each disk, `{disk: export_name}`
+        """
+        backup_xml = self.gen_libvirt_backup_xml(scratch_files, socket=socket)
+
+        logger.debug(
+            "%s: start pull mode backup job, exported on %s", self.dom.name(), socket
+        )
+        self.dom.backupBegin(backup_xml, self._get_checkpoint_xml(), 0)
+        # Libvirt names the exports after the disks.
+        return {disk: disk for disk in self.disks}
+
+    def _get_checkpoint_xml(self):
+        return self.gen_libvirt_checkpoint_xml() if self.checkpoint else None
+
+    def wait(self, stop_event=None):
+        """
+        Wait for the backup job to end
+        """
+        while self.dom.jobInfo()[0] != libvirt.VIR_DOMAIN_JOB_NONE:
+            if stop_event and stop_event.is_set():
+                self.abort()
+                raise CancelledError()
+            time.sleep(self.poll_interval)
+
+        stats = self.dom.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+        if stats.get("type") != libvirt.VIR_DOMAIN_JOB_COMPLETED:
+            raise BackupJobFailedError(self.dom.name(), stats.get("errmsg"))
+
+    def is_running(self):
+        """
+        Check if a backup job is running on the domain, as started by an
+        aborted backup
+        """
+        if self.dom.jobInfo()[0] == libvirt.VIR_DOMAIN_JOB_NONE:
+            return False
+
+        stats = self.dom.jobStats()
+        return stats.get("operation") == libvirt.VIR_DOMAIN_JOB_OPERATION_BACKUP
+
+    def abort(self):
+        try:
+            self.dom.abortJob()
+        except libvirt.libvirtError as e:
+            logger.debug(
+                "%s: cannot abort backup job: %s",
+                self.dom.name(),
+                e.get_error_message(),
+            )
+
+    def gen_libvirt_backup_xml(self, targets, socket=None):
+        """
+        Generate a xml defining the backup job
+
+        :param targets: path of the image of each disk, `{disk: path}`: the
+                        backup target in push mode, the scratch file in pull
+                        mode
+        :param socket: unix socket of the NBD server, in pull mode. Push mode if
+                       None.
+        """
+        root_el = lxml.etree.Element("domainbackup")
+        root_el.attrib["mode"] = "pull" if socket else "push"
+        xml_tree = root_el.getroottree()
+
+        if self.parent_checkpoint:
+            incremental_el = lxml.etree.Element("incremental")
+            incremental_el.text = self.parent_checkpoint
+            root_el.append(incremental_el)
+
+        if socket:
+            server_el = lxml.etree.Element("server")
+            server_el.attrib["transport"] = "unix"
+            server_el.attrib["socket"] = socket
+            root_el.append(server_el)
+
+        disks_el = lxml.etree.Element("disks")
+        root_el.append(disks_el)
+
+        for d in self._get_domain_disks():
+            disk_el = lxml.etree.Element("disk")
+            disk_el.attrib["name"] = d
+            if d in self.disks:
+                disk_el.attrib["backup"] = "yes"
+                disk_el.attrib["type"] = "file"
+                target_el = lxml.etree.Element("scratch" if socket else "target")
+                target_el.attrib["file"] = targets[d]
+                disk_el.append(target_el)
+                driver_el = lxml.etree.Element("driver")
+                driver_el.attrib["type"] = "qcow2"
+                disk_el.append(driver_el)
+            else:
+                disk_el.attrib["backup"] = "no"
+            disks_el.append(disk_el)
+
+        return lxml.etree.tostring(xml_tree, pretty_print=True).decode()
+
+    def gen_libvirt_checkpoint_xml(self):
+        """
+        Generate a xml defining the checkpoint
+        """
+        root_el = lxml.etree.Element("domaincheckpoint")
+        xml_tree = root_el.getroottree()
+
+        name_el = lxml.etree.Element("name")
+        name_el.text = self.checkpoint
+        root_el.append(name_el)
+
+        descr_el = lxml.etree.Element("description")
+        descr_el.text = "virt-backup checkpoint"
+        root_el.append(descr_el)
+
+        disks_el = lxml.etree.Element("disks")
+        root_el.append(disks_el)
+
+        for d in self._get_domain_disks():
+            disk_el = lxml.etree.Element("disk")
+            disk_el.attrib["name"] = d
+            disk_el.attrib["checkpoint"] = "bitmap" if d in self.disks else "no"
+            disks_el.append(disk_el)
+
+        return lxml.etree.tostring(xml_tree, pretty_print=True).decode()
+
+    def _get_domain_disks(self):
+        dom_xml = self.xml_cache.get_parsed()
+        return sorted(
+            tuple(get_domain_disks_of(dom_xml).keys())
+            + get_domain_incompatible_disks_of(dom_xml)
+        )
+
+    def delete_checkpoint(self, name):
+        """
+        Delete a checkpoint. Its changes are merged in its parent checkpoint, if
+        any.
+        """
+        try:
+            self.dom.checkpointLookupByName(name).delete()
+        except libvirt.libvirtError as e:
+            logger.warning(
+                "%s: cannot delete checkpoint %s: %s",
+                self.dom.name(),
+                name,
+                e.get_error_message(),
+            )
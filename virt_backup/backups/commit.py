@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+import libvirt
+
+from virt_backup.throttle import format_rate
+
+logger = logging.getLogger("virt_backup")
+
+#: lowest bandwidth given to a blockcommit, in bytes per second
+MIN_BANDWIDTH = 2**20
+#: the commit bandwidth is kept above the guest write rate times this margin, to
+#  converge even when the latency target is exceeded
+CONVERGENCE_MARGIN = 1.25
+#: factors applied on the bandwidth when the latency target is exceeded, or met
+DECREASE_FACTOR = 0.5
+INCREASE_FACTOR = 1.5
+
+
+class _CommitState:
+    def __init__(self, bandwidth):
+        #: current bandwidth limit, in bytes per second. Unlimited if 0.
+        self.bandwidth = bandwidth
+
+        self.last_poll = None
+        self.last_cur = None
+        self.last_stats = None
+
+
+class BlockCommitController:
+    """
+    Adapt the bandwidth of the active blockcommits of a domain
+
+    The progress of each blockcommit and the write statistics of its disk are
+    polled. While the guest write latency stays under the latency target, the
+    bandwidth is increased up to the throughput target, so commits on idle
+    domains end fast. When the latency target is exceeded, the bandwidth is
+    halved, but kept above the guest write rate for the commit to converge.
+    """
+
+    def __init__(self, dom, max_bandwidth=None, latency_target=None, poll_interval=1):
+        #: domain to commit. Has to be a libvirt.virDomain object
+        self.dom = dom
+
+        #: throughput target: maximum bandwidth of each commit, in bytes per
+        #  second. Unlimited if None.
+        self.max_bandwidth = max_bandwidth
+
+        #: maximum guest write latency, in seconds, before slowing down the
+        #  commits. Not checked if None.
+        self.latency_target = latency_target
+
+        #: interval, in seconds, between 2 adjustments of the bandwidth
+        self.poll_interval = poll_interval
+
+        self._commits = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def initial_bandwidth(self):
+        """
+        Bandwidth to start a blockcommit with, in bytes per second. Unlimited if 0.
+        """
+        return self.max_bandwidth or 0
+
+    def add(self, disk):
+        """
+        Control the blockcommit of disk, started with self.initial_bandwidth
+        """
+        with self._lock:
+            self._commits[disk] = _CommitState(self.initial_bandwidth)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="blockcommit-controller-{}".format(self.dom.name()),
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def remove(self, disk):
+        """
+        Stop controlling the blockcommit of disk, once ready to pivot
+        """
+        with self._lock:
+            self._commits.pop(disk, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            with self._lock:
+                commits = tuple(self._commits.items())
+                if not commits:
+                    self._thread = None
+                    return
+
+            for disk, state in commits:
+                try:
+                    if not self.adjust(disk, state):
+                        self.remove(disk)
+                except libvirt.libvirtError as e:
+                    # The job can end between 2 polls.
+                    logger.debug(
+                        "%s: cannot adjust the blockcommit of %s: %s",
+                        self.dom.name(),
+                        disk,
+                        e,
+                    )
+
+    def adjust(self, disk, state):
+        """
+        Poll the blockcommit of disk, and adjust its bandwidth
+
+        :returns: False if the blockcommit has ended
+        """
+        now = time.monotonic()
+        info = self.dom.blockJobInfo(disk, 0)
+        if not info:
+            return False
+        stats = self.dom.blockStatsFlags(disk)
+
+        previous = (state.last_poll, state.last_cur, state.last_stats)
+        state.last_poll, state.last_cur, state.last_stats = now, info["cur"], stats
+        if previous[0] is None:
+            return True
+
+        elapsed = now - previous[0]
+        commit_rate = (info["cur"] - previous[1]) / elapsed
+        write_rate = (stats["wr_bytes"] - previous[2]["wr_bytes"]) / elapsed
+        write_ops = stats["wr_operations"] - previous[2]["wr_operations"]
+        latency = (
+            (stats["wr_total_times"] - previous[2]["wr_total_times"]) / write_ops / 1e9
+            if write_ops
+            else 0
+        )
+
+        bandwidth = self._compute_bandwidth(
+            state.bandwidth, commit_rate, write_rate, latency
+        )
+        if bandwidth == state.bandwidth:
+            return True
+
+        logger.debug(
+            (
+                "%s: blockcommit of %s at %s, guest writing at %s with %.1fms of "
+                "latency, set bandwidth to %s"
+            ),
+            self.dom.name(),
+            disk,
+            format_rate(commit_rate),
+            format_rate(write_rate),
+            latency * 1000,
+            format_rate(bandwidth) if bandwidth else "unlimited",
+        )
+        self.dom.blockJobSetSpeed(
+            disk, int(bandwidth), libvirt.VIR_DOMAIN_BLOCK_JOB_SPEED_BANDWIDTH_BYTES
+        )
+        state.bandwidth = bandwidth
+        return True
+
+    def _compute_bandwidth(self, bandwidth, commit_rate, write_rate, latency):
+        """
+        :returns: new bandwidth of a commit, in bytes per second. Unlimited if 0.
+        """
+        if self.latency_target is not None and latency > self.latency_target:
+            current = min(bandwidth, commit_rate) if bandwidth else commit_rate
+            floor = max(write_rate * CONVERGENCE_MARGIN, MIN_BANDWIDTH)
+            bandwidth = max(current * DECREASE_FACTOR, floor)
+            return min(bandwidth, self.max_bandwidth or bandwidth)
+
+        if not bandwidth:
+            return bandwidth
+
+        bandwidth *= INCREASE_FACTOR
+        if self.max_bandwidth:
+            return min(bandwidth, self.max_bandwidth)
+        elif bandwidth > commit_rate * 2:
+            # The limit does not slow down the commit anymore.
+            return 0
+        return bandwidth
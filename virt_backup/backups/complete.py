@@ -1,16 +1,28 @@
 import arrow
+import concurrent.futures
+import json
 import logging
 import lxml.etree
 import os
 import shutil
+import subprocess
 import tarfile
+import tempfile
+import time
 
 from virt_backup.backups.packagers import ReadBackupPackagers, WriteBackupPackagers
+from virt_backup.catalog import get_catalog_of_domain_dir
 from virt_backup.compat_layers.definition import convert as compat_convert_definition
 from virt_backup.domains import get_domain_disks_of
-from virt_backup.exceptions import DomainRunningError
+from virt_backup.exceptions import (
+    CancelledError,
+    DomainRunningError,
+    ImageFoundError,
+    ParentBackupNotFoundError,
+)
 from virt_backup.tools import copy_file
 from . import _BaseDomBackup
+from .delta import DeltaMergeTarget, ImagePipe
 
 logger = logging.getLogger("virt_backup")
 
@@ -28,6 +40,11 @@ def build_dom_complete_backup_from_def(
         disks=definition.get("disks", None),
         packager=definition["packager"]["type"],
         packager_opts=definition["packager"].get("opts", {}),
+        backup_mode=definition.get("backup_mode", "full"),
+        checkpoint=definition.get("checkpoint", None),
+        parent=definition.get("parent", None),
+        block_hashes=definition.get("block_hashes", None),
+        backup_engine=definition.get("backup_engine", "snapshot"),
     )
 
     if definition_filename:
@@ -36,6 +53,99 @@ def build_dom_complete_backup_from_def(
     return backup
 
 
+def build_dom_complete_backup_record(summary, backup_dir, definition_filename):
+    """
+    :param summary: summary of the definition, as returned by
+        :func:`virt_backup.catalog.summarize_definition`
+    """
+    return DomCompleteBackupRecord(
+        name=summary["name"],
+        dom_name=summary["domain_name"],
+        backup_dir=backup_dir,
+        definition_filename=definition_filename,
+        timestamp=summary["date"],
+        backup_mode=summary["backup_mode"],
+        parent=summary["parent"],
+    )
+
+
+class DomCompleteBackupRecord:
+    """
+    Lightweight record of a complete backup, as listed from a backup directory
+
+    Only what is needed to list, sort and select the backups is kept. Any other
+    attribute (domain XML, disks, packager options…) or method (restore, delete…)
+    is read from the full DomCompleteBackup, built from the definition file on
+    first access.
+    """
+
+    __slots__ = (
+        "name",
+        "dom_name",
+        "backup_dir",
+        "definition_filename",
+        "timestamp",
+        "backup_mode",
+        "parent",
+        "_date",
+        "_backup",
+    )
+
+    def __init__(
+        self,
+        name,
+        dom_name,
+        backup_dir,
+        definition_filename,
+        timestamp,
+        backup_mode="full",
+        parent=None,
+    ):
+        self.name = name
+        self.dom_name = dom_name
+        self.backup_dir = backup_dir
+        self.definition_filename = definition_filename
+        #: backup date, as a unix timestamp
+        self.timestamp = timestamp
+        self.backup_mode = backup_mode or "full"
+        self.parent = parent
+        self._date = None
+        self._backup = None
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = arrow.get(self.timestamp)
+        return self._date
+
+    def get_complete_path_of(self, filename):
+        return os.path.join(self.backup_dir, filename)
+
+    def get_backup(self):
+        """
+        :returns: the full DomCompleteBackup, built on first call
+        """
+        if self._backup is None:
+            definition_path = self.get_complete_path_of(self.definition_filename)
+            with open(definition_path, "r") as definition_file:
+                definition = json.load(definition_file)
+            self._backup = build_dom_complete_backup_from_def(
+                definition,
+                self.backup_dir,
+                definition_filename=self.definition_filename,
+            )
+        return self._backup
+
+    def __getattr__(self, attr):
+        # Only called for what the record does not have.
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        return getattr(self.get_backup(), attr)
+
+    def __repr__(self):
+        return "<{} {}>".format(type(self).__name__, self.name)
+
+
 class DomCompleteBackup(_BaseDomBackup):
     def __init__(
         self,
@@ -48,6 +158,11 @@ class DomCompleteBackup(_BaseDomBackup):
         packager="tar",
         packager_opts=None,
         definition_filename=None,
+        backup_mode="full",
+        checkpoint=None,
+        parent=None,
+        block_hashes=None,
+        backup_engine="snapshot",
     ):
         super().__init__()
 
@@ -78,6 +193,32 @@ class DomCompleteBackup(_BaseDomBackup):
         #: expected format: {disk_name1: filename1, disk_name2: filename2, …}
         self.disks = disks
 
+        #: "full", "incremental" or "delta"
+        self.backup_mode = backup_mode or "full"
+
+        #: libvirt checkpoint created by the backup job. None if the backup was
+        #  not done by a backup job.
+        self.checkpoint = checkpoint
+
+        #: name of the backup this one is an increment or a delta of
+        self.parent = parent
+
+        #: hashes of each block of the disks, stored by the full backups done in
+        #  delta mode. Expected format:
+        #  {"block_size": size, "disks": {disk_name1: filename1, …}}
+        self.block_hashes = block_hashes
+
+        #: engine which read the disks: "snapshot", or "pull" if read from the
+        #  raw NBD exports of a pull mode backup job
+        self.backup_engine = backup_engine or "snapshot"
+
+    @property
+    def timestamp(self):
+        """
+        Backup date, as a unix timestamp
+        """
+        return self.date.int_timestamp if self.date is not None else None
+
     def restore_replace_domain(self, conn, id=None):
         """
         :param conn: libvirt connection to the hypervisor
@@ -141,27 +282,328 @@ class DomCompleteBackup(_BaseDomBackup):
             except IndexError:
                 continue
 
-    def restore_to(self, target):
+    def restore_to(self, target, threads=0, progress_interval=30):
+        """
+        Restore all the disks and the domain XML into a directory
+
+        The read packager is opened once for all the disks. If the packager
+        allows it, the disks are restored concurrently.
+
+        :param target: destination directory
+        :param threads: maximum number of disks to restore at the same time. One
+                        per disk if 0.
+        :param progress_interval: interval, in seconds, between 2 progress logs
+                                  of the disks being restored
+        """
         if not os.path.exists(target):
             os.makedirs(target)
 
         # TODO: store the original images names in the definition file
         disks_src = get_domain_disks_of(self.dom_xml)
-        for d in self.disks:
-            original_img_name = os.path.basename(disks_src[d]["src"])
-            self.restore_disk_to(d, os.path.join(target, original_img_name))
+        targets = {
+            d: os.path.join(target, os.path.basename(disks_src[d]["src"]))
+            for d in self.disks
+        }
+
+        packager = self._get_packager()
+        with packager:
+            self._restore_disks_to(targets, packager, threads, progress_interval)
+
         xml_path = "{}.xml".format(os.path.join(target, self.dom_name))
         with open(xml_path, "w") as xml_file:
             xml_file.write(self.dom_xml or "")
 
-    def restore_disk_to(self, disk, target):
+    def _restore_disks_to(self, targets, packager, threads=0, progress_interval=30):
+        """
+        Restore disks from an opened packager, on a pool of workers, and log the
+        progress of each disk
+
+        :param targets: destination path of each disk, `{disk: target}`
+        """
+        workers = 1
+        if packager.concurrent_restore:
+            workers = min(threads or len(targets), len(targets)) or 1
+        logger.info(
+            "%s: Restore %s disks with %s workers",
+            self.dom_name,
+            len(targets),
+            workers,
+        )
+
+        started = {}
+
+        def restore(disk):
+            started[disk] = time.monotonic()
+            logger.info("%s: Restore disk %s", self.dom_name, disk)
+            result = self.restore_disk_to(disk, targets[disk], packager)
+            logger.info(
+                "%s: Disk %s restored in %.1fs",
+                self.dom_name,
+                disk,
+                time.monotonic() - started.pop(disk),
+            )
+            return result
+
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            not_done = {executor.submit(restore, d) for d in targets}
+            try:
+                while not_done:
+                    done, not_done = concurrent.futures.wait(
+                        not_done,
+                        timeout=progress_interval,
+                        return_when=concurrent.futures.FIRST_EXCEPTION,
+                    )
+                    for future in done:
+                        future.result()
+                    for disk, start in list(started.items()):
+                        self._log_restore_progress(disk, targets[disk], start)
+            except:
+                # Do not start the disks still waiting for a worker, but let the
+                # running ones end.
+                for future in not_done:
+                    future.cancel()
+                raise
+
+    def _log_restore_progress(self, disk, target, start):
+        try:
+            size = os.path.getsize(target)
+        except OSError:
+            # Not created yet, or the disk is restored elsewhere first (for
+            # backing chains).
+            size = 0
+        logger.info(
+            "%s: Restoring disk %s, %.1f MiB written in %.0fs",
+            self.dom_name,
+            disk,
+            size / 2**20,
+            time.monotonic() - start,
+        )
+
+    def restore_disk_to(self, disk, target, packager=None):
         """
         :param disk: disk name
         :param target: destination path for the restoration
+        :param packager: opened read packager of this backup. A new one is opened
+                         if not set.
         """
+        if self.checkpoint:
+            return self._restore_chain_disk_to(disk, target, packager)
+        elif self.backup_mode == "delta":
+            return self._restore_delta_disk_to(disk, target, packager)
+        elif self.backup_engine == "pull":
+            return self._restore_pull_disk_to(disk, target, packager)
+
+        return self._restore_with_packager(self.disks[disk], target, packager)
+
+    def _restore_with_packager(self, name, target, packager=None, stop_event=None):
+        """
+        Restore an image with packager, if it is set, otherwise open a new
+        packager
+        """
+        stop_event = stop_event or self._cancel_flag
+        if packager is not None:
+            return packager.restore(name, target, stop_event)
+
         packager = self._get_packager()
         with packager:
-            return packager.restore(self.disks[disk], target, self._cancel_flag)
+            return packager.restore(name, target, stop_event)
+
+    def _restore_chain_disk_to(self, disk, target, packager=None):
+        """
+        Restore a disk exported by a backup job, by rebuilding the image from the
+        backing chain (the full backup, then each incremental backup).
+
+        Images exported by the backup jobs are qcow2, they are converted back to
+        the disk format.
+        """
+        if not os.path.exists(target) and target.endswith("/"):
+            os.makedirs(target)
+        if os.path.isdir(target):
+            target = os.path.join(target, self.disks[disk])
+        if os.path.isfile(target):
+            raise ImageFoundError(target)
+
+        disk_format = self._get_disk_format(disk)
+        chain = self.get_backing_chain()
+        tmp_dir = tempfile.mkdtemp(
+            prefix=".{}.".format(self.name), dir=os.path.dirname(target)
+        )
+        try:
+            images = []
+            for backup in chain:
+                images.append(
+                    backup._restore_with_packager(
+                        backup.disks[disk],
+                        os.path.join(tmp_dir, backup.disks[disk]),
+                        packager if backup is self else None,
+                        self._cancel_flag,
+                    )
+                )
+
+            for parent_image, image in zip(images, images[1:]):
+                self._qemu_img_rebase(image, parent_image)
+            self._qemu_img_convert(images[-1], target, disk_format)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return target
+
+    def _restore_delta_disk_to(self, disk, target, packager=None):
+        """
+        Restore the disk of the base backup, with the changed blocks of the delta
+        written instead of its own, in one sequential pass
+        """
+        base = self.get_parent()
+        if not os.path.exists(target) and target.endswith("/"):
+            os.makedirs(target)
+        if os.path.isdir(target):
+            # Use the image extension of the base backup rather than ".delta".
+            target = os.path.join(
+                target,
+                "{}{}".format(
+                    os.path.splitext(self.disks[disk])[0],
+                    os.path.splitext(base.disks[disk])[1],
+                ),
+            )
+        if os.path.isfile(target):
+            raise ImageFoundError(target)
+
+        # The delta is restored in a thread, and merged with the base image while
+        # it is restored.
+        delta = ImagePipe(self.disks[disk])
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(self._restore_delta_to_pipe, disk, delta, packager)
+            try:
+                base._restore_with_packager(
+                    base.disks[disk],
+                    DeltaMergeTarget(target, delta, self.io_mode),
+                    stop_event=self._cancel_flag,
+                )
+                future.result()
+            except:
+                delta.close()
+                if os.path.exists(target):
+                    os.remove(target)
+                raise
+
+        return target
+
+    def _restore_delta_to_pipe(self, disk, pipe, packager=None):
+        try:
+            self._restore_with_packager(self.disks[disk], pipe, packager)
+        except BaseException as e:
+            try:
+                pipe.abort(e)
+            except CancelledError:
+                pass
+            raise
+
+    def _restore_pull_disk_to(self, disk, target, packager=None):
+        """
+        Restore a disk read from a NBD export. Exports are raw, images are
+        converted back to the disk format.
+        """
+        disk_format = self._get_disk_format(disk)
+        if disk_format == "raw":
+            return self._restore_with_packager(self.disks[disk], target, packager)
+
+        if not os.path.exists(target) and target.endswith("/"):
+            os.makedirs(target)
+        if os.path.isdir(target):
+            target = os.path.join(
+                target,
+                "{}.{}".format(os.path.splitext(self.disks[disk])[0], disk_format),
+            )
+        if os.path.isfile(target):
+            raise ImageFoundError(target)
+
+        tmp_dir = tempfile.mkdtemp(
+            prefix=".{}.".format(self.name), dir=os.path.dirname(target)
+        )
+        try:
+            image = self._restore_with_packager(
+                self.disks[disk], os.path.join(tmp_dir, self.disks[disk]), packager
+            )
+            self._qemu_img_convert(image, target, disk_format, source_format="raw")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        return target
+
+    def _get_disk_format(self, disk):
+        if self.dom_xml:
+            disks = get_domain_disks_of(self.dom_xml)
+            if disk in disks and disks[disk]["type"]:
+                return disks[disk]["type"]
+
+        return "qcow2"
+
+    def _qemu_img_rebase(self, image, backing_image):
+        """
+        Set the backing file of an incremental image, without touching its data
+        """
+        return subprocess.check_call(
+            (
+                "qemu-img",
+                "rebase",
+                "-u",
+                "-f",
+                "qcow2",
+                "-F",
+                "qcow2",
+                "-b",
+                backing_image,
+                image,
+            )
+        )
+
+    def _qemu_img_convert(self, image, target, target_format, source_format="qcow2"):
+        """
+        Convert image into target, flattening its backing chain
+        """
+        return subprocess.check_call(
+            (
+                "qemu-img",
+                "convert",
+                "-f",
+                source_format,
+                "-O",
+                target_format,
+                image,
+                target,
+            )
+        )
+
+    def get_backing_chain(self):
+        """
+        Get the backups needed to restore this backup, from the full backup to
+        this one.
+        """
+        chain = [self]
+        while chain[-1].parent:
+            chain.append(chain[-1].get_parent())
+
+        return list(reversed(chain))
+
+    def get_parent(self):
+        """
+        Get the backup this one is an increment of
+        """
+        if not self.parent:
+            return None
+
+        definition_filename = os.path.join(
+            self.backup_dir, "{}.json".format(self.parent)
+        )
+        try:
+            with open(definition_filename, "r") as definition_file:
+                definition = json.load(definition_file)
+        except FileNotFoundError:
+            raise ParentBackupNotFoundError(self.name, self.parent)
+
+        return build_dom_complete_backup_from_def(
+            definition, self.backup_dir, definition_filename=definition_filename
+        )
 
     def _get_packager(self):
         return self._get_read_packager(self.name)
@@ -173,7 +615,14 @@ class DomCompleteBackup(_BaseDomBackup):
         if not self.backup_dir:
             raise Exception("Backup dir not defined, cannot clean backup")
 
-        packager = self._get_write_packager()
-        self._clean_packager(packager, self.disks.values())
-        if self.definition_filename:
-            os.remove(self.get_complete_path_of(self.definition_filename))
+        catalog = get_catalog_of_domain_dir(self.backup_dir)
+        with catalog.updating(self.backup_dir) as catalog_changes:
+            packager = self._get_write_packager()
+            self._clean_packager(packager, self.disks.values())
+            if self.block_hashes:
+                for hashes_filename in self.block_hashes.get("disks", {}).values():
+                    self._delete_with_error_printing(hashes_filename)
+            if self.definition_filename:
+                definition_path = self.get_complete_path_of(self.definition_filename)
+                os.remove(definition_path)
+                catalog_changes.remove(definition_path)
@@ -0,0 +1,735 @@
+import array
+import collections
+import concurrent.futures
+import hashlib
+import io
+import os
+import queue
+import struct
+import threading
+
+from virt_backup.exceptions import CancelledError, DeltaCorruptedError
+from virt_backup.backups.packagers.buffers import readinto_full
+from virt_backup.backups.packagers.iomode import open_source, open_target
+from virt_backup.backups.packagers.sparse import (
+    get_image_size,
+    is_zero,
+    iter_image_extents,
+)
+
+#: size of the blocks compared between 2 backups
+BLOCK_SIZE = 2**16
+
+#: size of each block hash, in bytes
+HASH_SIZE = 16
+
+#: number of blocks read and hashed at once
+BATCH_BLOCKS = 256
+
+#: number of chunks written in an ImagePipe and not read yet
+PIPE_DEPTH = 16
+
+DELTA_MAGIC = b"VBDELTA1"
+_DELTA_HEADER = struct.Struct("<8sIQ")
+_DELTA_RECORD = struct.Struct("<Q")
+
+_ZEROS = bytes(2**20)
+
+
+def hash_batch(data, block_size=BLOCK_SIZE):
+    """
+    Hash each block of data
+
+    blake2b releases the GIL, so batches can be hashed in parallel on a pool of
+    threads.
+
+    :returns: the concatenated hashes
+    """
+    view = memoryview(data)
+    return b"".join(
+        hashlib.blake2b(view[i : i + block_size], digest_size=HASH_SIZE).digest()
+        for i in range(0, len(view), block_size)
+    )
+
+
+def iter_hashed_batches(fileobj, block_size=BLOCK_SIZE, threads=None, stop_event=None):
+    """
+    Read a file by batches of blocks, hashed in parallel while the next batches
+    are read.
+
+    :returns: generator of `(offset, data, hashes)` for each batch, in order.
+        `hashes` is the concatenation of the hashes of each block.
+    """
+    threads = threads or os.cpu_count()
+    batch_size = block_size * BATCH_BLOCKS
+    pending = []
+    offset = 0
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        while True:
+            if stop_event and stop_event.is_set():
+                raise CancelledError()
+
+            data = bytearray(batch_size)
+            read = fileobj.readinto(data)
+            if read:
+                del data[read:]
+                pending.append(
+                    (offset, data, executor.submit(hash_batch, data, block_size))
+                )
+                offset += read
+
+            while pending and (not read or len(pending) > threads):
+                batch_offset, batch_data, future = pending.pop(0)
+                yield batch_offset, batch_data, future.result()
+
+            if not read:
+                return
+
+
+def _open_image(src, io_mode=None):
+    if not isinstance(src, (str, bytes, os.PathLike)):
+        return src.open()
+    return open_source(src, io_mode)
+
+
+class BlockHasher:
+    """
+    Hash each block of an image from its data, given in order as it is read
+
+    The ranges skipped between the data, as the holes of a sparse image, are
+    hashed as zeros. Blocks are hashed by batches, in parallel on a pool of
+    threads, and their hashes written in order in fileobj.
+    """
+
+    def __init__(self, fileobj, block_size=BLOCK_SIZE, threads=None):
+        self.fileobj = fileobj
+        self.block_size = block_size
+
+        #: size of the image hashed so far, holes included
+        self.offset = 0
+
+        #: set if some data was not given in order: the hashes cannot be computed
+        self.unordered = False
+
+        self._threads = threads or os.cpu_count()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self._threads)
+        self._batch = bytearray()
+        self._zero_hash = hash_batch(bytes(block_size), block_size)
+
+        #: hashes to write in order: futures of batches, or numbers of zero blocks
+        self._pending = collections.deque()
+
+    def update(self, offset, data):
+        if self.unordered:
+            return
+        elif offset < self.offset:
+            self.unordered = True
+            return
+
+        if offset > self.offset:
+            self._add_zeros(offset - self.offset)
+        self._add_data(data)
+
+    def finish(self, size):
+        """
+        Hash the end of the image, up to size, and write the remaining hashes
+
+        :returns: if the hashes of all the blocks could be written
+        """
+        if self.unordered or self.offset > size:
+            return False
+
+        self._add_zeros(size - self.offset)
+        self._submit_batch()
+        self._write_hashes(wait=True)
+        self.close()
+        return True
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def _add_data(self, data):
+        view = memoryview(data).cast("B")
+        batch_size = self.block_size * BATCH_BLOCKS
+        while view:
+            length = min(batch_size - len(self._batch), len(view))
+            self._batch += view[:length]
+            view = view[length:]
+            self.offset += length
+            if len(self._batch) == batch_size:
+                self._submit_batch()
+
+    def _add_zeros(self, length):
+        # Only complete the current block with zeros, the next whole blocks all
+        # have the same hash.
+        partial = min(-self.offset % self.block_size, length)
+        if partial:
+            self._add_data(_ZEROS[:partial])
+            length -= partial
+
+        blocks, remainder = divmod(length, self.block_size)
+        if blocks:
+            self._submit_batch()
+            self._pending.append(blocks)
+            self.offset += blocks * self.block_size
+        while remainder:
+            zeros = _ZEROS[:remainder]
+            self._add_data(zeros)
+            remainder -= len(zeros)
+
+    def _submit_batch(self):
+        if self._batch:
+            self._pending.append(
+                self._executor.submit(hash_batch, self._batch, self.block_size)
+            )
+            self._batch = bytearray()
+        self._write_hashes()
+
+    def _write_hashes(self, wait=False):
+        """
+        Write the hashes computed, in order
+
+        :param wait: wait for all the batches to be hashed. Otherwise, only wait
+            if more batches are being hashed than threads to hash them.
+        """
+        while self._pending:
+            item = self._pending[0]
+            if isinstance(item, int):
+                for i in range(0, item, 2**16):
+                    self.fileobj.write(self._zero_hash * min(item - i, 2**16))
+            elif wait or item.done() or len(self._pending) > self._threads:
+                self.fileobj.write(item.result())
+            else:
+                return
+            self._pending.popleft()
+
+
+class HashingImage:
+    """
+    Image source hashing each block of an image while a packager reads it, to
+    compare the next delta backups with
+
+    The hashes are only complete if the packager read the image in order, see
+    :class:`BlockHasher`.
+    """
+
+    def __init__(
+        self, src, hashes_fileobj, block_size=BLOCK_SIZE, io_mode=None, threads=None
+    ):
+        #: path of the image, or an image source (as a NBD export)
+        self.src = src
+
+        self.hashes_fileobj = hashes_fileobj
+        self.block_size = block_size
+        self.io_mode = io_mode
+        self.threads = threads
+
+        self._hasher = None
+        self._size = None
+
+    def open(self):
+        fileobj = _open_image(self.src, self.io_mode)
+        if self._hasher is not None:
+            # Read twice, the hashes already written cannot be trusted.
+            self._hasher.unordered = True
+        else:
+            self._hasher = BlockHasher(
+                self.hashes_fileobj, self.block_size, self.threads
+            )
+        reader = _HashingReader(fileobj, self._hasher)
+        self._size = reader.size
+        return reader
+
+    def finish(self):
+        """
+        Write the hashes of the blocks not hashed yet, once the image is read
+
+        :returns: if the hashes of all the blocks could be written
+        """
+        return self._hasher is not None and self._hasher.finish(self._size)
+
+    def close(self):
+        if self._hasher is not None:
+            self._hasher.close()
+
+    def __str__(self):
+        return str(self.src)
+
+
+class _HashingReader(io.RawIOBase):
+    """
+    Read-only file object on an image, giving the data read to a BlockHasher
+
+    No file descriptor is exposed, so the image cannot be copied without being
+    read by the reader.
+    """
+
+    def __init__(self, fileobj, hasher):
+        super().__init__()
+        self.name = getattr(fileobj, "name", None)
+        self._fileobj = fileobj
+        self._hasher = hasher
+        self._position = 0
+        try:
+            self.size = get_image_size(fileobj)
+        except:
+            fileobj.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._position = self._fileobj.seek(offset, whence)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        count = self._fileobj.readinto(view)
+        if count:
+            self._hasher.update(self._position, view[:count])
+            self._position += count
+        return count
+
+    def iter_data_extents(self, size=None):
+        return iter_image_extents(self._fileobj, size)
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._fileobj.close()
+        super().close()
+
+
+class DeltaImage:
+    """
+    Delta of an image since a base image, which can be added to a packager like
+    an image path
+
+    A delta is a header (magic, block size, image size), followed by a record
+    per changed block: its index, then its data.
+
+    Opening it hashes the whole image, to find the blocks which hash changed and
+    know the size of the delta. Reading it then only reads the changed blocks
+    again, so the delta is not written anywhere else than in the packager.
+    """
+
+    def __init__(
+        self,
+        src,
+        base_hashes,
+        block_size=BLOCK_SIZE,
+        io_mode=None,
+        threads=None,
+        stop_event=None,
+    ):
+        #: path of the image, or an image source (as a NBD export)
+        self.src = src
+
+        #: concatenated hashes of the blocks of the base image
+        self.base_hashes = base_hashes
+
+        self.block_size = block_size
+        self.io_mode = io_mode
+        self.threads = threads
+        self.stop_event = stop_event
+
+        #: number of blocks changed, known once opened
+        self.changed_blocks = None
+
+    def open(self):
+        fileobj = _open_image(self.src, self.io_mode)
+        try:
+            blocks = array.array("Q")
+            size = 0
+            for offset, data, hashes in iter_hashed_batches(
+                fileobj, self.block_size, self.threads, self.stop_event
+            ):
+                first_block = offset // self.block_size
+                for i in range(0, len(hashes), HASH_SIZE):
+                    block = first_block + i // HASH_SIZE
+                    base_hash = self.base_hashes[
+                        block * HASH_SIZE : (block + 1) * HASH_SIZE
+                    ]
+                    if hashes[i : i + HASH_SIZE] != base_hash:
+                        blocks.append(block)
+                size = offset + len(data)
+        except:
+            fileobj.close()
+            raise
+
+        self.changed_blocks = len(blocks)
+        return _DeltaReader(fileobj, size, self.block_size, blocks, str(self))
+
+    def __str__(self):
+        return "{}.delta".format(self.src)
+
+
+class _DeltaReader(io.RawIOBase):
+    """
+    Read-only file object on a delta, reading the changed blocks from the image
+    """
+
+    def __init__(self, fileobj, image_size, block_size, blocks, name):
+        super().__init__()
+        self.name = name
+        self._fileobj = fileobj
+        self._image_size = image_size
+        self._block_size = block_size
+        self._blocks = blocks
+        self._header = _DELTA_HEADER.pack(DELTA_MAGIC, block_size, image_size)
+        self._record_size = _DELTA_RECORD.size + block_size
+        self._position = 0
+
+        self.size = len(self._header) + len(blocks) * self._record_size
+        if blocks:
+            # Only the last block of the image can be partial.
+            self.size -= max(0, (blocks[-1] + 1) * block_size - image_size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        read = 0
+        while read < len(view) and self._position < self.size:
+            part = view[read:]
+            if self._position < len(self._header):
+                count = self._copy(self._header[self._position :], part)
+            else:
+                index, start = divmod(
+                    self._position - len(self._header), self._record_size
+                )
+                block = self._blocks[index]
+                if start < _DELTA_RECORD.size:
+                    count = self._copy(_DELTA_RECORD.pack(block)[start:], part)
+                else:
+                    count = self._read_block(block, start - _DELTA_RECORD.size, part)
+
+            self._position += count
+            read += count
+
+        return read
+
+    def _copy(self, data, view):
+        count = min(len(data), len(view))
+        view[:count] = data[:count]
+        return count
+
+    def _read_block(self, block, start, view):
+        offset = block * self._block_size + start
+        length = min(len(view), self._block_size - start, self._image_size - offset)
+        self._fileobj.seek(offset)
+        if readinto_full(self._fileobj, view[:length]) != length:
+            raise EOFError("{}: image shorter than expected".format(self.name))
+        return length
+
+    def iter_data_extents(self, size=None):
+        size = self.size if size is None else min(size, self.size)
+        if size:
+            yield 0, size
+
+    def close(self):
+        if self.closed:
+            return
+
+        self._fileobj.close()
+        super().close()
+
+
+class ImagePipe:
+    """
+    Image target read by another thread as it is written, through a bounded queue
+
+    The image has to be written in order: the ranges seeked over are read as
+    zeros.
+    """
+
+    def __init__(self, name, depth=PIPE_DEPTH):
+        self.name = name
+        self._queue = queue.Queue(depth)
+        self._closed = threading.Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+
+    def open(self):
+        return _PipeWriter(self)
+
+    def read(self, size):
+        """
+        :returns: up to size bytes, or b"" at the end of the image
+        """
+        while not self._chunk and not self._eof:
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, BaseException):
+                raise item
+            else:
+                self._chunk = memoryview(item)
+
+        data = bytes(self._chunk[:size])
+        self._chunk = self._chunk[size:]
+        return data
+
+    def abort(self, error):
+        """
+        Make the reads fail with error, raised while writing the image
+        """
+        self._put(error)
+
+    def close(self):
+        """
+        Stop reading the image: writing it then fails
+        """
+        self._closed.set()
+
+    def _put(self, item):
+        while True:
+            if self._closed.is_set():
+                raise CancelledError()
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __str__(self):
+        return self.name
+
+
+class _PipeWriter:
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._position = 0
+
+    def write(self, data):
+        if len(data):
+            self._pipe._put(bytes(data))
+            self._position += len(data)
+        return len(data)
+
+    def seek(self, position):
+        if position < self._position:
+            raise ValueError("{}: cannot seek backward".format(self._pipe))
+        self._write_zeros(position - self._position)
+        return position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size):
+        self.seek(size)
+        return size
+
+    def _write_zeros(self, length):
+        while length:
+            zeros = _ZEROS[:length]
+            self.write(zeros)
+            length -= len(zeros)
+
+    def close(self):
+        self._pipe._put(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # On error, the reads are aborted by whoever writes in the pipe.
+        if exc_type is None:
+            self.close()
+
+
+class DeltaMergeTarget:
+    """
+    Image target merging the image restored in it with a delta of this image
+
+    The image and the delta are both read in order, so the target is written in
+    one sequential pass: each block is either written from the image, or from
+    the delta.
+    """
+
+    def __init__(self, path, delta, io_mode=None):
+        #: path of the merged image
+        self.path = path
+
+        #: delta, as a file object read in order, as an ImagePipe
+        self.delta = delta
+
+        self.io_mode = io_mode
+
+    def open(self):
+        records = _DeltaRecords(self.delta)
+        return _DeltaMergeWriter(open_target(self.path, self.io_mode), records)
+
+    def __str__(self):
+        return self.path
+
+
+class _DeltaRecords:
+    """
+    Read the records of a delta, in order
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.name = str(fileobj)
+        try:
+            magic, self.block_size, self.size = _DELTA_HEADER.unpack(
+                self._read(_DELTA_HEADER.size)
+            )
+        except struct.error:
+            raise DeltaCorruptedError(self.name)
+        if magic != DELTA_MAGIC:
+            raise DeltaCorruptedError(self.name)
+        self._last_offset = -1
+
+    def next(self):
+        """
+        :returns: `(offset, data)` of the next changed block, or None
+        """
+        record = self._read(_DELTA_RECORD.size)
+        if not record:
+            return None
+        elif len(record) != _DELTA_RECORD.size:
+            raise DeltaCorruptedError(self.name)
+
+        (block,) = _DELTA_RECORD.unpack(record)
+        offset = block * self.block_size
+        length = min(self.block_size, self.size - offset)
+        if offset <= self._last_offset or length <= 0:
+            raise DeltaCorruptedError(self.name)
+        data = self._read(length)
+        if len(data) != length:
+            raise DeltaCorruptedError(self.name)
+
+        self._last_offset = offset
+        return offset, data
+
+    def _read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.fileobj.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+
+class _DeltaMergeWriter:
+    """
+    Write an image into fileobj, with its changed blocks replaced by the ones of
+    a delta
+
+    The image has to be written in order, with seeks forward over its holes, as
+    by a SparseWriter. The merged image is resized to the size of the delta once
+    closed.
+    """
+
+    def __init__(self, fileobj, records):
+        self.fileobj = fileobj
+        self._records = records
+        self._record = records.next()
+
+        #: position in the image written
+        self._position = 0
+        #: end of the last block written from the delta. The image is not
+        #  written before it.
+        self._delta_end = 0
+        #: end of the data written in fileobj
+        self._written_end = 0
+        self._fileobj_position = 0
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        start, end = self._position, self._position + len(view)
+        while start < end:
+            self._write_records(start)
+            start = max(start, self._delta_end)
+            if start >= end:
+                break
+            stop = end if self._record is None else min(end, self._record[0])
+            self._write_at(start, view[start - self._position : stop - self._position])
+            start = stop
+
+        self._position = end
+        return len(view)
+
+    def seek(self, position):
+        # The delta blocks in the hole seeked over are written now.
+        self._write_records(position)
+        self._position = position
+        return position
+
+    def tell(self):
+        return self._position
+
+    def truncate(self, size):
+        # Resized to the size of the delta once closed.
+        return size
+
+    def _write_records(self, position):
+        """
+        Write the delta blocks starting before position
+        """
+        while self._record is not None and self._record[0] <= position:
+            offset, data = self._record
+            self._write_at(offset, data, sparse=True)
+            self._delta_end = max(self._delta_end, offset + len(data))
+            self._record = self._records.next()
+
+    def _write_at(self, offset, data, sparse=False):
+        # Nothing is written yet after self._written_end, it is read as zeros.
+        if sparse and offset >= self._written_end and is_zero(data):
+            return
+
+        if offset != self._fileobj_position:
+            self.fileobj.seek(offset)
+        self.fileobj.write(data)
+        self._fileobj_position = offset + len(data)
+        self._written_end = max(self._written_end, self._fileobj_position)
+
+    def close(self):
+        try:
+            # Blocks after the end of the image, if it grew.
+            self._write_records(self._records.size)
+            self.fileobj.truncate(self._records.size)
+        finally:
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.fileobj.close()
+
+
+def read_block_hashes(path):
+    with open(path, "rb") as f:
+        return f.read()
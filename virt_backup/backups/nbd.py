@@ -0,0 +1,469 @@
+import concurrent.futures
+import io
+import logging
+import os
+import socket
+import struct
+import threading
+
+from virt_backup.exceptions import NBDError
+
+logger = logging.getLogger("virt_backup")
+
+#: magics and flags of the NBD protocol, fixed newstyle negotiation
+NBDMAGIC = 0x4E42444D41474943
+IHAVEOPT = 0x49484156454F5054
+OPTION_REPLY_MAGIC = 0x3E889045565A9
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+STRUCTURED_REPLY_MAGIC = 0x668E33EF
+
+FLAG_FIXED_NEWSTYLE = 1 << 0
+FLAG_NO_ZEROES = 1 << 1
+
+OPT_GO = 7
+OPT_STRUCTURED_REPLY = 8
+OPT_SET_META_CONTEXT = 10
+
+REP_ACK = 1
+REP_INFO = 3
+REP_META_CONTEXT = 4
+REP_FLAG_ERROR = 1 << 31
+
+INFO_EXPORT = 0
+
+#: transmission flag set if the export can be read through several connections
+FLAG_CAN_MULTI_CONN = 1 << 8
+
+CMD_READ = 0
+CMD_DISC = 2
+CMD_BLOCK_STATUS = 7
+
+REPLY_FLAG_DONE = 1 << 0
+REPLY_TYPE_NONE = 0
+REPLY_TYPE_OFFSET_DATA = 1
+REPLY_TYPE_OFFSET_HOLE = 2
+REPLY_TYPE_BLOCK_STATUS = 5
+REPLY_TYPE_FLAG_ERROR = 1 << 15
+
+#: flags of the extents of the base:allocation context
+STATE_HOLE = 1 << 0
+STATE_ZERO = 1 << 1
+
+ALLOCATION_CONTEXT = "base:allocation"
+
+#: maximum length of a read request, as servers can refuse bigger ones (32M
+#  for qemu)
+MAX_REQUEST_SIZE = 2**25
+#: maximum length of a block status request
+MAX_STATUS_SIZE = 2**32 - 2**16
+
+#: reads smaller than this are not split between the connections
+MIN_PARALLEL_READ = 2**18
+
+
+class NBDClient:
+    """
+    Minimal NBD client, to read an export: fixed newstyle negotiation, read and
+    block status commands
+
+    Only one request is sent at a time. Use several clients to send them in
+    parallel.
+    """
+
+    def __init__(self, address, export_name):
+        #: path of the unix socket of the server, or `(host, port)`
+        self.address = address
+
+        self.export_name = export_name
+
+        #: size of the export, in bytes. Set once connected.
+        self.size = None
+
+        #: transmission flags of the export. Set once connected.
+        self.transmission_flags = 0
+
+        self._sock = None
+        self._structured_replies = False
+        self._allocation_context = None
+        self._cookie = 0
+        self._lock = threading.Lock()
+
+    @property
+    def can_multi_conn(self):
+        return bool(self.transmission_flags & FLAG_CAN_MULTI_CONN)
+
+    def connect(self):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(self.address)
+            self._negotiate()
+        except:
+            self._sock.close()
+            self._sock = None
+            raise
+
+        return self
+
+    def close(self):
+        if self._sock is None:
+            return
+
+        try:
+            with self._lock:
+                self._send_request(CMD_DISC, 0, 0)
+        except OSError:
+            pass
+        finally:
+            self._sock.close()
+            self._sock = None
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _negotiate(self):
+        magic, opt_magic, flags = struct.unpack(">QQH", self._recv(18))
+        if magic != NBDMAGIC or opt_magic != IHAVEOPT:
+            raise NBDError(self.export_name, "not a NBD newstyle server")
+        if not flags & FLAG_FIXED_NEWSTYLE:
+            raise NBDError(self.export_name, "fixed newstyle negotiation unsupported")
+        self._sock.sendall(
+            struct.pack(">I", flags & (FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES))
+        )
+
+        self._structured_replies = self._negotiate_structured_replies()
+        if self._structured_replies:
+            self._allocation_context = self._negotiate_meta_context(ALLOCATION_CONTEXT)
+        self._negotiate_go()
+
+    def _negotiate_structured_replies(self):
+        self._send_option(OPT_STRUCTURED_REPLY)
+        reply_type, _ = self._recv_option_reply(OPT_STRUCTURED_REPLY)
+        return reply_type == REP_ACK
+
+    def _negotiate_meta_context(self, context):
+        """
+        :returns: id of the metadata context, or None if not supported
+        """
+        export, query = self.export_name.encode(), context.encode()
+        self._send_option(
+            OPT_SET_META_CONTEXT,
+            struct.pack(">I", len(export))
+            + export
+            + struct.pack(">II", 1, len(query))
+            + query,
+        )
+
+        context_id = None
+        while True:
+            reply_type, data = self._recv_option_reply(OPT_SET_META_CONTEXT)
+            if reply_type == REP_META_CONTEXT:
+                if data[4:].decode() == context:
+                    context_id = struct.unpack(">I", data[:4])[0]
+            elif reply_type == REP_ACK or reply_type & REP_FLAG_ERROR:
+                return context_id
+
+    def _negotiate_go(self):
+        export = self.export_name.encode()
+        self._send_option(
+            OPT_GO, struct.pack(">I", len(export)) + export + struct.pack(">H", 0)
+        )
+
+        while True:
+            reply_type, data = self._recv_option_reply(OPT_GO)
+            if reply_type & REP_FLAG_ERROR:
+                raise NBDError(
+                    self.export_name,
+                    "refused by the server: {}".format(
+                        data.decode(errors="replace") or reply_type
+                    ),
+                )
+            elif reply_type == REP_INFO:
+                (info_type,) = struct.unpack(">H", data[:2])
+                if info_type == INFO_EXPORT:
+                    self.size, self.transmission_flags = struct.unpack(
+                        ">QH", data[2:12]
+                    )
+            elif reply_type == REP_ACK:
+                break
+
+        if self.size is None:
+            raise NBDError(self.export_name, "size not sent by the server")
+
+    def _send_option(self, option, data=b""):
+        self._sock.sendall(struct.pack(">QII", IHAVEOPT, option, len(data)) + data)
+
+    def _recv_option_reply(self, option):
+        magic, reply_option, reply_type, length = struct.unpack(">QIII", self._recv(20))
+        if magic != OPTION_REPLY_MAGIC or reply_option != option:
+            raise NBDError(self.export_name, "unexpected negotiation reply")
+        return reply_type, self._recv(length)
+
+    def readinto(self, buf, offset):
+        """
+        Read the export from offset, to fill buf
+        """
+        view = memoryview(buf).cast("B")
+        with self._lock:
+            cookie = self._send_request(CMD_READ, offset, len(view))
+            for reply_type, length in self._iter_replies(cookie):
+                if reply_type is None:
+                    # Simple reply, the data follows.
+                    self._recv_into(view)
+                elif reply_type == REPLY_TYPE_OFFSET_DATA:
+                    (chunk_offset,) = struct.unpack(">Q", self._recv(8))
+                    start = chunk_offset - offset
+                    self._recv_into(view[start : start + length - 8])
+                elif reply_type == REPLY_TYPE_OFFSET_HOLE:
+                    chunk_offset, hole_size = struct.unpack(">QI", self._recv(12))
+                    start = chunk_offset - offset
+                    view[start : start + hole_size] = bytes(hole_size)
+                else:
+                    self._recv(length)
+
+        return len(view)
+
+    def block_status(self, offset, length):
+        """
+        Get the allocation status of a range of the export. The server can
+        describe less than the range.
+
+        :returns: list of `(offset, length, flags)`, flags being a combination
+            of STATE_HOLE and STATE_ZERO
+        """
+        if self._allocation_context is None:
+            return [(offset, length, 0)]
+
+        extents = []
+        with self._lock:
+            cookie = self._send_request(
+                CMD_BLOCK_STATUS, offset, min(length, MAX_STATUS_SIZE)
+            )
+            for reply_type, reply_length in self._iter_replies(cookie):
+                data = self._recv(reply_length)
+                if reply_type != REPLY_TYPE_BLOCK_STATUS:
+                    continue
+                (context_id,) = struct.unpack(">I", data[:4])
+                if context_id != self._allocation_context:
+                    continue
+
+                extent_offset = offset
+                for extent_length, flags in struct.iter_unpack(">II", data[4:]):
+                    extents.append((extent_offset, extent_length, flags))
+                    extent_offset += extent_length
+
+        return extents
+
+    def _send_request(self, command, offset, length):
+        self._cookie += 1
+        self._sock.sendall(
+            struct.pack(
+                ">IHHQQI", REQUEST_MAGIC, 0, command, self._cookie, offset, length
+            )
+        )
+        return self._cookie
+
+    def _iter_replies(self, cookie):
+        """
+        Iterate on the replies to a request, as `(reply_type, payload_length)`.
+        The payload has to be read before the next iteration.
+
+        A simple reply is yielded with a None type. Errors are raised once all
+        the replies to the request are received.
+        """
+        error = None
+        while True:
+            (magic,) = struct.unpack(">I", self._recv(4))
+            if magic == SIMPLE_REPLY_MAGIC:
+                errno_, reply_cookie = struct.unpack(">IQ", self._recv(12))
+                self._check_cookie(cookie, reply_cookie)
+                if errno_:
+                    raise NBDError(self.export_name, os.strerror(errno_))
+                yield None, 0
+                return
+            elif magic != STRUCTURED_REPLY_MAGIC:
+                raise NBDError(self.export_name, "unexpected reply magic")
+
+            flags, reply_type, reply_cookie, length = struct.unpack(
+                ">HHQI", self._recv(16)
+            )
+            self._check_cookie(cookie, reply_cookie)
+            if reply_type & REPLY_TYPE_FLAG_ERROR:
+                data = self._recv(length)
+                errno_, msg_length = struct.unpack(">IH", data[:6])
+                error = data[6 : 6 + msg_length].decode(errors="replace") or (
+                    os.strerror(errno_)
+                )
+            elif reply_type != REPLY_TYPE_NONE:
+                yield reply_type, length
+
+            if flags & REPLY_FLAG_DONE:
+                break
+
+        if error:
+            raise NBDError(self.export_name, error)
+
+    def _check_cookie(self, cookie, reply_cookie):
+        if reply_cookie != cookie:
+            raise NBDError(self.export_name, "reply to an unknown request")
+
+    def _recv(self, length):
+        buf = bytearray(length)
+        self._recv_into(memoryview(buf))
+        return bytes(buf)
+
+    def _recv_into(self, view):
+        while view:
+            received = self._sock.recv_into(view)
+            if not received:
+                raise NBDError(self.export_name, "connection closed by the server")
+            view = view[received:]
+
+
+class NBDImage:
+    """
+    Disk exported by a NBD server, which can be added to a packager like an
+    image path
+    """
+
+    def __init__(self, address, export_name, connections=1):
+        #: path of the unix socket of the server, or `(host, port)`
+        self.address = address
+
+        self.export_name = export_name
+
+        #: number of connections to read the export in parallel, if the server
+        #  allows it
+        self.connections = connections
+
+    def open(self):
+        return NBDReader(self.address, self.export_name, self.connections)
+
+    def __str__(self):
+        if isinstance(self.address, str):
+            return "nbd+unix:///{}?socket={}".format(self.export_name, self.address)
+        return "nbd://{}:{}/{}".format(*self.address, self.export_name)
+
+
+class NBDReader(io.RawIOBase):
+    """
+    Read-only file object on a NBD export
+
+    Large reads are split between several connections, if the server allows
+    to read the export through multiple connections. The data extents are
+    known by the block status of the export, as a sparse file gives them with
+    SEEK_DATA/SEEK_HOLE.
+    """
+
+    def __init__(self, address, export_name, connections=1):
+        super().__init__()
+        self.name = str(NBDImage(address, export_name))
+        self._clients = [NBDClient(address, export_name).connect()]
+        self._executor = None
+        self._position = 0
+
+        try:
+            self.size = self._clients[0].size
+            if connections > 1 and not self._clients[0].can_multi_conn:
+                logger.debug(
+                    "%s cannot be read through multiple connections", self.name
+                )
+            elif connections > 1:
+                for _ in range(connections - 1):
+                    self._clients.append(NBDClient(address, export_name).connect())
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    len(self._clients), thread_name_prefix="nbd-reader"
+                )
+        except:
+            self.close()
+            raise
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position {}".format(offset))
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def readinto(self, b):
+        length = max(min(len(b), self.size - self._position), 0)
+        view = memoryview(b).cast("B")[:length]
+        if not length:
+            return 0
+
+        if self._executor is None or length < MIN_PARALLEL_READ:
+            self._read_range(self._clients[0], view, self._position)
+        else:
+            part_size = -(-length // len(self._clients))
+            futures = [
+                self._executor.submit(
+                    self._read_range,
+                    client,
+                    view[start : start + part_size],
+                    self._position + start,
+                )
+                for client, start in zip(self._clients, range(0, length, part_size))
+            ]
+            for future in futures:
+                future.result()
+
+        self._position += length
+        return length
+
+    def _read_range(self, client, view, offset):
+        for start in range(0, len(view), MAX_REQUEST_SIZE):
+            client.readinto(view[start : start + MAX_REQUEST_SIZE], offset + start)
+
+    def iter_data_extents(self, size=None):
+        """
+        Yield the data extents of the export, as `(offset, length)`. Ranges
+        read as zeros are skipped.
+        """
+        size = self.size if size is None else min(size, self.size)
+        data_start = data_end = None
+        offset = 0
+        while offset < size:
+            extents = self._clients[0].block_status(offset, size - offset)
+            for extent_offset, extent_length, flags in extents:
+                extent_length = min(extent_length, size - extent_offset)
+                if flags & STATE_ZERO:
+                    if data_start is not None:
+                        yield data_start, data_end - data_start
+                        data_start = None
+                elif data_start is None:
+                    data_start = extent_offset
+                    data_end = extent_offset + extent_length
+                else:
+                    data_end = extent_offset + extent_length
+                if extent_offset + extent_length <= offset:
+                    raise NBDError(self._clients[0].export_name, "invalid block status")
+                offset = extent_offset + extent_length
+
+        if data_start is not None:
+            yield data_start, data_end - data_start
+
+    def close(self):
+        if self.closed:
+            return
+
+        if self._executor is not None:
+            self._executor.shutdown()
+        for client in self._clients:
+            client.close()
+        super().close()
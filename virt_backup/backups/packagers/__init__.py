@@ -1,11 +1,20 @@
 from abc import ABC, abstractmethod
 from enum import Enum
 import logging
+import os
 
 from virt_backup.exceptions import (
     BackupPackagerNotOpenedError,
     BackupPackagerOpenedError,
+    ImageFoundError,
 )
+from .buffers import (
+    DEFAULT_BUFFER_SIZE,
+    get_buffer_pool,
+    iter_pooled_reads,
+    tune_buffer_size,
+)
+from .iomode import open_source, open_target
 
 logger = logging.getLogger("virt_backup")
 
@@ -32,10 +41,27 @@ class _AbstractBackupPackager(ABC):
     #: backups.
     is_shareable = False
 
-    def __init__(self, name=None, *args, **kwargs):
+    def __init__(
+        self, name=None, throttle=None, io_mode=None, buffer_size=None, *args, **kwargs
+    ):
         #: Used for logging
         self.name = name
 
+        #: Throttle limiting the bandwidth of the copies. Not limited if None.
+        self.throttle = throttle
+
+        #: I/O mode used to read the images to add and write the restored ones,
+        #: in virt_backup.backups.packagers.iomode.IO_MODES. Buffered if None.
+        self.io_mode = io_mode
+
+        #: size of the buffers used to copy the images. If None, tuned for the
+        #: storage written to.
+        self.buffer_size = buffer_size
+
+        #: Copy method used for each file added or restored, by file name. Only
+        #: filled by packagers able to use different copy methods.
+        self.copy_methods = {}
+
     def __enter__(self):
         return self.open()
 
@@ -66,6 +92,73 @@ class _AbstractBackupPackager(ABC):
         if not self.closed:
             raise BackupPackagerOpenedError(self)
 
+    def _throttle(self, size, stop_event=None):
+        """
+        Wait for the bandwidth to allow to copy size bytes
+        """
+        if self.throttle is not None:
+            self.throttle.consume(size, stop_event)
+
+    def _get_chunk_size(self, size):
+        """
+        :returns: size, reduced if needed for the throttling to stay smooth
+        """
+        if self.throttle is not None:
+            return self.throttle.get_chunk_size(size)
+        return size
+
+    def _get_buffer_size(self, target):
+        """
+        :param target: path of the file written by the copy, or an image target
+            (see :meth:`_create_image`)
+        :returns: size of the buffers to copy into target
+        """
+        if not isinstance(target, (str, bytes, os.PathLike)):
+            return self._get_chunk_size(self.buffer_size or DEFAULT_BUFFER_SIZE)
+        return self._get_chunk_size(self.buffer_size or tune_buffer_size(target))
+
+    def _buffer(self, target):
+        """
+        Take a buffer to copy into target from the shared pools, for the duration
+        of the context
+        """
+        return get_buffer_pool(self._get_buffer_size(target)).buffer()
+
+    def _read_chunks(self, fileobj, pool, length=None, fill=False, stop_event=None):
+        """
+        Read fileobj in buffers of pool, as the reader stage of a pipeline, and
+        throttle the reads
+
+        :returns: generator of memoryviews, to give back to pool once written
+        """
+        for data in iter_pooled_reads(fileobj, pool, length, fill):
+            self._throttle(len(data), stop_event)
+            yield data
+
+    def _open_image(self, src):
+        """
+        Open an image to add, following the I/O mode
+
+        :param src: path of the image, or an image source opened by its `open()`
+            method, as :class:`virt_backup.backups.nbd.NBDImage`
+        """
+        if not isinstance(src, (str, bytes, os.PathLike)):
+            return src.open()
+        return open_source(src, self.io_mode)
+
+    def _create_image(self, target):
+        """
+        Create an image to restore, following the I/O mode
+
+        :param target: path of the image, or an image target opened by its
+            `open()` method, as :class:`virt_backup.backups.delta.DeltaMergeTarget`.
+            The file object of an image target is written in order, with seeks
+            forward over the holes.
+        """
+        if not isinstance(target, (str, bytes, os.PathLike)):
+            return target.open()
+        return open_target(target, self.io_mode)
+
     def log(self, level, message, *args, **kwargs):
         if self.name:
             message = "{}: {}".format(self.name, message)
@@ -73,12 +166,45 @@ class _AbstractBackupPackager(ABC):
 
 
 class _AbstractReadBackupPackager(_AbstractBackupPackager, ABC):
+    #: concurrent_restore indicates if multiple images can be restored at the
+    #: same time, from the same opened packager.
+    concurrent_restore = False
+
     @abstractmethod
     def restore(self, name, target, stop_event=None):
         pass
 
+    def _get_restore_target(self, name, target):
+        """
+        Path of the image to restore, in target if it is a directory. Image
+        targets are returned as is.
+
+        :raises ImageFoundError: if the image already exists
+        """
+        if not isinstance(target, (str, bytes, os.PathLike)):
+            return target
+
+        if not os.path.exists(target) and target.endswith("/"):
+            os.makedirs(target)
+        if os.path.isdir(target):
+            target = os.path.join(target, name)
+        if os.path.isfile(target):
+            raise ImageFoundError(target)
+        return target
+
+    def _remove_restored(self, target):
+        """
+        Remove an image which restore failed
+        """
+        if isinstance(target, (str, bytes, os.PathLike)) and os.path.exists(target):
+            os.remove(target)
+
 
 class _AbstractWriteBackupPackager:
+    #: concurrent_add indicates if multiple images can be added at the same
+    #: time, to the same opened packager.
+    concurrent_add = False
+
     @abstractmethod
     def add(self, src, name=None, stop_event=None):
         pass
@@ -90,12 +216,14 @@ class _AbstractWriteBackupPackager:
 
 class _AbstractShareableWriteBackupPackager(_AbstractBackupPackager, ABC):
     is_shareable = True
+    concurrent_add = False
 
     @abstractmethod
     def remove(self, name):
         pass
 
 
+from .chunkstore import ReadBackupPackagerChunkStore, WriteBackupPackagerChunkStore
 from .directory import ReadBackupPackagerDir, WriteBackupPackagerDir
 from .tar import ReadBackupPackagerTar, WriteBackupPackagerTar
 
@@ -116,12 +244,14 @@ except ImportError as e:
 
 
 class ReadBackupPackagers(Enum):
+    chunkstore = ReadBackupPackagerChunkStore
     directory = ReadBackupPackagerDir
     tar = ReadBackupPackagerTar
     zstd = ReadBackupPackagerZSTD
 
 
 class WriteBackupPackagers(Enum):
+    chunkstore = WriteBackupPackagerChunkStore
     directory = WriteBackupPackagerDir
     tar = WriteBackupPackagerTar
     zstd = WriteBackupPackagerZSTD
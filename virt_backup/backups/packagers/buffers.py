@@ -0,0 +1,168 @@
+import collections
+import contextlib
+import os
+import threading
+
+#: default size of the buffers used to copy the images
+DEFAULT_BUFFER_SIZE = 2**20
+#: maximum size of a tuned buffer, unless the storage needs more for one I/O
+MAX_BUFFER_SIZE = 2**24
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class BufferPool:
+    """
+    Preallocated buffers, reused between the copies instead of allocating a new
+    bytes object for each chunk read
+
+    Buffers are memoryviews on bytearrays, filled with readinto(). Each copy takes
+    its own buffer and gives it back once done, so a pool can be shared between
+    threads. A slice of a buffer can be given back instead of the buffer itself.
+    """
+
+    def __init__(self, size=DEFAULT_BUFFER_SIZE, max_free=16):
+        #: size of each buffer, in bytes
+        self.size = size
+
+        #: maximum number of free buffers kept for the next copies
+        self.max_free = max_free
+
+        self._free = collections.deque()
+
+    @contextlib.contextmanager
+    def buffer(self):
+        """
+        Take a buffer from the pool for the duration of the context
+        """
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def acquire(self):
+        """
+        :returns: memoryview of self.size bytes, to give back with release()
+        """
+        try:
+            return memoryview(self._free.pop())
+        except IndexError:
+            return memoryview(bytearray(self.size))
+
+    def release(self, buf):
+        """
+        Give back a buffer, or a slice of it. Other objects are ignored.
+        """
+        array = buf.obj
+        if not isinstance(array, bytearray) or len(array) != self.size:
+            return
+        if len(self._free) < self.max_free:
+            self._free.append(array)
+
+
+def get_buffer_pool(size):
+    """
+    :returns: the BufferPool shared by all the copies using buffers of size bytes
+    """
+    with _pools_lock:
+        try:
+            return _pools[size]
+        except KeyError:
+            pool = _pools[size] = BufferPool(size)
+            return pool
+
+
+def readinto_full(fileobj, buf):
+    """
+    Fill buf by reading fileobj, until buf is full or the end of fileobj
+
+    :returns: number of bytes read
+    """
+    read = 0
+    while read < len(buf):
+        count = fileobj.readinto(buf[read:])
+        if not count:
+            break
+        read += count
+
+    return read
+
+
+def iter_readinto(fileobj, buf, length=None):
+    """
+    Read fileobj by chunks of the size of buf, until length bytes are read or the
+    end of fileobj
+
+    :returns: generator of memoryviews on buf, filled with the chunks. Each of
+        them is only valid until the next one is read.
+    """
+    while length is None or length > 0:
+        view = buf if length is None or length >= len(buf) else buf[:length]
+        count = fileobj.readinto(view)
+        if not count:
+            return
+
+        yield view[:count]
+        if length is not None:
+            length -= count
+
+
+def iter_pooled_reads(fileobj, pool, length=None, fill=False):
+    """
+    Read fileobj in buffers taken from pool, until length bytes are read or the
+    end of fileobj
+
+    Unlike with iter_readinto(), each chunk has its own buffer: it can be kept
+    while the next ones are read, and has to be given back to the pool once used.
+
+    :param fill: fill each buffer completely, except the last one
+    :returns: generator of memoryviews on the buffers, filled with the chunks
+    """
+    while length is None or length > 0:
+        buf = pool.acquire()
+        view = buf if length is None or length >= len(buf) else buf[:length]
+        count = readinto_full(fileobj, view) if fill else fileobj.readinto(view)
+        if not count:
+            pool.release(buf)
+            return
+
+        yield view[:count]
+        if length is not None:
+            length -= count
+
+
+def tune_buffer_size(path, size=DEFAULT_BUFFER_SIZE):
+    """
+    Adapt a buffer size to the storage of path
+
+    The size is rounded up to a multiple of the preferred I/O size of the
+    filesystem (st_blksize, up to several MB on network filesystems) and of the
+    device (its optimal I/O size, as the stripe width of a RAID), so each write
+    is a full I/O.
+
+    :param path: file to read or write. If it does not exist yet, its directory
+        is used.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = os.stat(os.path.dirname(os.path.abspath(path)))
+
+    io_size = max(st.st_blksize, _get_device_optimal_io_size(st.st_dev), 1)
+    size = -(-size // io_size) * io_size
+    return min(size, max(MAX_BUFFER_SIZE, io_size))
+
+
+def _get_device_optimal_io_size(device):
+    device_path = "/sys/dev/block/{}:{}".format(os.major(device), os.minor(device))
+    # The queue of a partition is described by its parent device.
+    for queue_path in ("queue", "../queue"):
+        try:
+            with open(os.path.join(device_path, queue_path, "optimal_io_size")) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            continue
+
+    return 0
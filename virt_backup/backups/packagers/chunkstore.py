@@ -0,0 +1,462 @@
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import zlib
+
+from virt_backup.exceptions import (
+    CancelledError,
+    ChunkCorruptedError,
+    ImageNotFoundError,
+)
+from . import (
+    _AbstractBackupPackager,
+    _AbstractReadBackupPackager,
+    _AbstractShareableWriteBackupPackager,
+    _opened_only,
+    _closed_only,
+)
+from .pipeline import run_pipeline
+from .sparse import SparseWriter, get_image_size, is_zero, iter_image_extents
+
+#: Bytes sequence where a chunk can end, if the window preceding it matches the
+#: chunker mask.
+CHUNK_ANCHOR = b"\x5a\xa5"
+#: Size of the window, ending with the anchor, hashed to decide of a boundary.
+CHUNK_WINDOW = 48
+#: Expected distance between 2 anchors, for random data.
+_ANCHOR_DISTANCE = 2 ** (8 * len(CHUNK_ANCHOR))
+
+
+def chunker_mask(chunk_size):
+    """
+    Compute the mask to apply on the window hash, so chunks are around
+    `chunk_size` bytes on average.
+    """
+    min_size = chunk_size // 4
+    distance = max((chunk_size - min_size) // _ANCHOR_DISTANCE, 1)
+    return (1 << (distance.bit_length() - 1)) - 1
+
+
+def find_chunk_end(data, start, chunk_size, mask=None):
+    """
+    Find where the chunk starting at `start` ends in data.
+
+    Boundaries only depend on the content preceding them: the end of a chunk is
+    right after an anchor, when the checksum of the window ending with it
+    matches the mask. Inserting or removing data in an image then only changes
+    the chunks around the modification. Chunks are between `chunk_size / 4` and
+    `chunk_size * 4` bytes.
+
+    :returns: the end offset of the chunk, or None if data is too short to find
+        it
+    """
+    if mask is None:
+        mask = chunker_mask(chunk_size)
+    min_end = start + max(chunk_size // 4, CHUNK_WINDOW)
+    max_end = start + chunk_size * 4
+
+    position = min_end - len(CHUNK_ANCHOR)
+    limit = min(max_end, len(data))
+    while True:
+        position = data.find(CHUNK_ANCHOR, position, limit)
+        if position == -1:
+            break
+
+        end = position + len(CHUNK_ANCHOR)
+        if not zlib.crc32(data[end - CHUNK_WINDOW : end]) & mask:
+            return end
+        position += 1
+
+    if max_end <= len(data):
+        return max_end
+    return None
+
+
+def iter_chunks(fileobj, offset, length, chunk_size, stop_event=None):
+    """
+    Read `length` bytes of fileobj from `offset`, and split them in content
+    defined chunks.
+
+    :returns: generator of `(offset, chunk)`
+    """
+    mask = chunker_mask(chunk_size)
+    read_size = chunk_size * 8
+    buf = b""
+    end = offset + length
+
+    fileobj.seek(offset)
+    while True:
+        if stop_event and stop_event.is_set():
+            raise CancelledError()
+
+        data = fileobj.read(min(read_size, end - offset - len(buf)))
+        if data:
+            buf += data
+        elif not buf:
+            return
+
+        start = 0
+        while True:
+            chunk_end = find_chunk_end(buf, start, chunk_size, mask)
+            if chunk_end is None:
+                break
+            yield offset, buf[start:chunk_end]
+            offset += chunk_end - start
+            start = chunk_end
+
+        buf = buf[start:]
+        if not data:
+            # End of the extent, the remaining data is the last chunk.
+            if buf:
+                yield offset, buf
+            return
+
+
+def hash_chunk(chunk):
+    return hashlib.blake2b(chunk, digest_size=32).hexdigest()
+
+
+class _AbstractBackupPackagerChunkStore(_AbstractBackupPackager):
+    """
+    Images are split in content defined chunks, stored once by hash in a chunk
+    store shared by all the backups of the same directory. Each image is
+    described by a manifest listing its chunks.
+    """
+
+    def __init__(
+        self, name, path, name_prefix, chunk_size=2**20, threads=0, *args, **kwargs
+    ):
+        super().__init__(name, **kwargs)
+
+        #: Directory path to store the manifests and the chunk store in.
+        self.path = path
+
+        #: Each image from this package will have its own manifest, prefixed by
+        #: name_prefix.
+        self.name_prefix = name_prefix
+
+        #: Average size of the chunks. Should not be lower than 256KB, otherwise
+        #: too many chunks are cut at their maximum size rather than on their
+        #: content.
+        self.chunk_size = chunk_size
+
+        #: Number of chunks hashed, stored or read in parallel.
+        self.workers = threads if threads > 0 else os.cpu_count()
+
+    @property
+    def complete_path(self):
+        return self.path
+
+    @property
+    def chunks_path(self):
+        return os.path.join(self.path, "chunks")
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_path, chunk_hash[:2], chunk_hash)
+
+    def manifest_path(self, name):
+        """
+        WARNING: it does not check that the manifest actually exists,
+        just returns the path it should have
+        """
+        return os.path.join(self.path, self._gen_manifest_name(name))
+
+    def _gen_manifest_name(self, filename):
+        return "{}_{}.manifest".format(self.name_prefix, filename)
+
+    def open(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self.closed = False
+        return self
+
+    @_opened_only
+    def close(self):
+        self.closed = True
+
+    @_opened_only
+    def list(self):
+        results = []
+        pattern = re.compile(r"{}_(.*)\.manifest$".format(re.escape(self.name_prefix)))
+        for i in glob.glob(os.path.join(self.complete_path, "*.manifest")):
+            m = pattern.match(os.path.basename(i))
+            if m:
+                results.append(m.group(1))
+
+        return results
+
+    def _read_manifest(self, name):
+        with open(self.manifest_path(name), "r") as f:
+            return json.load(f)
+
+
+class ReadBackupPackagerChunkStore(
+    _AbstractReadBackupPackager, _AbstractBackupPackagerChunkStore
+):
+    concurrent_restore = True
+
+    @_opened_only
+    def restore(self, name, target, stop_event=None):
+        if name not in self.list():
+            raise ImageNotFoundError(self.manifest_path(name), self.complete_path)
+
+        target = self._get_restore_target(name, target)
+
+        manifest = self._read_manifest(name)
+        self.log(
+            logging.DEBUG,
+            "Restore %s chunks with %s workers",
+            len(manifest["chunks"]),
+            self.workers,
+        )
+        try:
+            with self._create_image(target) as ofh:
+                writer = SparseWriter(ofh)
+
+                def read_chunk(entry):
+                    offset, _, chunk_hash = entry
+                    return offset, self._read_chunk(chunk_hash)
+
+                def write_chunk(item):
+                    offset, data = item
+                    self._throttle(len(data), stop_event)
+                    writer.seek(offset)
+                    writer.write(data)
+
+                run_pipeline(
+                    lambda: manifest["chunks"],
+                    write_chunk,
+                    transform=read_chunk,
+                    workers=self.workers,
+                    stop_event=stop_event,
+                )
+                writer.seek(manifest["size"])
+                writer.close()
+        except:
+            self._remove_restored(target)
+            raise
+
+        return target
+
+    def _read_chunk(self, chunk_hash):
+        with open(self.chunk_path(chunk_hash), "rb") as f:
+            chunk = f.read()
+
+        if hash_chunk(chunk) != chunk_hash:
+            raise ChunkCorruptedError(chunk_hash, self.chunks_path)
+        return chunk
+
+
+class WriteBackupPackagerChunkStore(
+    _AbstractShareableWriteBackupPackager, _AbstractBackupPackagerChunkStore
+):
+    _lock_fd = None
+    concurrent_add = True
+
+    def open(self):
+        super().open()
+
+        # Held shared while adding images, so the garbage collection of another
+        # packager cannot remove the chunks not yet referenced by a manifest.
+        self._lock_fd = os.open(
+            os.path.join(self.path, "chunks.lock"), os.O_RDWR | os.O_CREAT, 0o600
+        )
+        fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+
+        #: Chunks referenced by the removed manifests, checked once when closing.
+        self._removed_chunks = set()
+        return self
+
+    @_opened_only
+    def close(self):
+        try:
+            if self._removed_chunks:
+                self.collect_garbage(self._removed_chunks)
+        finally:
+            self._removed_chunks = set()
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            super().close()
+
+    @_opened_only
+    def add(self, src, name=None, stop_event=None):
+        name = name or os.path.basename(src)
+        manifest_path = self.manifest_path(name)
+        self.log(logging.DEBUG, "Add %s into %s", src, manifest_path)
+
+        chunks = []
+        stored_size = 0
+
+        def read_chunks():
+            for extent_offset, extent_length in iter_image_extents(ifh, size):
+                for offset, chunk in iter_chunks(
+                    ifh, extent_offset, extent_length, self.chunk_size, stop_event
+                ):
+                    self._throttle(len(chunk), stop_event)
+                    if is_zero(chunk):
+                        # Restored as a hole.
+                        continue
+                    yield offset, chunk
+
+        def store_chunk(item):
+            offset, chunk = item
+            return (offset, len(chunk), *self._store_chunk(chunk))
+
+        def add_chunk(stored_chunk):
+            nonlocal stored_size
+            offset, length, chunk_hash, stored = stored_chunk
+            chunks.append((offset, length, chunk_hash))
+            stored_size += stored
+
+        with self._open_image(src) as ifh:
+            size = get_image_size(ifh)
+            run_pipeline(
+                read_chunks,
+                add_chunk,
+                transform=store_chunk,
+                workers=self.workers,
+                stop_event=stop_event,
+            )
+
+        self.log(
+            logging.DEBUG,
+            "%s split in %s chunks, %s new bytes stored",
+            src,
+            len(chunks),
+            stored_size,
+        )
+        self._write_manifest(name, {"size": size, "chunks": chunks})
+        return manifest_path
+
+    def _store_chunk(self, chunk):
+        """
+        Store a chunk, if not already in the store.
+
+        :returns: (chunk hash, number of bytes written)
+        """
+        chunk_hash = hash_chunk(chunk)
+        chunk_path = self.chunk_path(chunk_hash)
+        if os.path.exists(chunk_path):
+            return chunk_hash, 0
+
+        os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+        self._write_atomically(chunk_path, chunk)
+        return chunk_hash, len(chunk)
+
+    def _write_manifest(self, name, manifest):
+        self._write_atomically(
+            self.manifest_path(name), json.dumps(manifest).encode("utf-8")
+        )
+
+    def _write_atomically(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @_opened_only
+    def remove(self, name):
+        if name not in self.list():
+            raise ImageNotFoundError(self.manifest_path(name), self.complete_path)
+
+        # The chunks are only checked when closing the packager, to read the
+        # manifests of the store once for all the removed images.
+        self._removed_chunks.update(c[2] for c in self._read_manifest(name)["chunks"])
+        os.remove(self.manifest_path(name))
+
+    @_opened_only
+    def collect_garbage(self, candidates=None, stop_event=None):
+        """
+        Remove the chunks not referenced by any manifest of the store.
+
+        Images removed through this packager have their chunks checked when it
+        is closed. Checking the whole store is only needed as a maintenance
+        operation, to remove the chunks left by an interrupted backup.
+
+        :param candidates: only check these chunks. If None, check the whole
+            store.
+        :returns: number of chunks removed
+        """
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        try:
+            refcounts = self._count_references()
+            if candidates is None:
+                candidates = self._list_chunks()
+
+            removed = 0
+            for chunk_hash in candidates:
+                if stop_event and stop_event.is_set():
+                    raise CancelledError()
+                if refcounts.get(chunk_hash):
+                    continue
+
+                try:
+                    os.remove(self.chunk_path(chunk_hash))
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_SH)
+
+        self.log(logging.DEBUG, "%s unreferenced chunks removed", removed)
+        return removed
+
+    def _count_references(self):
+        """
+        Count the references to each chunk from all the manifests of the store,
+        whatever their prefix.
+        """
+        refcounts = {}
+        for manifest_path in glob.glob(os.path.join(self.path, "*.manifest")):
+            with open(manifest_path, "r") as f:
+                for _, _, chunk_hash in json.load(f)["chunks"]:
+                    refcounts[chunk_hash] = refcounts.get(chunk_hash, 0) + 1
+
+        return refcounts
+
+    def _list_chunks(self):
+        if not os.path.isdir(self.chunks_path):
+            return []
+        return [
+            entry.name
+            for subdir in os.scandir(self.chunks_path)
+            if subdir.is_dir()
+            for entry in os.scandir(subdir.path)
+            if not entry.name.startswith(".tmp")
+        ]
+
+    @_closed_only
+    def remove_package(self, stop_event=None):
+        if not os.path.exists(self.complete_path):
+            raise FileNotFoundError(self.complete_path)
+
+        with self:
+            for i in self.list():
+                if stop_event and stop_event.is_set():
+                    raise CancelledError()
+                self.remove(i)
+
+            if stop_event and stop_event.is_set():
+                raise CancelledError()
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            if glob.glob(os.path.join(self.path, "*.manifest")):
+                # Only the chunks of this package are checked, when closing.
+                return
+
+            # Last backup of the store. The lock file is kept, as other packagers
+            # could be waiting on it.
+            self._removed_chunks = set()
+            if os.path.isdir(self.chunks_path):
+                shutil.rmtree(self.chunks_path)
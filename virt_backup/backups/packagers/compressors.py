@@ -0,0 +1,327 @@
+from collections import deque
+import bz2
+import concurrent.futures
+import gzip
+import io
+import lzma
+import os
+import struct
+
+#: Compression functions by algorithm. Each call returns a complete stream,
+#: so concatenating them still gives a valid file.
+COMPRESSORS = {
+    "gz": lambda data, lvl: gzip.compress(
+        data, compresslevel=9 if lvl is None else lvl, mtime=0
+    ),
+    "xz": lambda data, lvl: lzma.compress(data, format=lzma.FORMAT_XZ, preset=lvl),
+    "bz2": lambda data, lvl: bz2.compress(
+        data, compresslevel=9 if lvl is None else lvl
+    ),
+}
+
+#: Readers decompressing a file object, from its current position, through the
+#: following concatenated streams.
+STREAM_READERS = {
+    "gz": lambda fileobj: gzip.GzipFile(fileobj=fileobj, mode="rb"),
+    "xz": lambda fileobj: lzma.LZMAFile(fileobj, mode="rb"),
+    "bz2": lambda fileobj: bz2.BZ2File(fileobj, mode="rb"),
+}
+
+#: Default size of the blocks compressed as independent streams.
+DEFAULT_BLOCK_SIZE = 2**23
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+
+
+class ParallelCompressionWriter(io.RawIOBase):
+    """
+    Compress what is written by blocks, on a pool of threads.
+
+    Each block is compressed as an independent stream (a gzip member, a xz or
+    bz2 stream). Concatenated streams are still a standard file, that can be
+    read by the usual tools, but allow to compress and decompress it in
+    parallel.
+
+    Memory usage is bounded to around `2 * threads * block_size`.
+    """
+
+    def __init__(
+        self, fileobj, compression, compression_lvl=None, threads=None, block_size=None
+    ):
+        super().__init__()
+
+        #: file object to write the compressed streams to
+        self.fileobj = fileobj
+
+        self._compress = COMPRESSORS[compression]
+        self.compression_lvl = compression_lvl
+        self.threads = threads or os.cpu_count()
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._position = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+
+        #: number of blocks submitted for compression
+        self._nb_blocks = 0
+        #: offset, in the compressed file, of each block already written
+        self.block_offsets = []
+        self._compressed_position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[: self.block_size])
+            del self._buffer[: self.block_size]
+            self._submit(block)
+
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def end_block(self):
+        """
+        Compress what is buffered as a block, even if smaller than block_size, so
+        that the following data starts a new stream.
+
+        :returns: index of the block the following data will start, to get its
+            offset in `block_offsets` once written.
+        """
+        if self._buffer:
+            block = bytes(self._buffer)
+            self._buffer.clear()
+            self._submit(block)
+
+        return self._nb_blocks
+
+    def _submit(self, block):
+        self._pending.append(
+            self._executor.submit(self._compress, block, self.compression_lvl)
+        )
+        self._nb_blocks += 1
+        if len(self._pending) >= 2 * self.threads:
+            self._write_next_block()
+
+    def _write_next_block(self):
+        compressed = self._pending.popleft().result()
+        self.block_offsets.append(self._compressed_position)
+        self.fileobj.write(compressed)
+        self._compressed_position += len(compressed)
+
+    def flush(self):
+        while self._pending:
+            self._write_next_block()
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self.end_block()
+            self.flush()
+        finally:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown()
+            try:
+                super().close()
+            finally:
+                self.fileobj.close()
+
+
+def read_xz_streams(fileobj):
+    """
+    List the streams of a xz file, by walking backward from its end through the
+    stream footers and indexes.
+
+    :returns: list of `(compressed_offset, compressed_size, uncompressed_offset,
+        uncompressed_size)` for each stream, or None if the file cannot be parsed
+    """
+    fileobj.seek(0, os.SEEK_END)
+    position = fileobj.tell()
+    streams = []
+    try:
+        while position > 0:
+            # Skip the stream padding.
+            fileobj.seek(position - 4)
+            if fileobj.read(4) == b"\0\0\0\0":
+                position -= 4
+                continue
+
+            fileobj.seek(position - 12)
+            footer = fileobj.read(12)
+            if footer[10:] != XZ_FOOTER_MAGIC:
+                return None
+            index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+
+            fileobj.seek(position - 12 - index_size)
+            blocks_size, uncompressed_size = _parse_xz_index(fileobj.read(index_size))
+            stream_start = position - 12 - index_size - blocks_size - 12
+            fileobj.seek(stream_start)
+            if stream_start < 0 or fileobj.read(6) != XZ_HEADER_MAGIC:
+                return None
+
+            streams.append((stream_start, position - stream_start, uncompressed_size))
+            position = stream_start
+    except (ValueError, IndexError, struct.error):
+        return None
+
+    results = []
+    uncompressed_offset = 0
+    for compressed_offset, compressed_size, uncompressed_size in reversed(streams):
+        results.append(
+            (compressed_offset, compressed_size, uncompressed_offset, uncompressed_size)
+        )
+        uncompressed_offset += uncompressed_size
+    return results
+
+
+def _parse_xz_index(index):
+    """
+    :returns: (size of the blocks, with their padding, uncompressed size)
+    """
+    if index[0] != 0:
+        raise ValueError("not a xz index")
+
+    position = 1
+    nb_records, position = _read_xz_varint(index, position)
+    blocks_size = uncompressed_size = 0
+    for _ in range(nb_records):
+        unpadded_size, position = _read_xz_varint(index, position)
+        record_uncompressed_size, position = _read_xz_varint(index, position)
+        blocks_size += (unpadded_size + 3) // 4 * 4
+        uncompressed_size += record_uncompressed_size
+
+    return blocks_size, uncompressed_size
+
+
+def _read_xz_varint(buf, position):
+    value = shift = 0
+    while True:
+        byte = buf[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+class ParallelXZReader(io.RawIOBase):
+    """
+    Seekable reader of a xz file made of multiple streams, decompressing the
+    following streams in advance, on a pool of threads.
+
+    Streams are decompressed in advance as long as their uncompressed size stays
+    under `2 * threads * block_size`, so memory usage is bounded to around this
+    size, or the size of the stream read if it is bigger.
+    """
+
+    def __init__(self, fileobj, streams, threads=None, block_size=None):
+        """
+        :param streams: list of streams, as returned by :func:`read_xz_streams`
+        :param block_size: expected size of the uncompressed streams, as given to
+            :class:`ParallelCompressionWriter`
+        """
+        super().__init__()
+        self.fileobj = fileobj
+        self.streams = streams
+        self.threads = threads or os.cpu_count()
+        self.block_size = block_size or DEFAULT_BLOCK_SIZE
+
+        self._size = sum(s[3] for s in streams)
+        self._position = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        #: decompressed streams, or their future, by stream index
+        self._cache = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._position = max(offset, 0)
+        return self._position
+
+    def readinto(self, b):
+        # Fill the whole buffer, even across streams, as tarfile does not handle
+        # short reads.
+        read = 0
+        while read < len(b) and self._position < self._size:
+            index = self._stream_index(self._position)
+            _, _, uncompressed_offset, _ = self.streams[index]
+            data = self._get_stream(index)
+            start = self._position - uncompressed_offset
+            chunk = data[start : start + len(b) - read]
+            b[read : read + len(chunk)] = chunk
+            self._position += len(chunk)
+            read += len(chunk)
+
+        return read
+
+    def flush(self):
+        pass
+
+    def _stream_index(self, position):
+        low, high = 0, len(self.streams) - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.streams[middle][2] <= position:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def _get_stream(self, index):
+        # Window of the streams to decompress in advance, bounded in number and
+        # in uncompressed size.
+        end = index + 1
+        max_end = min(index + 2 * self.threads, len(self.streams))
+        buffered = self.streams[index][3]
+        while end < max_end:
+            buffered += self.streams[end][3]
+            if buffered > 2 * self.threads * self.block_size:
+                break
+            end += 1
+
+        for i in list(self._cache):
+            if i < index or i >= end:
+                self._cache.pop(i).cancel()
+
+        for i in range(index, end):
+            if i not in self._cache:
+                self._cache[i] = self._executor.submit(self._decompress_stream, i)
+
+        return self._cache[index].result()
+
+    def _decompress_stream(self, index):
+        compressed_offset, compressed_size, _, _ = self.streams[index]
+        compressed = os.pread(self.fileobj.fileno(), compressed_size, compressed_offset)
+        return memoryview(lzma.decompress(compressed, format=lzma.FORMAT_XZ))
+
+    def close(self):
+        if self.closed:
+            return
+
+        for future in self._cache.values():
+            future.cancel()
+        self._executor.shutdown()
+        self.fileobj.close()
+        super().close()
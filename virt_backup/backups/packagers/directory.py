@@ -10,6 +10,7 @@ from . import (
     _opened_only,
     _closed_only,
 )
+from .fastcopy import copy_fileobj
 
 
 class _AbstractBackupPackagerDir(_AbstractBackupPackager):
@@ -18,7 +19,7 @@ class _AbstractBackupPackagerDir(_AbstractBackupPackager):
     """
 
     def __init__(self, name, path, *args, **kwargs):
-        super().__init__(name)
+        super().__init__(name, **kwargs)
         self.path = path
 
     @property
@@ -40,29 +41,42 @@ class _AbstractBackupPackagerDir(_AbstractBackupPackager):
     def list(self):
         return os.listdir(self.path)
 
-    def _copy_file(self, src, dst, stop_event=None, buffersize=2**20):
-        if not os.path.exists(dst) and dst.endswith("/"):
-            os.makedirs(dst)
-        if os.path.isdir(dst):
-            dst = os.path.join(dst, os.path.basename(src))
+    def _copy_file(self, src, dst, name=None, stop_event=None):
+        """
+        :param dst: path of the copy, or an image target when restoring (see
+            :meth:`_create_image`)
+        """
+        if isinstance(dst, (str, bytes, os.PathLike)):
+            if not os.path.exists(dst) and dst.endswith("/"):
+                os.makedirs(dst)
+            if os.path.isdir(dst):
+                dst = os.path.join(dst, os.path.basename(src))
 
         if stop_event and stop_event.is_set():
             raise CancelledError()
-        with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
-            while True:
-                if stop_event and stop_event.is_set():
-                    raise CancelledError()
-                data = fsrc.read(buffersize)
-                if not data:
-                    break
-
-                if stop_event and stop_event.is_set():
-                    raise CancelledError()
-                fdst.write(data)
+        with self._open_copy_src(src) as fsrc, self._open_copy_dst(dst) as fdst:
+            copy_method = copy_fileobj(
+                fsrc,
+                fdst,
+                stop_event=stop_event,
+                buffersize=self._get_buffer_size(dst),
+                throttle=self.throttle,
+            )
+
+        self.log(logging.DEBUG, "%s copied with method %s", dst, copy_method)
+        self.copy_methods[name or os.path.basename(dst)] = copy_method
         return dst
 
+    def _open_copy_src(self, src):
+        return open(src, "rb")
+
+    def _open_copy_dst(self, dst):
+        return open(dst, "xb")
+
 
 class ReadBackupPackagerDir(_AbstractReadBackupPackager, _AbstractBackupPackagerDir):
+    concurrent_restore = True
+
     @_opened_only
     def restore(self, name, target, stop_event=None):
         src = os.path.join(self.path, name)
@@ -70,22 +84,30 @@ class ReadBackupPackagerDir(_AbstractReadBackupPackager, _AbstractBackupPackager
             raise ImageNotFoundError(name, self.path)
 
         self.log(logging.DEBUG, "Restore %s in %s", src, target)
-        return self._copy_file(src, target, stop_event=stop_event)
+        return self._copy_file(src, target, name=name, stop_event=stop_event)
+
+    def _open_copy_dst(self, dst):
+        return self._create_image(dst)
 
 
 class WriteBackupPackagerDir(
     _AbstractShareableWriteBackupPackager, _AbstractBackupPackagerDir
 ):
+    concurrent_add = True
+
     @_opened_only
     def add(self, src, name=None, stop_event=None):
         if not name:
             name = os.path.basename(src)
         target = os.path.join(self.path, name)
         self.log(logging.DEBUG, "Copy %s as %s", src, target)
-        self._copy_file(src, target, stop_event=stop_event)
+        self._copy_file(src, target, name=name, stop_event=stop_event)
 
         return target
 
+    def _open_copy_src(self, src):
+        return self._open_image(src)
+
     @_opened_only
     def remove(self, name):
         target = os.path.join(self.path, name)
@@ -0,0 +1,152 @@
+import errno
+import fcntl
+import os
+
+from virt_backup.exceptions import CancelledError
+from .iomode import mark_processed
+from .sparse import copy_sparse, iter_data_extents, reports_holes
+
+#: ioctl request to clone a file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+
+#: errors meaning that a copy method is not supported for these files
+_UNSUPPORTED_ERRNOS = (
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EXDEV,
+    errno.EBADF,
+    errno.ETXTBSY,
+)
+
+
+class _CopyMethodUnsupported(Exception):
+    pass
+
+
+def copy_fileobj(
+    fsrc, fdst, stop_event=None, buffersize=2**20, range_size=2**26, throttle=None
+):
+    """
+    Copy fsrc into fdst with the fastest method available, and returns its name.
+
+    Methods are tried in this order:
+
+    * ``reflink``: clone the file (FICLONE), constant time on filesystems
+      supporting it (XFS, btrfs…).
+    * ``copy_file_range``: copy done by the kernel, by ranges of `range_size`.
+    * ``sendfile``: copy done by the kernel, by ranges of `range_size`.
+    * ``buffered``: copy through python buffers of `buffersize`.
+
+    Except for reflink, only the data extents are copied and holes are recreated.
+    If the source filesystem does not report holes, the buffered copy is used to
+    detect the zero blocks. Sources which are not files, as NBD exports, and
+    targets which are not files, as the merge of a delta, are always copied
+    through the buffered copy.
+
+    Files opened with an I/O mode releasing the page cache (see
+    :mod:`virt_backup.backups.packagers.iomode`) are released as the kernel
+    copies them.
+
+    :param fsrc: source file object, opened in binary mode
+    :param fdst: target file object, opened in binary mode and empty
+    :param throttle: Throttle limiting the bandwidth of the copy. A reflink is
+        not throttled, as it does not copy any data.
+    :returns: name of the method used
+    """
+    if stop_event and stop_event.is_set():
+        raise CancelledError()
+
+    if throttle is not None:
+        buffersize = throttle.get_chunk_size(buffersize)
+        range_size = throttle.get_chunk_size(range_size)
+    if hasattr(fsrc, "iter_data_extents") or not hasattr(fdst, "fileno"):
+        copy_sparse(
+            fsrc, fdst, stop_event=stop_event, buffersize=buffersize, throttle=throttle
+        )
+        return "buffered"
+
+    fdst.flush()
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    size = os.fstat(src_fd).st_size
+
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return "reflink"
+    except OSError:
+        pass
+
+    if reports_holes(src_fd, size):
+        extents = tuple(iter_data_extents(src_fd, size))
+        for method, copy_range in (
+            ("copy_file_range", _copy_file_range),
+            ("sendfile", _sendfile),
+        ):
+            try:
+                for offset, length in extents:
+                    _copy_by_ranges(
+                        copy_range,
+                        fsrc,
+                        fdst,
+                        offset,
+                        length,
+                        range_size,
+                        stop_event,
+                        throttle,
+                    )
+            except _CopyMethodUnsupported:
+                os.ftruncate(dst_fd, 0)
+                continue
+
+            os.ftruncate(dst_fd, size)
+            return method
+
+    fsrc.seek(0)
+    fdst.seek(0)
+    copy_sparse(
+        fsrc, fdst, stop_event=stop_event, buffersize=buffersize, throttle=throttle
+    )
+    return "buffered"
+
+
+def _copy_by_ranges(
+    copy_range, fsrc, fdst, offset, length, range_size, stop_event, throttle=None
+):
+    src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+    end = offset + length
+    while offset < end:
+        if stop_event and stop_event.is_set():
+            raise CancelledError()
+
+        count = min(range_size, end - offset)
+        if throttle is not None:
+            throttle.consume(count, stop_event)
+        copied = copy_range(src_fd, dst_fd, offset, count)
+        if not copied:
+            # Source shrunk during the copy.
+            break
+        mark_processed(fsrc, offset, copied)
+        mark_processed(fdst, offset, copied)
+        offset += copied
+
+
+def _copy_file_range(src_fd, dst_fd, offset, count):
+    try:
+        return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+    except (AttributeError, OSError) as e:
+        _raise_copy_error(e)
+
+
+def _sendfile(src_fd, dst_fd, offset, count):
+    try:
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        return os.sendfile(dst_fd, src_fd, offset, count)
+    except OSError as e:
+        _raise_copy_error(e)
+
+
+def _raise_copy_error(e):
+    if isinstance(e, AttributeError) or e.errno in _UNSUPPORTED_ERRNOS:
+        raise _CopyMethodUnsupported() from e
+    raise e
@@ -0,0 +1,237 @@
+import errno
+import io
+import logging
+import mmap
+import os
+
+logger = logging.getLogger("virt_backup")
+
+#: available I/O modes:
+#:   * buffered: through the page cache, as any file
+#:   * nocache: through the page cache, but the data is released from it once
+#:     read or written, with a readahead window in front of the reads
+#:   * direct: reads bypass the page cache (O_DIRECT). Writes are done as in
+#:     nocache.
+IO_MODES = ("buffered", "nocache", "direct")
+
+#: data read or written before releasing it from the page cache
+CACHE_WINDOW = 2**25
+#: data asked to be read ahead of the reads, in nocache mode
+READAHEAD_SIZE = 2**23
+#: alignment of the offsets, sizes and buffers for O_DIRECT
+DIRECT_ALIGNMENT = 2**12
+#: size of the aligned buffer used for O_DIRECT reads
+DIRECT_BUFFER_SIZE = 2**22
+
+
+def open_source(path, io_mode=None):
+    """
+    Open a file to read, following io_mode
+
+    :returns: a binary file object. Its fileno() can be used for kernel copies,
+        which have to call :func:`mark_processed` to release what they copied.
+    """
+    io_mode = check_io_mode(io_mode)
+    if io_mode == "buffered":
+        return open(path, "rb")
+
+    if io_mode == "direct":
+        try:
+            return io.BufferedReader(
+                DirectReader(os.open(path, os.O_RDONLY | os.O_DIRECT)),
+                buffer_size=DIRECT_BUFFER_SIZE,
+            )
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            logger.warning("O_DIRECT not supported for %s, use nocache", path)
+
+    return NoCacheFile(os.open(path, os.O_RDONLY))
+
+
+def open_target(path, io_mode=None):
+    """
+    Create a file to write, following io_mode
+
+    The file must not exist, as with the "xb" mode of open().
+    """
+    io_mode = check_io_mode(io_mode)
+    if io_mode == "buffered":
+        return open(path, "xb")
+
+    return NoCacheFile(
+        os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), writable=True
+    )
+
+
+def mark_processed(fileobj, offset, length):
+    """
+    Mark a range as processed by something else than the file object (a kernel
+    copy using its file descriptor), for it to be released from the page cache
+    """
+    if isinstance(fileobj, io.BufferedReader):
+        fileobj = fileobj.raw
+    if isinstance(fileobj, _UncachedFile):
+        fileobj.processed(offset, length)
+
+
+def check_io_mode(io_mode):
+    """
+    :returns: io_mode, or "buffered" if None
+    :raises ValueError: if io_mode is unknown
+    """
+    io_mode = io_mode or "buffered"
+    if io_mode not in IO_MODES:
+        raise ValueError("invalid I/O mode: {}".format(io_mode))
+    return io_mode
+
+
+class _UncachedFile(io.RawIOBase):
+    """
+    Raw file, releasing from the page cache what it reads or writes
+
+    Reads and writes are positional: the position of the file descriptor is not
+    used, so it can be given to other functions (lseek(SEEK_DATA)…).
+    """
+
+    def __init__(self, fd, writable=False):
+        super().__init__()
+        self._fd = fd
+        self._writable = writable
+        self._position = 0
+
+        #: range read or written, and not released from the page cache yet
+        self._window = None
+
+    def fileno(self):
+        return self._fd
+
+    def readable(self):
+        return not self._writable
+
+    def writable(self):
+        return self._writable
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += os.fstat(self._fd).st_size
+        self._position = offset
+        return offset
+
+    def truncate(self, size=None):
+        size = self._position if size is None else size
+        os.ftruncate(self._fd, size)
+        return size
+
+    def processed(self, offset, length):
+        if self._window is None:
+            self._window = (offset, offset + length)
+        else:
+            start, end = self._window
+            self._window = (min(start, offset), max(end, offset + length))
+
+        start, end = self._window
+        if end - start >= CACHE_WINDOW:
+            self._release()
+
+    def _release(self):
+        if self._window is None:
+            return
+
+        start, end = self._window
+        self._window = None
+        if self._writable:
+            # Dirty pages are not released, write them first.
+            os.fdatasync(self._fd)
+        os.posix_fadvise(self._fd, start, end - start, os.POSIX_FADV_DONTNEED)
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            self._release()
+        finally:
+            os.close(self._fd)
+            super().close()
+
+
+class NoCacheFile(_UncachedFile):
+    """
+    File read or written through the page cache, but released from it once
+    processed, to not evict the cache of the other processes
+
+    Reads are sequentially read ahead.
+    """
+
+    def __init__(self, fd, writable=False):
+        super().__init__(fd, writable)
+
+        #: range asked to be read ahead
+        self._readahead = (0, 0)
+        if not writable:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    def readinto(self, b):
+        position = self._position
+        start, end = self._readahead
+        if not start <= position or position + len(b) > end:
+            size = max(READAHEAD_SIZE, len(b))
+            os.posix_fadvise(self._fd, position, size, os.POSIX_FADV_WILLNEED)
+            self._readahead = (position, position + size)
+
+        read = os.preadv(self._fd, [b], position)
+        self._position += read
+        self.processed(position, read)
+        return read
+
+    def write(self, b):
+        written = os.pwrite(self._fd, b, self._position)
+        self.processed(self._position, written)
+        self._position += written
+        return written
+
+
+class DirectReader(_UncachedFile):
+    """
+    File read with O_DIRECT, bypassing the page cache
+
+    O_DIRECT needs aligned offsets, sizes and buffers: aligned blocks are read in
+    an aligned buffer, then the requested part is copied.
+    """
+
+    def __init__(self, fd):
+        super().__init__(fd)
+        self._buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE)
+
+    def readinto(self, b):
+        position = self._position
+        aligned_start = position - position % DIRECT_ALIGNMENT
+        size = min(len(b), DIRECT_BUFFER_SIZE - (position - aligned_start))
+        aligned_size = -(-(position - aligned_start + size) // DIRECT_ALIGNMENT)
+        aligned_size *= DIRECT_ALIGNMENT
+
+        buf = memoryview(self._buffer)[:aligned_size]
+        try:
+            read = os.preadv(self._fd, [buf], aligned_start)
+            read = max(min(read - (position - aligned_start), size), 0)
+            b[:read] = buf[position - aligned_start : position - aligned_start + read]
+        finally:
+            buf.release()
+
+        self._position += read
+        return read
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._buffer.close()
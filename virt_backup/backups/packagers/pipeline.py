@@ -0,0 +1,111 @@
+import concurrent.futures
+import queue
+import threading
+
+from virt_backup.exceptions import CancelledError
+
+#: default number of chunks waiting between the reader and the writer
+DEFAULT_DEPTH = 4
+
+#: how often a blocked stage checks if the pipeline is stopped, in seconds
+_POLL_INTERVAL = 0.1
+
+_END = object()
+
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def run_pipeline(
+    read, write, transform=None, workers=1, depth=None, release=None, stop_event=None
+):
+    """
+    Copy chunks through staged threads: a reader thread, transform workers, and
+    the calling thread as writer, connected by bounded queues. The source is read
+    while the previous chunks are transformed (compressed…) and written.
+
+    Chunks are written in the order they are read. At most `depth` chunks wait
+    between the reader and the writer, plus one chunk per stage, which caps the
+    memory used by the pipeline.
+
+    If a stage fails, or stop_event is set, all the stages stop and the error is
+    raised.
+
+    :param read: callable returning an iterable of chunks, iterated in the
+        reader thread
+    :param write: callable called on each transformed chunk, in order
+    :param transform: callable applied on each chunk, in a pool of `workers`
+        threads. If None, chunks are written as read.
+    :param depth: maximum number of chunks waiting to be written. Default to
+        2 * workers, or DEFAULT_DEPTH without transform.
+    :param release: callable called with each chunk once written, to reuse its
+        buffer
+    :raises CancelledError: if stop_event is set
+    """
+    if depth is None:
+        depth = 2 * workers if transform else DEFAULT_DEPTH
+    chunks = queue.Queue(max(depth, 1))
+    stopped = threading.Event()
+    executor = (
+        concurrent.futures.ThreadPoolExecutor(workers)
+        if transform is not None
+        else None
+    )
+
+    def is_stopped():
+        return stopped.is_set() or (stop_event is not None and stop_event.is_set())
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                chunks.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_reader():
+        try:
+            for chunk in read():
+                if is_stopped():
+                    raise CancelledError()
+                future = executor.submit(transform, chunk) if executor else None
+                if not put((chunk, future)):
+                    if future is not None:
+                        future.cancel()
+                    return
+            put(_END)
+        except BaseException as e:
+            put(_Failure(e))
+
+    reader = threading.Thread(target=run_reader, name="pipeline-reader", daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _END:
+                break
+            elif isinstance(item, _Failure):
+                raise item.exception
+
+            chunk, future = item
+            transformed = future.result() if future is not None else chunk
+            if stop_event is not None and stop_event.is_set():
+                raise CancelledError()
+            write(transformed)
+            if release is not None:
+                release(chunk)
+    finally:
+        stopped.set()
+        reader.join()
+        while True:
+            try:
+                item = chunks.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple) and item[1] is not None:
+                item[1].cancel()
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,176 @@
+import errno
+import os
+
+from virt_backup.exceptions import CancelledError
+from .buffers import get_buffer_pool, iter_readinto
+
+#: Used to detect zero blocks without allocating a new buffer for each comparison.
+_ZEROS = memoryview(bytes(2**20))
+
+
+def iter_data_extents(fd, size=None):
+    """
+    Yield the data extents of a file, as `(offset, length)`, by using
+    SEEK_DATA/SEEK_HOLE.
+
+    If the filesystem does not report holes, the whole file is considered as one
+    data extent.
+
+    :param fd: file descriptor to inspect
+    :param size: file size. Computed if not given.
+    """
+    if size is None:
+        size = os.fstat(fd).st_size
+
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole until the end of the file.
+                return
+            elif e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield offset, size - offset
+                return
+            raise
+
+        data_end = os.lseek(fd, data_start, os.SEEK_HOLE)
+        if data_end > size:
+            data_end = size
+        if data_end <= data_start:
+            break
+
+        yield data_start, data_end - data_start
+        offset = data_end
+
+
+def get_image_size(fileobj):
+    """
+    Size of an opened image: a file, or a reader of an image source giving its
+    own size and data extents (as a NBD export)
+    """
+    if hasattr(fileobj, "iter_data_extents"):
+        return fileobj.size
+    return os.fstat(fileobj.fileno()).st_size
+
+
+def iter_image_extents(fileobj, size=None):
+    """
+    Yield the data extents of an opened image, as `(offset, length)`
+
+    See :func:`get_image_size` for the supported images.
+    """
+    if hasattr(fileobj, "iter_data_extents"):
+        return fileobj.iter_data_extents(size)
+    return iter_data_extents(fileobj.fileno(), size)
+
+
+def reports_holes(fd, size=None):
+    """
+    Check if the filesystem reports holes for this file.
+
+    A file fully made of data, as returned by filesystems not supporting
+    SEEK_HOLE, is considered as not reporting holes.
+    """
+    if size is None:
+        size = os.fstat(fd).st_size
+
+    for offset, length in iter_data_extents(fd, size):
+        return not (offset == 0 and length == size)
+
+    # Empty file, or only made of a hole.
+    return True
+
+
+def is_zero(data):
+    if len(data) <= len(_ZEROS):
+        return data == _ZEROS[: len(data)]
+    if isinstance(data, memoryview):
+        return all(
+            is_zero(data[i : i + len(_ZEROS)]) for i in range(0, len(data), len(_ZEROS))
+        )
+    return data.count(0) == len(data)
+
+
+class SparseWriter:
+    """
+    Write into a file, but seek over zero blocks instead of writing them, to
+    recreate holes.
+
+    :func:`close` needs to be called to extend the file up to its real size, in
+    case it ends with a hole.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+        #: current logical position in the file
+        self.position = fileobj.tell()
+
+        #: if the real file position is behind self.position
+        self._pending_seek = False
+
+    def write(self, data):
+        if is_zero(data):
+            self.position += len(data)
+            self._pending_seek = True
+            return len(data)
+
+        if self._pending_seek:
+            self.fileobj.seek(self.position)
+            self._pending_seek = False
+        self.fileobj.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, position):
+        if position != self.position:
+            self.position = position
+            self._pending_seek = True
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self._pending_seek:
+            self.fileobj.truncate(self.position)
+            self._pending_seek = False
+
+
+def copy_sparse(fsrc, fdst, stop_event=None, buffersize=2**20, throttle=None):
+    """
+    Copy fsrc into fdst by only reading the data extents of fsrc, and recreate
+    the holes in fdst.
+
+    Zero blocks are also detected in the data extents, to keep the target sparse
+    when the source filesystem does not report holes.
+
+    Data is read in a buffer of buffersize taken from the shared buffer pools.
+
+    :param fsrc: source image, opened in binary mode (see :func:`get_image_size`)
+    :param fdst: target file object, opened in binary mode
+    :param throttle: Throttle limiting the bandwidth of the copy
+    :returns: number of bytes actually read from fsrc
+    """
+    size = get_image_size(fsrc)
+    writer = SparseWriter(fdst)
+    read_bytes = 0
+
+    with get_buffer_pool(buffersize).buffer() as buf:
+        for offset, length in iter_image_extents(fsrc, size):
+            if stop_event and stop_event.is_set():
+                raise CancelledError()
+            fsrc.seek(offset)
+            writer.seek(offset)
+            for data in iter_readinto(fsrc, buf, length):
+                if throttle is not None:
+                    throttle.consume(len(data), stop_event)
+                if stop_event and stop_event.is_set():
+                    raise CancelledError()
+                writer.write(data)
+                read_bytes += len(data)
+
+    writer.seek(size)
+    writer.close()
+    return read_bytes
@@ -1,11 +1,14 @@
+import contextlib
 import io
+import json
 import logging
 import os
 import re
 import shutil
 import tarfile
+import time
 
-from virt_backup.exceptions import CancelledError, ImageNotFoundError, ImageFoundError
+from virt_backup.exceptions import CancelledError, ImageNotFoundError
 from . import (
     _AbstractBackupPackager,
     _AbstractReadBackupPackager,
@@ -13,10 +16,29 @@ from . import (
     _opened_only,
     _closed_only,
 )
+from .buffers import get_buffer_pool, iter_readinto
+from .compressors import (
+    COMPRESSORS,
+    STREAM_READERS,
+    ParallelCompressionWriter,
+    ParallelXZReader,
+    read_xz_streams,
+)
+from .pipeline import run_pipeline
+from .sparse import SparseWriter, get_image_size, iter_image_extents
+
+#: Maximum size of a xz stream to be decompressed in memory by the parallel reader.
+MAX_PARALLEL_STREAM_SIZE = 2**28
+
+#: The index of the archive members is stored next to the archive, with its name
+#: followed by this suffix.
+INDEX_SUFFIX = ".index"
+INDEX_VERSION = 1
 
 
 class _AbstractBackupPackagerTar(_AbstractBackupPackager):
     _tarfile = None
+    _fileobj = None
     _mode = ""
 
     def __init__(
@@ -26,10 +48,12 @@ class _AbstractBackupPackagerTar(_AbstractBackupPackager):
         archive_name,
         compression=None,
         compression_lvl=None,
+        compression_threads=None,
+        compression_block_size=None,
         *args,
         **kwargs,
     ):
-        super().__init__(name)
+        super().__init__(name, **kwargs)
 
         #: directory path to store the tarfile in
         self.path = path
@@ -41,6 +65,14 @@ class _AbstractBackupPackagerTar(_AbstractBackupPackager):
         self.compression = compression
         self.compression_lvl = compression_lvl
 
+        #: if set, the archive is compressed by blocks on this number of threads,
+        #: instead of a single compression stream. Also used to decompress the
+        #: archive in parallel, for xz.
+        self.compression_threads = compression_threads
+
+        #: size of the blocks compressed in parallel
+        self.compression_block_size = compression_block_size
+
     @property
     def complete_path(self):
         if self.compression not in (None, "tar"):
@@ -57,12 +89,21 @@ class _AbstractBackupPackagerTar(_AbstractBackupPackager):
 
         return complete_path
 
+    @property
+    def index_path(self):
+        return "{}{}".format(self.complete_path, INDEX_SUFFIX)
+
     def open(self):
         self._tarfile = self._open_tar(self._mode)
         self.closed = False
         return self
 
     def _open_tar(self, mode_prefix):
+        if self.compression_threads and self.compression in COMPRESSORS:
+            tar = self._open_parallel_tar(mode_prefix)
+            if tar is not None:
+                return tar
+
         extra_args = {}
         if self.compression not in (None, "tar"):
             mode_suffix = "{}".format(self.compression)
@@ -80,9 +121,67 @@ class _AbstractBackupPackagerTar(_AbstractBackupPackager):
         mode = "{}:{}".format(mode_prefix, mode_suffix) if mode_suffix else mode_prefix
         return tarfile.open(self.complete_path, mode, **extra_args)
 
+    def _open_parallel_tar(self, mode_prefix):
+        """
+        Open the tar archive with a compression done by blocks, in parallel.
+
+        :returns: the tarfile, or None if the archive cannot be read in parallel
+        """
+        if mode_prefix == "r":
+            if self.compression != "xz":
+                return None
+
+            self._fileobj = self._open_parallel_xz_reader()
+            if self._fileobj is None:
+                return None
+            return tarfile.open(fileobj=self._fileobj, mode="r")
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        self._fileobj = ParallelCompressionWriter(
+            open(self.complete_path, "{}b".format(mode_prefix)),
+            self.compression,
+            self.compression_lvl,
+            threads=self.compression_threads,
+            block_size=self.compression_block_size,
+        )
+        return tarfile.open(fileobj=self._fileobj, mode="w")
+
+    def _open_parallel_xz_reader(self):
+        """
+        :returns: a ParallelXZReader on the archive, or None if the archive cannot
+            be read in parallel
+        """
+        fileobj = open(self.complete_path, "rb")
+        streams = read_xz_streams(fileobj)
+        is_parallelizable = (
+            streams
+            and len(streams) > 1
+            and max(s[3] for s in streams) <= MAX_PARALLEL_STREAM_SIZE
+        )
+        if not is_parallelizable:
+            fileobj.close()
+            return None
+
+        self.log(logging.DEBUG, "Decompress %s xz streams", len(streams))
+        return ParallelXZReader(
+            fileobj,
+            streams,
+            threads=self.compression_threads,
+            block_size=self.compression_block_size,
+        )
+
     @_opened_only
     def close(self):
-        self._tarfile.close()
+        try:
+            if self._tarfile is not None:
+                self._tarfile.close()
+        finally:
+            self._tarfile = None
+            if self._fileobj is not None:
+                self._fileobj.close()
+                self._fileobj = None
         self.closed = True
 
     @_opened_only
@@ -91,54 +190,252 @@ class _AbstractBackupPackagerTar(_AbstractBackupPackager):
 
 
 class ReadBackupPackagerTar(_AbstractReadBackupPackager, _AbstractBackupPackagerTar):
+    """
+    If the archive has an index, its members are listed and, for uncompressed
+    archives or archives compressed by blocks, read without scanning the
+    archive. Otherwise, the tar archive is read.
+    """
+
     _mode = "r"
+    #: index entry of each member, by name. None if the archive has no index.
+    _index = None
 
     def __init__(
-        self, name, path, archive_name, compression=None, compression_lvl=None
+        self,
+        name,
+        path,
+        archive_name,
+        compression=None,
+        compression_lvl=None,
+        compression_threads=None,
+        *args,
+        **kwargs,
     ):
         # Do not set compression_lvl on readonly, as it can trigger some errors (with
         # XZ for example)
-        super().__init__(name, path, archive_name, compression)
+        super().__init__(
+            name,
+            path,
+            archive_name,
+            compression,
+            compression_threads=compression_threads,
+            **kwargs,
+        )
+
+    def open(self):
+        self._index = self._read_index()
+        if self._index is None:
+            self._tarfile = self._open_tar(self._mode)
+        self.closed = False
+        return self
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self.log(logging.WARNING, "Invalid index %s, ignored", self.index_path)
+            return None
+
+        is_valid = index.get("version") == INDEX_VERSION and index.get(
+            "archive_size"
+        ) == os.path.getsize(self.complete_path)
+        if not is_valid:
+            self.log(
+                logging.WARNING,
+                "Index %s does not match the archive, ignored",
+                self.index_path,
+            )
+            return None
+
+        return {m["name"]: m for m in index["members"]}
+
+    def _get_tarfile(self):
+        if self._tarfile is None:
+            self._tarfile = self._open_tar(self._mode)
+        return self._tarfile
+
+    @_opened_only
+    def list(self):
+        if self._index is not None:
+            return list(self._index)
+        return self._tarfile.getnames()
 
     @_opened_only
     def restore(self, name, target, stop_event=None):
+        entry = disk_tarinfo = None
+        if self._index is not None:
+            entry = self._index.get(name)
+            if entry is None:
+                raise ImageNotFoundError(name, self.complete_path)
+            elif not self._is_seekable(entry):
+                entry = None
+
+        if entry is None:
+            try:
+                disk_tarinfo = self._get_tarfile().getmember(name)
+            except KeyError:
+                raise ImageNotFoundError(name, self.complete_path)
+
+        target = self._get_restore_target(name, target)
+
         try:
-            disk_tarinfo = self._tarfile.getmember(name)
-        except KeyError:
-            raise ImageNotFoundError(name, self.complete_path)
-
-        if not os.path.exists(target) and target.endswith("/"):
-            os.makedirs(target)
-        if os.path.isdir(target):
-            target = os.path.join(target, name)
-        if os.path.isfile(target):
-            raise ImageFoundError(target)
-
-        buffersize = 2**20
-        self._tarfile.fileobj.flush()
-        try:
-            with self._tarfile.extractfile(disk_tarinfo) as fsrc:
-                with open(target, "xb") as fdst:
-                    while True:
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-                        data = fsrc.read(buffersize)
-                        if not data:
-                            break
-
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-                        fdst.write(data)
+            with self._buffer(target) as buf, self._create_image(target) as fdst:
+                writer = SparseWriter(fdst)
+                if entry is not None:
+                    self.log(logging.DEBUG, "Read %s from the index", name)
+                    with self._open_member_data(entry) as fsrc:
+                        self._copy_member_data(
+                            fsrc,
+                            entry["size"],
+                            entry["sparse"],
+                            writer,
+                            stop_event,
+                            buf,
+                        )
+                    size = entry["size"]
+                elif disk_tarinfo.sparse is not None:
+                    self._tarfile.fileobj.flush()
+                    self._tarfile.fileobj.seek(disk_tarinfo.offset_data)
+                    self._copy_member_data(
+                        self._tarfile.fileobj,
+                        disk_tarinfo.size,
+                        disk_tarinfo.sparse,
+                        writer,
+                        stop_event,
+                        buf,
+                    )
+                    size = disk_tarinfo.size
+                else:
+                    self._tarfile.fileobj.flush()
+                    with self._tarfile.extractfile(disk_tarinfo) as fsrc:
+                        self._copy_member_data(
+                            fsrc,
+                            disk_tarinfo.size,
+                            None,
+                            writer,
+                            stop_event,
+                            buf,
+                        )
+                    size = disk_tarinfo.size
+                writer.seek(size)
+                writer.close()
         except:
-            if os.path.exists(target):
-                os.remove(target)
+            self._remove_restored(target)
             raise
 
         return target
 
+    def _is_seekable(self, entry):
+        """
+        Can a member be read without decompressing what precedes it
+        """
+        return self.compression in (None, "tar") or (
+            entry.get("block_offset") is not None and self.compression in STREAM_READERS
+        )
+
+    @contextlib.contextmanager
+    def _open_member_data(self, entry):
+        """
+        Open the archive, positioned at the data of a member
+        """
+        if self.compression == "xz" and self.compression_threads:
+            reader = self._open_parallel_xz_reader()
+            if reader is not None:
+                with reader:
+                    reader.seek(entry["data_offset"])
+                    yield reader
+                return
+
+        with open(self.complete_path, "rb") as f:
+            if self.compression in (None, "tar"):
+                f.seek(entry["data_offset"])
+                yield f
+                return
+
+            # The member header starts a new compressed stream.
+            f.seek(entry["block_offset"])
+            with STREAM_READERS[self.compression](f) as reader:
+                header_size = entry["data_offset"] - entry["header_offset"]
+                if len(reader.read(header_size)) != header_size:
+                    raise tarfile.ReadError("unexpected end of data")
+                yield reader
+
+    def _copy_member_data(self, fsrc, size, sparse, writer, stop_event, buf):
+        """
+        Copy the data of a member, from fsrc positioned at its beginning, through
+        buf.
+
+        For a sparse member, only the data regions are stored: write them at
+        their offset so the holes are recreated.
+        """
+        extents = sparse if sparse is not None else ((0, size),)
+        for offset, length in extents:
+            if stop_event and stop_event.is_set():
+                raise CancelledError()
+            writer.seek(offset)
+            for data in iter_readinto(fsrc, buf, length):
+                self._throttle(len(data), stop_event)
+                if stop_event and stop_event.is_set():
+                    raise CancelledError()
+                writer.write(data)
+                length -= len(data)
+
+            if length > 0:
+                raise tarfile.ReadError("unexpected end of data")
+
 
 class WriteBackupPackagerTar(_AbstractWriteBackupPackager, _AbstractBackupPackagerTar):
+    """
+    An index of the members is written next to the archive when closing it.
+
+    When compressed by blocks, each member starts a new compressed stream, so it
+    can be read without decompressing the previous ones.
+    """
+
     _mode = "x"
+    #: index entry of each member added
+    _index_members = ()
+
+    def open(self):
+        self._index_members = []
+        return super().open()
+
+    @_opened_only
+    def close(self):
+        fileobj = self._fileobj
+        super().close()
+        self._dump_index(fileobj)
+
+    def _dump_index(self, fileobj=None):
+        """
+        :param fileobj: ParallelCompressionWriter used to write the archive, if any,
+            to get the offset of the compressed block of each member
+        """
+        block_offsets = getattr(fileobj, "block_offsets", ())
+        members = []
+        for entry in self._index_members:
+            entry = entry.copy()
+            block = entry.pop("block")
+            entry["block_offset"] = (
+                block_offsets[block]
+                if block is not None and block < len(block_offsets)
+                else None
+            )
+            members.append(entry)
+
+        index = {
+            "version": INDEX_VERSION,
+            "archive_size": os.path.getsize(self.complete_path),
+            "compression": self.compression,
+            "members": members,
+        }
+        tmp_path = "{}.tmp".format(self.index_path)
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
 
     @_opened_only
     def add(self, src, name=None, stop_event=None):
@@ -151,31 +448,51 @@ class WriteBackupPackagerTar(_AbstractWriteBackupPackager, _AbstractBackupPackag
         stop_event.
         """
         self.log(logging.DEBUG, "Add %s into %s", src, self.complete_path)
-        tarinfo = self._tarfile.gettarinfo(src, arcname=name or os.path.basename(src))
-
         if stop_event and stop_event.is_set():
             raise CancelledError()
 
-        buf = tarinfo.tobuf(
-            self._tarfile.format, self._tarfile.encoding, self._tarfile.errors
-        )
-        self._tarfile.fileobj.write(buf)
-        self._tarfile.offset += len(buf)
-        buffersize = 2**20
-
-        with open(src, "rb") as fsrc:
-            while True:
-                if stop_event and stop_event.is_set():
-                    raise CancelledError()
-                data = fsrc.read(buffersize)
-                if not data:
-                    break
+        with self._open_image(src) as fsrc:
+            tarinfo = self._get_tarinfo(src, fsrc, name or os.path.basename(src))
+            extents = tuple(iter_image_extents(fsrc, tarinfo.size))
+            is_sparse = (
+                self._tarfile.format == tarfile.PAX_FORMAT
+                and extents != ((0, tarinfo.size),)
+                and tarinfo.size > 0
+            )
+            if is_sparse:
+                self.log(
+                    logging.DEBUG, "%s is sparse, %s data extents", src, len(extents)
+                )
+                buf = self._build_sparse_header(tarinfo, extents)
+            else:
+                extents = ((0, tarinfo.size),)
+                buf = tarinfo.tobuf(
+                    self._tarfile.format, self._tarfile.encoding, self._tarfile.errors
+                )
+
+            block = None
+            if isinstance(self._fileobj, ParallelCompressionWriter):
+                # Start the member on a new compressed stream.
+                block = self._fileobj.end_block()
+            header_offset = self._tarfile.offset
+            self._tarfile.fileobj.write(buf)
+            self._tarfile.offset += len(buf)
+            self._index_members.append(
+                {
+                    "name": tarinfo.name,
+                    "header_offset": header_offset,
+                    "data_offset": self._tarfile.offset,
+                    "size": tarinfo.size,
+                    "sparse": tarinfo.sparse if is_sparse else None,
+                    "block": block,
+                }
+            )
 
-                if stop_event and stop_event.is_set():
-                    raise CancelledError()
-                self._tarfile.fileobj.write(data)
+            self._copy_extents(fsrc, extents, stop_event)
 
-        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        # The sparse map, in buf, is already padded and counted in the offset.
+        data_size = sum(length for _, length in extents)
+        blocks, remainder = divmod(data_size, tarfile.BLOCKSIZE)
         if remainder > 0:
             self._tarfile.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
             blocks += 1
@@ -184,9 +501,102 @@ class WriteBackupPackagerTar(_AbstractWriteBackupPackager, _AbstractBackupPackag
 
         return self.complete_path
 
+    def _copy_extents(self, fsrc, extents, stop_event=None):
+        """
+        Copy the extents of fsrc in the archive, through a pipeline reading fsrc
+        while the previous chunks are written (and compressed).
+        """
+        pool = get_buffer_pool(self._get_buffer_size(self.complete_path))
+
+        def read_extents():
+            for offset, length in extents:
+                fsrc.seek(offset)
+                for data in self._read_chunks(
+                    fsrc, pool, length, stop_event=stop_event
+                ):
+                    length -= len(data)
+                    yield data
+
+                if length > 0:
+                    # The file shrunk during the backup: pad to keep the archive
+                    # consistent with the header.
+                    yield memoryview(tarfile.NUL * length)
+
+        run_pipeline(
+            read_extents,
+            self._tarfile.fileobj.write,
+            release=pool.release,
+            stop_event=stop_event,
+        )
+
+    def _get_tarinfo(self, src, fsrc, arcname):
+        """
+        Build the header of an image. Image sources which are not files, as NBD
+        exports, are archived as regular files of the current date.
+        """
+        if isinstance(src, (str, bytes, os.PathLike)):
+            return self._tarfile.gettarinfo(src, arcname=arcname)
+
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = get_image_size(fsrc)
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0o644
+        return tarinfo
+
+    def _build_sparse_header(self, tarinfo, extents):
+        """
+        Build the headers of a sparse member, following the GNU PAX sparse format
+        1.0: a PAX header describing the real name and size, then a ustar header
+        which size includes the sparse map, then the sparse map itself, in the
+        member data.
+
+        :returns: headers and sparse map
+        """
+        if not extents or sum(extents[-1]) < tarinfo.size:
+            # Like GNU tar, mark a trailing hole with an empty region at the end of
+            # the file, otherwise the file would not be extended to its real size.
+            extents += ((tarinfo.size, 0),)
+
+        sparse_map = "{}\n{}".format(
+            len(extents),
+            "".join("{}\n{}\n".format(offset, length) for offset, length in extents),
+        ).encode("ascii")
+        remainder = len(sparse_map) % tarfile.BLOCKSIZE
+        if remainder:
+            sparse_map += tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+        stored_size = len(sparse_map) + sum(length for _, length in extents)
+        pax_headers = {
+            "GNU.sparse.major": "1",
+            "GNU.sparse.minor": "0",
+            "GNU.sparse.name": tarinfo.name,
+            "GNU.sparse.realsize": str(tarinfo.size),
+        }
+
+        info = tarinfo.get_info()
+        # Same placeholder name as GNU tar, for tools not handling sparse files.
+        # Too long names are truncated in the ustar header, as a PAX path record
+        # would override the real name.
+        info["name"] = "GNUSparseFile.0/{}".format(tarinfo.name)
+        info["size"] = stored_size
+        header = tarfile.TarInfo._create_pax_generic_header(
+            pax_headers, tarfile.XHDTYPE, self._tarfile.encoding
+        )
+        # The GNU format is only used to encode numbers: it allows sizes over 8GB
+        # in base-256, rather than a PAX size record that would override the size
+        # of the sparse map.
+        header += tarfile.TarInfo._create_header(
+            info, tarfile.GNU_FORMAT, self._tarfile.encoding, self._tarfile.errors
+        )
+
+        tarinfo.sparse = list(extents)
+        return header + sparse_map
+
     @_closed_only
     def remove_package(self, stop_event=None):
         if not os.path.exists(self.complete_path):
             raise FileNotFoundError(self.complete_path)
 
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
         return os.remove(self.complete_path)
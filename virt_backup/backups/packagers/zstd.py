@@ -1,11 +1,13 @@
+from bisect import bisect_right
 import glob
 import logging
 import os
 import re
 import shutil
+import struct
 import zstandard as zstd
 
-from virt_backup.exceptions import CancelledError, ImageNotFoundError, ImageFoundError
+from virt_backup.exceptions import CancelledError, ImageNotFoundError
 from . import (
     _AbstractBackupPackager,
     _AbstractReadBackupPackager,
@@ -13,15 +15,103 @@ from . import (
     _opened_only,
     _closed_only,
 )
+from .buffers import BufferPool, get_buffer_pool, iter_readinto
+from .pipeline import run_pipeline
+from .sparse import SparseWriter
+
+#: Magic number of the skippable frame storing the seek table.
+SEEK_TABLE_SKIPPABLE_MAGIC = 0x184D2A5E
+#: Magic number ending a seekable archive.
+SEEKABLE_MAGIC = 0x8F92EAB1
+#: Seek table footer: number of frames, descriptor, seekable magic number.
+_SEEK_TABLE_FOOTER = struct.Struct("<IBI")
+#: Seek table entry: compressed size, decompressed size.
+_SEEK_TABLE_ENTRY = struct.Struct("<II")
+#: Set in the seek table descriptor if each entry ends with a checksum.
+_SEEK_TABLE_CHECKSUM_FLAG = 1 << 7
+
+
+def read_seek_table(fileobj):
+    """
+    Read the seek table of a seekable zstd archive, following the zstd seekable
+    format.
+
+    :param fileobj: archive file object, opened in binary mode
+    :returns: list of `(compressed_offset, decompressed_offset, compressed_size,
+        decompressed_size)` for each frame, or None if the archive is not seekable
+    """
+    fileobj.seek(0, os.SEEK_END)
+    archive_size = fileobj.tell()
+    if archive_size < _SEEK_TABLE_FOOTER.size:
+        return None
+
+    fileobj.seek(archive_size - _SEEK_TABLE_FOOTER.size)
+    nb_frames, descriptor, magic = _SEEK_TABLE_FOOTER.unpack(
+        fileobj.read(_SEEK_TABLE_FOOTER.size)
+    )
+    if magic != SEEKABLE_MAGIC:
+        return None
+
+    entry_size = _SEEK_TABLE_ENTRY.size
+    if descriptor & _SEEK_TABLE_CHECKSUM_FLAG:
+        entry_size += 4
+    table_size = nb_frames * entry_size + _SEEK_TABLE_FOOTER.size
+    table_offset = archive_size - table_size - 8
+    if table_offset < 0:
+        return None
+
+    fileobj.seek(table_offset)
+    skippable_magic, frame_size = struct.unpack("<II", fileobj.read(8))
+    if skippable_magic != SEEK_TABLE_SKIPPABLE_MAGIC or frame_size != table_size:
+        return None
+
+    entries = fileobj.read(nb_frames * entry_size)
+    frames = []
+    compressed_offset = decompressed_offset = 0
+    for i in range(nb_frames):
+        compressed_size, decompressed_size = _SEEK_TABLE_ENTRY.unpack_from(
+            entries, i * entry_size
+        )
+        frames.append(
+            (compressed_offset, decompressed_offset, compressed_size, decompressed_size)
+        )
+        compressed_offset += compressed_size
+        decompressed_offset += decompressed_size
+
+    return frames
+
+
+def build_seek_table(frames_sizes):
+    """
+    :param frames_sizes: list of `(compressed_size, decompressed_size)`
+    :returns: the seek table, as a zstd skippable frame
+    """
+    entries = b"".join(_SEEK_TABLE_ENTRY.pack(*sizes) for sizes in frames_sizes)
+    footer = _SEEK_TABLE_FOOTER.pack(len(frames_sizes), 0, SEEKABLE_MAGIC)
+    return (
+        struct.pack(
+            "<II", SEEK_TABLE_SKIPPABLE_MAGIC, len(entries) + _SEEK_TABLE_FOOTER.size
+        )
+        + entries
+        + footer
+    )
 
 
 class _AbstractBackupPackagerZSTD(_AbstractBackupPackager):
     _mode = ""
 
     def __init__(
-        self, name, path, name_prefix, compression_lvl=0, threads=0, *args, **kwargs
+        self,
+        name,
+        path,
+        name_prefix,
+        compression_lvl=0,
+        threads=0,
+        frame_size=None,
+        *args,
+        **kwargs,
     ):
-        super().__init__(name)
+        super().__init__(name, **kwargs)
 
         #: Directory path to store the archives in.
         self.path = path
@@ -35,6 +125,20 @@ class _AbstractBackupPackagerZSTD(_AbstractBackupPackager):
             compression_lvl, threads=threads
         )
 
+        #: If set, archives are written as independent frames of `frame_size`
+        #: bytes (before compression), followed by a seek table. Frames are then
+        #: compressed and decompressed in parallel.
+        self.frame_size = frame_size
+
+        #: Number of frames compressed or decompressed in parallel.
+        self.workers = threads if threads > 0 else os.cpu_count()
+
+        #: zstd_frame_params is used by the compressor of each independent frame,
+        #: as the multithreading is done between frames.
+        self.zstd_frame_params = zstd.ZstdCompressionParameters.from_level(
+            compression_lvl
+        )
+
     @property
     def complete_path(self):
         return self.path
@@ -74,68 +178,138 @@ class _AbstractBackupPackagerZSTD(_AbstractBackupPackager):
 
 class ReadBackupPackagerZSTD(_AbstractReadBackupPackager, _AbstractBackupPackagerZSTD):
     _mode = "r"
+    concurrent_restore = True
 
     @_opened_only
     def restore(self, name, target, stop_event=None):
         if name not in self.list():
             raise ImageNotFoundError(self.archive_path(name), self.complete_path)
 
-        if not os.path.exists(target) and target.endswith("/"):
-            os.makedirs(target)
-        if os.path.isdir(target):
-            target = os.path.join(target, name)
-        if os.path.isfile(target):
-            raise ImageFoundError(target)
+        target = self._get_restore_target(name, target)
 
-        buffersize = 2**20
-        dctx = zstd.ZstdDecompressor()
         try:
-            with open(self.archive_path(name), "rb") as ifh, open(target, "xb") as ofh:
-                with dctx.stream_reader(ifh) as reader:
-                    while True:
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-
-                        data = reader.read(buffersize)
-                        if not data:
-                            break
-
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-                        ofh.write(data)
+            with (
+                open(self.archive_path(name), "rb") as ifh,
+                self._create_image(target) as ofh,
+            ):
+                seek_table = read_seek_table(ifh)
+                ifh.seek(0)
+                writer = SparseWriter(ofh)
+                if seek_table is None:
+                    with self._buffer(target) as buf:
+                        self._restore_stream(ifh, writer, buf, stop_event)
+                else:
+                    self._restore_frames(ifh, writer, seek_table, stop_event)
+                writer.close()
         except:
-            if os.path.exists(target):
-                os.remove(target)
+            self._remove_restored(target)
             raise
 
         return target
 
+    def _restore_stream(self, ifh, writer, buf, stop_event=None):
+        """
+        Restore an archive made of a single zstd frame, decompressed into buf
+        """
+        dctx = zstd.ZstdDecompressor()
+        with dctx.stream_reader(ifh) as reader:
+            for data in iter_readinto(reader, buf):
+                self._throttle(len(data), stop_event)
+                if stop_event and stop_event.is_set():
+                    raise CancelledError()
+                writer.write(data)
+
+    def _restore_frames(self, ifh, writer, seek_table, stop_event=None):
+        """
+        Restore a seekable archive, through a pipeline reading the frames,
+        decompressing them in parallel and writing them
+        """
+        self.log(
+            logging.DEBUG,
+            "Decompress %s frames with %s workers",
+            len(seek_table),
+            self.workers,
+        )
+
+        def read_frames():
+            for compressed_offset, _, compressed_size, decompressed_size in seek_table:
+                compressed = os.pread(ifh.fileno(), compressed_size, compressed_offset)
+                yield compressed, decompressed_size
+
+        def write_frame(data):
+            self._throttle(len(data), stop_event)
+            writer.write(data)
+
+        run_pipeline(
+            read_frames,
+            write_frame,
+            transform=lambda frame: self._decompress(*frame),
+            workers=self.workers,
+            stop_event=stop_event,
+        )
+
+    @_opened_only
+    def read(self, name, offset, size):
+        """
+        Read `size` bytes of an image, starting at `offset`.
+
+        For seekable archives, only the frames containing the range are
+        decompressed.
+        """
+        if name not in self.list():
+            raise ImageNotFoundError(self.archive_path(name), self.complete_path)
+
+        with open(self.archive_path(name), "rb") as ifh:
+            seek_table = read_seek_table(ifh)
+            ifh.seek(0)
+            if seek_table is None:
+                dctx = zstd.ZstdDecompressor()
+                with dctx.stream_reader(ifh) as reader:
+                    reader.seek(offset)
+                    return reader.read(size)
+
+            decompressed_offsets = [frame[1] for frame in seek_table]
+            first_frame = max(bisect_right(decompressed_offsets, offset) - 1, 0)
+            data = bytearray()
+            for frame in seek_table[first_frame:]:
+                if frame[1] >= offset + size:
+                    break
+                data += self._decompress_frame(ifh.fileno(), frame)
+
+            start = offset - seek_table[first_frame][1] if seek_table else 0
+            return bytes(data[start : start + size])
+
+    def _decompress_frame(self, fd, frame):
+        compressed_offset, _, compressed_size, decompressed_size = frame
+        compressed = os.pread(fd, compressed_size, compressed_offset)
+        return self._decompress(compressed, decompressed_size)
+
+    def _decompress(self, compressed, decompressed_size):
+        return zstd.ZstdDecompressor().decompress(
+            compressed, max_output_size=decompressed_size
+        )
+
 
 class WriteBackupPackagerZSTD(
     _AbstractWriteBackupPackager, _AbstractBackupPackagerZSTD
 ):
     _mode = "x"
+    concurrent_add = True
 
     @_opened_only
     def add(self, src, name=None, stop_event=None):
         name = name or os.path.basename(src)
         self.log(logging.DEBUG, "Add %s into %s", src, self.archive_path(name))
 
-        cctx = zstd.ZstdCompressor(compression_params=self.zstd_params)
         try:
-            with open(src, "rb") as ifh, open(self.archive_path(name), "wb") as ofh:
-                with cctx.stream_writer(ofh) as writer:
-                    while True:
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-
-                        data = ifh.read(zstd.COMPRESSION_RECOMMENDED_INPUT_SIZE)
-                        if not data:
-                            break
-
-                        if stop_event and stop_event.is_set():
-                            raise CancelledError()
-                        writer.write(data)
+            with (
+                self._open_image(src) as ifh,
+                open(self.archive_path(name), "wb") as ofh,
+            ):
+                if self.frame_size:
+                    self._add_frames(ifh, ofh, stop_event)
+                else:
+                    self._add_stream(ifh, ofh, stop_event)
         except:
             if os.path.exists(self.archive_path(name)):
                 os.remove(self.archive_path(name))
@@ -143,6 +317,66 @@ class WriteBackupPackagerZSTD(
 
         return self.archive_path(name)
 
+    def _add_stream(self, ifh, ofh, stop_event=None):
+        """
+        Compress ifh as a single zstd frame, through a pipeline reading ifh while
+        the previous chunks are compressed
+        """
+        cctx = zstd.ZstdCompressor(compression_params=self.zstd_params)
+        # Chunks larger than the recommended input size are split by the
+        # compressor: read bigger chunks to hand fewer of them between stages.
+        pool = get_buffer_pool(self._get_buffer_size(ofh.name))
+        with cctx.stream_writer(ofh) as writer:
+            run_pipeline(
+                lambda: self._read_chunks(ifh, pool, stop_event=stop_event),
+                writer.write,
+                release=pool.release,
+                stop_event=stop_event,
+            )
+
+    def _add_frames(self, ifh, ofh, stop_event=None):
+        """
+        Compress ifh as independent frames of self.frame_size, and end the
+        archive with a seek table.
+
+        Frames are read, compressed in parallel and written by the stages of a
+        pipeline.
+        """
+        self.log(
+            logging.DEBUG,
+            "Compress frames of %s bytes with %s workers",
+            self.frame_size,
+            self.workers,
+        )
+        frames_sizes = []
+        depth = 2 * self.workers
+        # One buffer per frame waiting in the pipeline, plus the ones read and
+        # written.
+        pool = BufferPool(self.frame_size, max_free=depth + 2)
+
+        def compress_frame(data):
+            return self._compress_frame(data), len(data)
+
+        def write_frame(frame):
+            compressed, decompressed_size = frame
+            ofh.write(compressed)
+            frames_sizes.append((len(compressed), decompressed_size))
+
+        run_pipeline(
+            lambda: self._read_chunks(ifh, pool, fill=True, stop_event=stop_event),
+            write_frame,
+            transform=compress_frame,
+            workers=self.workers,
+            depth=depth,
+            release=pool.release,
+            stop_event=stop_event,
+        )
+        ofh.write(build_seek_table(frames_sizes))
+
+    def _compress_frame(self, data):
+        cctx = zstd.ZstdCompressor(compression_params=self.zstd_frame_params)
+        return cctx.compress(data)
+
     @_opened_only
     def remove(self, name):
         if name not in self.list():
@@ -1,25 +1,49 @@
 import arrow
+import concurrent.futures
 import json
 import libvirt
 import logging
-import lxml.etree
 import os
+import shutil
 import subprocess
 import tarfile
+import threading
+import time
 
 import virt_backup
 from virt_backup.backups.packagers import ReadBackupPackagers, WriteBackupPackagers
+from virt_backup.backups.packagers.iomode import check_io_mode, open_source
+from virt_backup.catalog import get_catalog_of_domain_dir
 from virt_backup.compat_layers.pending_info import (
     convert as compat_convert_pending_info,
 )
-from virt_backup.domains import get_xml_block_of_disk
+from virt_backup.domains import DomainXMLCache, get_xml_block_of_disk
 from virt_backup.exceptions import CancelledError
+from virt_backup.scanner import PENDING_INFO_SUFFIX, iter_json_files, load_json_files
+from virt_backup.throttle import get_strictest_throttle, parse_rate, parse_size
 from virt_backup.tools import copy_file
 from . import _BaseDomBackup
+from .checkpoint import DomBackupJob, has_checkpoint
+from .commit import BlockCommitController
+from .delta import (
+    BLOCK_SIZE,
+    DeltaImage,
+    HashingImage,
+    iter_hashed_batches,
+    read_block_hashes,
+)
+from .nbd import NBDImage
 from .snapshot import DomExtSnapshot
 
 logger = logging.getLogger("virt_backup")
 
+#: available engines to read the disks of a running domain in full backups:
+#:   * snapshot: frozen by an external snapshot, read from their images, then
+#:     merged back by blockcommits
+#:   * pull: exported through NBD by a libvirt pull mode backup job, as they are
+#:     at the start of the job. No snapshot nor blockcommit.
+BACKUP_ENGINES = ("snapshot", "pull")
+
 
 def build_dom_backup_from_pending_info(
     pending_info, backup_dir, conn, callbacks_registrer
@@ -41,6 +65,21 @@ def build_dom_backup_from_pending_info(
     return backup
 
 
+def get_image_source_size(src):
+    """
+    Size of a disk image, in bytes
+
+    :param src: path of the image (a file or a block device), or an image
+        source opened by its `open()` method, as :class:`.nbd.NBDImage`
+    """
+    if isinstance(src, (str, bytes, os.PathLike)):
+        fileobj = open(src, "rb")
+    else:
+        fileobj = src.open()
+    with fileobj:
+        return fileobj.seek(0, os.SEEK_END)
+
+
 class DomBackup(_BaseDomBackup):
     """
     Libvirt domain backup
@@ -59,6 +98,17 @@ class DomBackup(_BaseDomBackup):
         ext_snapshot_helper=None,
         callbacks_registrer=None,
         quiesce=False,
+        backup_mode="full",
+        full_every=None,
+        disk_threads=1,
+        throttle=None,
+        io_mode=None,
+        buffer_size=None,
+        commit_bandwidth=None,
+        commit_latency=None,
+        backup_engine=None,
+        nbd_connections=None,
+        priority=None,
     ):
         """
         :param dev_disks: list of disks dev names to backup. Disks will be
@@ -74,6 +124,10 @@ class DomBackup(_BaseDomBackup):
         #: domain to backup. Has to be a libvirt.virDomain object
         self.dom = dom
 
+        #: cached definition of the domain, shared with the snapshot and backup
+        #  job helpers. Fetched again at each backup.
+        self._xml_cache = DomainXMLCache(dom)
+
         #: directory where backups will be saved
         self.backup_dir = backup_dir
 
@@ -108,6 +162,69 @@ class DomBackup(_BaseDomBackup):
         #  guest agent to run inside the VM.
         self.quiesce = quiesce
 
+        #: backup mode:
+        #    * "full": full copy of the disks, frozen by an external snapshot
+        #    * "incremental": libvirt backup job, creating a checkpoint at each
+        #        backup. Only the blocks changed since the last backup are copied,
+        #        if the last backup in backup_dir also is one of these jobs.
+        #    * "delta": like "full", but a hash of each block is stored with the
+        #        full backups. Next backups only store the blocks which hash
+        #        changed since the last full backup.
+        self.backup_mode = backup_mode or "full"
+
+        #: in incremental and delta modes, maximum number of backups in a backing
+        #  chain (the full backup included) before doing a new full backup.
+        #  Infinite chain if None.
+        self.full_every = full_every
+
+        #: number of disks to backup at the same time, if the packager allows it
+        self.disk_threads = disk_threads or 1
+
+        #: Throttle limiting the bandwidth of the packagers, shared with the
+        #  other backups it limits.
+        self.throttle = throttle
+
+        #: I/O mode used to read the disks, in
+        #  virt_backup.backups.packagers.iomode.IO_MODES
+        self.io_mode = check_io_mode(io_mode)
+
+        #: size of the buffers used to copy the disks, in bytes. Tuned for the
+        #  backup storage if None.
+        self.buffer_size = parse_size(buffer_size)
+
+        #: maximum bandwidth of the blockcommit of each disk, in bytes per second.
+        #  Unlimited if None.
+        self.commit_bandwidth = parse_rate(commit_bandwidth)
+
+        #: guest write latency, in milliseconds, above which the blockcommits are
+        #  slowed down. Not checked if None.
+        self.commit_latency = commit_latency
+
+        #: engine reading the disks of a running domain in full backups, in
+        #  BACKUP_ENGINES
+        self.backup_engine = backup_engine or "snapshot"
+        if self.backup_engine not in BACKUP_ENGINES:
+            raise ValueError("invalid backup engine: {}".format(self.backup_engine))
+
+        #: number of NBD connections to read each disk with, with the pull
+        #  engine. Only used if the NBD server allows it.
+        self.nbd_connections = nbd_connections or 1
+
+        #: priority of this backup in its group: when the backups of a group
+        #  cannot all end before a deadline, the lowest priorities are deferred
+        self.priority = priority or 0
+
+        #: droppable helper to run the libvirt backup jobs, in incremental mode
+        #  or with the pull engine
+        self._backup_job_helper = None
+
+        #: protect the pending info and definition updates when disks are backup
+        #  concurrently
+        self._pending_info_lock = threading.RLock()
+
+        #: definition of the full backup to compare with, in delta mode
+        self._delta_base = None
+
         #: droppable helper to take and clean external snapshots. Can be
         #  construct with an ext_snapshot_helper to clean the snapshots of an
         #  aborted backup. Starting a backup will erase this helper.
@@ -161,6 +278,21 @@ class DomBackup(_BaseDomBackup):
                 continue
             self.disks[dev] = dom_all_disks[dev]
 
+    def get_disks_size(self):
+        """
+        Sum of the size of the disks to backup, in bytes. Disks which size
+        cannot be read (network disks…) are ignored.
+        """
+        size = 0
+        for disk, prop in self.disks.items():
+            try:
+                size += get_image_source_size(prop["src"])
+            except OSError as e:
+                logger.debug(
+                    "%s: size of disk %s unknown: %s", self.dom.name(), disk, e
+                )
+        return size
+
     def cancel(self):
         self._cancel_flag.set()
 
@@ -176,33 +308,31 @@ class DomBackup(_BaseDomBackup):
             os.mkdir(self.backup_dir)
 
         logger.info("%s: Backup started", self.dom.name())
+        self._xml_cache.invalidate()
         definition = self.get_definition()
         definition["disks"] = {}
+        started = time.monotonic()
 
         try:
             self._running = True
-            self._ext_snapshot_helper = self._get_ext_snapshot_helper()
-
-            snapshot_date, definition = self._snapshot_and_save_date(definition)
-
-            self._name = self._main_backup_name_format(snapshot_date)
-            definition["name"], self.pending_info["name"] = self._name, self._name
-            self._dump_json_definition(definition)
-            self._dump_pending_info()
-
-            packager = self._get_packager()
-            # TODO: handle backingStore cases
-            with packager:
-                for disk, prop in self.disks.items():
-                    if self._cancel_flag.is_set():
-                        raise CancelledError()
-
-                    self._backup_disk(disk, prop, packager, definition)
-                    self._ext_snapshot_helper.clean_for_disk(disk)
-
-            self._dump_json_definition(definition)
-            self.post_backup()
-            self._clean_pending_info()
+            with self._updating_catalog() as catalog_changes:
+                if self._use_backup_job():
+                    self._backup_with_job(definition)
+                elif self._use_pull_job():
+                    self._backup_with_pull_job(definition)
+                else:
+                    self._backup_with_ext_snapshot(definition)
+
+                # Recorded to schedule the next backups of the group.
+                definition["duration"] = round(time.monotonic() - started, 3)
+                definition_path = self._dump_json_definition(definition)
+                self.post_backup()
+                pending_info_path = self._clean_pending_info()
+
+                # Already recorded, but recording the whole backup keeps the catalog
+                # in sync with the files written by the packager.
+                catalog_changes.put(definition_path, definition)
+                catalog_changes.remove(pending_info_path)
         except:
             self.clean_aborted()
             raise
@@ -210,6 +340,313 @@ class DomBackup(_BaseDomBackup):
             self._running = False
         logger.info("%s: Backup finished", self.dom.name())
 
+    def _use_backup_job(self):
+        if self.backup_mode != "incremental":
+            return False
+
+        if not self.dom.isActive():
+            logger.warning(
+                "%s: incremental backups need the domain to be running, fallback "
+                "to a full backup",
+                self.dom.name(),
+            )
+            return False
+
+        return True
+
+    def _use_pull_job(self):
+        if self.backup_engine != "pull":
+            return False
+
+        if self.backup_mode != "full":
+            logger.warning(
+                "%s: the pull engine only does full backups, use external snapshots",
+                self.dom.name(),
+            )
+            return False
+        if not self.dom.isActive():
+            logger.info(
+                "%s: domain not running, use external snapshots", self.dom.name()
+            )
+            return False
+
+        return True
+
+    def _backup_with_ext_snapshot(self, definition):
+        """
+        Freeze the disks with an external snapshot, then copy them
+        """
+        self._ext_snapshot_helper = self._get_ext_snapshot_helper()
+
+        snapshot_date, definition = self._snapshot_and_save_date(definition)
+
+        self._name = self._main_backup_name_format(snapshot_date)
+        definition["name"], self.pending_info["name"] = self._name, self._name
+        if self.backup_mode == "delta":
+            self._prepare_delta_backup(definition)
+        self._dump_json_definition(definition)
+        self._dump_pending_info()
+
+        packager = self._get_packager()
+        # TODO: handle backingStore cases
+        with packager:
+            # Blockcommits are serialized, as pivoting an inactive domain redefines
+            # it.
+            clean_lock = threading.Lock()
+            # Commits of a running domain continue during the backup of the next
+            # disks, and are all waited for by post_backup().
+            wait_commit = not self._ext_snapshot_helper.concurrent_commits
+
+            def clean_for_disk(disk):
+                with clean_lock:
+                    self._ext_snapshot_helper.clean_for_disk(disk, wait=wait_commit)
+
+            self._backup_disks(self.disks, packager, definition, clean_for_disk)
+
+    def _prepare_delta_backup(self, definition):
+        """
+        Search the full backup to compare with, and mark the backup as a delta
+        of it. Mark it as a full backup if none can be used.
+        """
+        self._delta_base = self._get_delta_base_definition()
+        if self._delta_base:
+            definition["backup_mode"] = "delta"
+            definition["parent"] = self._delta_base["name"]
+        else:
+            definition["backup_mode"] = "full"
+            definition["block_hashes"] = {"block_size": BLOCK_SIZE, "disks": {}}
+
+        for k in ("backup_mode", "parent"):
+            if k in definition:
+                self.pending_info[k] = definition[k]
+
+    def _backup_with_job(self, definition):
+        """
+        Export the disks with a libvirt backup job, then package them
+
+        The job creates a checkpoint, and only copies the blocks changed since
+        the checkpoint of the parent backup, if any.
+        """
+        parent = self._get_parent_definition()
+        backup_date = arrow.now()
+        self._name = self._main_backup_name_format(backup_date)
+
+        definition["date"] = backup_date.int_timestamp
+        definition["name"] = self._name
+        definition["backup_mode"] = "incremental" if parent else "full"
+        definition["checkpoint"] = "virt-backup-{}".format(self._name)
+        if parent:
+            definition["parent"] = parent["name"]
+
+        job_dir = os.path.join(self.backup_dir, "{}.job".format(self._name))
+        self.pending_info = definition.copy()
+        self.pending_info["job_dir"] = job_dir
+        self.pending_info["disks"] = {
+            disk: {"src": prop["src"], "type": prop["type"]}
+            for disk, prop in self.disks.items()
+        }
+        self._dump_json_definition(definition)
+        self._dump_pending_info()
+
+        self._backup_job_helper = DomBackupJob(
+            self.dom,
+            self.disks,
+            definition["checkpoint"],
+            parent["checkpoint"] if parent else None,
+            xml_cache=self._xml_cache,
+        )
+        os.mkdir(job_dir)
+        targets = {
+            disk: os.path.join(job_dir, "{}.qcow2".format(disk)) for disk in self.disks
+        }
+        logger.info(
+            "%s: Start %s backup job", self.dom.name(), definition["backup_mode"]
+        )
+        self._backup_job_helper.start(targets, self._cancel_flag)
+
+        packager = self._get_packager()
+        with packager:
+            self._backup_disks(
+                {disk: {"src": targets[disk], "type": "qcow2"} for disk in self.disks},
+                packager,
+                definition,
+                lambda disk: os.remove(targets[disk]),
+            )
+        shutil.rmtree(job_dir)
+
+        if parent:
+            # Only the last checkpoint is needed for the next backup. Its bitmap
+            # is merged by libvirt in the previous checkpoint, if any.
+            self._backup_job_helper.delete_checkpoint(parent["checkpoint"])
+
+    def _backup_with_pull_job(self, definition):
+        """
+        Export the disks with a libvirt pull mode backup job, and package them by
+        reading the NBD exports
+
+        The guest writes done during the job are redirected to scratch files,
+        dropped when the job ends: the disks do not need to be merged back.
+        """
+        backup_date = arrow.now()
+        self._name = self._main_backup_name_format(backup_date)
+
+        definition["date"] = backup_date.int_timestamp
+        definition["name"] = self._name
+        definition["backup_engine"] = "pull"
+
+        job_dir = os.path.join(self.backup_dir, "{}.job".format(self._name))
+        self.pending_info = definition.copy()
+        self.pending_info["job_dir"] = job_dir
+        self.pending_info["disks"] = {
+            disk: {"src": prop["src"], "type": prop["type"]}
+            for disk, prop in self.disks.items()
+        }
+        self._dump_json_definition(definition)
+        self._dump_pending_info()
+
+        self._backup_job_helper = DomBackupJob(
+            self.dom, self.disks, xml_cache=self._xml_cache
+        )
+        os.mkdir(job_dir)
+        socket = os.path.join(job_dir, "nbd.sock")
+        logger.info("%s: Start pull mode backup job", self.dom.name())
+        exports = self._backup_job_helper.start_pull(
+            socket,
+            {
+                disk: os.path.join(job_dir, "{}.scratch.qcow2".format(disk))
+                for disk in self.disks
+            },
+        )
+
+        packager = self._get_packager()
+        with packager:
+            # The exports are raw, whatever the format of the disks.
+            self._backup_disks(
+                {
+                    disk: {
+                        "src": NBDImage(socket, exports[disk], self.nbd_connections),
+                        "type": "raw",
+                    }
+                    for disk in self.disks
+                },
+                packager,
+                definition,
+            )
+        self._backup_job_helper.abort()
+        shutil.rmtree(job_dir)
+
+    def _get_parent_definition(self):
+        """
+        Get the definition of the backup to use as parent for an incremental
+        backup: the last complete backup of the domain in backup_dir, if done by a
+        backup job.
+
+        :returns: the parent definition, or None if a full backup is needed
+        """
+        definitions = self._get_complete_definitions()
+        if not definitions:
+            return None
+
+        last = max(definitions.values(), key=lambda d: d["date"])
+        if not last.get("checkpoint"):
+            return None
+        if not set(self.disks).issubset(last.get("disks", {})):
+            logger.info("%s: new disks to backup, full backup needed", self.dom.name())
+            return None
+
+        chain_length = 1
+        ancestor = last
+        while ancestor.get("parent"):
+            ancestor = definitions.get(ancestor["parent"])
+            if ancestor is None:
+                logger.warning(
+                    "%s: backing chain of backup %s is broken, full backup needed",
+                    self.dom.name(),
+                    last["name"],
+                )
+                return None
+            chain_length += 1
+
+        if self.full_every and chain_length >= self.full_every:
+            return None
+
+        if not has_checkpoint(self.dom, last["checkpoint"]):
+            logger.info(
+                "%s: checkpoint %s not found, full backup needed",
+                self.dom.name(),
+                last["checkpoint"],
+            )
+            return None
+
+        return last
+
+    def _get_delta_base_definition(self):
+        """
+        Get the definition of the full backup to compare with for a delta backup:
+        the last full backup of the domain in backup_dir, if its block hashes
+        were stored.
+
+        :returns: the base definition, or None if a full backup is needed
+        """
+        definitions = self._get_complete_definitions()
+        if not definitions:
+            return None
+
+        last = max(definitions.values(), key=lambda d: d["date"])
+        if last.get("backup_mode") == "delta":
+            base = definitions.get(last.get("parent"))
+        else:
+            base = last
+        if not base or not base.get("block_hashes"):
+            return None
+
+        hashes_files = base["block_hashes"].get("disks", {})
+        if not set(self.disks).issubset(hashes_files):
+            logger.info("%s: new disks to backup, full backup needed", self.dom.name())
+            return None
+        for disk in self.disks:
+            if not os.path.isfile(os.path.join(self.backup_dir, hashes_files[disk])):
+                logger.warning(
+                    "%s: block hashes of disk %s not found, full backup needed",
+                    self.dom.name(),
+                    disk,
+                )
+                return None
+
+        if self.full_every:
+            chain_length = 1 + sum(
+                1 for d in definitions.values() if d.get("parent") == base["name"]
+            )
+            if chain_length >= self.full_every:
+                return None
+
+        return base
+
+    def _get_complete_definitions(self):
+        """
+        Get the definitions of the complete backups of the domain in backup_dir
+
+        :returns: {backup_name: definition}
+        """
+        pending_paths = {
+            path for path, _, _ in iter_json_files(self.backup_dir, PENDING_INFO_SUFFIX)
+        }
+        definition_paths = (
+            path
+            for path, _, _ in iter_json_files(self.backup_dir)
+            if "{}.pending".format(path) not in pending_paths
+        )
+
+        definitions = {}
+        for definition in load_json_files(definition_paths).values():
+            if (
+                definition.get("domain_name") == self.dom.name()
+                and "name" in definition
+            ):
+                definitions[definition["name"]] = definition
+
+        return definitions
+
     def _get_ext_snapshot_helper(self):
         return DomExtSnapshot(
             self.dom,
@@ -218,6 +655,20 @@ class DomBackup(_BaseDomBackup):
             self.conn,
             self.timeout,
             quiesce=self.quiesce,
+            xml_cache=self._xml_cache,
+            commit_controller=self._get_commit_controller(),
+        )
+
+    def _get_commit_controller(self):
+        if self.commit_bandwidth is None and self.commit_latency is None:
+            return None
+
+        return BlockCommitController(
+            self.dom,
+            max_bandwidth=self.commit_bandwidth,
+            latency_target=(
+                self.commit_latency / 1000 if self.commit_latency is not None else None
+            ),
         )
 
     def _get_packager(self):
@@ -259,11 +710,54 @@ class DomBackup(_BaseDomBackup):
         return {
             "domain_id": self.dom.ID(),
             "domain_name": self.dom.name(),
-            "domain_xml": self.dom.XMLDesc(),
+            "domain_xml": self._xml_cache.get_xml(),
             "packager": {"type": self.packager, "opts": self.packager_opts},
             "version": virt_backup.VERSION,
         }
 
+    def _backup_disks(self, disks, packager, definition, after_disk=None):
+        """
+        Backup disks, concurrently if the packager allows it
+
+        If a disk backup fails, the backup is cancelled to stop the other disks.
+
+        :param disks: disks properties, `{disk: disk_properties}`
+        :param after_disk: called with the disk name, as soon as its backup is
+                           done
+        """
+        workers = 1
+        if packager.concurrent_add:
+            workers = min(self.disk_threads, len(disks)) or 1
+
+        def backup_disk(disk, prop):
+            if self._cancel_flag.is_set():
+                raise CancelledError()
+
+            self._backup_disk(disk, prop, packager, definition)
+            if after_disk:
+                after_disk(disk)
+
+        if workers == 1:
+            for disk, prop in disks.items():
+                backup_disk(disk, prop)
+            return
+
+        logger.debug("%s: Backup disks with %s workers", self.dom.name(), workers)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(backup_disk, d, p) for d, p in disks.items()]
+            concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION
+            )
+            if any(f.done() and f.exception() for f in futures):
+                self._cancel_flag.set()
+                concurrent.futures.wait(futures)
+                errors = [f.exception() for f in futures if f.exception()]
+                # Raise the error which cancelled the other disks.
+                raise next(
+                    (e for e in errors if not isinstance(e, CancelledError)),
+                    errors[0],
+                )
+
     def _backup_disk(self, disk, disk_properties, packager, definition):
         """
         Backup a disk and complete the definition by adding this disk
@@ -276,17 +770,109 @@ class DomBackup(_BaseDomBackup):
         """
         snapshot_date = arrow.get(definition["date"]).to("local")
         logger.info("%s: Backup disk %s", self.dom.name(), disk)
+        is_delta = definition.get("backup_mode") == "delta"
         bak_img = "{}.{}".format(
-            self._disk_backup_name_format(snapshot_date, disk), disk_properties["type"]
+            self._disk_backup_name_format(snapshot_date, disk),
+            "delta" if is_delta else disk_properties["type"],
+        )
+        disk_size = get_image_source_size(disk_properties["src"])
+        with self._pending_info_lock:
+            self.pending_info["disks"][disk]["target"] = bak_img
+            self._dump_pending_info()
+
+            if definition.get("disks", None) is None:
+                definition["disks"] = {}
+            definition["disks"][disk] = bak_img
+            definition["disks_size"] = definition.get("disks_size", 0) + disk_size
+
+        if is_delta:
+            self._backup_disk_delta(disk, disk_properties, bak_img, packager)
+        elif "block_hashes" in definition:
+            self._backup_disk_with_hashes(
+                disk, disk_properties, bak_img, packager, definition
+            )
+        else:
+            packager.add(disk_properties["src"], bak_img, self._cancel_flag)
+
+        copy_method = packager.copy_methods.get(bak_img)
+        if copy_method:
+            with self._pending_info_lock:
+                definition.setdefault("copy_methods", {})[disk] = copy_method
+
+    def _backup_disk_delta(self, disk, disk_properties, bak_img, packager):
+        """
+        Only package the blocks which hash changed since the base backup
+
+        The delta is read by the packager as it is computed, without being
+        written anywhere else.
+        """
+        base_hashes_info = self._delta_base["block_hashes"]
+        base_hashes = read_block_hashes(
+            os.path.join(self.backup_dir, base_hashes_info["disks"][disk])
+        )
+        delta = DeltaImage(
+            disk_properties["src"],
+            base_hashes,
+            base_hashes_info["block_size"],
+            io_mode=self.io_mode,
+            stop_event=self._cancel_flag,
+        )
+        packager.add(delta, bak_img, self._cancel_flag)
+
+        logger.debug(
+            "%s: %s blocks changed on disk %s since backup %s",
+            self.dom.name(),
+            delta.changed_blocks,
+            disk,
+            self._delta_base["name"],
         )
-        self.pending_info["disks"][disk]["target"] = bak_img
-        self._dump_pending_info()
 
-        if definition.get("disks", None) is None:
-            definition["disks"] = {}
-        definition["disks"][disk] = bak_img
+    def _backup_disk_with_hashes(
+        self, disk, disk_properties, bak_img, packager, definition
+    ):
+        """
+        Backup a disk and store the hash of each of its blocks, to compare the
+        next delta backups with
 
-        packager.add(disk_properties["src"], bak_img, self._cancel_flag)
+        The blocks are hashed while the packager reads the disk. If it did not
+        read it in order, the disk is read again to hash it.
+        """
+        block_hashes = definition["block_hashes"]
+        snapshot_date = arrow.get(definition["date"]).to("local")
+        hashes_filename = "{}.blockhash".format(
+            self._disk_backup_name_format(snapshot_date, disk)
+        )
+        with self._pending_info_lock:
+            block_hashes["disks"][disk] = hashes_filename
+            self.pending_info["block_hashes"] = block_hashes
+            self._dump_pending_info()
+
+        with open(os.path.join(self.backup_dir, hashes_filename), "xb") as f:
+            image = HashingImage(
+                disk_properties["src"],
+                f,
+                block_hashes["block_size"],
+                io_mode=self.io_mode,
+            )
+            try:
+                packager.add(image, bak_img, self._cancel_flag)
+                if image.finish():
+                    return
+            finally:
+                image.close()
+
+            logger.debug(
+                "%s: disk %s not read in order, read it again to hash it",
+                self.dom.name(),
+                disk,
+            )
+            f.seek(0)
+            f.truncate()
+            with open_source(disk_properties["src"], self.io_mode) as fsrc:
+                for _, _, hashes in iter_hashed_batches(
+                    fsrc, block_hashes["block_size"], stop_event=self._cancel_flag
+                ):
+                    f.write(hashes)
 
     def _disk_backup_name_format(self, snapdate, disk_name, *args, **kwargs):
         """
@@ -306,15 +892,21 @@ class DomBackup(_BaseDomBackup):
         if self._ext_snapshot_helper is not None:
             self._ext_snapshot_helper.clean()
             self._ext_snapshot_helper = None
+        self._backup_job_helper = None
+        self._delta_base = None
+        logger.debug(
+            "%s: domain definition fetched %s times, %s cache hits",
+            self.dom.name(),
+            self._xml_cache.misses,
+            self._xml_cache.hits,
+        )
         self._running = False
 
     def _parse_dom_xml(self):
         """
         Parse the domain's definition
         """
-        return lxml.etree.fromstring(
-            self.dom.XMLDesc(), lxml.etree.XMLParser(resolve_entities=False)
-        )
+        return self._xml_cache.get_parsed()
 
     def _dump_json_definition(self, definition):
         """
@@ -322,17 +914,29 @@ class DomBackup(_BaseDomBackup):
 
         Definition will describe our backup, with the date, backuped
         disks names and other informations
+
+        :returns: path of the definition
         """
         backup_date = arrow.get(definition["date"]).to("local")
         definition_path = self._get_json_definition_path(backup_date)
-        with open(definition_path, "w") as json_definition:
-            json.dump(definition, json_definition, indent=4)
+        with self._updating_catalog() as catalog_changes:
+            with open(definition_path, "w") as json_definition:
+                json.dump(definition, json_definition, indent=4)
+            catalog_changes.put(definition_path, definition)
+
+        return definition_path
 
     def _clean_definition(self, definition={}):
         backup_date = arrow.get(definition.get("date", self.pending_info["date"])).to(
             "local"
         )
-        os.remove(self._get_json_definition_path(backup_date))
+        definition_path = self._get_json_definition_path(backup_date)
+        with self._updating_catalog() as catalog_changes:
+            os.remove(definition_path)
+            catalog_changes.remove(definition_path)
+
+    def _updating_catalog(self):
+        return get_catalog_of_domain_dir(self.backup_dir).updating(self.backup_dir)
 
     def _get_json_definition_path(self, backup_date):
         return os.path.join(
@@ -346,14 +950,25 @@ class DomBackup(_BaseDomBackup):
 
         Useful
         """
-        json_path = self._get_pending_info_json_path()
-        with open(json_path, "w") as json_pending_info:
-            json.dump(self.pending_info, json_pending_info, indent=4)
+        with self._pending_info_lock:
+            json_path = self._get_pending_info_json_path()
+            # Write then rename, to never leave a partially written pending info.
+            tmp_path = "{}.tmp".format(json_path)
+            with self._updating_catalog() as catalog_changes:
+                with open(tmp_path, "w") as json_pending_info:
+                    json.dump(self.pending_info, json_pending_info, indent=4)
+                os.replace(tmp_path, json_path)
+                catalog_changes.put(json_path, self.pending_info)
 
     def _clean_pending_info(self):
-        os.remove(self._get_pending_info_json_path())
+        json_path = self._get_pending_info_json_path()
+        with self._updating_catalog() as catalog_changes:
+            os.remove(json_path)
+            catalog_changes.remove(json_path)
         self.pending_info = {}
 
+        return json_path
+
     def _get_pending_info_json_path(self):
         backup_date = arrow.get(self.pending_info["date"]).to("local")
         json_path = os.path.join(
@@ -363,8 +978,18 @@ class DomBackup(_BaseDomBackup):
         return json_path
 
     def clean_aborted(self):
+        # The backup could have changed the domain without invalidating the cache.
+        self._xml_cache.invalidate()
+        if self.pending_info.get("checkpoint"):
+            self._clean_aborted_backup_job()
+        elif self.pending_info.get("backup_engine") == "pull":
+            self._clean_aborted_pull_job()
+
         is_ext_snap_helper_needed = (
-            not self._ext_snapshot_helper and self.pending_info.get("disks", None)
+            not self._ext_snapshot_helper
+            and self.pending_info.get("disks", None)
+            and not self.pending_info.get("checkpoint")
+            and self.pending_info.get("backup_engine") != "pull"
         )
         if is_ext_snap_helper_needed:
             self._ext_snapshot_helper = self._get_ext_snapshot_helper()
@@ -382,6 +1007,16 @@ class DomBackup(_BaseDomBackup):
         if self._ext_snapshot_helper:
             self._ext_snapshot_helper.clean()
 
+        job_dir = self.pending_info.get("job_dir")
+        if job_dir and os.path.isdir(job_dir):
+            shutil.rmtree(job_dir)
+
+        block_hashes = self.pending_info.get("block_hashes", {}).get("disks", {})
+        for hashes_filename in block_hashes.values():
+            hashes_path = os.path.join(self.backup_dir, hashes_filename)
+            if os.path.exists(hashes_path):
+                os.remove(hashes_path)
+
         # If the name couldn't have been written, no packager has been created.
         if "name" in self.pending_info:
             packager = self._get_write_packager(self.pending_info["name"])
@@ -405,6 +1040,31 @@ class DomBackup(_BaseDomBackup):
                     # Info had no time to be filled, so had not be dumped.
                     pass
 
+    def _clean_aborted_backup_job(self):
+        """
+        Delete the checkpoint of an aborted backup job
+        """
+        if has_checkpoint(self.dom, self.pending_info["checkpoint"]):
+            job_helper = self._backup_job_helper or DomBackupJob(
+                self.dom,
+                self.disks,
+                self.pending_info["checkpoint"],
+                xml_cache=self._xml_cache,
+            )
+            job_helper.delete_checkpoint(self.pending_info["checkpoint"])
+        self._backup_job_helper = None
+
+    def _clean_aborted_pull_job(self):
+        """
+        End the pull mode backup job of an aborted backup, if still running
+        """
+        job_helper = self._backup_job_helper or DomBackupJob(
+            self.dom, self.disks, xml_cache=self._xml_cache
+        )
+        if job_helper.is_running():
+            job_helper.abort()
+        self._backup_job_helper = None
+
     def compatible_with(self, dombackup):
         """
         Is compatible with dombackup ?
@@ -417,7 +1077,13 @@ class DomBackup(_BaseDomBackup):
         if not same_domain:
             return False
 
-        attributes_to_compare = ("backup_dir", "packager")
+        attributes_to_compare = (
+            "backup_dir",
+            "packager",
+            "backup_mode",
+            "full_every",
+            "backup_engine",
+        )
         for a in attributes_to_compare:
             if getattr(self, a) != getattr(dombackup, a):
                 return False
@@ -432,6 +1098,31 @@ class DomBackup(_BaseDomBackup):
         return True
 
     def merge_with(self, dombackup):
+        """
+        Merge a compatible dombackup into this one
+
+        The concurrency and priority options keep the highest value, and the
+        bandwidth limits the strictest one. The I/O mode of this backup is kept,
+        and its buffer size if it is set.
+        """
         self.add_disks(*dombackup.disks.keys())
         timeout = self.timeout or dombackup.timeout
         self.timeout = timeout
+        self.disk_threads = max(self.disk_threads, dombackup.disk_threads)
+        self.nbd_connections = max(self.nbd_connections, dombackup.nbd_connections)
+        self.priority = max(self.priority, dombackup.priority)
+        self.throttle = get_strictest_throttle(self.throttle, dombackup.throttle)
+        self.commit_bandwidth = _get_lowest_limit(
+            self.commit_bandwidth, dombackup.commit_bandwidth
+        )
+        self.commit_latency = _get_lowest_limit(
+            self.commit_latency, dombackup.commit_latency
+        )
+        self.buffer_size = self.buffer_size or dombackup.buffer_size
+
+
+def _get_lowest_limit(*limits):
+    """
+    :returns: the lowest of limits, ignoring the unset ones, or None
+    """
+    return min((limit for limit in limits if limit), default=None)
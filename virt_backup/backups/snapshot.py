@@ -1,18 +1,25 @@
 from collections import defaultdict
+import copy
 import logging
 import os
 import subprocess
 import threading
+import time
 import arrow
 import libvirt
 import lxml.etree
 
 from virt_backup.domains import (
+    DomainXMLCache,
     get_domain_disks_of,
     get_domain_incompatible_disks_of,
     get_xml_block_of_disk,
 )
-from virt_backup.exceptions import DiskNotSnapshot, SnapshotNotStarted
+from virt_backup.exceptions import (
+    DiskNotSnapshot,
+    SnapshotNotPivoted,
+    SnapshotNotStarted,
+)
 
 logger = logging.getLogger("virt_backup")
 
@@ -63,11 +70,24 @@ class DomExtSnapshot:
     metadatas = None
 
     def __init__(
-        self, dom, disks, callbacks_registrer, conn=None, timeout=None, quiesce=False
+        self,
+        dom,
+        disks,
+        callbacks_registrer,
+        conn=None,
+        timeout=None,
+        quiesce=False,
+        xml_cache=None,
+        concurrent_commits=True,
+        commit_controller=None,
     ):
         #: domain to snapshot. Has to be a libvirt.virDomain object
         self.dom = dom
 
+        #: cached definition of the domain, shared with the backup. Invalidated
+        #  by each change of the domain done here.
+        self.xml_cache = DomainXMLCache(dom) if xml_cache is None else xml_cache
+
         self.disks = disks
 
         self._callbacks_registrer = callbacks_registrer
@@ -84,9 +104,23 @@ class DomExtSnapshot:
         #  to quiesce deactivated.
         self.quiesce = quiesce
 
+        #: when cleaning a running domain, blockcommit all the disks at once then
+        #  wait for all of them to pivot, instead of one disk after the other.
+        self.concurrent_commits = concurrent_commits
+
         #: used to trigger when block pivot ends, by snapshot path
         self._wait_for_pivot = defaultdict(threading.Event)
 
+        #: BlockCommitController adapting the bandwidth of the blockcommits. Not
+        #  limited if None.
+        self.commit_controller = commit_controller
+
+        #: disks with a blockcommit started, and not pivoted yet
+        self._committing = set()
+
+        #: blockcommits not ready to pivot yet, `{snapshot_path: (disk, start)}`
+        self._commits_start = {}
+
     def start(self):
         """
         Start the external snapshot
@@ -137,6 +171,9 @@ class DomExtSnapshot:
                 flags = self._get_snapshot_flags(quiesce=False)
                 return self.dom.snapshotCreateXML(snap_xml, flags)
             raise
+        finally:
+            # The snapshots replaced the disks sources.
+            self.xml_cache.invalidate()
 
     def _get_snapshot_flags(self, quiesce=False):
         flags = (
@@ -163,11 +200,8 @@ class DomExtSnapshot:
         disks_el = lxml.etree.Element("disks")
         root_el.append(disks_el)
 
-        all_domain_disks = get_domain_disks_of(
-            lxml.etree.fromstring(
-                self.dom.XMLDesc(), lxml.etree.XMLParser(resolve_entities=False)
-            )
-        )
+        dom_xml = self.xml_cache.get_parsed()
+        all_domain_disks = get_domain_disks_of(dom_xml)
         for d in sorted(all_domain_disks.keys()):
             disk_el = lxml.etree.Element("disk")
             disk_el.attrib["name"] = d
@@ -177,11 +211,7 @@ class DomExtSnapshot:
             disk_el.attrib["snapshot"] = "external" if d in self.disks else "no"
             disks_el.append(disk_el)
 
-        non_snapshotable_disks = get_domain_incompatible_disks_of(
-            lxml.etree.fromstring(
-                self.dom.XMLDesc(), lxml.etree.XMLParser(resolve_entities=False)
-            )
-        )
+        non_snapshotable_disks = get_domain_incompatible_disks_of(dom_xml)
         for d in non_snapshotable_disks:
             disk_el = lxml.etree.Element("disk")
             disk_el.attrib["name"] = d
@@ -194,10 +224,7 @@ class DomExtSnapshot:
         return "{}.{}".format(os.path.splitext(parent_disk_path)[0], snapshot.getName())
 
     def _get_disk_type(self, disk):
-        dom_xml = lxml.etree.fromstring(
-            self.dom.XMLDesc(), lxml.etree.XMLParser(resolve_entities=False)
-        )
-        disk_xml = get_xml_block_of_disk(dom_xml, disk)
+        disk_xml = get_xml_block_of_disk(self.xml_cache.get_parsed(), disk)
         return disk_xml.xpath("driver")[0].get("type", "raw")
 
     def clean(self):
@@ -205,13 +232,15 @@ class DomExtSnapshot:
             raise SnapshotNotStarted()
 
         disks = tuple(self.metadatas["disks"].keys())
-        snapshot_paths = tuple(
-            os.path.abspath(self.metadatas["disks"][disk]["snapshot"]) for disk in disks
-        )
+        snapshot_paths = {
+            disk: os.path.abspath(self.metadatas["disks"][disk]["snapshot"])
+            for disk in disks
+        }
+        concurrent = self.concurrent_commits and self.dom.isActive()
         try:
             for disk in disks:
                 try:
-                    self.clean_for_disk(disk)
+                    self.clean_for_disk(disk, wait=not concurrent)
                 except Exception as e:
                     logger.critical(
                         (
@@ -219,15 +248,39 @@ class DomExtSnapshot:
                         ).format(disk, self.dom.name(), e)
                     )
                     raise
+        except Exception:
+            if concurrent:
+                # Also wait for the commits started before the failure, without
+                # masking it.
+                try:
+                    self.wait_for_pivots()
+                except SnapshotNotPivoted as e:
+                    logger.error("%s: %s", self.dom.name(), e)
+            raise
+        else:
+            if concurrent:
+                self.wait_for_pivots()
         finally:
-            for snapshot in snapshot_paths:
-                self._callbacks_registrer.callbacks.pop(snapshot, None)
+            for disk, snapshot in snapshot_paths.items():
+                # A commit not pivoted can still be, if cleaned again.
+                if disk not in self._committing:
+                    self._callbacks_registrer.callbacks.pop(snapshot, None)
 
-    def clean_for_disk(self, disk):
+    def clean_for_disk(self, disk, wait=True):
+        """
+        Merge the snapshot of disk in its source and pivot it
+
+        :param wait: for a running domain, wait for the disk to be pivoted.
+            Otherwise, only start the blockcommit, then use wait_for_pivots().
+        """
         if not self.metadatas:
             raise SnapshotNotStarted()
         elif disk not in self.metadatas["disks"]:
             raise DiskNotSnapshot(disk)
+        elif disk in self._committing:
+            if wait:
+                self.wait_for_pivots((disk,))
+            return
 
         snapshot_path = os.path.abspath(self.metadatas["disks"][disk]["snapshot"])
         disk_path = os.path.abspath(self.metadatas["disks"][disk]["src"])
@@ -235,7 +288,7 @@ class DomExtSnapshot:
 
         # Do not commit and pivot if our snapshot is not the current top disk
         current_disk_path = (
-            get_xml_block_of_disk(self.dom.XMLDesc(), disk)
+            get_xml_block_of_disk(self.xml_cache.get_parsed(), disk)
             .xpath("source")[0]
             .get("file")
         )
@@ -253,11 +306,15 @@ class DomExtSnapshot:
             return
 
         if self.dom.isActive():
-            self.blockcommit_disk(disk)
-        else:
-            self._qemu_img_commit(disk_path, snapshot_path)
-            self._manually_pivot_disk(disk, disk_path, disk_type)
-            os.remove(snapshot_path)
+            # The disk is removed from the metadatas once pivoted.
+            self.start_blockcommit(disk)
+            if wait:
+                self.wait_for_pivots((disk,))
+            return
+
+        self._qemu_img_commit(disk_path, snapshot_path)
+        self._manually_pivot_disk(disk, disk_path, disk_type)
+        os.remove(snapshot_path)
 
         self.metadatas["disks"].pop(disk)
         self._callbacks_registrer.callbacks.pop(snapshot_path, None)
@@ -270,25 +327,71 @@ class DomExtSnapshot:
         disk main image
         Wait for the pivot to be triggered in case of active blockcommit.
 
+        :param disk: diskname to blockcommit
+        """
+        self.start_blockcommit(disk)
+        self.wait_for_pivots((disk,))
+
+    def start_blockcommit(self, disk):
+        """
+        Start an active block commit, without waiting for it to pivot
+
         :param disk: diskname to blockcommit
         """
         snapshot_path = os.path.abspath(self.metadatas["disks"][disk]["snapshot"])
+        # Created before the job starts, as set by the libvirt events thread.
+        self._wait_for_pivot[snapshot_path] = threading.Event()
         self._callbacks_registrer.callbacks[snapshot_path] = self._pivot_callback
 
-        logger.debug("%s: blockcommit %s to pivot snapshot", self.dom.name(), disk)
-        self.dom.blockCommit(
-            disk,
-            None,
-            None,
-            0,
-            (
-                libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
-                + libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
-            ),
+        flags = (
+            libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+            + libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
         )
+        bandwidth = 0
+        if self.commit_controller is not None:
+            bandwidth = self.commit_controller.initial_bandwidth
+        if bandwidth:
+            flags += libvirt.VIR_DOMAIN_BLOCK_COMMIT_BANDWIDTH_BYTES
+
+        logger.debug("%s: blockcommit %s to pivot snapshot", self.dom.name(), disk)
+        self._commits_start[snapshot_path] = (disk, time.monotonic())
+        self.dom.blockCommit(disk, None, None, bandwidth, flags)
+
+        self._committing.add(disk)
+        if self.commit_controller is not None:
+            self.commit_controller.add(disk)
+        # The domain now has a block job.
+        self.xml_cache.invalidate()
 
-        self._wait_for_pivot[snapshot_path].wait(timeout=self.timeout)
-        self._wait_for_pivot.pop(snapshot_path)
+    def wait_for_pivots(self, disks=None):
+        """
+        Wait for the block commits to pivot, all together within self.timeout
+
+        Each pivoted disk is removed from the metadatas. The others are kept, to
+        be cleaned again.
+
+        :param disks: disks to wait for. Default to all the disks being committed.
+        :raises SnapshotNotPivoted: if some disks were not pivoted in time
+        """
+        disks = tuple(self._committing if disks is None else disks)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        not_pivoted = []
+        for disk in sorted(disks):
+            snapshot_path = os.path.abspath(self.metadatas["disks"][disk]["snapshot"])
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not self._wait_for_pivot[snapshot_path].wait(timeout=timeout):
+                not_pivoted.append(disk)
+                continue
+
+            self._wait_for_pivot.pop(snapshot_path)
+            self._callbacks_registrer.callbacks.pop(snapshot_path, None)
+            self._committing.discard(disk)
+            self.metadatas["disks"].pop(disk)
+
+        if disks:
+            self.xml_cache.invalidate()
+        if not_pivoted:
+            raise SnapshotNotPivoted(not_pivoted)
 
     def _pivot_callback(self, conn, dom, snap, event_id, status, *args):
         """
@@ -299,7 +402,18 @@ class DomExtSnapshot:
         """
         domain_matches = dom.UUID() == self.dom.UUID()
         if status == libvirt.VIR_DOMAIN_BLOCK_JOB_READY and domain_matches:
+            disk, start = self._commits_start.pop(os.path.abspath(snap), (None, None))
+            if disk is not None:
+                logger.info(
+                    "%s: blockcommit of %s converged in %.1fs",
+                    self.dom.name(),
+                    disk,
+                    time.monotonic() - start,
+                )
+                if self.commit_controller is not None:
+                    self.commit_controller.remove(disk)
             dom.blockJobAbort(snap, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+            self.xml_cache.invalidate()
             os.remove(snap)
             self._wait_for_pivot[os.path.abspath(snap)].set()
 
@@ -321,19 +435,20 @@ class DomExtSnapshot:
         :param disk: disk name
         :param src: new disk path
         """
-        dom_xml = lxml.etree.fromstring(
-            self.dom.XMLDesc(), lxml.etree.XMLParser(resolve_entities=False)
-        )
+        dom_xml = copy.deepcopy(self.xml_cache.get_parsed())
 
         disk_xml = get_xml_block_of_disk(dom_xml, disk)
         disk_xml.xpath("source")[0].set("file", src)
         disk_xml.xpath("driver")[0].set("type", disk_type)
 
-        if self.conn.getLibVersion() >= 3000000:
-            # update a disk is broken in libvirt < 3.0
-            return self.dom.updateDeviceFlags(
-                lxml.etree.tostring(disk_xml).decode(),
-                libvirt.VIR_DOMAIN_AFFECT_CONFIG,
-            )
-        else:
-            return self.conn.defineXML(lxml.etree.tostring(dom_xml).decode())
+        try:
+            if self.conn.getLibVersion() >= 3000000:
+                # update a disk is broken in libvirt < 3.0
+                return self.dom.updateDeviceFlags(
+                    lxml.etree.tostring(disk_xml).decode(),
+                    libvirt.VIR_DOMAIN_AFFECT_CONFIG,
+                )
+            else:
+                return self.conn.defineXML(lxml.etree.tostring(dom_xml).decode())
+        finally:
+            self.xml_cache.invalidate()
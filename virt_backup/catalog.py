@@ -0,0 +1,489 @@
+import collections
+import contextlib
+import copy
+import logging
+import os
+import sqlite3
+import threading
+
+from virt_backup.compat_layers.definition import (
+    convert as compat_convert_definition,
+    is_convert_needed as compat_is_convert_needed,
+)
+from virt_backup.scanner import (
+    DEFINITION_SUFFIX,
+    PENDING_INFO_SUFFIX,
+    iter_json_files,
+    iter_subdirs,
+    dumps,
+    load_json_files,
+    loads,
+)
+
+logger = logging.getLogger("virt_backup")
+
+#: name of the catalog database, stored in the backup directory of a group
+CATALOG_FILENAME = ".virt-backup-catalog.sqlite"
+
+#: how long to wait for another process to release the catalog, in seconds
+CATALOG_TIMEOUT = 60
+
+#: version of the catalog schema. A catalog with another version is rebuilt.
+CATALOG_VERSION = 5
+
+#: fields of the definitions stored in their own columns, to list the backups
+#: without decoding their whole definition
+SUMMARY_FIELDS = ("name", "date", "backup_mode", "parent", "duration", "disks_size")
+
+_SCHEMA = (
+    "CREATE TABLE domain_dirs (" "  name TEXT PRIMARY KEY," "  mtime_ns INTEGER" ")",
+    "CREATE TABLE definitions ("
+    "  domain_dir TEXT NOT NULL,"
+    "  filename TEXT NOT NULL,"
+    "  domain_name TEXT NOT NULL,"
+    "  pending INTEGER NOT NULL,"
+    "  mtime_ns INTEGER,"
+    "  size INTEGER,"
+    "  name TEXT,"
+    "  date INTEGER,"
+    "  backup_mode TEXT,"
+    "  parent TEXT,"
+    "  duration REAL,"
+    "  disks_size INTEGER,"
+    "  content TEXT NOT NULL,"
+    "  PRIMARY KEY (domain_dir, filename)"
+    ")",
+)
+
+
+#: number of contexts updating each domain directory, by path
+_writers = collections.Counter()
+_writers_lock = threading.Lock()
+
+
+def get_catalog_of_domain_dir(domain_dir):
+    """
+    Get the catalog of the backup directory containing a domain directory
+
+    Backups have to respect the structure: backup_dir/domain_name/*backups*
+    """
+    return BackupCatalog(os.path.dirname(os.path.normpath(domain_dir)))
+
+
+def summarize_definition(definition):
+    """
+    Get the fields needed to list and select the backups from a definition,
+    converted to the last definition version if needed
+
+    :returns: {"domain_name": str, "name": str, "date": int, "backup_mode": str,
+        "parent": str or None, "duration": float or None, "disks_size": int or None}
+    """
+    if compat_is_convert_needed(definition):
+        definition = copy.deepcopy(definition)
+        compat_convert_definition(definition)
+
+    return {
+        "domain_name": definition["domain_name"],
+        "name": definition["name"],
+        "date": int(definition["date"]),
+        "backup_mode": definition.get("backup_mode", "full"),
+        "parent": definition.get("parent", None),
+        "duration": definition.get("duration", None),
+        "disks_size": definition.get("disks_size", None),
+    }
+
+
+def _get_mtime_ns(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class BackupCatalog:
+    """
+    Catalog of the backup definitions and pending infos of a backup directory
+
+    It mirrors the json files of each domain directory (backup_dir/domain_name/)
+    in a SQLite database, stored in backup_dir. The modification time of each
+    domain directory is recorded when indexed: a directory changed without
+    updating the catalog, or which update failed, is indexed again when listing
+    the definitions. Only the files which modification time or size changed are
+    then loaded again.
+
+    The catalog is created by the first listing, or by :meth:`reindex`. Until
+    then, updates are ignored.
+    """
+
+    def __init__(self, backup_dir, threads=None):
+        """
+        :param threads: number of json files loaded at the same time when indexing
+        """
+        self.backup_dir = backup_dir
+        self.path = os.path.join(backup_dir, CATALOG_FILENAME)
+        self.threads = threads
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    @contextlib.contextmanager
+    def _transaction(self, refresh=False):
+        """
+        :param refresh: index the domain directories changed since their last
+            indexation. The database is only locked for writing if some changed,
+            to not block the other processes to only read it.
+        """
+        conn = sqlite3.connect(self.path, timeout=CATALOG_TIMEOUT, isolation_level=None)
+        try:
+            up_to_date = False
+            if refresh:
+                conn.execute("BEGIN")
+                up_to_date = self._is_up_to_date(conn)
+                if not up_to_date:
+                    conn.execute("ROLLBACK")
+            if not up_to_date:
+                # Lock the database for writing now, to not fail on a lock upgrade
+                # if another process writes in the meantime.
+                conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._migrate(conn)
+                if refresh and not up_to_date:
+                    self._refresh(conn)
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def _migrate(self, conn):
+        """
+        Create the tables, or recreate them if the schema changed. The catalog is
+        then filled from the json files.
+        """
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version == CATALOG_VERSION:
+            return
+
+        if version:
+            logger.info("Catalog %s outdated, rebuild it", self.path)
+        conn.execute("DROP TABLE IF EXISTS domain_dirs")
+        conn.execute("DROP TABLE IF EXISTS definitions")
+        for statement in _SCHEMA:
+            conn.execute(statement)
+        conn.execute("PRAGMA user_version = {:d}".format(CATALOG_VERSION))
+
+    def _is_up_to_date(self, conn):
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if version != CATALOG_VERSION:
+            return False
+
+        removed_dirs, changed_dirs = self._diff_domain_dirs(conn)
+        return not (removed_dirs or changed_dirs)
+
+    def list_definitions(self, pending=False):
+        """
+        List the definitions, or the pending infos, grouped by domain
+
+        Domain directories changed since their last indexation are indexed again.
+
+        :param pending: list the pending infos instead of the definitions
+        :returns: {domain_name: [(definition_path, definition_dict), …], …}
+        :rtype: dict
+        """
+        if not os.path.isdir(self.backup_dir):
+            return {}
+
+        backups = {}
+        with self._transaction(refresh=True) as conn:
+            rows = conn.execute(
+                "SELECT domain_dir, filename, domain_name, content FROM definitions "
+                "WHERE pending = ?",
+                (int(pending),),
+            )
+            for domain_dir, filename, domain_name, content in rows:
+                path = os.path.join(self.backup_dir, domain_dir, filename)
+                backups.setdefault(domain_name, []).append((path, loads(content)))
+
+        return backups
+
+    def list_summaries(self):
+        """
+        List the summary of the definitions, grouped by domain
+
+        Nothing else than the summary columns is read, so it does not decode the
+        definitions.
+
+        :returns: {domain_name: [(definition_path, summary), …], …}, with summary
+            as returned by :func:`summarize_definition`
+        :rtype: dict
+        """
+        if not os.path.isdir(self.backup_dir):
+            return {}
+
+        backups = {}
+        with self._transaction(refresh=True) as conn:
+            rows = conn.execute(
+                "SELECT domain_dir, filename, domain_name, {} FROM definitions "
+                "WHERE pending = 0 AND name IS NOT NULL".format(
+                    ", ".join(SUMMARY_FIELDS)
+                )
+            )
+            for domain_dir, filename, domain_name, *fields in rows:
+                path = os.path.join(self.backup_dir, domain_dir, filename)
+                summary = dict(zip(SUMMARY_FIELDS, fields), domain_name=domain_name)
+                backups.setdefault(domain_name, []).append((path, summary))
+
+        return backups
+
+    def reindex(self):
+        """
+        Rebuild the catalog from the json files
+
+        :returns: number of definitions and pending infos indexed
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM definitions")
+            conn.execute("DELETE FROM domain_dirs")
+            self._refresh(conn)
+            (count,) = conn.execute("SELECT COUNT(*) FROM definitions").fetchone()
+
+        logger.info("%s: %d entries indexed", self.path, count)
+        return count
+
+    def _refresh(self, conn):
+        removed_dirs, changed_dirs = self._diff_domain_dirs(conn)
+        for name in removed_dirs:
+            conn.execute("DELETE FROM definitions WHERE domain_dir = ?", (name,))
+            conn.execute("DELETE FROM domain_dirs WHERE name = ?", (name,))
+
+        if changed_dirs:
+            self._index_domain_dirs(conn, changed_dirs)
+
+    def _diff_domain_dirs(self, conn):
+        """
+        :returns: (names of the removed domain directories,
+            {name: modification time} of the changed ones)
+        """
+        indexed_dirs = dict(conn.execute("SELECT name, mtime_ns FROM domain_dirs"))
+        current_dirs = {
+            entry.name: entry.stat().st_mtime_ns
+            for entry in iter_subdirs(self.backup_dir)
+        }
+
+        removed_dirs = indexed_dirs.keys() - current_dirs.keys()
+        changed_dirs = {
+            name: mtime_ns
+            for name, mtime_ns in current_dirs.items()
+            if indexed_dirs.get(name) != mtime_ns
+        }
+        return removed_dirs, changed_dirs
+
+    def _index_domain_dirs(self, conn, domain_dirs):
+        """
+        Index the json files changed in domain directories, loaded all at once
+
+        :param domain_dirs: {name: modification time}, read before listing them
+        """
+        to_load = {}
+        for name in domain_dirs:
+            domain_dir = os.path.join(self.backup_dir, name)
+            logger.debug("Index the backups of %s", domain_dir)
+            indexed = {
+                filename: (mtime_ns, size)
+                for filename, mtime_ns, size in conn.execute(
+                    "SELECT filename, mtime_ns, size FROM definitions "
+                    "WHERE domain_dir = ?",
+                    (name,),
+                )
+            }
+
+            current = set()
+            for suffix in (DEFINITION_SUFFIX, PENDING_INFO_SUFFIX):
+                for path, mtime_ns, size in iter_json_files(domain_dir, suffix):
+                    filename = os.path.basename(path)
+                    current.add(filename)
+                    if indexed.get(filename) != (mtime_ns, size):
+                        to_load[path] = (name, filename, mtime_ns, size)
+
+            for filename in indexed.keys() - current:
+                self._delete(conn, name, filename)
+
+        loaded = load_json_files(to_load, self.threads)
+        for path, (name, filename, mtime_ns, size) in to_load.items():
+            if path in loaded:
+                self._put(conn, name, filename, loaded[path], mtime_ns, size)
+            else:
+                self._delete(conn, name, filename)
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO domain_dirs (name, mtime_ns) VALUES (?, ?)",
+            domain_dirs.items(),
+        )
+
+    def _delete(self, conn, domain_dir, filename):
+        conn.execute(
+            "DELETE FROM definitions WHERE domain_dir = ? AND filename = ?",
+            (domain_dir, filename),
+        )
+
+    def _put(self, conn, domain_dir, filename, definition, mtime_ns=None, size=None):
+        """
+        :param mtime_ns: modification time of the file. If unknown, the file will be
+            loaded again the next time its domain directory is indexed.
+        """
+        try:
+            domain_name = definition["domain_name"]
+        except (KeyError, TypeError):
+            logger.debug("No domain name in file {}, ignored".format(filename))
+            return
+
+        pending = filename.endswith(PENDING_INFO_SUFFIX)
+        summary = {}
+        if not pending:
+            try:
+                summary = summarize_definition(definition)
+            except Exception as e:
+                logger.debug("Invalid definition {}: {}".format(filename, e))
+
+        conn.execute(
+            "INSERT OR REPLACE INTO definitions "
+            "(domain_dir, filename, domain_name, pending, mtime_ns, size, {}, content) "
+            "VALUES (?, ?, ?, ?, ?, ?, {}, ?)".format(
+                ", ".join(SUMMARY_FIELDS), ", ".join("?" for _ in SUMMARY_FIELDS)
+            ),
+            (
+                domain_dir,
+                filename,
+                domain_name,
+                int(pending),
+                mtime_ns,
+                size,
+                *(summary.get(f) for f in SUMMARY_FIELDS),
+                dumps(definition),
+            ),
+        )
+
+    @contextlib.contextmanager
+    def updating(self, domain_dir):
+        """
+        Record the json files written or removed in a domain directory
+
+        The changes are applied in one transaction, once the context exits without
+        error. If the catalog was in sync with the directory when entering the
+        context, and no other context changed it in the meantime, it stays in sync.
+        Otherwise, or if the context exits with an error, the directory will be
+        indexed on the next listing. Contexts can be nested, to keep the catalog in
+        sync with the files written by a whole backup.
+
+        Catalog errors are logged but not raised, as the catalog can always be
+        rebuilt from the json files.
+
+        :returns: a context manager yielding a :class:`CatalogChanges`
+        """
+        domain_dir = os.path.normpath(domain_dir)
+        name = os.path.basename(domain_dir)
+        writer_key = os.path.abspath(domain_dir)
+        with _writers_lock:
+            _writers[writer_key] += 1
+        try:
+            indexed_mtime_ns = self._get_indexed_mtime_ns(name, domain_dir)
+            changes = CatalogChanges()
+            try:
+                yield changes
+            except BaseException:
+                # The files changed before the error were maybe not recorded.
+                self._mark_dirty(name)
+                raise
+        finally:
+            with _writers_lock:
+                # The files of the other contexts are maybe not recorded yet.
+                alone = _writers[writer_key] == 1
+                _writers[writer_key] -= 1
+                if not _writers[writer_key]:
+                    del _writers[writer_key]
+        if not alone:
+            indexed_mtime_ns = None
+
+        if not self.exists() or (
+            not changes and indexed_mtime_ns in (None, _get_mtime_ns(domain_dir))
+        ):
+            return
+
+        try:
+            with self._transaction() as conn:
+                for filename, definition in changes.items():
+                    if definition is None:
+                        self._delete(conn, name, filename)
+                        continue
+
+                    try:
+                        stat = os.stat(os.path.join(domain_dir, filename))
+                        mtime_ns, size = stat.st_mtime_ns, stat.st_size
+                    except FileNotFoundError:
+                        mtime_ns = size = None
+                    self._put(conn, name, filename, definition, mtime_ns, size)
+
+                if indexed_mtime_ns is not None:
+                    # Only stays in sync if no other process changed the
+                    # directory in the meantime, or marked it as dirty.
+                    conn.execute(
+                        "UPDATE domain_dirs SET mtime_ns = ? "
+                        "WHERE name = ? AND mtime_ns = ?",
+                        (_get_mtime_ns(domain_dir), name, indexed_mtime_ns),
+                    )
+        except sqlite3.Error as e:
+            logger.warning("Cannot update the catalog %s: %s", self.path, e)
+
+    def _get_indexed_mtime_ns(self, name, domain_dir):
+        """
+        :returns: modification time of the domain directory when indexed, if the
+            catalog is in sync with it, None otherwise
+        """
+        if not self.exists():
+            return None
+
+        try:
+            conn = sqlite3.connect(self.path, timeout=CATALOG_TIMEOUT)
+            try:
+                indexed = conn.execute(
+                    "SELECT mtime_ns FROM domain_dirs WHERE name = ?", (name,)
+                ).fetchone()
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return None
+
+        if indexed is None or indexed[0] != _get_mtime_ns(domain_dir):
+            return None
+        return indexed[0]
+
+    def _mark_dirty(self, name):
+        """
+        Index the domain directory again on the next listing
+        """
+        if not self.exists():
+            return
+
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    "UPDATE domain_dirs SET mtime_ns = NULL WHERE name = ?", (name,)
+                )
+        except sqlite3.Error as e:
+            logger.warning("Cannot update the catalog %s: %s", self.path, e)
+
+
+class CatalogChanges(dict):
+    """
+    Json files written or removed in a domain directory
+
+    {filename: definition_dict, or None if removed}
+    """
+
+    def put(self, path, definition):
+        self[os.path.basename(path)] = definition
+
+    def remove(self, path):
+        self[os.path.basename(path)] = None
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import functools
 import logging
 import re
 
@@ -10,9 +11,8 @@ logger = logging.getLogger("virt_backup")
 
 
 def convert(definition):
-    converters = (ToV0_4(),)
-    for c in converters:
-        def_version = version_parser(definition["version"])
+    for c in _get_converters():
+        def_version = _parse_version(definition["version"])
         if c.is_needed(def_version):
             logger.debug(
                 "definition %s needs convertion update to v%s",
@@ -22,6 +22,21 @@ def convert(definition):
             c.convert(definition)
 
 
+def is_convert_needed(definition):
+    def_version = _parse_version(definition["version"])
+    return any(c.is_needed(def_version) for c in _get_converters())
+
+
+def _get_converters():
+    return (ToV0_4(),)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_version(version):
+    # Definitions share a few versions, but parsing one is costly.
+    return version_parser(version)
+
+
 class DefConverter(ABC):
     from_version_to = ()
     _parsed_versions = ()
@@ -1,5 +1,6 @@
 import logging
 import re
+import threading
 import lxml.etree
 
 from virt_backup.exceptions import DiskNotFoundError
@@ -7,6 +8,67 @@ from virt_backup.exceptions import DiskNotFoundError
 logger = logging.getLogger("virt_backup")
 
 
+class DomainXMLCache:
+    """
+    Definition of a domain, fetched and parsed once then shared, until
+    invalidated
+
+    Each XMLDesc() is a libvirt call (a remote one through qemu+ssh), followed by
+    a full parse of the definition. The cache has to be invalidated after each
+    change of the domain definition: snapshot, pivot, device update...
+
+    The parsed definition is shared: copy it before modifying it.
+    """
+
+    def __init__(self, dom):
+        #: domain to describe. Has to be a libvirt.virDomain object
+        self.dom = dom
+
+        #: number of definitions served from the cache
+        self.hits = 0
+
+        #: number of definitions fetched from libvirt
+        self.misses = 0
+
+        self._xml = None
+        self._parsed = None
+        self._lock = threading.Lock()
+
+    def get_xml(self):
+        """
+        :returns: domain definition, as a string
+        """
+        with self._lock:
+            return self._fetch()
+
+    def get_parsed(self):
+        """
+        :returns: domain definition, parsed by lxml
+        """
+        with self._lock:
+            xml = self._fetch()
+            if self._parsed is None:
+                self._parsed = lxml.etree.fromstring(
+                    xml, lxml.etree.XMLParser(resolve_entities=False)
+                )
+            return self._parsed
+
+    def invalidate(self):
+        """
+        Drop the cached definition, to fetch it again on next access
+        """
+        with self._lock:
+            self._xml = self._parsed = None
+
+    def _fetch(self):
+        if self._xml is None:
+            self.misses += 1
+            self._xml = self.dom.XMLDesc()
+        else:
+            self.hits += 1
+        return self._xml
+
+
 def get_domain_disks_of(dom_xml, *filter_dev):
     """
     Get disks from the domain xml
@@ -8,6 +8,25 @@ class BackupNotFoundError(Exception):
         super().__init__("backup not found")
 
 
+class ParentBackupNotFoundError(Exception):
+    def __init__(self, backup, parent):
+        super().__init__("parent backup {} of {} not found".format(parent, backup))
+
+
+class BackupJobFailedError(Exception):
+    def __init__(self, domain, reason=None):
+        msg = "backup job failed for domain {}".format(domain)
+        if reason:
+            msg = "{}: {}".format(msg, reason)
+
+        super().__init__(msg)
+
+
+class NBDError(Exception):
+    def __init__(self, export, reason):
+        super().__init__("NBD export {}: {}".format(export, reason))
+
+
 class BackupsFailureInGroupError(Exception):
     def __init__(self, completed_backups, exceptions):
         """
@@ -24,6 +43,17 @@ class BackupsFailureInGroupError(Exception):
         self.exceptions = exceptions
 
 
+class CleanFailureInGroupError(Exception):
+    def __init__(self, removed_backups, exceptions):
+        """
+        :param removed_backups: set of removed backups.
+        :param exceptions: dictionary of exceptions. {backup: exception}
+        """
+        super().__init__("{} backup(s) could not be removed".format(len(exceptions)))
+        self.removed_backups = removed_backups
+        self.exceptions = exceptions
+
+
 class DiskNotFoundError(Exception):
     """
     Disk not found in a domain
@@ -70,6 +100,15 @@ class DiskNotSnapshot(Exception):
         super().__init__("disk {} not snapshot".format(disk))
 
 
+class SnapshotNotPivoted(Exception):
+    def __init__(self, disks):
+        super().__init__(
+            "snapshot of disks {} not pivoted before the timeout".format(
+                ", ".join(disks)
+            )
+        )
+
+
 class BackupPackagerNotOpenedError(Exception):
     def __init__(self, packager):
         super().__init__("Backup packager {} not opened".format(packager.name))
@@ -82,6 +121,16 @@ class BackupPackagerOpenedError(Exception):
         )
 
 
+class ChunkCorruptedError(Exception):
+    def __init__(self, chunk, target):
+        super().__init__("Chunk {} corrupted in {}".format(chunk, target))
+
+
+class DeltaCorruptedError(Exception):
+    def __init__(self, delta):
+        super().__init__("Delta {} corrupted".format(delta))
+
+
 class UnsupportedPackagerError(Exception):
     def __init__(self, packager_name, reason=None):
         msg = "Packager {} unsupported".format(packager_name)
@@ -1,15 +1,23 @@
-from collections import defaultdict
-import glob
-import json
+import concurrent.futures
+import contextlib
 import logging
 import os
+import sqlite3
 
 from virt_backup.backups import (
-    build_dom_complete_backup_from_def,
+    build_dom_complete_backup_record,
     build_dom_backup_from_pending_info,
 )
-from virt_backup.exceptions import BackupNotFoundError, DomainNotFoundError
+from virt_backup.catalog import BackupCatalog, summarize_definition
+from virt_backup.exceptions import (
+    BackupNotFoundError,
+    CleanFailureInGroupError,
+    DomainNotFoundError,
+)
+from virt_backup.scanner import DEFINITION_SUFFIX, PENDING_INFO_SUFFIX, scan_definitions
+from .deletion import DeletionPool
 from .pattern import domains_matching_with_patterns
+from .retention import plan_retention
 
 logger = logging.getLogger("virt_backup")
 
@@ -23,7 +31,33 @@ def list_backups_by_domain(backup_dir):
     :returns: {domain_name: [(definition_path, definition_dict), …], …}
     :rtype: dict
     """
-    return _list_json_following_pattern_by_domain(backup_dir, "*/*.json")
+    return _list_from_catalog(backup_dir, DEFINITION_SUFFIX, pending=False)
+
+
+def list_backup_summaries_by_domain(backup_dir):
+    """
+    Group the summary of all available backups by domain, in a dict
+
+    Backups have to respect the structure: backup_dir/domain_name/*backups*
+
+    :returns: {domain_name: [(definition_path, summary_dict), …], …}, with
+        summary_dict as returned by :func:`virt_backup.catalog.summarize_definition`
+    :rtype: dict
+    """
+    try:
+        return BackupCatalog(backup_dir).list_summaries()
+    except sqlite3.Error as e:
+        logger.warning("Catalog of %s unusable, scan the backups: %s", backup_dir, e)
+
+    summaries = {}
+    for json_file, definition in scan_definitions(backup_dir).items():
+        try:
+            summary = summarize_definition(definition)
+        except Exception as e:
+            logger.debug("Error for file {}: {}".format(json_file, e))
+            continue
+        summaries.setdefault(summary["domain_name"], []).append((json_file, summary))
+    return summaries
 
 
 def list_broken_backups_by_domain(backup_dir):
@@ -35,23 +69,25 @@ def list_broken_backups_by_domain(backup_dir):
     :returns: {domain_name: [(backup_dir, pending_info_dict), …], …}
     :rtype: dict
     """
-    return _list_json_following_pattern_by_domain(backup_dir, "*/*.json.pending")
+    return _list_from_catalog(backup_dir, PENDING_INFO_SUFFIX, pending=True)
+
+
+def _list_from_catalog(backup_dir, suffix, pending):
+    """
+    List the definitions from the catalog of backup_dir. If the catalog cannot be
+    used, scan the json files ending with suffix instead.
+    """
+    try:
+        return BackupCatalog(backup_dir).list_definitions(pending=pending)
+    except sqlite3.Error as e:
+        logger.warning("Catalog of %s unusable, scan the backups: %s", backup_dir, e)
+        return _scan_json_by_domain(backup_dir, suffix)
 
 
-def _list_json_following_pattern_by_domain(directory, glob_pattern):
+def _scan_json_by_domain(directory, suffix):
     backups = {}
-    for json_file in glob.glob(os.path.join(directory, glob_pattern)):
+    for json_file, metadata in scan_definitions(directory, suffix).items():
         logger.debug("{} detected".format(json_file))
-        try:
-            with open(json_file, "r") as definition_file:
-                try:
-                    metadata = json.load(definition_file)
-                except Exception as e:
-                    logger.debug("Error for file {}: {}".format(json_file, e))
-                    continue
-        except FileNotFoundError as e:
-            logger.warning(f"File not found or already removed: {e}")
-            continue
         domain_name = metadata["domain_name"]
         if domain_name not in backups:
             backups[domain_name] = []
@@ -98,6 +134,16 @@ def complete_groups_from_dict(groups_dict, conn=None, callbacks_registrer=None):
         yield build(group_name, group_properties)
 
 
+@contextlib.contextmanager
+def _deletion_pool_or_default(deletion_pool=None):
+    if deletion_pool is not None:
+        yield deletion_pool
+        return
+
+    with DeletionPool() as deletion_pool:
+        yield deletion_pool
+
+
 class CompleteBackupGroup:
     """
     Group of complete libvirt domain backups
@@ -151,22 +197,26 @@ class CompleteBackupGroup:
             )
 
     def _build_backups(self):
+        """
+        Backups are listed as lightweight records, the full backups are loaded
+        when needed.
+        """
         backups = {}
-        backups_by_domain = list_backups_by_domain(self.backup_dir)
+        backups_by_domain = list_backup_summaries_by_domain(self.backup_dir)
         domains_to_include = domains_matching_with_patterns(
             backups_by_domain.keys(), self.hosts
         )
         for dom_name in domains_to_include:
             backups[dom_name] = sorted(
                 (
-                    build_dom_complete_backup_from_def(
-                        definition,
+                    build_dom_complete_backup_record(
+                        summary,
                         backup_dir=os.path.dirname(definition_filename),
                         definition_filename=definition_filename,
                     )
-                    for definition_filename, definition in backups_by_domain[dom_name]
+                    for definition_filename, summary in backups_by_domain[dom_name]
                 ),
-                key=lambda b: b.date,
+                key=lambda b: b.timestamp,
             )
 
         self.backups = backups
@@ -217,59 +267,124 @@ class CompleteBackupGroup:
 
         return diff_list[:n] if diff_list else None
 
-    def clean(self, hourly=5, daily=5, weekly=5, monthly=5, yearly=5):
+    def plan_clean(self, hourly=5, daily=5, weekly=5, monthly=5, yearly=5):
+        """
+        :returns: RetentionPlan of the backups to keep and to delete
+        """
+        return plan_retention(
+            self.backups,
+            hourly=hourly,
+            daily=daily,
+            weekly=weekly,
+            monthly=monthly,
+            yearly=yearly,
+        )
+
+    def clean(
+        self,
+        hourly=5,
+        daily=5,
+        weekly=5,
+        monthly=5,
+        yearly=5,
+        plan=None,
+        deletion_pool=None,
+    ):
+        """
+        :param plan: RetentionPlan to execute, planned from the periods if not
+            given
+        :param deletion_pool: DeletionPool removing the backups. A pool with the
+            default options is used if not given.
+        :returns: set of the removed backups
+        :raises CleanFailureInGroupError: once all the removals are done, if
+            some backups could not be removed
+        """
+        if plan is None:
+            plan = self.plan_clean(hourly, daily, weekly, monthly, yearly)
+
         backups_removed = set()
-        for domain, domain_backups in self.backups.items():
-            domain_backups = sorted(domain_backups, key=lambda b: b.date)
-            keep_backups = set()
-
-            keep_backups.update(
-                self._keep_n_periodic_backups(domain_backups, "hour", hourly),
-                self._keep_n_periodic_backups(domain_backups, "day", daily),
-                self._keep_n_periodic_backups(domain_backups, "week", weekly),
-                self._keep_n_periodic_backups(domain_backups, "month", monthly),
-                self._keep_n_periodic_backups(domain_backups, "year", yearly),
+        errors = {}
+        with _deletion_pool_or_default(deletion_pool) as pool:
+            futures = {
+                pool.submit(b.backup_dir, self._delete_backup, domain, b): (domain, b)
+                for domain, b in plan.iter_deletions()
+            }
+            for f in concurrent.futures.as_completed(futures):
+                domain, b = futures[f]
+                try:
+                    f.result()
+                except Exception as e:
+                    logger.error(
+                        "Error when cleaning backup %s for domain %s: %s",
+                        b.date,
+                        domain,
+                        e,
+                    )
+                    errors[b] = e
+                else:
+                    backups_removed.add(b)
+
+        for domain, kept_backups in plan.keep.items():
+            self.backups[domain] = sorted(
+                kept_backups + [b for b in plan.delete[domain] if b in errors],
+                key=lambda b: b.timestamp,
             )
 
-            backups_to_remove = set(domain_backups).difference(keep_backups)
-            for b in backups_to_remove:
-                logger.info("Cleaning backup {} for domain {}".format(b.date, domain))
-                b.delete()
-                self.backups[domain].remove(b)
-                backups_removed.add(b)
-
+        if errors:
+            raise CleanFailureInGroupError(backups_removed, errors)
         return backups_removed
 
-    def clean_broken_backups(self):
+    def _delete_backup(self, domain, backup):
+        logger.info("Cleaning backup {} for domain {}".format(backup.date, domain))
+        backup.delete()
+
+    def clean_broken_backups(self, deletion_pool=None):
+        """
+        Broken backups of different domains are cleaned at the same time, the
+        ones of a same domain one after another.
+
+        :param deletion_pool: DeletionPool cleaning the backups. A pool with the
+            default options is used if not given.
+        :returns: set of the cleaned backups
+        :raises CleanFailureInGroupError: once all the cleanings are done, if
+            some backups could not be cleaned
+        """
         backups_removed = set()
-        for domain, backups in self.broken_backups.items():
-            for backup in backups:
-                backup.clean_aborted()
-                self.broken_backups[domain].remove(backup)
-                backups_removed.add(backup)
-
+        errors = {}
+        with _deletion_pool_or_default(deletion_pool) as pool:
+            futures = [
+                pool.submit(
+                    backups[0].backup_dir, self._clean_broken_backups_of, domain
+                )
+                for domain, backups in self.broken_backups.items()
+                if backups
+            ]
+            for f in concurrent.futures.as_completed(futures):
+                domain_backups_removed, domain_errors = f.result()
+                backups_removed.update(domain_backups_removed)
+                errors.update(domain_errors)
+
+        if errors:
+            raise CleanFailureInGroupError(backups_removed, errors)
         return backups_removed
 
-    def _keep_n_periodic_backups(self, sorted_backups, period, n):
-        if not n:
-            return []
-
-        grouped_backups = self._group_backup_by_period(sorted_backups, period)
-
-        # will keep all yearly backups
-        if n == "*":
-            n = 0
-        return set(
-            backups[0] for group, backups in sorted(grouped_backups.items())[-n:]
-        )
-
-    def _group_backup_by_period(self, sorted_backups, period):
-        grouped_backups = defaultdict(list)
-        periods = ("hour", "day", "week", "month", "year")
-        for backup in sorted_backups:
-            key = tuple(
-                getattr(backup.date, p)
-                for p in reversed(periods[periods.index(period) :])
-            )
-            grouped_backups[key].append(backup)
-        return grouped_backups
+    def _clean_broken_backups_of(self, domain):
+        backups_removed = set()
+        errors = {}
+        for backup in tuple(self.broken_backups[domain]):
+            try:
+                backup.clean_aborted()
+            except Exception as e:
+                logger.error(
+                    "Error when cleaning broken backup %s for domain %s: %s",
+                    backup.pending_info.get("name"),
+                    domain,
+                    e,
+                )
+                errors[backup] = e
+                continue
+
+            self.broken_backups[domain].remove(backup)
+            backups_removed.add(backup)
+
+        return backups_removed, errors
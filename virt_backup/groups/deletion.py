@@ -0,0 +1,77 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+logger = logging.getLogger("virt_backup")
+
+
+class DeletionPool:
+    """
+    Pool of threads removing backups
+
+    Removing large archives is mostly waiting on the filesystem, so several
+    removals are run at the same time. To not saturate a storage, the number of
+    removals running on the same device is limited.
+
+    The pool can be shared between groups, for the limit to apply on all of
+    them.
+    """
+
+    def __init__(self, threads=4, threads_per_device=2):
+        #: maximum number of removals running at the same time
+        self.threads = max(threads or 1, 1)
+
+        #: maximum number of removals running at the same time on one device.
+        #  None or 0 to not limit them.
+        self.threads_per_device = threads_per_device
+
+        self._executor = None
+        self._device_semaphores = {}
+        self._device_semaphores_lock = threading.Lock()
+
+    def submit(self, path, func, *args, **kwargs):
+        """
+        Run func in the pool, once a removal slot is available on the device
+        containing path
+
+        :returns: concurrent.futures.Future
+        """
+        if self._executor is None:
+            raise RuntimeError("deletion pool not started")
+
+        return self._executor.submit(self._run, path, func, *args, **kwargs)
+
+    def _run(self, path, func, *args, **kwargs):
+        semaphore = self._get_device_semaphore(path)
+        if semaphore is None:
+            return func(*args, **kwargs)
+
+        with semaphore:
+            return func(*args, **kwargs)
+
+    def _get_device_semaphore(self, path):
+        if not self.threads_per_device:
+            return None
+
+        try:
+            device = os.stat(path).st_dev
+        except FileNotFoundError:
+            device = None
+
+        with self._device_semaphores_lock:
+            if device not in self._device_semaphores:
+                self._device_semaphores[device] = threading.BoundedSemaphore(
+                    self.threads_per_device
+                )
+            return self._device_semaphores[device]
+
+    def __enter__(self):
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self._executor.shutdown(wait=True, cancel_futures=exc[0] is not None)
+        finally:
+            self._executor = None
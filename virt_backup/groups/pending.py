@@ -7,12 +7,14 @@ import os
 from virt_backup.backups import DomBackup, build_dom_complete_backup_from_def
 from virt_backup.domains import search_domains_regex
 from virt_backup.exceptions import BackupsFailureInGroupError, CancelledError
+from virt_backup.throttle import build_throttle
 from .pattern import matching_libvirt_domains_from_config
+from .scheduling import plan_backups
 
 logger = logging.getLogger("virt_backup")
 
 
-def groups_from_dict(groups_dict, conn, callbacks_registrer):
+def groups_from_dict(groups_dict, conn, callbacks_registrer, throttle=None):
     """
     Construct and yield BackupGroups from a dict (typically as stored in
     config)
@@ -20,6 +22,7 @@ def groups_from_dict(groups_dict, conn, callbacks_registrer):
     :param groups_dict: dict of groups properties (take a look at the
                         config syntax for more info)
     :param conn: connection with libvirt
+    :param throttle: Throttle shared by all the groups, parent of their own
     """
 
     def build(name, properties):
@@ -44,7 +47,11 @@ def groups_from_dict(groups_dict, conn, callbacks_registrer):
         sanitize_properties(properties)
 
         backup_group = BackupGroup(
-            name=name, conn=conn, callbacks_registrer=callbacks_registrer, **properties
+            name=name,
+            conn=conn,
+            callbacks_registrer=callbacks_registrer,
+            throttle=throttle,
+            **properties,
         )
         for i in include:
             for domain_name in i["domains"]:
@@ -55,6 +62,9 @@ def groups_from_dict(groups_dict, conn, callbacks_registrer):
                         domain,
                         i["properties"].get("disks", ()),
                         quiesce=i["properties"].get("quiesce"),
+                        disk_threads=i["properties"].get("disk_threads"),
+                        bandwidth_limit=i["properties"].get("bandwidth_limit"),
+                        priority=i["properties"].get("priority"),
                     )
 
         return backup_group
@@ -91,23 +101,41 @@ class BackupGroup:
     """
 
     def __init__(
-        self, name="unnamed", domlst=None, autostart=True, **default_bak_param
+        self,
+        name="unnamed",
+        domlst=None,
+        autostart=True,
+        bandwidth_limit=None,
+        throttle=None,
+        **default_bak_param,
     ):
         """
         :param domlst: domain and disks to backup. If specified, has to be a
                        dict, where key would be the domain to backup, and value
                        an iterable containing the disks name to backup. Value
                        could be None
+        :param bandwidth_limit: maximum bandwidth used by all the backups of
+                                this group, in bytes per second
+        :param throttle: parent Throttle of the one of this group
         """
         #: list of DomBackup
         self.backups = list()
 
+        #: DomBackup deferred by the last start, as not predicted to end before
+        #  its deadline
+        self.deferred_backups = list()
+
         #: group name, "unnamed" by default
         self.name = name
 
         #: does this group have to be autostarted from the main function or not
         self.autostart = autostart
 
+        #: Throttle shared by the backups of this group
+        self.throttle = build_throttle(
+            bandwidth_limit, name="group {}".format(name), parent=throttle
+        )
+
         #: default attributes for new created domain backups. Keys and values
         #  correspond to what a DomBackup object expect as attributes
         self.default_bak_param = default_bak_param
@@ -120,7 +148,15 @@ class BackupGroup:
                     dom, disks = (bak_item, ())
                 self.add_domain(dom, disks)
 
-    def add_domain(self, dom, disks=(), quiesce=None):
+    def add_domain(
+        self,
+        dom,
+        disks=(),
+        quiesce=None,
+        disk_threads=None,
+        bandwidth_limit=None,
+        priority=None,
+    ):
         """
         Add a domain and disks to backup in this group
 
@@ -129,6 +165,12 @@ class BackupGroup:
 
         :param dom: dom to backup
         :param disks: disks to backup and attached to dom
+        :param quiesce: override the group quiesce option
+        :param disk_threads: override the group disk_threads option
+        :param bandwidth_limit: maximum bandwidth used by the backup of this
+                                domain, in bytes per second. The limit of the
+                                group still applies.
+        :param priority: override the group priority option
         """
         try:
             # if a backup of `dom` already exists, add the disks to the first
@@ -140,6 +182,15 @@ class BackupGroup:
             kwargs = self.default_bak_param.copy()
             if quiesce is not None:
                 kwargs["quiesce"] = quiesce
+            if disk_threads is not None:
+                kwargs["disk_threads"] = disk_threads
+            if priority is not None:
+                kwargs["priority"] = priority
+            kwargs["throttle"] = build_throttle(
+                bandwidth_limit,
+                name="domain {}".format(dom.name()),
+                parent=self.throttle,
+            )
 
             self.backups.append(DomBackup(dom=dom, dev_disks=disks, **kwargs))
 
@@ -179,16 +230,19 @@ class BackupGroup:
             for attr, val in self.default_bak_param.items():
                 setattr(backup, attr, val)
 
-    def start(self):
+    def start(self, deadline=None):
         """
         Start to backup all DomBackup objects attached
 
+        :param deadline: date of the end of the backup window. Backups not
+                         predicted to end before are deferred.
         :returns results: dictionary of domain names and their backup
         """
         completed_backups = {}
         error_backups = {}
 
-        for b in self.backups:
+        backups, self.deferred_backups = plan_backups(self.backups, 1, deadline)
+        for b in backups:
             dom_name = b.dom.name()
             try:
                 completed_backups[dom_name] = self._start_backup(b)
@@ -204,10 +258,15 @@ class BackupGroup:
         else:
             return completed_backups
 
-    def start_multithread(self, nb_threads=None):
+    def start_multithread(self, nb_threads=None, deadline=None):
         """
         Start all backups, multi threaded
 
+        Backups are started by predicted duration, longest first, for all of
+        them to end as soon as possible. With a deadline, the backups not
+        predicted to end before it are deferred (see
+        :func:`virt_backup.groups.scheduling.plan_backups`).
+
         It is wanted to avoid running multiple backups on the same domain (if
         the target dir is different for 2 backups of the same domain, for
         example), because of the way backups are done. An external snapshot is
@@ -219,10 +278,15 @@ class BackupGroup:
         queue.
         If no other backup is to do for this domain, it will be dropped,
         otherwise a backup targeting this domain will be started.
+
+        :param deadline: date of the end of the backup window
         """
         nb_threads = nb_threads or multiprocessing.cpu_count()
 
-        backups_by_domain = self._group_backups_by_domain()
+        backups, self.deferred_backups = plan_backups(
+            self.backups, nb_threads, deadline
+        )
+        backups_by_domain = self._group_backups_by_domain(backups)
 
         completed_backups = {}
         error_backups = {}
@@ -232,17 +296,17 @@ class BackupGroup:
         try:
             with concurrent.futures.ThreadPoolExecutor(nb_threads) as executor:
                 for backups_for_domain in backups_by_domain.values():
-                    backup = backups_for_domain.pop()
+                    backup = backups_for_domain.pop(0)
                     future = self._submit_backup_future(
                         executor, backup, completed_doms
                     )
                     futures[future] = backup
 
-                while len(futures) < len(self.backups):
+                while len(futures) < len(backups):
                     next(concurrent.futures.as_completed(futures))
                     dom = completed_doms.pop().dom
                     if backups_by_domain.get(dom):
-                        backup = backups_by_domain[dom].pop()
+                        backup = backups_by_domain[dom].pop(0)
                         future = self._submit_backup_future(
                             executor, backup, completed_doms
                         )
@@ -274,9 +338,12 @@ class BackupGroup:
         else:
             return completed_backups
 
-    def _group_backups_by_domain(self):
+    def _group_backups_by_domain(self, backups):
+        """
+        :returns: {dom: [backup, …]}, keeping the order of the backups
+        """
         backups_by_domain = defaultdict(list)
-        for b in self.backups:
+        for b in backups:
             backups_by_domain[b.dom].append(b)
 
         return backups_by_domain
@@ -0,0 +1,129 @@
+import time
+
+#: retention periods, from the shortest to the longest
+PERIODS = ("hourly", "daily", "weekly", "monthly", "yearly")
+
+
+class RetentionPlan:
+    """
+    Backups to keep and to delete for each domain, following a retention policy
+    """
+
+    def __init__(self):
+        #: {domain_name: [backup, …]}, sorted by date
+        self.keep = {}
+        #: {domain_name: [backup, …]}, sorted by date
+        self.delete = {}
+
+    def iter_deletions(self):
+        """
+        :returns: generator of (domain_name, backup) for each backup to delete
+        """
+        for domain_name, backups in self.delete.items():
+            for backup in backups:
+                yield domain_name, backup
+
+    def __len__(self):
+        """
+        :returns: number of backups to delete
+        """
+        return sum(len(backups) for backups in self.delete.values())
+
+
+def plan_retention(backups_by_domain, hourly=5, daily=5, weekly=5, monthly=5, yearly=5):
+    """
+    Plan which backups to keep following a retention policy
+
+    For each period, the oldest backup of each of the n last periods containing
+    a backup is kept. "*" keeps one backup for each period, 0 or None does not
+    keep any backup for this period. The parents of the kept backups are kept
+    too, as they are needed to restore them.
+
+    Periods are computed in UTC.
+
+    :param backups_by_domain: {domain_name: [backup, …]}, of DomCompleteBackup
+        or DomCompleteBackupRecord
+    :returns: RetentionPlan
+    """
+    limits = (hourly, daily, weekly, monthly, yearly)
+    plan = RetentionPlan()
+    for domain_name, backups in backups_by_domain.items():
+        plan.keep[domain_name], plan.delete[domain_name] = _plan_domain_retention(
+            backups, limits
+        )
+
+    return plan
+
+
+def _plan_domain_retention(backups, limits):
+    backups = sorted(backups, key=lambda b: b.timestamp)
+
+    # Backups are sorted, so the backups of one period are contiguous: only
+    # keep the index of the first backup of each period.
+    firsts_by_period = tuple([] for _ in PERIODS)
+    last_hour = last_day = None
+    last_keys = [None] * len(PERIODS)
+    for i, backup in enumerate(backups):
+        hour = backup.timestamp // 3600
+        if hour == last_hour:
+            continue
+        firsts_by_period[0].append(i)
+        last_hour = hour
+
+        # Same day implies same week, month and year.
+        day = backup.timestamp // 86400
+        if day == last_day:
+            continue
+        last_day = day
+
+        for p, key in enumerate(_period_keys(backup.timestamp, day), start=1):
+            if key != last_keys[p]:
+                firsts_by_period[p].append(i)
+                last_keys[p] = key
+
+    kept = bytearray(len(backups))
+    for firsts, n in zip(firsts_by_period, limits):
+        if not n:
+            continue
+        # will keep all periodic backups
+        if n == "*":
+            n = 0
+        for i in firsts[-n:]:
+            kept[i] = 1
+    _keep_parents(backups, kept)
+
+    keep, delete = [], []
+    for backup, is_kept in zip(backups, kept):
+        (keep if is_kept else delete).append(backup)
+    return keep, delete
+
+
+def _period_keys(timestamp, day):
+    """
+    :param day: number of days since epoch of timestamp
+    :returns: keys of the day, week, month and year of timestamp
+    """
+    date = time.gmtime(timestamp)
+    month = date.tm_year * 12 + date.tm_mon - 1
+    # 1970-01-01 was a thursday: shift to count weeks from mondays. Weeks are
+    # split between months.
+    week = (month, (day + 3) // 7)
+    return day, week, month, date.tm_year
+
+
+def _keep_parents(backups, kept):
+    """
+    Incremental backups cannot be restored without their parents. Mark the
+    backing chain of each kept backup as kept.
+    """
+    index_by_name = {b.name: i for i, b in enumerate(backups)}
+    to_check = [i for i, is_kept in enumerate(kept) if is_kept]
+    while to_check:
+        parent = backups[to_check.pop()].parent
+        if parent is None:
+            continue
+
+        i = index_by_name.get(parent)
+        if i is not None and not kept[i]:
+            kept[i] = 1
+            to_check.append(i)
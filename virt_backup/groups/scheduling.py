@@ -0,0 +1,178 @@
+import heapq
+import logging
+import os
+
+import arrow
+
+from .complete import list_backup_summaries_by_domain
+
+logger = logging.getLogger("virt_backup")
+
+
+def parse_deadline(deadline, now=None):
+    """
+    Get the date of the end of a backup window
+
+    :param deadline: time of the day, as "HH:MM" or as minutes since midnight,
+        or a date. A time of the day already past is the one of the next day.
+    :param now: current date, arrow.now() by default
+    :returns: arrow date
+    :raises ValueError: if the deadline is invalid
+    """
+    now = now or arrow.now()
+    try:
+        if isinstance(deadline, bool):
+            raise ValueError()
+        elif isinstance(deadline, int):
+            # YAML reads an unquoted HH:MM as a base 60 integer, in minutes.
+            hour, minute = divmod(deadline, 60)
+        elif isinstance(deadline, str):
+            hour, minute = (int(i) for i in deadline.split(":"))
+        else:
+            return arrow.get(deadline)
+        date = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    except (TypeError, ValueError):
+        raise ValueError("invalid deadline: {}".format(deadline))
+    if date <= now:
+        date = date.shift(days=1)
+
+    return date
+
+
+def predict_durations(backups):
+    """
+    Predict how long each backup will take, from the previous backups of their
+    domain
+
+    The duration of the last backup of the domain is used, preferably of the
+    same backup mode. Without any recorded duration, it is estimated from the
+    size of the disks to backup, at the throughput of the other domains.
+
+    :param backups: DomBackup objects
+    :returns: {backup: duration in seconds, or None if it cannot be predicted}
+    """
+    summaries_by_dir = {}
+    durations = {}
+    recorded_duration = recorded_size = 0
+    for backup in backups:
+        if not backup.backup_dir:
+            durations[backup] = None
+            continue
+
+        group_dir = _get_group_backup_dir(backup)
+        if group_dir not in summaries_by_dir:
+            summaries_by_dir[group_dir] = list_backup_summaries_by_domain(group_dir)
+        summaries = [
+            summary
+            for _, summary in summaries_by_dir[group_dir].get(backup.dom.name(), ())
+            if summary.get("duration") is not None
+        ]
+
+        last = _get_last_summary(
+            [s for s in summaries if s["backup_mode"] == backup.backup_mode]
+        ) or _get_last_summary(summaries)
+        if last is None:
+            durations[backup] = None
+            continue
+
+        durations[backup] = last["duration"]
+        if last.get("disks_size") and last["duration"] > 0:
+            recorded_duration += last["duration"]
+            recorded_size += last["disks_size"]
+
+    throughput = recorded_size / recorded_duration if recorded_duration else None
+    for backup, duration in durations.items():
+        if duration is None and throughput:
+            durations[backup] = backup.get_disks_size() / throughput or None
+
+    return durations
+
+
+def plan_backups(backups, nb_threads=1, deadline=None, now=None):
+    """
+    Order backups by predicted duration, longest first, and defer the ones
+    which cannot end before a deadline
+
+    Starting the longest backups first shortens the time taken by all of them
+    (longest processing time first scheduling). Backups which duration cannot
+    be predicted are started first, by size of their disks, and never deferred.
+
+    With a deadline, the backups are planned by priority: a backup is deferred
+    if, added to the backups of higher priority, they would not all end before
+    the deadline.
+
+    :param backups: DomBackup objects
+    :param nb_threads: number of backups running at the same time
+    :param deadline: date of the end of the backup window. Nothing is deferred
+        if None.
+    :param now: current date, arrow.now() by default
+    :returns: (backups to start, in order; deferred backups)
+    """
+    backups = list(backups)
+    durations = predict_durations(backups)
+    sizes = {b: b.get_disks_size() for b in backups if durations[b] is None}
+
+    def order(backups):
+        return sorted(
+            backups,
+            key=lambda b: (durations[b] is None, durations[b] or 0, sizes.get(b, 0)),
+            reverse=True,
+        )
+
+    if deadline is None:
+        planned, deferred = order(backups), []
+    else:
+        remaining = (deadline - (now or arrow.now())).total_seconds()
+        planned, deferred = [], []
+        by_priority = sorted(
+            backups, key=lambda b: (b.priority, durations[b] or 0), reverse=True
+        )
+        for backup in by_priority:
+            candidates = order(planned + [backup])
+            makespan = _get_makespan(
+                [durations[b] or 0 for b in candidates], nb_threads
+            )
+            if durations[backup] is None or makespan <= remaining:
+                planned = candidates
+                continue
+
+            logger.warning(
+                "%s: Backup deferred, predicted to take %ds and not to end before %s",
+                backup.dom.name(),
+                durations[backup],
+                deadline,
+            )
+            deferred.append(backup)
+
+    logger.debug(
+        "Backups order: %s", ", ".join(b.dom.name() for b in planned) or "nothing"
+    )
+    return planned, deferred
+
+
+def _get_group_backup_dir(backup):
+    """
+    Backup directory of the group, containing the directory of each domain
+    """
+    backup_dir = os.path.normpath(backup.backup_dir)
+    if os.path.basename(backup_dir) == backup.dom.name():
+        return os.path.dirname(backup_dir)
+    return backup_dir
+
+
+def _get_last_summary(summaries):
+    return max(summaries, key=lambda s: s["date"], default=None)
+
+
+def _get_makespan(durations, nb_threads):
+    """
+    Time taken by backups started in order, nb_threads at the same time
+    """
+    workers = [0] * max(nb_threads, 1)
+    makespan = 0
+    for duration in durations:
+        end = heapq.heappop(workers) + duration
+        heapq.heappush(workers, end)
+        makespan = max(makespan, end)
+
+    return makespan
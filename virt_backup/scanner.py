@@ -0,0 +1,142 @@
+import concurrent.futures
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger("virt_backup")
+
+#: suffix of the backup definitions
+DEFINITION_SUFFIX = ".json"
+#: suffix of the pending infos
+PENDING_INFO_SUFFIX = ".json.pending"
+
+#: number of files loaded by each task of the pool, to not pay the pool overhead
+#: for each file
+LOAD_BATCH_SIZE = 64
+
+
+def loads(data):
+    """
+    Decode json, with orjson if installed
+
+    :param data: bytes or str
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """
+    Encode json in a compact str, with orjson if installed
+    """
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def iter_subdirs(directory):
+    """
+    :returns: generator of os.DirEntry, for each subdirectory of directory
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_dir():
+                yield entry
+
+
+def iter_json_files(directory, suffix=DEFINITION_SUFFIX):
+    """
+    List the files of a directory ending with suffix
+
+    :returns: generator of (path, mtime_ns, size)
+    """
+    try:
+        it = os.scandir(directory)
+    except FileNotFoundError:
+        return
+
+    with it:
+        for entry in it:
+            # Ignore hidden files, as a glob would.
+            if entry.name.startswith(".") or not entry.name.endswith(suffix):
+                continue
+
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            yield entry.path, stat.st_mtime_ns, stat.st_size
+
+
+def load_json_file(path):
+    """
+    :returns: the decoded json, or None if the file cannot be read or decoded
+    """
+    try:
+        with open(path, "rb") as f:
+            return loads(f.read())
+    except Exception as e:
+        logger.debug("Error for file {}: {}".format(path, e))
+        return None
+
+
+def load_json_files(paths, threads=None):
+    """
+    Load json files on a pool of threads
+
+    Reading is mostly waiting on the storage, so loading in parallel hides the
+    latency of each file on network filesystems.
+
+    :param threads: maximum number of files read at the same time. Defaults to
+        the ThreadPoolExecutor default.
+    :returns: {path: decoded json}, without the files which cannot be loaded
+    """
+    paths = list(paths)
+    batches = [
+        paths[i : i + LOAD_BATCH_SIZE] for i in range(0, len(paths), LOAD_BATCH_SIZE)
+    ]
+    if len(batches) <= 1:
+        loaded = map(_load_json_batch, batches)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            loaded = list(executor.map(_load_json_batch, batches))
+
+    return {
+        path: content
+        for batch in loaded
+        for path, content in batch
+        if content is not None
+    }
+
+
+def _load_json_batch(paths):
+    return [(path, load_json_file(path)) for path in paths]
+
+
+def scan_definitions(backup_dir, suffix=DEFINITION_SUFFIX, threads=None):
+    """
+    Load the json files of each domain directory of backup_dir
+
+    Backups have to respect the structure: backup_dir/domain_name/*backups*
+
+    :returns: {path: decoded json}
+    """
+    try:
+        domain_dirs = [entry.path for entry in iter_subdirs(backup_dir)]
+    except FileNotFoundError:
+        return {}
+
+    paths = (
+        path
+        for domain_dir in domain_dirs
+        for path, _, _ in iter_json_files(domain_dir, suffix)
+    )
+    return load_json_files(paths, threads)
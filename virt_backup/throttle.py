@@ -0,0 +1,243 @@
+import logging
+import re
+import subprocess
+import threading
+import time
+
+from virt_backup.exceptions import CancelledError
+
+logger = logging.getLogger("virt_backup")
+
+#: smallest chunk of data to copy between two throttlings
+MIN_CHUNK_SIZE = 2**16
+
+_SIZE_PATTERN = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$", re.IGNORECASE
+)
+_RATE_PATTERN = re.compile(
+    r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?(?:/s)?\s*$", re.IGNORECASE
+)
+_RATE_UNITS = {"": 1, "k": 2**10, "m": 2**20, "g": 2**30, "t": 2**40}
+
+#: ionice classes, by name
+IO_PRIORITY_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+
+
+def parse_rate(rate):
+    """
+    Parse a bandwidth, as written in the configuration
+
+    :param rate: bytes per second, as a number or a string with a binary unit
+        ("500K", "100M", "1.5GiB/s"…)
+    :returns: rate in bytes per second, or None if rate is None
+    """
+    return _parse_with_unit(rate, _RATE_PATTERN, "bandwidth")
+
+
+def parse_size(size):
+    """
+    Parse a size, as written in the configuration
+
+    :param size: bytes, as a number or a string with a binary unit ("512K",
+        "4MiB"…)
+    :returns: size in bytes, or None if size is None
+    """
+    return _parse_with_unit(size, _SIZE_PATTERN, "size")
+
+
+def _parse_with_unit(value, pattern, kind):
+    if value is None or isinstance(value, (int, float)):
+        return value
+
+    match = pattern.match(str(value))
+    if not match:
+        raise ValueError("invalid {}: {}".format(kind, value))
+
+    number, unit = match.groups()
+    return int(float(number) * _RATE_UNITS[unit.lower()])
+
+
+def format_rate(rate):
+    for unit in ("", "Ki", "Mi", "Gi"):
+        if rate < 1024:
+            break
+        rate /= 1024
+    else:
+        unit = "Ti"
+
+    return "{:.1f}{}B/s".format(rate, unit)
+
+
+class Throttle:
+    """
+    Token bucket limiting the bandwidth of the threads sharing it
+
+    Each thread consumes tokens for the data it copies, and waits if the bucket
+    is empty. A throttle can have a parent, also consumed, to nest the limits:
+    for example a throttle per domain, having the throttle of its group as
+    parent, itself having a global throttle as parent.
+
+    The current rate is logged every log_interval seconds while data is copied.
+    """
+
+    def __init__(self, rate=None, name=None, parent=None, burst=None, log_interval=60):
+        """
+        :param rate: maximum bandwidth in bytes per second. If None, the rate is
+            not limited, but still logged.
+        :param burst: size of the bucket, in bytes. Default to one second of rate.
+        """
+        #: maximum bandwidth, in bytes per second
+        self.rate = parse_rate(rate)
+        self.name = name
+        self.parent = parent
+        self.burst = burst or self.rate
+        self.log_interval = log_interval
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last_fill = time.monotonic()
+
+        self._stats_start = self._last_fill
+        self._stats_bytes = 0
+        self._stats_wait = 0.0
+
+    def consume(self, size, stop_event=None):
+        """
+        Consume size bytes, and wait until the bandwidth allows it
+
+        :raises CancelledError: if stop_event is set while waiting
+        """
+        wait = self._reserve(size) if self.rate else 0
+        if wait > 0:
+            if stop_event is None:
+                time.sleep(wait)
+            elif stop_event.wait(wait):
+                raise CancelledError()
+
+        if self.parent:
+            self.parent.consume(size, stop_event)
+
+        self._account(size, wait)
+
+    def _reserve(self, size):
+        """
+        :returns: time to wait before the reserved tokens are available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last_fill) * self.rate
+            )
+            self._last_fill = now
+            # Tokens can go negative: next threads wait until this debt is paid,
+            # so they are served in order.
+            self._tokens -= size
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def _account(self, size, wait):
+        with self._lock:
+            self._stats_bytes += size
+            self._stats_wait += wait
+            elapsed = time.monotonic() - self._stats_start
+            if elapsed < self.log_interval:
+                return
+
+            stats = (self._stats_bytes / elapsed, self._stats_wait, elapsed)
+            self._stats_start += elapsed
+            self._stats_bytes = 0
+            self._stats_wait = 0.0
+
+        self._log_stats(*stats)
+
+    def _log_stats(self, current_rate, wait, elapsed):
+        name = self.name or "total"
+        if not self.rate:
+            logger.info("Bandwidth of %s: %s", name, format_rate(current_rate))
+            return
+
+        logger.info(
+            "Bandwidth of %s: %s, limited to %s (throttled for %.1fs in %.1fs)",
+            name,
+            format_rate(current_rate),
+            format_rate(self.rate),
+            wait,
+            elapsed,
+        )
+
+    def get_chunk_size(self, size):
+        """
+        Reduce a chunk size for the throttling to stay smooth: data copied by
+        big chunks would be sent in bursts.
+
+        :returns: size, reduced to a quarter of second of the lowest rate
+        """
+        throttle = self
+        while throttle is not None:
+            if throttle.rate:
+                size = min(size, max(throttle.rate // 4, MIN_CHUNK_SIZE))
+            throttle = throttle.parent
+
+        return size
+
+    def get_lowest_rate(self):
+        """
+        :returns: the lowest rate of this throttle and its parents, or None if
+            none of them limits the bandwidth
+        """
+        rates = []
+        throttle = self
+        while throttle is not None:
+            if throttle.rate:
+                rates.append(throttle.rate)
+            throttle = throttle.parent
+
+        return min(rates, default=None)
+
+
+def get_strictest_throttle(*throttles):
+    """
+    :returns: the throttle, among throttles, with the lowest rate (its parents
+        included), or the first one set if none limits the bandwidth
+    """
+    throttles = [t for t in throttles if t is not None]
+    limited = [t for t in throttles if t.get_lowest_rate()]
+    if limited:
+        return min(limited, key=lambda t: t.get_lowest_rate())
+    return next(iter(throttles), None)
+
+
+def build_throttle(rate, name=None, parent=None):
+    """
+    :returns: a new Throttle limited to rate, with parent as parent, or parent
+        if rate is not set
+    """
+    if not rate:
+        return parent
+    return Throttle(rate, name=name, parent=parent)
+
+
+def set_io_priority(io_priority, tid=None):
+    """
+    Set the I/O scheduling class and priority of a thread, with ionice
+
+    Threads inherit the I/O priority of the thread creating them: setting it in
+    the main thread, before starting the backups, applies it to all the workers.
+    The priority is only used by I/O schedulers supporting it (BFQ).
+
+    :param io_priority: "idle", "best-effort", "realtime", with an optional
+        level from 0 (highest) to 7 for the last two ("best-effort:7")
+    :param tid: thread id. Default to the current thread.
+    """
+    io_class, _, level = io_priority.partition(":")
+    try:
+        cmd = ["ionice", "-c", str(IO_PRIORITY_CLASSES[io_class])]
+    except KeyError:
+        raise ValueError("invalid I/O priority: {}".format(io_priority))
+    if level:
+        cmd += ["-n", level]
+    cmd += ["-p", str(tid or threading.get_native_id())]
+
+    try:
+        subprocess.run(cmd, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Cannot set the I/O priority to %s: %s", io_priority, e)